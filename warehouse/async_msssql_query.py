@@ -1,11 +1,21 @@
-# async_msssql_query.py — loop-safe, compat rows=list, no pooling
+# async_msssql_query.py — loop-safe, compat rows=list, pool opzionale legato al loop globale
 from __future__ import annotations
 
 import asyncio, urllib.parse, time, logging
-from typing import Any, Dict, Optional
-from sqlalchemy.ext.asyncio import create_async_engine
-from sqlalchemy.pool import NullPool
-from sqlalchemy import text
+import contextlib
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, asdict
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncConnection
+from sqlalchemy.pool import NullPool, AsyncAdaptedQueuePool
+from sqlalchemy import event, exc as sa_exc
+
+from columnar_result import ColumnarBuilder
+from metrics import QueryMetrics, estimate_bytes
+from slow_query_log import SlowQueryLog, parse_statistics_io
+from query_cache import QueryCache, cache_key, invalidated_tables, is_dml
+from query_trace import QueryTrace
+from sql_statements import STATEMENTS, StatementRegistry, input_sizes
 
 try:
     import orjson as _json
@@ -28,16 +38,202 @@ def make_mssql_dsn(
     odbc = ";".join(f"{k}={v}" for k,v in kv.items()) + ";"
     return f"mssql+aioodbc:///?odbc_connect={urllib.parse.quote_plus(odbc)}"
 
+
+def is_sqlite_dsn(dsn: str) -> bool:
+    return dsn.lower().startswith("sqlite")
+
+
+def make_client(dsn: str, **kw: Any) -> AsyncMSSQLClient:
+    """Client per il DSN: sqlite:///file → AsyncSQLiteClient (importato solo qui), altrimenti AsyncMSSQLClient."""
+    if is_sqlite_dsn(dsn):
+        from sqlite_backend import AsyncSQLiteClient
+        return AsyncSQLiteClient(dsn, **kw)
+    return AsyncMSSQLClient(dsn, **kw)
+
+
+def _pyodbc_cursor(cursor: Any) -> Optional[Any]:
+    """
+    Cursore pyodbc sotto un cursore aioodbc (o l'adapter SQLAlchemy che lo avvolge), per ciò che aioodbc
+    non espone: setinputsizes sincrono, messages, cancel. È l'unico punto che legge _impl; None se manca,
+    e chi lo usa rinuncia a tipi/messaggi/cancel invece di fallire.
+    """
+    for c in (getattr(cursor, "_cursor", None), cursor):    # adapt → aioodbc → pyodbc
+        impl = getattr(c, "_impl", None)
+        if impl is not None:
+            return impl
+    return None
+
+
+def _pyodbc_sizes(st_sizes) -> List[Any]:
+    """input_sizes di uno statement → argomento di pyodbc.Cursor.setinputsizes (come do_set_input_sizes)."""
+    return [dbtype if isinstance(dbtype, tuple) else (dbtype, None, None) for _k, dbtype, _t in st_sizes]
+
+@dataclass
+class PoolStats:
+    """Contatori del pool: servono a dimostrare che il login ODBC non pesa più sulla singola query."""
+    checkouts: int = 0          # connessioni prese dal pool (o aperte, con NullPool)
+    waits: int = 0              # checkout avvenuti a pool saturo (attesa di una connessione libera)
+    wait_ms_total: float = 0.0  # tempo totale speso ad attendere/ottenere la connessione
+    connects: int = 0           # login ODBC reali
+    connect_ms_total: float = 0.0
+    connect_ms_max: float = 0.0
+    pings: int = 0              # health check eseguiti (solo su connessioni rimaste idle)
+    ping_failures: int = 0
+    cancels: int = 0            # statement annullati lato server (SQLCancel) da task cancellati
+
+    def as_dict(self) -> Dict[str, Any]:
+        d = asdict(self)
+        d["connect_ms_avg"] = round(self.connect_ms_total / self.connects, 3) if self.connects else 0.0
+        d["wait_ms_avg"] = round(self.wait_ms_total / self.checkouts, 3) if self.checkouts else 0.0
+        return d
+
+
+class _Flight:
+    """Query in volo condivisa da più chiamanti (single-flight)."""
+    __slots__ = ("task", "waiters", "followers")
+
+    def __init__(self, task: "asyncio.Future[Dict[str, Any]]"):
+        self.task = task
+        self.waiters = 0
+        self.followers = 0
+
+
+def _own_rows(res: Dict[str, Any], **extra: Any) -> Dict[str, Any]:
+    """Copia di un risultato condiviso: righe proprie (liste/dict); le viste columnar sono in sola lettura."""
+    out = dict(res, **extra)
+    if "columnar" not in res:
+        out["rows"] = [dict(r) if isinstance(r, dict) else list(r) for r in res["rows"]]
+    return out
+
+
+class Transaction:
+    """
+    Unità di lavoro su una sola connessione con transazione aperta (vedi AsyncMSSQLClient.transaction).
+    Tutti gli statement condividono sessione e transazione: SCOPE_IDENTITY(), #temp e lock restano validi.
+    """
+    def __init__(self, conn: AsyncConnection, statements: StatementRegistry = STATEMENTS,
+                 measured: Optional[Callable[[str], Any]] = None, traced: Optional[Callable[..., Any]] = None):
+        self._conn = conn
+        self._stmts = statements
+        self._measured = measured or (lambda _sql: contextlib.nullcontext({}))
+        self._traced = traced or (lambda *_a, **_k: contextlib.nullcontext({}))
+        self.statements = 0
+        self._written: Set[str] = set()
+        self._written_unknown = False  # DML con tabelle non riconosciute → a fine commit si svuota la cache
+
+    @property
+    def backend(self) -> str:
+        """Dialetto della connessione, come AsyncMSSQLClient.backend."""
+        return self._conn.dialect.name
+
+    def _track(self, sql: str) -> None:
+        self.statements += 1
+        if is_dml(sql):
+            tables = invalidated_tables(sql)
+            if tables is None:
+                self._written_unknown = True
+            else:
+                self._written |= tables
+
+    async def query(self, sql: str, params: Optional[Dict[str, Any]]=None, *,
+                    as_dict_rows: bool=False) -> Dict[str, Any]:
+        """Come query_json (stesso formato), ma sulla connessione della transazione e senza cache."""
+        t0 = time.perf_counter()
+        self._track(sql)
+        with self._traced("query", sql, params, as_dict_rows=as_dict_rows) as ev, self._measured(sql) as m:
+            res = await self._conn.execute(self._stmts.clause(sql), params or {})
+            cols = list(res.keys()) if res.returns_rows else []
+            rows = res.fetchall() if res.returns_rows else []
+            m["rows"] = ev["rows"] = len(rows)
+        rows_out: List[Any]
+        if as_dict_rows:
+            rows_out = [dict(zip(cols, r)) for r in rows]
+        else:
+            rows_out = [list(r) for r in rows]
+        return {"columns": cols, "rows": rows_out, "elapsed_ms": round((time.perf_counter()-t0)*1000, 3)}
+
+    query_json = query  # i porting delle SP usano l'interfaccia del client
+
+    async def scalar(self, sql: str, params: Optional[Dict[str, Any]]=None) -> Any:
+        """Prima colonna della prima riga (None se nessuna riga)."""
+        self._track(sql)
+        with self._traced("scalar", sql, params), self._measured(sql):
+            res = await self._conn.execute(self._stmts.clause(sql), params or {})
+            return res.scalar() if res.returns_rows else None
+
+    async def exec(self, sql: str, params: Optional[Dict[str, Any]]=None) -> int:
+        self._track(sql)
+        with self._traced("exec", sql, params) as ev, self._measured(sql) as m:
+            res = await self._conn.execute(self._stmts.clause(sql), params or {})
+            n = res.rowcount or 0
+            m["rows"] = ev["rows"] = max(n, 0)
+        return n
+
+    async def executemany(self, sql: str, seq_params: Iterable[Dict[str, Any]]) -> int:
+        """
+        Stesso statement per ogni dizionario di parametri (executemany DBAPI).
+        Con fast_executemany i parametri partono come array: un round trip per blocco, non per riga.
+        """
+        seq = list(seq_params)
+        if not seq:
+            return 0
+        self._track(sql)
+        with self._traced("executemany", sql, seq) as ev, self._measured(sql) as m:
+            res = await self._conn.execute(self._stmts.clause(sql), seq)
+            m["rows"] = ev["rows"] = n = max(res.rowcount, 0) if res.rowcount is not None else 0
+        return n
+
+    async def exec_json(self, sql: str, rows: Iterable[Dict[str, Any]], *, param: str="rows",
+                        chunk_rows: int=5000) -> int:
+        """
+        Bulk via OPENJSON: le righe viaggiano come un solo parametro JSON (NVARCHAR(MAX)), es.
+            UPDATE c SET IDStato = j.S FROM Celle c JOIN OPENJSON(:rows) WITH (ID int, S int) j ON j.ID = c.ID
+        Uno statement ogni chunk_rows righe; set-based sul server, niente round trip per riga.
+        """
+        rows = list(rows)
+        total = 0
+        for i in range(0, len(rows), max(1, chunk_rows)):
+            total += await self.exec(sql, {param: _dumps(rows[i:i + chunk_rows])})
+        return total
+
+
 class AsyncMSSQLClient:
     """
-    Engine creato pigramente sul loop corrente, senza pool (NullPool).
-    Evita “Future attached to a different loop” nei reset/close del pool.
+    Engine creato pigramente sul loop corrente.
+    - pool_size=0 (default): nessun pool (NullPool), ogni query fa login ODBC.
+      Evita “Future attached to a different loop” nei reset/close del pool.
+    - pool_size>0: pool legato al loop che ha creato l'engine (il loop globale).
+      Le connessioni vengono riciclate dopo pool_recycle secondi e "pingate" solo se
+      sono rimaste idle più di pool_ping_idle secondi (niente round trip extra a ogni checkout).
+      Va chiuso con dispose() sullo stesso loop.
     """
-    def __init__(self, dsn: str, *, echo: bool=False, log: bool=True):
+    def __init__(self, dsn: str, *, echo: bool=False, log: bool=True,
+                 pool_size: int=0, max_overflow: int=0, pool_timeout: float=30.0,
+                 pool_recycle: int=1800, pool_ping_idle: float=30.0, cache_size: int=256,
+                 fast_executemany: bool=True, statements: Optional[StatementRegistry]=None,
+                 slow_query_ms: Optional[float]=None, slow_log_path: str="logs/slow_queries.jsonl"):
         self._dsn = dsn
         self._echo = echo
         self._engine = None
         self._engine_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._pool_size = max(0, int(pool_size))
+        self._max_overflow = max(0, int(max_overflow))
+        self._pool_timeout = pool_timeout
+        self._pool_recycle = pool_recycle
+        self._pool_ping_idle = pool_ping_idle
+        self._fast_executemany = fast_executemany
+        # text() costruite una volta per testo SQL (vedi sql_statements.register)
+        self._statements = statements if statements is not None else STATEMENTS
+        self._pool_stats = PoolStats()
+        self._cache: Optional[QueryCache] = QueryCache(cache_size) if cache_size > 0 else None
+        self._inflight: Dict[Tuple, _Flight] = {}
+        self._sf_stats = {"leaders": 0, "coalesced": 0}
+        self.query_metrics = QueryMetrics()   # per nome di statement (vedi query_stats)
+        # query oltre slow_query_ms → slow_log_path (JSONL) + piano rieseguendo la SELECT una volta
+        self.slow_log: Optional[SlowQueryLog] = (SlowQueryLog(slow_log_path, slow_query_ms)
+                                                 if slow_query_ms else None)
+        # con start_trace: ogni chiamata (parametri, tempi, forma del risultato) su file, per query_trace.replay
+        self.trace: Optional[QueryTrace] = None
         self._logger = logging.getLogger("AsyncMSSQLClient")
         if log and not self._logger.handlers:
             h = logging.StreamHandler()
@@ -45,22 +241,285 @@ class AsyncMSSQLClient:
             self._logger.addHandler(h)
         self._enable_log = log
 
+    @property
+    def pooled(self) -> bool:
+        return self._pool_size > 0
+
+    @property
+    def backend(self) -> str:
+        """Dialetto del DSN: "mssql", "sqlite" (per gli statement che cambiano fra i due)."""
+        return self._dsn.split(":", 1)[0].split("+", 1)[0].lower()
+
+    @property
+    def pool_capacity(self) -> int:
+        """Connessioni contemporanee massime (pool_size + max_overflow; 0 senza pool)."""
+        return self._pool_size + self._max_overflow if self.pooled else 0
+
+    def _engine_kwargs(self, loop: asyncio.AbstractEventLoop) -> Dict[str, Any]:
+        """Argomenti di create_async_engine propri del driver (aioodbc/pyodbc); i backend li ridefiniscono."""
+        return {
+            "fast_executemany": self._fast_executemany,  # executemany a blocchi (pyodbc)
+            "connect_args": {"loop": loop},              # usa il loop corrente in aioodbc
+        }
+
     async def _ensure_engine(self):
+        loop = asyncio.get_running_loop()
         if self._engine is not None:
+            if self.pooled and loop is not self._engine_loop:
+                # le connessioni del pool appartengono al loop che le ha aperte
+                raise RuntimeError(f"{type(self).__name__} (pool) usato da un loop diverso da quello dell'engine")
             return
-        loop = asyncio.get_running_loop()
-        self._engine = create_async_engine(
-            self._dsn,
-            echo=self._echo,
-            # IMPORTANTI:
-            poolclass=NullPool,                 # no pooling → no reset su loop “sbagliati”
-            connect_args={"loop": loop},        # usa il loop corrente in aioodbc
-        )
+        if self.pooled:
+            pool = dict(
+                poolclass=AsyncAdaptedQueuePool,
+                pool_size=self._pool_size,
+                max_overflow=self._max_overflow,
+                pool_timeout=self._pool_timeout,
+                pool_recycle=self._pool_recycle,
+                pool_pre_ping=False,            # ping solo dopo inattività (vedi _install_pool_events)
+            )
+        else:
+            pool = dict(poolclass=NullPool)     # no pooling → no reset su loop “sbagliati”
+        self._engine = create_async_engine(self._dsn, echo=self._echo, **pool, **self._engine_kwargs(loop))
         self._engine_loop = loop
+        self._install_pool_events(self._engine)
         if self._enable_log:
-            self._logger.info("Engine created on loop %s", id(loop))
+            self._logger.info("Engine created on loop %s (pool_size=%s)", id(loop), self._pool_size)
+
+    def _install_pool_events(self, engine):
+        st = self._pool_stats
+        sync_engine = engine.sync_engine
+        ping_idle = self._pool_ping_idle
+
+        @event.listens_for(sync_engine, "do_connect")
+        def _timed_connect(dialect, conn_rec, cargs, cparams):
+            t0 = time.perf_counter()
+            dbapi_conn = dialect.connect(*cargs, **cparams)
+            ms = (time.perf_counter() - t0) * 1000
+            st.connects += 1
+            st.connect_ms_total += ms
+            st.connect_ms_max = max(st.connect_ms_max, ms)
+            return dbapi_conn
+
+        @event.listens_for(sync_engine, "checkin")
+        def _on_checkin(dbapi_conn, conn_rec):
+            conn_rec.info["idle_since"] = time.monotonic()
+
+        @event.listens_for(sync_engine, "before_cursor_execute")
+        def _typed_binds(conn, cursor, statement, parameters, context, executemany):
+            # text() con parametri tipizzati (register(..., barcode=BARCODE)): VARCHAR resta VARCHAR
+            compiled = getattr(context, "compiled", None)
+            if compiled is None or not context.is_text:
+                return
+            sizes = input_sizes(compiled)
+            if sizes:
+                context.dialect.do_set_input_sizes(cursor, sizes, context)
+
+        @event.listens_for(sync_engine, "handle_error")
+        def _on_error(ctx):
+            # task annullato durante execute/fetch: SQLAlchemy invalida la connessione subito dopo,
+            # ma lo statement andrebbe avanti sul server nel thread di aioodbc → SQLCancel prima
+            if not isinstance(ctx.original_exception, asyncio.CancelledError):
+                return
+            cursor = getattr(ctx.execution_context, "cursor", None) or getattr(ctx, "cursor", None)
+            if cursor is not None:
+                self._cancel_statement(cursor)
+
+        @event.listens_for(sync_engine, "checkout")
+        def _on_checkout(dbapi_conn, conn_rec, conn_proxy):
+            idle_since = conn_rec.info.get("idle_since")
+            if idle_since is None or time.monotonic() - idle_since < ping_idle:
+                return
+            st.pings += 1
+            try:
+                engine.dialect.do_ping(dbapi_conn)
+            except Exception as ex:
+                st.ping_failures += 1
+                # il pool scarta questa connessione e ne apre una nuova
+                raise sa_exc.DisconnectionError(f"ping fallito dopo inattività: {ex}") from ex
+
+    def start_trace(self, path: str, *, app_version: str="") -> QueryTrace:
+        """Registra da ora le chiamate in path (.gz = compresso); una traccia già aperta viene chiusa."""
+        self.stop_trace()
+        self.trace = QueryTrace(path, name_of=self._statements.name_of, backend=self._dsn.split(":", 1)[0],
+                                app_version=app_version)
+        return self.trace
+
+    def stop_trace(self) -> Optional[Dict[str, Any]]:
+        tr, self.trace = self.trace, None
+        if tr is None:
+            return None
+        tr.close()
+        return tr.stats()
+
+    def trace_stats(self) -> Dict[str, Any]:
+        return self.trace.stats() if self.trace is not None else {}
+
+    def _traced(self, op: str, sql: Any, params: Any=None, **opts: Any):
+        tr = self.trace
+        if tr is None or not tr.active:
+            return contextlib.nullcontext({})
+        return tr.event(op, sql, params, **opts)
+
+    @contextlib.contextmanager
+    def _measured(self, sql: str, *, name: Optional[str]=None, params: Optional[Dict[str, Any]]=None,
+                  slow: bool=True):
+        """
+        Misura uno statement per query_metrics: il blocco riempie m["rows"], m["bytes"] e
+        (tramite _connection(timing=m)) m["connect_ms"]. Errori e annullamenti contati a parte.
+        Oltre soglia finisce nello slow log; con params (SELECT rieseguibile) anche con il piano.
+        """
+        name = name or self._statements.name_of(sql)
+        m: Dict[str, Any] = {"rows": 0, "bytes": 0, "connect_ms": None, "params": params, "slow": slow}
+        t0 = time.perf_counter()
+        try:
+            yield m
+        except GeneratorExit:
+            # stream chiuso dal consumatore prima della fine: lettura parziale, non un errore
+            self._record(name, sql, m, t0)
+            raise
+        except BaseException as ex:
+            self.query_metrics.record_error(name, sql, ex)
+            raise
+        self._record(name, sql, m, t0)
+
+    def _record(self, name: str, sql: str, m: Dict[str, Any], t0: float) -> None:
+        ms = (time.perf_counter() - t0) * 1000
+        self.query_metrics.record(name, sql, elapsed_ms=ms,
+                                  rows=m["rows"], nbytes=m["bytes"], connect_ms=m["connect_ms"])
+        slow = self.slow_log
+        if slow is not None and m["slow"] and slow.is_slow(ms):
+            self.query_metrics.record_slow(name)
+            params = m["params"]
+            rerun = params is not None and not is_dml(sql)     # i DML non si rieseguono mai
+            slow.observe(name, sql, params, ms, self._capture_plan if rerun else None,
+                         rows=m["rows"], connect_ms=m["connect_ms"])
+
+    async def _capture_plan(self, sql: str, params: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Riesegue la SELECT una volta con SET STATISTICS XML/IO ON (solo SQL Server):
+        piano effettivo, letture logiche per tabella, righe e durata della riesecuzione.
+        """
+        async with self._connection() as conn:
+            dialect = conn.dialect
+            if dialect.name != "mssql":
+                return {"note": f"piano non disponibile su {dialect.name}"}
+            compiled, names, st_sizes = self._statements.get(sql).compiled(dialect)
+            args = [(params or {})[n] for n in names]
+            raw = (await conn.get_raw_connection()).driver_connection
+            cur = await raw.cursor()
+            messages: List[str] = []
+            plan: Optional[str] = None
+            rows = 0
+            try:
+                await cur.execute("SET STATISTICS XML ON; SET STATISTICS IO ON;")
+                pyodbc_cur = _pyodbc_cursor(cur)
+                if st_sizes and pyodbc_cur is not None:
+                    pyodbc_cur.setinputsizes(_pyodbc_sizes(st_sizes))
+                t0 = time.perf_counter()
+                await cur.execute(compiled, *args)
+                while True:
+                    messages.extend(str(msg[1]) for msg in (getattr(pyodbc_cur, "messages", None) or ()))
+                    desc = cur.description
+                    if desc is not None:
+                        data = await cur.fetchall()
+                        if len(desc) == 1 and "showplan" in str(desc[0][0]).lower():
+                            plan = data[0][0] if data else plan     # result set del piano
+                        else:
+                            rows += len(data)
+                    if not await cur.nextset():
+                        break
+                rerun_ms = (time.perf_counter() - t0) * 1000
+            except asyncio.CancelledError:
+                if self._cancel_statement(cur):
+                    with contextlib.suppress(Exception):
+                        await conn.invalidate()
+                raise
+            finally:
+                with contextlib.suppress(Exception):
+                    await cur.execute("SET STATISTICS XML OFF; SET STATISTICS IO OFF;")
+                with contextlib.suppress(Exception):
+                    await cur.close()
+        io = parse_statistics_io(messages)
+        return {"rerun_ms": round(rerun_ms, 3), "rows": rows, "logical_reads": io["logical_reads"],
+                "io": io["tables"], "plan_xml": plan}
+
+    @asynccontextmanager
+    async def _connection(self, *, begin: bool=False,
+                          timing: Optional[Dict[str, Any]]=None) -> AsyncIterator[AsyncConnection]:
+        """
+        Checkout di una connessione (con transazione se begin=True) misurando attese e tempi;
+        timing["connect_ms"] = attesa del pool + eventuale login per questa richiesta.
+        """
+        await self._ensure_engine()
+        st = self._pool_stats
+        if self.pooled and self._engine.pool.checkedout() >= self._pool_size + self._max_overflow:
+            st.waits += 1
+        t0 = time.perf_counter()
+        conn = await self._engine.connect()
+        ms = (time.perf_counter() - t0) * 1000
+        st.checkouts += 1
+        st.wait_ms_total += ms
+        if timing is not None:
+            timing["connect_ms"] = ms
+        try:
+            if begin:
+                async with conn.begin():
+                    yield conn
+            else:
+                yield conn
+        finally:
+            await conn.close()
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator[Transaction]:
+        """
+        async with db.transaction() as tx:
+            n = await tx.scalar("SELECT ...", {...})
+            await tx.exec("UPDATE ...", {...})
+        Una connessione per tutto il blocco: commit all'uscita, rollback se il blocco solleva.
+        La cache viene invalidata solo dopo il commit, per le tabelle scritte.
+        """
+        async with self._connection(begin=True) as conn:
+            with self._traced("transaction", None) as ev:
+                txid = ev.get("id")
+                traced = (lambda op, sql, params=None, **kw: self._traced(op, sql, params, tx=txid, **kw))
+                tx = Transaction(conn, self._statements, self._measured, traced if txid else None)
+                yield tx
+        if self._cache is not None:
+            if tx._written_unknown:
+                self._cache.clear()
+            elif tx._written:
+                self._cache.invalidate_tables(tx._written)
+
+    def _cancel_statement(self, cursor: Any) -> bool:
+        """
+        L'execute di aioodbc gira in un thread e non si ferma con il task:
+        cancel() del cursore pyodbc (SQLCancel, thread-safe) interrompe lo statement sul server.
+        """
+        cancel = getattr(_pyodbc_cursor(cursor) or cursor, "cancel", None)
+        if cancel is None:
+            return False
+        try:
+            cancel()
+        except Exception as ex:
+            if self._enable_log:
+                self._logger.warning("cancel statement fallito: %s", ex)
+            return False
+        self._pool_stats.cancels += 1
+        return True
+
+    def pool_stats(self) -> Dict[str, Any]:
+        d = self._pool_stats.as_dict()
+        d["pool_size"] = self._pool_size
+        d["max_overflow"] = self._max_overflow
+        if self._engine is not None and self.pooled:
+            d["checked_out"] = self._engine.pool.checkedout()
+            d["status"] = self._engine.pool.status()
+        return d
 
     async def dispose(self):
+        self.stop_trace()
         if self._engine is None:
             return
         # sempre sullo stesso loop in cui è nato
@@ -73,21 +532,272 @@ class AsyncMSSQLClient:
         if self._enable_log:
             self._logger.info("Engine disposed")
 
-    async def query_json(self, sql: str, params: Optional[Dict[str, Any]]=None, *, as_dict_rows: bool=False) -> Dict[str, Any]:
-        await self._ensure_engine()
+    async def query_json(self, sql: str, params: Optional[Dict[str, Any]]=None, *, as_dict_rows: bool=False,
+                         columnar: bool=False, cache_ttl: Optional[float]=None,
+                         cache_refresh: bool=False) -> Dict[str, Any]:
+        """
+        Ritorna {"columns", "rows", "elapsed_ms"}; rows = liste (o dict con as_dict_rows).
+        columnar=True: le righe vengono lette a blocchi dal cursore e accumulate per colonna
+        (res["columnar"] è un ColumnarResult); res["rows"] è una vista per riga, tuple o
+        mapping con as_dict_rows, in sola lettura (dict(row) per modificarla).
+        cache_ttl=secondi: il risultato resta in cache (chiave = SQL + parametri) finché non scade
+        o finché un DML su una tabella letta non lo invalida; cache_refresh=True rilegge e aggiorna.
+        Un risultato dalla cache è condiviso: non va modificato (ha "cached": True).
+        """
+        with self._traced("query_json", sql, params, as_dict_rows=as_dict_rows, columnar=columnar,
+                          cache_ttl=cache_ttl, cache_refresh=cache_refresh) as ev:
+            ev["res"] = res = await self._query_json(sql, params, as_dict_rows=as_dict_rows, columnar=columnar,
+                                                     cache_ttl=cache_ttl, cache_refresh=cache_refresh)
+        return res
+
+    async def _query_json(self, sql: str, params: Optional[Dict[str, Any]], *, as_dict_rows: bool,
+                          columnar: bool, cache_ttl: Optional[float], cache_refresh: bool) -> Dict[str, Any]:
+        cache = self._cache
+        if is_dml(sql):
+            try:
+                return await self._query(sql, params, as_dict_rows=as_dict_rows, columnar=columnar)
+            finally:
+                if cache is not None:
+                    cache.invalidate_for(sql)
+        key = cache_key(sql, params) + (as_dict_rows, columnar)
+        use_cache = cache is not None and bool(cache_ttl)
+        if use_cache and not cache_refresh:
+            hit = cache.get(key)
+            if hit is not None:
+                self.query_metrics.record_cached(self._statements.name_of(sql), sql)
+                return _own_rows(hit, cached=True)
+
+        async def _fetch():
+            gen = cache.generation() if use_cache else None
+            res = await self._query(sql, params, as_dict_rows=as_dict_rows, columnar=columnar)
+            if use_cache:
+                cache.put(key, res, ttl=cache_ttl, sql=sql, started_gen=gen)
+                return _own_rows(res)
+            return res
+
+        return await self._single_flight(key, _fetch)
+
+    async def _single_flight(self, key: Tuple, factory: Callable[[], Awaitable[Dict[str, Any]]]) -> Dict[str, Any]:
+        """
+        Richieste identiche (SQL + parametri + formato) già in volo condividono un solo round trip:
+        chi arriva dopo attende lo stesso task e riceve una copia delle righe. Il task viene
+        annullato solo quando tutti quelli che lo attendono sono stati annullati.
+        """
+        fl = self._inflight.get(key)
+        if fl is None:
+            fl = _Flight(asyncio.ensure_future(factory()))
+            self._inflight[key] = fl
+            self._sf_stats["leaders"] += 1
+            fl.task.add_done_callback(lambda _t, k=key, f=fl: self._inflight.pop(k, None) if self._inflight.get(k) is f else None)
+            follower = False
+        else:
+            self._sf_stats["coalesced"] += 1
+            fl.followers += 1
+            follower = True
+        fl.waiters += 1
+        try:
+            res = await asyncio.shield(fl.task)
+        finally:
+            fl.waiters -= 1
+            if fl.waiters == 0 and not fl.task.done():
+                fl.task.cancel()
+                # una richiesta identica che arriva ora deve ripartire, non unirsi a un task annullato
+                if self._inflight.get(key) is fl:
+                    del self._inflight[key]
+        if follower:
+            return _own_rows(res, coalesced=True)
+        return _own_rows(res) if fl.followers else res
+
+    def singleflight_stats(self) -> Dict[str, Any]:
+        return dict(self._sf_stats, in_flight=len(self._inflight))
+
+    def query_stats(self) -> Dict[str, Any]:
+        """Per nome di query: count, cached, errors, latenza p50/p95/p99, righe, byte, connect_ms."""
+        return self.query_metrics.snapshot()
+
+    def statement_stats(self) -> Dict[str, Any]:
+        return self._statements.stats()
+
+    def cache_stats(self) -> Dict[str, Any]:
+        return self._cache.stats() if self._cache is not None else {}
+
+    def invalidate_cache(self, *tables: str) -> int:
+        """Invalida le voci che leggono le tabelle indicate (tutte se nessuna)."""
+        if self._cache is None:
+            return 0
+        return self._cache.invalidate_tables(tables) if tables else self._cache.clear()
+
+    async def _query(self, sql: str, params: Optional[Dict[str, Any]], *, as_dict_rows: bool,
+                     columnar: bool) -> Dict[str, Any]:
         t0 = time.perf_counter()
-        async with self._engine.connect() as conn:
-            res = await conn.execute(text(sql), params or {})
-            rows = res.fetchall()
-            cols = list(res.keys())
+        if columnar:
+            return await self._query_columnar(sql, params, as_dict_rows=as_dict_rows, t0=t0)
+        with self._measured(sql, params=params) as m:
+            async with self._connection(timing=m) as conn:
+                res = await conn.execute(self._statements.clause(sql), params or {})
+                rows = res.fetchall()
+                cols = list(res.keys())
+            m["rows"] = len(rows)
+            m["bytes"] = estimate_bytes(rows)
+        rows_out: List[Any]
         if as_dict_rows:
             rows_out = [dict(zip(cols, r)) for r in rows]
         else:
             rows_out = [list(r) for r in rows]
         return {"columns": cols, "rows": rows_out, "elapsed_ms": round((time.perf_counter()-t0)*1000, 3)}
 
+    async def _query_columnar(self, sql: str, params: Optional[Dict[str, Any]], *, as_dict_rows: bool,
+                              t0: float, batch_size: int=2000) -> Dict[str, Any]:
+        with self._measured(sql, params=params) as m:
+            async with self._connection(timing=m) as conn:
+                res = await conn.stream(self._statements.clause(sql), params or {}, execution_options={"yield_per": batch_size})
+                builder = ColumnarBuilder(res.keys())
+                try:
+                    async for part in res.partitions(batch_size):
+                        builder.extend(part)
+                finally:
+                    await res.close()
+            col = builder.finish()
+            m["rows"] = len(col)
+            m["bytes"] = estimate_bytes(col.rows)
+        return {"columns": col.columns, "rows": col.dicts() if as_dict_rows else col.rows,
+                "columnar": col, "elapsed_ms": round((time.perf_counter()-t0)*1000, 3)}
+
+    async def query_batch(self, statements: Sequence[Tuple[str, Optional[Dict[str, Any]]]], *,
+                          as_dict_rows: bool=False) -> List[Dict[str, Any]]:
+        """
+        Più SELECT in un solo batch (un round trip): [(sql1, p1), (sql2, p2), ...] →
+        una lista di {"columns", "rows"} nello stesso ordine, letti con nextset().
+        Ogni statement deve restituire un result set; "elapsed_ms" è del batch intero.
+        Niente cache/single-flight: serve ai refresh che leggono più viste insieme.
+        """
+        if not statements:
+            return []
+        with self._traced("query_batch", [sql for sql, _p in statements], [p for _s, p in statements],
+                          as_dict_rows=as_dict_rows) as ev:
+            ev["res"] = res = await self._query_batch(statements, as_dict_rows=as_dict_rows)
+        return res
+
+    async def _query_batch(self, statements: Sequence[Tuple[str, Optional[Dict[str, Any]]]], *,
+                           as_dict_rows: bool) -> List[Dict[str, Any]]:
+        t0 = time.perf_counter()
+        label = "+".join(self._statements.name_of(sql) for sql, _p in statements)
+        with self._measured("\n;\n".join(sql for sql, _p in statements), name=f"batch:{label}") as m:
+            async with self._connection(timing=m) as conn:
+                dialect = conn.dialect
+                if dialect.name != "mssql":
+                    # backend senza batch multi-result: stessi risultati, una query alla volta
+                    out = []
+                    for sql, params in statements:
+                        res = await conn.execute(self._statements.clause(sql), params or {})
+                        out.append((list(res.keys()), res.fetchall()))
+                else:
+                    parts: List[str] = ["SET NOCOUNT ON"]
+                    args: List[Any] = []
+                    sizes: List[Any] = []
+                    typed = False
+                    for sql, params in statements:
+                        # :nome → ? nell'ordine di comparizione (paramstyle qmark di pyodbc)
+                        compiled, names, st_sizes = self._statements.get(sql).compiled(dialect)
+                        params = params or {}
+                        parts.append(compiled.strip().rstrip(";"))
+                        args.extend(params[name] for name in names)
+                        if st_sizes:
+                            typed = True
+                            sizes.extend(_pyodbc_sizes(st_sizes))
+                        else:
+                            sizes.extend((None, None, None) for _ in names)
+                    batch = ";\n".join(parts) + ";"
+                    raw = (await conn.get_raw_connection()).driver_connection   # aioodbc: ha nextset()
+                    cur = await raw.cursor()
+                    out = []
+                    try:
+                        pyodbc_cur = _pyodbc_cursor(cur)
+                        if typed and pyodbc_cur is not None:
+                            pyodbc_cur.setinputsizes(sizes)     # tipi dichiarati (come _typed_binds)
+                        await cur.execute(batch, *args)
+                        for _ in statements:
+                            while cur.description is None and await cur.nextset():
+                                pass
+                            if cur.description is None:
+                                raise RuntimeError(f"query_batch: attesi {len(statements)} result set, letti {len(out)}")
+                            out.append(([d[0] for d in cur.description], await cur.fetchall()))
+                            await cur.nextset()
+                    except asyncio.CancelledError:
+                        if self._cancel_statement(cur):
+                            with contextlib.suppress(Exception):
+                                await conn.invalidate()
+                        raise
+                    finally:
+                        with contextlib.suppress(Exception):
+                            await cur.close()
+            m["rows"] = sum(len(rows) for _c, rows in out)
+            m["bytes"] = sum(estimate_bytes(rows) for _c, rows in out)
+        elapsed = round((time.perf_counter()-t0)*1000, 3)
+        results = []
+        for cols, rows in out:
+            rows_out: List[Any]
+            if as_dict_rows:
+                rows_out = [dict(zip(cols, r)) for r in rows]
+            else:
+                rows_out = [list(r) for r in rows]
+            results.append({"columns": cols, "rows": rows_out, "elapsed_ms": elapsed})
+        return results
+
+    async def stream(self, sql: str, params: Optional[Dict[str, Any]]=None, *,
+                     batch_size: int=500, as_dict_rows: bool=False) -> AsyncIterator[list]:
+        """
+        Itera il risultato a blocchi di batch_size righe (fetchmany):
+            async with contextlib.aclosing(db.stream(sql, params)) as it:
+                async for batch in it: ...
+        Non è un cursore server-side: è il result set predefinito di pyodbc (forward-only), che il
+        driver legge dalla rete a ogni fetchmany. Lato Python resta un blocco (più i buffer del driver);
+        la connessione resta occupata fino alla chiusura dell'iteratore, poi torna al pool.
+        """
+        with self._traced("stream", sql, params, batch_size=batch_size, as_dict_rows=as_dict_rows) as ev, \
+                self._measured(sql, slow=False) as m:
+            ev["rows"] = 0
+            async with self._connection(timing=m) as conn:
+                res = await conn.stream(self._statements.clause(sql), params or {}, execution_options={"yield_per": batch_size})
+                cols = list(res.keys())
+                try:
+                    async for part in res.partitions(batch_size):
+                        m["rows"] += len(part)
+                        ev["rows"] = m["rows"]
+                        m["bytes"] += estimate_bytes(part)
+                        if as_dict_rows:
+                            yield [dict(zip(cols, r)) for r in part]
+                        else:
+                            yield [list(r) for r in part]
+                finally:
+                    await res.close()
+
     async def exec(self, sql: str, params: Optional[Dict[str, Any]]=None, *, commit: bool=False) -> int:
-        await self._ensure_engine()
-        async with (self._engine.begin() if commit else self._engine.connect()) as conn:
-            res = await conn.execute(text(sql), params or {})
-            return res.rowcount or 0
+        try:
+            with self._traced("exec", sql, params, commit=commit) as ev, self._measured(sql) as m:
+                async with self._connection(begin=commit, timing=m) as conn:
+                    res = await conn.execute(self._statements.clause(sql), params or {})
+                    n = res.rowcount or 0
+                m["rows"] = ev["rows"] = max(n, 0)
+            return n
+        finally:
+            if self._cache is not None:
+                self._cache.invalidate_for(sql)
+
+    async def exec_many(self, sql: str, seq_params: Iterable[Dict[str, Any]], *, chunk_size: int=5000) -> int:
+        """
+        Stesso DML per ogni dizionario di parametri, in una transazione (commit alla fine).
+        fast_executemany: un round trip ogni chunk_size righe invece che uno per riga.
+        """
+        seq = list(seq_params)
+        total = 0
+        async with self.transaction() as tx:
+            for i in range(0, len(seq), max(1, chunk_size)):
+                total += await tx.executemany(sql, seq[i:i + chunk_size])
+        return total
+
+    async def exec_json(self, sql: str, rows: Iterable[Dict[str, Any]], *, param: str="rows",
+                        chunk_rows: int=5000) -> int:
+        """Bulk set-based via OPENJSON(:rows) in una transazione (vedi Transaction.exec_json)."""
+        async with self.transaction() as tx:
+            return await tx.exec_json(sql, rows, param=param, chunk_rows=chunk_rows)
@@ -2,24 +2,31 @@
 import asyncio
 from typing import Callable
 
+from gestione_aree_frame_async import TkBridge
+from runtime import RUNTIME
+from scheduler import INTERACTIVE
+
 class AsyncRunner:
-    """Esegue un awaitable sul loop globale e richiama i callback in Tk via .after."""
+    """Esegue un awaitable sul loop globale e richiama i callback in Tk (coda di completamento, niente polling)."""
     def __init__(self, tk_root, loop: asyncio.AbstractEventLoop):
         self.tk = tk_root
         self.loop = loop
+        self._bridge = TkBridge.for_widget(tk_root)
 
-    def run(self, awaitable, on_ok: Callable, on_err: Callable, busy=None, message: str | None=None):
+    def run(self, awaitable, on_ok: Callable, on_err: Callable, busy=None, message: str | None=None,
+            priority: str = INTERACTIVE):
         if busy: busy.show(message or "Lavoro in corso…")
-        fut = asyncio.run_coroutine_threadsafe(awaitable, self.loop)
-        self._poll(fut, on_ok, on_err, busy)
+        if self.loop is RUNTIME.loop:
+            fut = RUNTIME.submit(awaitable, priority=priority)
+        else:
+            fut = asyncio.run_coroutine_threadsafe(awaitable, self.loop)
+        self._bridge.watch(fut, lambda: self._done(fut, on_ok, on_err, busy))
 
-    def _poll(self, fut, on_ok, on_err, busy):
-        if fut.done():
-            if busy: busy.hide()
-            try:
-                res = fut.result()
-                on_ok(res)
-            except Exception as ex:
-                on_err(ex)
+    def _done(self, fut, on_ok, on_err, busy):
+        if busy: busy.hide()
+        try:
+            res = fut.result()
+        except BaseException as ex:
+            on_err(ex)
             return
-        self.tk.after(50, lambda: self._poll(fut, on_ok, on_err, busy))
+        on_ok(res)
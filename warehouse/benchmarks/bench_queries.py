@@ -0,0 +1,273 @@
+# bench_queries.py — query di produzione sul backend SQLite a più scale di dati: latenza, memoria, post-elaborazione
+#
+#   python benchmarks/bench_queries.py --scales dev,prod --runs 30
+#   python benchmarks/bench_queries.py --scales dev --update-baseline      # riscrive benchmarks/baseline.json
+#
+# Per ogni scala genera (una volta, poi riusa) un database con datagen in --data-dir, ricava i parametri
+# dai dati (corsia più piena, cella doppia, UDC a magazzino, documento), esegue ogni query N volte
+# (p50/p95, righe) più un passaggio sotto tracemalloc (picco di memoria lato Python) e misura la
+# post-elaborazione delle finestre (build_matrix, _rows_to_dicts). Output JSON su stdout o --out;
+# con una baseline segnala le regressioni oltre --threshold ed esce con codice 1.
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from datagen import SCALES, WarehouseGenerator, load_sqlite                       # noqa: E402
+from gestione_pickinglist import SQL_PL, SQL_PL_DETAILS, _rows_to_dicts             # noqa: E402
+from layout_window import SQL_MATRIX, SQL_STATS_TOT, build_matrix                   # noqa: E402
+from reset_corsie import SQL_DETTAGLIO, SQL_RIEPILOGO                               # noqa: E402
+from search_pallets import SQL_SEARCH                                               # noqa: E402
+from sql_statements import pick                                                     # noqa: E402
+from sqlite_backend import AsyncSQLiteClient                                        # noqa: E402
+from stock_snapshot import GIACENZA, StockSnapshot                                  # noqa: E402
+from traccia_prodotti import TRACCIA, TracciaProdotti                               # noqa: E402
+from view_celle_multiple import (SQL_CELLE_DUP_PER_CORSIA, SQL_CORSIE, SQL_PALLET_IN_CELLA,  # noqa: E402
+                                 SQL_RIEPILOGO_PERCENTUALI)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(HERE, "baseline.json")
+DEFAULT_DATA_DIR = os.path.join(HERE, "data")
+
+# parametri ricavati dai dati generati (SQL valido su entrambi i backend: passa da rewrite_tsql)
+SQL_PARAM_CORSIA = """
+    SELECT TOP (1) RTRIM(c.Corsia) AS Corsia
+    FROM dbo.XMag_GiacenzaPalletSnapshot g JOIN dbo.Celle c ON c.ID = g.IDCella
+    WHERE c.ID <> 9999 AND c.Corsia <> '7G'
+    GROUP BY c.Corsia ORDER BY COUNT(*) DESC
+"""
+SQL_PARAM_DUP = """
+    SELECT TOP (1) IDCella FROM dbo.XMag_GiacenzaPalletSnapshot
+    WHERE IDCella <> 9999 GROUP BY IDCella HAVING COUNT(*) > 1 ORDER BY IDCella
+"""
+SQL_PARAM_UDC = """
+    SELECT TOP (1) g.BarcodePallet FROM dbo.XMag_GiacenzaPalletSnapshot g
+    WHERE g.IDCella <> 9999 ORDER BY g.BarcodePallet
+"""
+SQL_PARAM_DOC = "SELECT TOP (1) Documento FROM dbo.XMag_ViewPackingList ORDER BY Documento"
+
+# load_sqlite costruisce snapshot e copia della traccia: le finestre leggono le stesse varianti dopo il deploy
+LOCAL = frozenset({GIACENZA, TRACCIA})
+
+# (nome, SQL, parametri da p, opzioni di query_json come nelle finestre)
+QUERIES: List[Tuple[str, str, Callable[[Dict[str, Any]], Dict[str, Any]], Dict[str, Any]]] = [
+    ("search.udc", pick(SQL_SEARCH, LOCAL), lambda p: {"udc": p["udc_part"], "lotto": None, "codice": None}, {}),
+    ("search.all", pick(SQL_SEARCH, LOCAL), lambda p: {"udc": None, "lotto": None, "codice": None}, {}),
+    ("layout.stats_tot", pick(SQL_STATS_TOT, LOCAL), lambda p: {}, {}),
+    ("layout.matrice", pick(SQL_MATRIX, LOCAL), lambda p: {"corsia": p["corsia"]}, {}),
+    ("pickinglist.elenco", SQL_PL, lambda p: {}, {"columnar": True}),
+    ("pickinglist.dettagli", SQL_PL_DETAILS, lambda p: {"Documento": p["documento"]}, {"columnar": True}),
+    ("reset_corsie.riepilogo", pick(SQL_RIEPILOGO, LOCAL), lambda p: {"corsia": p["corsia"]}, {}),
+    ("reset_corsie.dettaglio", pick(SQL_DETTAGLIO, LOCAL), lambda p: {"corsia": p["corsia"]}, {}),
+    ("celle_multiple.corsie", pick(SQL_CORSIE, LOCAL), lambda p: {}, {"as_dict_rows": True, "columnar": True}),
+    ("celle_multiple.celle_dup", pick(SQL_CELLE_DUP_PER_CORSIA, LOCAL), lambda p: {"corsia": p["corsia"]},
+     {"as_dict_rows": True, "columnar": True}),
+    ("celle_multiple.pallet_in_cella", pick(SQL_PALLET_IN_CELLA, LOCAL), lambda p: {"idcella": p["idcella"]},
+     {"as_dict_rows": True, "columnar": True}),
+    ("celle_multiple.riepilogo_percentuali", pick(SQL_RIEPILOGO_PERCENTUALI, LOCAL), lambda p: {},
+     {"as_dict_rows": True, "columnar": True}),
+]
+
+
+def _pct(xs: List[float], p: float) -> float:
+    xs = sorted(xs)
+    return round(xs[min(len(xs) - 1, int(p * len(xs)))], 3)
+
+
+def _timed(fn: Callable[[], Any], runs: int) -> Dict[str, Any]:
+    fn()
+    lat: List[float] = []
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        fn()
+        lat.append((time.perf_counter() - t0) * 1000)
+    tracemalloc.start()
+    fn()
+    _cur, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"runs": runs, "mean_ms": round(statistics.fmean(lat), 3), "p50_ms": _pct(lat, 0.50),
+            "p95_ms": _pct(lat, 0.95), "peak_kb": round(peak / 1024, 1)}
+
+
+async def _timed_query(db: AsyncSQLiteClient, sql: str, params: Dict[str, Any], kw: Dict[str, Any],
+                       runs: int) -> Dict[str, Any]:
+    res = await db.query_json(sql, params, **kw)        # connessione + preparazione fuori dal tempo
+    lat: List[float] = []
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        await db.query_json(sql, params, **kw)
+        lat.append((time.perf_counter() - t0) * 1000)
+    tracemalloc.start()         # picco delle allocazioni Python (righe, colonne), non della cache SQLite
+    await db.query_json(sql, params, **kw)
+    _cur, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"runs": runs, "rows": len(res["rows"]), "mean_ms": round(statistics.fmean(lat), 3),
+            "p50_ms": _pct(lat, 0.50), "p95_ms": _pct(lat, 0.95), "peak_kb": round(peak / 1024, 1)}
+
+
+async def _scalar(db: AsyncSQLiteClient, sql: str) -> Any:
+    rows = (await db.query_json(sql))["rows"]
+    return rows[0][0] if rows else None
+
+
+async def _params(db: AsyncSQLiteClient) -> Dict[str, Any]:
+    udc = await _scalar(db, SQL_PARAM_UDC)
+    return {"corsia": await _scalar(db, SQL_PARAM_CORSIA) or "1A",
+            "idcella": await _scalar(db, SQL_PARAM_DUP) or 1,
+            "udc_part": (udc or "")[1:5] or None,
+            "documento": await _scalar(db, SQL_PARAM_DOC) or 0}
+
+
+async def _prepare(path: str, scale: str, seed: int) -> Dict[str, Any]:
+    """Rigenera il database solo se manca o se scala/seed sono cambiati; le statistiche di carico restano nel .json."""
+    meta_path = path + ".json"
+    want = {"scale": scale, "seed": seed, "params": repr(SCALES[scale])}
+    if os.path.exists(path) and os.path.exists(meta_path):
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("want") == want:
+            # database di una versione precedente: schema (idempotente), snapshot e copia SAMA1 se mancano
+            db = AsyncSQLiteClient(path, log=False)
+            try:
+                await db.create_schema()
+                stock = await StockSnapshot(db).refresh()
+                traccia = await TracciaProdotti(db).refresh()
+            finally:
+                await db.dispose()
+            return dict(meta["load"], reused=True, stock=stock, traccia=traccia)
+    db = AsyncSQLiteClient(path, log=False)
+    try:
+        t0 = time.perf_counter()
+        tables = await load_sqlite(db, WarehouseGenerator(SCALES[scale], seed=seed))
+        load = {"seconds": round(time.perf_counter() - t0, 1),
+                "tables": {t: v for t, v in tables.items() if t not in ("generator", "stock", "traccia")},
+                "stock": tables["stock"], "traccia": tables["traccia"]}
+    finally:
+        await db.dispose()
+    with open(meta_path, "w", encoding="utf-8") as f:
+        json.dump({"want": want, "load": load}, f, indent=2)
+    return dict(load, reused=False)
+
+
+async def bench_scale(scale: str, args) -> Dict[str, Any]:
+    path = os.path.join(args.data_dir, f"warehouse_{scale}_{args.seed}.db")
+    load = await _prepare(path, scale, args.seed)
+    out: Dict[str, Any] = {"db": os.path.basename(path), "db_mb": round(os.path.getsize(path) / 2**20, 1),
+                           "load": load, "queries": {}, "post": {}}
+
+    db = AsyncSQLiteClient(path, log=False, cache_size=0)
+    try:
+        p = await _params(db)
+        out["params"] = p
+        for name, sql, params, kw in QUERIES:
+            if args.only and not any(s in name for s in args.only):
+                continue
+            out["queries"][name] = await _timed_query(db, sql, params(p), kw, args.runs)
+
+        # post-elaborazione delle finestre, sugli stessi risultati
+        corsia = p["corsia"]
+        rows = (await db.query_json(pick(SQL_MATRIX, LOCAL), {"corsia": corsia}))["rows"]
+        out["post"]["layout.build_matrix"] = dict(_timed(lambda: build_matrix(rows, corsia), args.runs),
+                                                  rows=len(rows))
+        for label, kw in (("rows", {}), ("columnar", {"columnar": True})):
+            for qname, sql in (("elenco", SQL_PL), ("dettagli", SQL_PL_DETAILS)):
+                res = await db.query_json(sql, {"Documento": p["documento"]} if qname == "dettagli" else {}, **kw)
+                out["post"][f"pickinglist.rows_to_dicts.{qname}.{label}"] = dict(
+                    _timed(lambda: _rows_to_dicts(res), args.runs), rows=len(res["rows"]))
+    finally:
+        await db.dispose()
+    return out
+
+
+# ---------------- confronto con la baseline ----------------
+def compare(current: Dict[str, Any], baseline: Dict[str, Any], *, threshold: float, min_ms: float,
+            min_kb: float) -> List[Dict[str, Any]]:
+    """
+    Regressione = p50 oltre baseline × (1 + threshold) e di almeno min_ms (sotto il millisecondo
+    è rumore), oppure picco di memoria oltre la stessa soglia e di almeno min_kb.
+    Si confrontano solo scale e voci presenti in entrambe.
+    """
+    out: List[Dict[str, Any]] = []
+    for scale, cur in current.get("scales", {}).items():
+        base = baseline.get("scales", {}).get(scale)
+        if not base:
+            continue
+        for section in ("queries", "post"):
+            for name, c in cur.get(section, {}).items():
+                b = base.get(section, {}).get(name)
+                if not b:
+                    continue
+                for key, floor in (("p50_ms", min_ms), ("peak_kb", min_kb)):
+                    if key not in b or key not in c:
+                        continue
+                    old, new = b[key], c[key]
+                    if new > old * (1 + threshold) and new - old >= floor:
+                        out.append({"scale": scale, "name": f"{section}.{name}", "metric": key,
+                                    "baseline": old, "current": new,
+                                    "ratio": round(new / old, 2) if old else None})
+    return out
+
+
+async def main(args) -> Dict[str, Any]:
+    os.makedirs(args.data_dir, exist_ok=True)
+    out: Dict[str, Any] = {
+        "meta": {"python": platform.python_version(), "sqlite": sqlite3.sqlite_version,
+                 "platform": platform.platform(), "seed": args.seed, "runs": args.runs,
+                 "at": time.strftime("%Y-%m-%d %H:%M:%S")},
+        "scales": {},
+    }
+    for scale in args.scales:
+        out["scales"][scale] = await bench_scale(scale, args)
+    return out
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Benchmark delle query di produzione sul backend SQLite")
+    ap.add_argument("--scales", default="dev", help=f"elenco separato da virgole fra {', '.join(SCALES)}")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--runs", type=int, default=20)
+    ap.add_argument("--only", help="solo le query il cui nome contiene una di queste parti (virgole)")
+    ap.add_argument("--data-dir", default=DEFAULT_DATA_DIR)
+    ap.add_argument("--out", help="file JSON dei risultati (default: stdout)")
+    ap.add_argument("--baseline", default=DEFAULT_BASELINE)
+    ap.add_argument("--threshold", type=float, default=0.25, help="rallentamento tollerato (0.25 = +25%%)")
+    ap.add_argument("--min-ms", type=float, default=1.0)
+    ap.add_argument("--min-kb", type=float, default=256.0)
+    ap.add_argument("--update-baseline", action="store_true")
+    a = ap.parse_args()
+    a.scales = [s.strip() for s in a.scales.split(",") if s.strip()]
+    a.only = [s.strip() for s in a.only.split(",")] if a.only else None
+    bad = [s for s in a.scales if s not in SCALES]
+    if bad:
+        ap.error(f"scale sconosciute: {', '.join(bad)}")
+
+    result = asyncio.run(main(a))
+    regressions: List[Dict[str, Any]] = []
+    if a.update_baseline:
+        with open(a.baseline, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+            f.write("\n")
+    elif os.path.exists(a.baseline):
+        with open(a.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(result, baseline, threshold=a.threshold, min_ms=a.min_ms, min_kb=a.min_kb)
+        result["baseline"] = {"path": a.baseline, "at": baseline.get("meta", {}).get("at"),
+                              "threshold": a.threshold, "regressions": regressions}
+    text = json.dumps(result, indent=2)
+    if a.out:
+        with open(a.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,102 @@
+# bench_scheduler.py — latenza interattiva sotto carico background/refresh: senza scheduler vs QueryScheduler
+#
+#   python benchmarks/bench_scheduler.py                      # simulato: pool di 8 connessioni finte
+#   WAREHOUSE_BENCH_DSN="mssql+aioodbc://..." python benchmarks/bench_scheduler.py --pool 4 --overflow 4
+#
+# Carico: --background richieste lunghe (export/statistiche) lanciate tutte insieme più
+# --interactive ricerche brevi che arrivano ogni --every-ms. Senza scheduler ogni richiesta
+# va dritta al pool (FIFO sul pool); con lo scheduler passa per le classi di priorità.
+# Output JSON: p50/p95/p99 della latenza interattiva e attesa in coda per classe.
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from typing import Any, Callable, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metrics import Histogram, MetricsRegistry                   # noqa: E402
+from scheduler import BACKGROUND, INTERACTIVE, REFRESH, QueryScheduler  # noqa: E402
+
+SQL_INTERACTIVE = "SELECT TOP (1) ID FROM dbo.Celle WHERE ID = 1"
+SQL_HEAVY = "SELECT COUNT_BIG(*) FROM sys.all_objects a CROSS JOIN sys.all_objects b"
+
+
+def _make_query(args) -> Callable[[str], Any]:
+    if args.dsn:
+        from async_msssql_query import AsyncMSSQLClient
+        db = AsyncMSSQLClient(args.dsn, pool_size=args.pool, max_overflow=args.overflow, cache_size=0, log=False)
+
+        async def _query(kind: str):
+            await db.query_json(SQL_INTERACTIVE if kind == INTERACTIVE else SQL_HEAVY)
+        _query.db = db
+        return _query
+
+    pool = asyncio.Semaphore(args.pool + args.overflow)     # pool finto: una connessione = un permesso
+
+    async def _sim(kind: str):
+        async with pool:
+            await asyncio.sleep(args.fast_ms / 1000 if kind == INTERACTIVE else args.slow_ms / 1000)
+    _sim.db = None
+    return _sim
+
+
+async def _scenario(args, use_scheduler: bool) -> Dict[str, Any]:
+    query = _make_query(args)
+    metrics = MetricsRegistry()
+    sched = QueryScheduler(args.pool + args.overflow, metrics=metrics) if use_scheduler else None
+    lat = Histogram()
+
+    async def _submit(kind: str, priority: str):
+        t0 = time.perf_counter()
+        if sched is None:
+            await query(kind)
+        else:
+            await sched.run(query(kind), priority, queued_at=t0)
+        if priority == INTERACTIVE:
+            lat.observe((time.perf_counter() - t0) * 1000)
+
+    load: List[asyncio.Task] = []
+    for i in range(args.background):
+        prio = BACKGROUND if i % 2 else REFRESH
+        load.append(asyncio.create_task(_submit("heavy", prio)))
+    inter: List[asyncio.Task] = []
+    for _ in range(args.interactive):
+        inter.append(asyncio.create_task(_submit(INTERACTIVE, INTERACTIVE)))
+        await asyncio.sleep(args.every_ms / 1000)
+    await asyncio.gather(*inter)
+    await asyncio.gather(*load)
+    if query.db is not None:
+        await query.db.dispose()
+    out: Dict[str, Any] = {"interactive_latency_ms": lat.summary()}
+    if sched is not None:
+        out["queue_wait_ms"] = {k.rsplit(".", 1)[1]: v for k, v in metrics.snapshot()["histograms"].items()
+                                if k.startswith("scheduler.wait_ms.")}
+    return out
+
+
+async def main(args) -> Dict[str, Any]:
+    return {
+        "mode": "sql" if args.dsn else "simulated",
+        "pool": args.pool + args.overflow,
+        "background": args.background, "interactive": args.interactive,
+        "no_scheduler": await _scenario(args, False),
+        "scheduler": await _scenario(args, True),
+    }
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--dsn", default=os.environ.get("WAREHOUSE_BENCH_DSN"))
+    ap.add_argument("--pool", type=int, default=4)
+    ap.add_argument("--overflow", type=int, default=4)
+    ap.add_argument("--background", type=int, default=60)
+    ap.add_argument("--interactive", type=int, default=40)
+    ap.add_argument("--every-ms", type=float, default=50.0)
+    ap.add_argument("--fast-ms", type=float, default=5.0)
+    ap.add_argument("--slow-ms", type=float, default=200.0)
+    print(json.dumps(asyncio.run(main(ap.parse_args())), indent=2))
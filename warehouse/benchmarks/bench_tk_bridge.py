@@ -0,0 +1,110 @@
+# bench_tk_bridge.py — latenza aggiunta e risvegli di Tk: polling per-future (after 60 ms) vs TkBridge
+#
+#   python benchmarks/bench_tk_bridge.py --futures 200 --max-ms 500
+#
+# Lancia N coroutine (sleep casuale fino a max-ms) sul loop del runtime e misura, per ogni
+# modalità, il ritardo fra completamento sul loop e callback sul thread Tk, più il numero di
+# risvegli del thread Tk (timer after() eseguiti / eventi). Serve un display (Tk reale).
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import time
+import tkinter as tk
+from typing import Any, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gestione_aree_frame_async import TkBridge  # noqa: E402
+from runtime import RUNTIME                     # noqa: E402
+
+
+async def _job(delay: float) -> float:
+    await asyncio.sleep(delay)
+    return time.perf_counter()          # istante di completamento sul loop
+
+
+def _summary(lat: List[float], wakeups: int, elapsed: float) -> Dict[str, Any]:
+    lat = sorted(lat)
+    return {
+        "callbacks": len(lat),
+        "latency_ms_mean": round(statistics.fmean(lat), 3),
+        "latency_ms_p95": round(lat[int(0.95 * (len(lat) - 1))], 3),
+        "latency_ms_max": round(lat[-1], 3),
+        "tk_wakeups": wakeups,
+        "wakeups_per_s": round(wakeups / elapsed, 1),
+    }
+
+
+def bench_polling(root: tk.Tk, delays: List[float]) -> Dict[str, Any]:
+    """Il vecchio schema: un after(60) per ogni future finché non è done."""
+    lat: List[float] = []
+    state = {"wakeups": 0, "left": len(delays)}
+
+    def _watch(fut):
+        def _poll():
+            state["wakeups"] += 1
+            if fut.done():
+                lat.append((time.perf_counter() - fut.result()) * 1000)
+                state["left"] -= 1
+                if not state["left"]:
+                    root.quit()
+            else:
+                root.after(60, _poll)
+        _poll()
+
+    t0 = time.perf_counter()
+    for d in delays:
+        _watch(RUNTIME.submit(_job(d)))
+    root.mainloop()
+    return _summary(lat, state["wakeups"], time.perf_counter() - t0)
+
+
+def bench_bridge(root: tk.Tk, delays: List[float]) -> Dict[str, Any]:
+    bridge = TkBridge.for_widget(root)
+    before = bridge.stats()
+    lat: List[float] = []
+    state = {"left": len(delays)}
+
+    def _cb(fut):
+        lat.append((time.perf_counter() - fut.result()) * 1000)
+        state["left"] -= 1
+        if not state["left"]:
+            root.quit()
+
+    t0 = time.perf_counter()
+    for d in delays:
+        fut = RUNTIME.submit(_job(d))
+        bridge.watch(fut, lambda f=fut: _cb(f))
+    root.mainloop()
+    after = bridge.stats()
+    wakeups = after["pumps"] - before["pumps"]
+    return _summary(lat, wakeups, time.perf_counter() - t0)
+
+
+def main(args) -> Dict[str, Any]:
+    rnd = random.Random(args.seed)
+    delays = [rnd.uniform(0.001, args.max_ms / 1000) for _ in range(args.futures)]
+    root = tk.Tk()
+    root.withdraw()
+    RUNTIME.start()
+    try:
+        return {"futures": args.futures, "max_ms": args.max_ms,
+                "polling_60ms": bench_polling(root, delays),
+                "tk_bridge": bench_bridge(root, delays)}
+    finally:
+        root.destroy()
+        RUNTIME.shutdown()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--futures", type=int, default=200)
+    ap.add_argument("--max-ms", type=float, default=500.0)
+    ap.add_argument("--seed", type=int, default=1)
+    print(json.dumps(main(ap.parse_args()), indent=2))
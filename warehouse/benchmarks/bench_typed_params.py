@@ -0,0 +1,125 @@
+# bench_typed_params.py — parametri text() non tipizzati (NVARCHAR) vs tipizzati (VARCHAR): piani e latenza
+#
+#   WAREHOUSE_BENCH_DSN="mssql+aioodbc://..." python benchmarks/bench_typed_params.py --runs 200 --barcode 000123456789
+#
+# Per ogni query esegue N volte la variante senza tipi e quella con i tipi dichiarati
+# (sql_statements.register), poi legge dal plan cache dichiarazione dei parametri,
+# CONVERT_IMPLICIT e operatori seek/scan. Output JSON su stdout.
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import re
+import statistics
+import sys
+import time
+from typing import Any, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from async_msssql_query import AsyncMSSQLClient          # noqa: E402
+from sql_statements import BARCODE, ID_INT, StatementRegistry  # noqa: E402
+
+# (nome, SQL, tipi, parametri di default): il marcatore /*bench:...*/ separa le voci nel plan cache
+QUERIES = [
+    ("cerca_udc", """
+        SELECT TOP (1) c.ID, RTRIM(c.Corsia) AS Corsia, RTRIM(c.Colonna) AS Colonna, RTRIM(c.Fila) AS Fila
+        FROM dbo.XMag_GiacenzaPallet g
+        JOIN dbo.Celle c ON c.ID = g.IDCella
+        WHERE g.BarcodePallet = :barcode
+    """, {"barcode": BARCODE}, lambda a: {"barcode": a.barcode}),
+    ("magazzini_pallet", """
+        SELECT ID, IDCella, Attributo
+        FROM dbo.MagazziniPallet
+        WHERE Attributo = :barcode
+    """, {"barcode": BARCODE}, lambda a: {"barcode": a.barcode}),
+    ("pallet_in_cella", """
+        SELECT g.BarcodePallet
+        FROM dbo.XMag_GiacenzaPallet g
+        WHERE g.IDCella = :idcella
+    """, {"idcella": ID_INT}, lambda a: {"idcella": a.idcella}),
+]
+
+SQL_PLANS = """
+    SELECT st.text AS sql_text, qs.execution_count, qs.total_elapsed_time, qs.total_logical_reads,
+           CAST(qp.query_plan AS nvarchar(max)) AS plan_xml
+    FROM sys.dm_exec_query_stats AS qs
+    CROSS APPLY sys.dm_exec_sql_text(qs.sql_handle) AS st
+    CROSS APPLY sys.dm_exec_query_plan(qs.plan_handle) AS qp
+    WHERE st.text LIKE :marker
+"""
+
+_RE_DECL = re.compile(r"^\s*\(([^)]*)\)")
+_RE_OP = re.compile(r'PhysicalOp="([^"]+)"')
+
+
+def _plan_shape(rows: List[Dict[str, Any]]) -> Dict[str, Any]:
+    ops: Dict[str, int] = {}
+    converts = 0
+    decl = None
+    execs = reads = 0
+    for r in rows:
+        m = _RE_DECL.match(r["sql_text"] or "")
+        decl = decl or (m.group(1) if m else None)
+        xml = r["plan_xml"] or ""
+        converts += xml.count("CONVERT_IMPLICIT")
+        for op in _RE_OP.findall(xml):
+            if "Seek" in op or "Scan" in op:
+                ops[op] = ops.get(op, 0) + 1
+        execs += int(r["execution_count"] or 0)
+        reads += int(r["total_logical_reads"] or 0)
+    return {"params": decl, "convert_implicit": converts, "operators": ops,
+            "logical_reads_per_exec": round(reads / execs, 1) if execs else None}
+
+
+def _pct(xs: List[float], p: float) -> float:
+    xs = sorted(xs)
+    return round(xs[min(len(xs) - 1, int(p * len(xs)))], 3)
+
+
+async def _run(db: AsyncMSSQLClient, sql: str, params: Dict[str, Any], runs: int) -> Dict[str, Any]:
+    await db.query_json(sql, params)                    # connessione + compilazione fuori dal tempo
+    lat: List[float] = []
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        await db.query_json(sql, params)
+        lat.append((time.perf_counter() - t0) * 1000)
+    return {"runs": runs, "mean_ms": round(statistics.fmean(lat), 3),
+            "p50_ms": _pct(lat, 0.50), "p95_ms": _pct(lat, 0.95)}
+
+
+async def main(args) -> Dict[str, Any]:
+    typed_reg = StatementRegistry()
+    untyped = AsyncMSSQLClient(args.dsn, statements=StatementRegistry(), cache_size=0, log=False)
+    typed = AsyncMSSQLClient(args.dsn, statements=typed_reg, cache_size=0, log=False)
+    out: Dict[str, Any] = {"runs": args.runs, "queries": {}}
+    try:
+        for name, sql, types, params in QUERIES:
+            res: Dict[str, Any] = {}
+            for label, db in (("untyped", untyped), ("typed", typed)):
+                tagged = f"/*bench:{name}:{label}*/ {sql}"
+                if label == "typed":
+                    typed_reg.register(name, tagged, types)
+                res[label] = await _run(db, tagged, params(args), args.runs)
+                plans = await untyped.query_json(SQL_PLANS, {"marker": f"%bench:{name}:{label}*/%"},
+                                                 as_dict_rows=True)
+                res[label]["plan"] = _plan_shape(plans["rows"])
+            out["queries"][name] = res
+    finally:
+        await untyped.dispose()
+        await typed.dispose()
+    return out
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument("--dsn", default=os.environ.get("WAREHOUSE_BENCH_DSN"))
+    ap.add_argument("--runs", type=int, default=200)
+    ap.add_argument("--barcode", default="000000000000")
+    ap.add_argument("--idcella", type=int, default=1)
+    a = ap.parse_args()
+    if not a.dsn:
+        ap.error("serve --dsn o WAREHOUSE_BENCH_DSN (SQL Server: i piani vengono dal plan cache)")
+    print(json.dumps(asyncio.run(main(a)), indent=2))
@@ -0,0 +1,70 @@
+# replay_trace.py — rigioca una traccia registrata dal client (WAREHOUSE_TRACE) su un server di test o su SQLite
+#
+#   WAREHOUSE_BENCH_DSN="mssql+aioodbc://..." python benchmarks/replay_trace.py logs/sessione.jsonl.gz
+#   python benchmarks/replay_trace.py logs/sessione.jsonl.gz --dsn sqlite:///benchmarks/data/warehouse_prod_1.db \
+#       --speed 0 --concurrency 8 --scheduler
+#
+# --speed 1 mantiene gli arrivi originali (2 = il doppio più veloce), --speed 0 va il più veloce possibile.
+# Le scritture (DML, transazioni) si rigiocano solo con --writes. Output JSON: latenze registrate vs
+# rigiocate per query, errori, righe diverse, ritardo degli arrivi; statistiche di pool, cache e scheduler.
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+from typing import Any, Dict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from async_msssql_query import make_client          # noqa: E402
+from metrics import MetricsRegistry                 # noqa: E402
+from query_trace import load_trace, replay          # noqa: E402
+from scheduler import QueryScheduler                # noqa: E402
+
+
+async def main(args) -> Dict[str, Any]:
+    trace = load_trace(args.trace, limit=args.limit)
+    db = make_client(args.dsn, pool_size=args.pool_size, max_overflow=args.max_overflow,
+                     cache_size=args.cache_size, log=False)
+    metrics = MetricsRegistry()
+    scheduler = None
+    if args.scheduler:
+        scheduler = QueryScheduler(args.concurrency, None, metrics)
+    try:
+        out = await replay(db, trace, speed=args.speed, writes=args.writes, scheduler=scheduler,
+                           concurrency=args.concurrency)
+        out["trace"] = dict(trace.header, path=args.trace)
+        out["pool"] = db.pool_stats()
+        out["cache"] = db.cache_stats()
+        out["singleflight"] = db.singleflight_stats()
+        if scheduler is not None:
+            out["scheduler"] = metrics.snapshot().get("histograms", {})
+    finally:
+        await db.dispose()
+    return out
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Replay di una traccia di query")
+    ap.add_argument("trace")
+    ap.add_argument("--dsn", default=os.environ.get("WAREHOUSE_BENCH_DSN"))
+    ap.add_argument("--speed", type=float, default=1.0, help="1 = tempi originali, 0 = il più veloce possibile")
+    ap.add_argument("--concurrency", type=int, default=4, help="gruppi in volo con --speed 0 / slot dello scheduler")
+    ap.add_argument("--scheduler", action="store_true", help="passa dalle code di priorità con le classi registrate")
+    ap.add_argument("--writes", action="store_true", help="rigioca anche DML e transazioni (solo su DB di test!)")
+    ap.add_argument("--limit", type=int, help="solo i primi N eventi")
+    ap.add_argument("--pool-size", type=int, default=4)
+    ap.add_argument("--max-overflow", type=int, default=4)
+    ap.add_argument("--cache-size", type=int, default=256, help="0 = senza cache dei risultati")
+    ap.add_argument("--out", help="file JSON dei risultati (default: stdout)")
+    a = ap.parse_args()
+    if not a.dsn:
+        ap.error("serve --dsn o WAREHOUSE_BENCH_DSN (anche sqlite:///file)")
+    text = json.dumps(asyncio.run(main(a)), indent=2, default=str)
+    if a.out:
+        with open(a.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
@@ -0,0 +1,72 @@
+# celle_sql.py — porting async di spt_SaveCelle per blocchi di celle (upsert set-based via OPENJSON)
+from __future__ import annotations
+
+from datetime import datetime
+from typing import Any, Dict, Iterable, List
+
+from sql_statements import register
+
+# Colonne di spt_SaveCelle (stesso ordine dei parametri della SP) e tipo per OPENJSON ... WITH
+CELLE_COLUMNS = (
+    ("ID", "int"),
+    ("Descrizione", "varchar(32)"),
+    ("IDArea", "int"),
+    ("IDDimensione", "int"),
+    ("IDStato", "int"),
+    ("Ordinamento", "float"),
+    ("X", "int"),
+    ("Y", "int"),
+    ("Z", "int"),
+    ("Corsia", "varchar(8)"),
+    ("Colonna", "varchar(8)"),
+    ("Fila", "varchar(8)"),
+    ("PortataMassimaCella", "float"),
+    ("PortataMassimaColonna", "float"),
+    ("UnitaVolumeOccupata", "float"),
+    ("InsUtente", "varchar(50)"),
+    ("InsDataOra", "datetime2"),
+    ("ModUtente", "varchar(50)"),
+    ("ModDataOra", "datetime2"),
+)
+
+_WITH = ", ".join(f"{c} {t}" for c, t in CELLE_COLUMNS)
+_NAMES = ", ".join(c for c, _ in CELLE_COLUMNS)
+
+# UPDATE ... WHERE ID = @ID per tutte le celle del blocco in un solo statement
+SQL_SAVE_CELLE_UPDATE = register("celle.save_update", f"""
+    UPDATE c
+       SET {", ".join(f"{n} = j.{n}" for n, _ in CELLE_COLUMNS if n != "ID")}
+      FROM dbo.Celle AS c
+      JOIN OPENJSON(:rows) WITH ({_WITH}) AS j ON j.ID = c.ID
+""")
+
+# IF @@ROWCOUNT = 0 INSERT ... → inserisce solo gli ID che non esistono
+SQL_SAVE_CELLE_INSERT = register("celle.save_insert", f"""
+    INSERT INTO dbo.Celle ({_NAMES})
+    SELECT {", ".join(f"j.{n}" for n, _ in CELLE_COLUMNS)}
+      FROM OPENJSON(:rows) WITH ({_WITH}) AS j
+     WHERE NOT EXISTS (SELECT 1 FROM dbo.Celle AS c WHERE c.ID = j.ID)
+""")
+
+
+def _cella_row(c: Dict[str, Any]) -> Dict[str, Any]:
+    out = {}
+    for name, _t in CELLE_COLUMNS:
+        v = c.get(name)
+        out[name] = v.isoformat(sep=" ") if isinstance(v, datetime) else v
+    return out
+
+
+async def spt_SaveCelle_many_async(db, celle: Iterable[Dict[str, Any]], *, chunk_rows: int = 5000) -> int:
+    """
+    Equivalente di N chiamate a [dbo].[spt_SaveCelle] (update, se manca insert) in una transazione:
+    le celle viaggiano come JSON, due statement set-based ogni chunk_rows celle.
+    Ritorna il numero di righe aggiornate + inserite.
+    """
+    rows: List[Dict[str, Any]] = [_cella_row(c) for c in celle]
+    if not rows:
+        return 0
+    async with db.transaction() as tx:
+        n = await tx.exec_json(SQL_SAVE_CELLE_UPDATE, rows, chunk_rows=chunk_rows)
+        n += await tx.exec_json(SQL_SAVE_CELLE_INSERT, rows, chunk_rows=chunk_rows)
+    return n
@@ -0,0 +1,240 @@
+# change_feed.py — feed delle modifiche su MagazziniPallet e Celle dalla rowversion (VersioneDati), a eventi
+from __future__ import annotations
+
+import asyncio
+import logging
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple, Optional, Set, Tuple
+
+from async_msssql_query import AsyncMSSQLClient
+from sql_scripts import missing_objects
+from sql_statements import ID_INT, VERSIONE, register
+from stock_snapshot import OGGETTI, SQL_ROWVERSION, SQL_SVUOTATE, svuotate
+
+# oltre :rv (ultima versione vista) e fino a :hi (versione stabile: niente transazioni aperte sotto)
+_FILTRO = {"mssql": "{a}.VersioneDati > CAST(:rv AS binary(8)) AND {a}.VersioneDati <= CAST(:hi AS binary(8))",
+           "sqlite": "{a}.VersioneDati > :rv AND {a}.VersioneDati <= :hi"}
+_MOVIMENTI = """
+SELECT TOP (:n) m.ID, m.Tipo, m.Attributo, m.NumeroPallet, m.IDMagazzino, m.IDArea, m.IDCella, m.PesoUnitario,
+       m.ModDataOra, CAST(m.VersioneDati AS bigint) AS Versione, c.Corsia, c.Colonna, c.Fila
+FROM dbo.MagazziniPallet AS m
+LEFT JOIN dbo.Celle AS c ON c.ID = m.IDCella
+WHERE {filtro}
+ORDER BY m.VersioneDati
+"""
+_CELLE = """
+SELECT TOP (:n) c.ID, c.IDStato, c.Corsia, c.Colonna, c.Fila,
+       CASE WHEN c.DelDataOra IS NULL THEN 0 ELSE 1 END AS Cancellata,
+       c.ModDataOra, CAST(c.VersioneDati AS bigint) AS Versione
+FROM dbo.Celle AS c
+WHERE {filtro}
+ORDER BY c.VersioneDati
+"""
+SQL_MOVIMENTI = {d: register(f"feed.movimenti.{d}", _MOVIMENTI.format(filtro=f.format(a="m")),
+                             n=ID_INT, rv=VERSIONE, hi=VERSIONE) for d, f in _FILTRO.items()}
+SQL_CELLE = {d: register(f"feed.celle.{d}", _CELLE.format(filtro=f.format(a="c")),
+                         n=ID_INT, rv=VERSIONE, hi=VERSIONE) for d, f in _FILTRO.items()}
+# indici di change_feed.sql (deploy): senza, ogni giro sarebbe una scansione di tutta MagazziniPallet
+INDICI = ("MagazziniPallet.IX_MagazziniPallet_VersioneDati", "Celle.IX_Celle_VersioneDati")
+
+
+def norm_corsia(corsia: Optional[str]) -> str:
+    """Corsia come la confrontano le finestre (LTRIM(RTRIM(...)) con collation CI)."""
+    return (corsia or "").strip().upper()
+
+
+class Movimento(NamedTuple):
+    """Riga di MagazziniPallet inserita o modificata, con la cella in cui sta (Corsia/Colonna/Fila come nel DB)."""
+    ID: int
+    Tipo: str
+    UDC: Optional[str]
+    NumeroPallet: Optional[int]
+    IDMagazzino: Optional[int]
+    IDArea: Optional[int]
+    IDCella: Optional[int]
+    PesoUnitario: Optional[float]
+    ModDataOra: Any
+    Versione: int
+    Corsia: Optional[str]
+    Colonna: Optional[str]
+    Fila: Optional[str]
+
+
+class StatoCella(NamedTuple):
+    """Riga di Celle modificata: stato (IDStato, prenotazioni), posizione, cancellazione logica."""
+    ID: int
+    IDStato: Optional[int]
+    Corsia: Optional[str]
+    Colonna: Optional[str]
+    Fila: Optional[str]
+    Cancellata: bool
+    ModDataOra: Any
+    Versione: int
+
+
+class Delta(NamedTuple):
+    """Un giro del feed; svuotate: corsie svuotate da reset_corsie (i DELETE non hanno rowversion)."""
+    movimenti: Tuple[Movimento, ...] = ()
+    celle: Tuple[StatoCella, ...] = ()
+    svuotate: Tuple[str, ...] = ()
+
+    def idcelle(self) -> Set[int]:
+        """Celle toccate da movimenti o modifiche (non quelle delle corsie svuotate)."""
+        ids = {m.IDCella for m in self.movimenti if m.IDCella is not None}
+        ids.update(c.ID for c in self.celle)
+        return ids
+
+    def corsie(self) -> Set[str]:
+        """Corsie toccate, normalizzate con norm_corsia."""
+        out = {norm_corsia(m.Corsia) for m in self.movimenti if m.Corsia is not None}
+        out.update(norm_corsia(c.Corsia) for c in self.celle)
+        out.update(norm_corsia(c) for c in self.svuotate)
+        return out
+
+    def udc(self) -> Set[str]:
+        """Barcode dei movimenti (maiuscoli, senza spazi finali)."""
+        return {m.UDC.rstrip(" ").upper() for m in self.movimenti if m.UDC}
+
+
+class ChangeFeed:
+    """
+    Cosa è cambiato negli ultimi secondi, senza ricaricare tutto:
+        feed = ChangeFeed(db, before_publish=allinea_indici)
+        unsubscribe = feed.subscribe(fn)     # fn(Delta) sul loop del runtime: deve solo accodare (TkBridge.post)
+        await feed.run(2.0)                  # righe con VersioneDati oltre l'ultima vista, per tabella
+    Legge fino a MIN_ACTIVE_ROWVERSION() - 1; before_publish() allinea gli indici prima di ogni evento.
+    """
+    def __init__(self, db: AsyncMSSQLClient, *, batch_rows: int = 5_000,
+                 before_publish: Optional[Callable[[], Awaitable[Any]]] = None):
+        self.db = db
+        self.batch_rows = batch_rows
+        self.before_publish = before_publish
+        self._rv: Dict[str, Optional[int]] = {"movimenti": None, "celle": None}
+        self._svuotate: Optional[Dict[str, int]] = None     # CORSIA → generazione; None senza stock_snapshot.sql
+        self._subs: Tuple[Callable[[Delta], None], ...] = ()
+        self._subs_lock = threading.Lock()
+        self._log = logging.getLogger("ChangeFeed")
+        self._stats: Dict[str, Any] = {"polls": 0, "events": 0, "movements": 0, "cells": 0, "cleared": 0,
+                                       "errors": 0, "subscriber_errors": 0, "last_ms": None, "last_error": None,
+                                       "disabled": None}
+
+    async def check_schema(self) -> List[str]:
+        """Indici di change_feed.sql che mancano sul database."""
+        return await missing_objects(self.db, indexes=INDICI)
+
+    # ---------- sottoscrizioni (qualsiasi thread) ----------
+    def subscribe(self, fn: Callable[[Delta], None]) -> Callable[[], None]:
+        """fn(delta) a ogni evento, sul thread del loop; ritorna la funzione che annulla la sottoscrizione."""
+        with self._subs_lock:
+            self._subs = self._subs + (fn,)
+
+        def _unsubscribe():
+            with self._subs_lock:
+                self._subs = tuple(f for f in self._subs if f is not fn)
+        return _unsubscribe
+
+    def publish(self, delta: Delta) -> None:
+        """Consegna delta a tutti i sottoscrittori; l'errore di uno non ferma gli altri."""
+        s = self._stats
+        s["events"] += 1
+        for fn in self._subs:
+            try:
+                fn(delta)
+            except Exception as ex:
+                s["subscriber_errors"] += 1
+                self._log.warning("sottoscrittore del feed: %s: %s", type(ex).__name__, ex)
+
+    def svuotata(self, corsia: str, generazione: Optional[int] = None) -> None:
+        """Pubblica il reset di una corsia fatto da questo client; la sua generazione non si ripubblica al poll."""
+        key = norm_corsia(corsia)
+        if self._svuotate is not None and generazione == self._svuotate.get(key, 0) + 1:
+            self._svuotate[key] = generazione
+        self._stats["cleared"] += 1
+        self.publish(Delta(svuotate=(corsia,)))
+
+    # ---------- poll ----------
+    async def poll(self) -> Dict[str, Any]:
+        """Pubblica le modifiche oltre l'ultima versione vista e i reset di altri client; "more": ne restano."""
+        t0 = time.perf_counter()
+        if self._rv["movimenti"] is None and not await missing_objects(self.db, OGGETTI[1:2]):
+            self._svuotate = {}
+        stmts = [(SQL_ROWVERSION[self._dialect], None)]
+        if self._svuotate is not None:
+            stmts.append((SQL_SVUOTATE, None))
+        res = await self.db.query_batch(stmts)
+        rows = res[0]["rows"]
+        hi = int(rows[0][0] or 0) if rows else 0
+        gen = svuotate(res[1]["rows"]) if len(res) > 1 else {}
+        if self._rv["movimenti"] is None:
+            self._rv = {"movimenti": hi, "celle": hi}
+            if self._svuotate is not None:
+                self._svuotate = gen
+            return {"movements": 0, "cells": 0, "cleared": 0, "version": hi, "more": False, "ms": 0.0}
+        corsie = tuple(sorted(c for c, g in gen.items() if self._svuotate.get(c) != g))
+        if corsie:
+            self._svuotate.update(gen)
+        more = False
+        letti: Dict[str, tuple] = {}
+        for name, sql, tipo in (("movimenti", SQL_MOVIMENTI, Movimento), ("celle", SQL_CELLE, StatoCella)):
+            rv = self._rv[name]
+            rows = []
+            if rv < hi:
+                rows = (await self.db.query_json(sql[self._dialect],
+                                                 {"n": self.batch_rows, "rv": rv, "hi": hi}))["rows"]
+            letti[name] = tuple(tipo(*r) for r in rows)
+            # blocco pieno: si riparte dall'ultima riga letta, altrimenti tutto fino a hi è stato visto
+            if len(rows) >= self.batch_rows:
+                self._rv[name] = letti[name][-1].Versione
+                more = True
+            else:
+                self._rv[name] = hi
+        movimenti = letti["movimenti"]
+        celle = tuple(c._replace(Cancellata=bool(c.Cancellata)) for c in letti["celle"])
+        if (movimenti or corsie) and self.before_publish is not None:
+            await self.before_publish()
+        if movimenti or celle or corsie:
+            self.publish(Delta(movimenti, celle, corsie))
+        ms = round((time.perf_counter() - t0) * 1000, 3)
+        s = self._stats
+        s.update(polls=s["polls"] + 1, movements=s["movements"] + len(movimenti), cells=s["cells"] + len(celle),
+                 cleared=s["cleared"] + len(corsie), last_ms=ms)
+        return {"movements": len(movimenti), "cells": len(celle), "cleared": len(corsie), "version": hi,
+                "more": more, "ms": ms}
+
+    async def run(self, every_s: float, *, gate: Optional[Callable[[Awaitable[Any]], Awaitable[Any]]] = None) -> None:
+        """poll() ogni every_s (subito se un blocco era pieno); ogni giro passa da gate()."""
+        gate = gate or (lambda c: c)
+        try:
+            missing = await gate(self.check_schema())
+        except asyncio.CancelledError:
+            raise
+        except Exception as ex:
+            missing = None
+            self._error(ex)
+        if missing:
+            self._stats["disabled"] = f"mancano {', '.join(missing)}: eseguire change_feed.sql"
+            self._log.warning("feed modifiche: %s", self._stats["disabled"])
+            return
+        while True:
+            more = False
+            try:
+                more = (await gate(self.poll())).get("more", False)
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                self._error(ex)
+            if not more:
+                await asyncio.sleep(every_s)
+
+    def _error(self, ex: BaseException) -> None:
+        self._stats["errors"] += 1
+        self._stats["last_error"] = f"{type(ex).__name__}: {ex}"
+        self._log.warning("feed modifiche: %s", self._stats["last_error"])
+
+    @property
+    def _dialect(self) -> str:
+        return "sqlite" if self.db.backend == "sqlite" else "mssql"
+
+    def stats(self) -> Dict[str, Any]:
+        return dict(self._stats, subscribers=len(self._subs), versions=dict(self._rv))
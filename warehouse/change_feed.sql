@@ -0,0 +1,26 @@
+-- change_feed.sql — indici su VersioneDati (rowversion) per il feed delle modifiche (change_feed.py)
+--
+-- Il feed legge ogni pochi secondi le righe con VersioneDati oltre l'ultima versione vista: senza questi
+-- indici ogni giro sarebbe una scansione di tutta MagazziniPallet. VersioneDati la scrive il server a ogni
+-- INSERT/UPDATE; i DELETE non lasciano traccia (li pubblica l'app che li fa, vedi reset_corsie.py).
+--
+-- Passo di deploy, con il permesso DDL: sqlcmd -i change_feed.sql, SSMS o python sql_scripts.py <dsn>
+-- (la creazione degli indici su tabelle grandi va pianificata dal DBA). I client non lo eseguono:
+-- ChangeFeed.check_schema controlla che gli indici ci siano e, finché mancano, il feed resta spento.
+-- Idempotente: si può rieseguire.
+USE [Mediseawall]
+GO
+IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = N'IX_MagazziniPallet_VersioneDati'
+               AND object_id = OBJECT_ID(N'[dbo].[MagazziniPallet]'))
+CREATE NONCLUSTERED INDEX [IX_MagazziniPallet_VersioneDati] ON [dbo].[MagazziniPallet]
+(
+	[VersioneDati] ASC
+)
+GO
+IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = N'IX_Celle_VersioneDati'
+               AND object_id = OBJECT_ID(N'[dbo].[Celle]'))
+CREATE NONCLUSTERED INDEX [IX_Celle_VersioneDati] ON [dbo].[Celle]
+(
+	[VersioneDati] ASC
+)
+GO
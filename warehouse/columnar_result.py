@@ -0,0 +1,180 @@
+# columnar_result.py — risultato per colonne (array tipizzati) con viste per riga compatibili
+from __future__ import annotations
+
+import sys
+from array import array
+from collections.abc import Mapping, Sequence
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+# tipo python -> (dtype, typecode array). bool va prima di int (bool è sottoclasse di int)
+_TYPED = {bool: ("bool", "b"), int: ("int64", "q"), float: ("float64", "d")}
+_INT64_MIN, _INT64_MAX = -(2 ** 63), 2 ** 63 - 1
+
+
+def _dtype_of(values: List[Any]) -> tuple[str, Optional[str]]:
+    """Ritorna (dtype, typecode) per una colonna; typecode None = resta lista python."""
+    kinds = {type(v) for v in values if v is not None}
+    has_null = len(kinds) == 0 or any(v is None for v in values)
+    if len(kinds) != 1:
+        return ("null" if not kinds else "object"), None
+    kind = kinds.pop()
+    if kind in _TYPED:
+        dtype, code = _TYPED[kind]
+        if has_null:
+            return dtype, None  # NULL non rappresentabile in un array tipizzato
+        if kind is int and not all(_INT64_MIN <= v <= _INT64_MAX for v in values):
+            return "object", None
+        return dtype, code
+    return {str: "str", bytes: "bytes"}.get(kind, kind.__name__), None
+
+
+class ColumnarBuilder:
+    """Accumula blocchi di righe (es. da fetchmany) direttamente per colonna."""
+    def __init__(self, columns: Iterable[str]):
+        self.columns = list(columns)
+        self._cols: List[List[Any]] = [[] for _ in self.columns]
+        # stringhe ripetute (Corsia, Lotto, ...) condivise: una sola allocazione per valore
+        self._interned: List[Dict[str, str]] = [{} for _ in self.columns]
+
+    def extend(self, rows: Iterable[Sequence[Any]]) -> None:
+        rows = list(rows)
+        if not rows:
+            return
+        for j, values in enumerate(zip(*rows)):
+            col = self._cols[j]
+            pool = self._interned[j]
+            for v in values:
+                if type(v) is str:
+                    v = pool.setdefault(v, v)
+                col.append(v)
+
+    def finish(self) -> "ColumnarResult":
+        data: List[Any] = []
+        dtypes: List[str] = []
+        for col in self._cols:
+            dtype, code = _dtype_of(col)
+            dtypes.append(dtype)
+            data.append(array(code, col) if code else col)
+        self._cols = []
+        self._interned = []
+        return ColumnarResult(self.columns, dtypes, data)
+
+
+class ColumnarResult:
+    """
+    Una colonna per campo (array.array per int/float/bool senza NULL, lista altrimenti),
+    più nomi colonna e dtypes. rows/dicts() sono viste leggere in sola lettura: nessuna copia per riga.
+    """
+    __slots__ = ("columns", "dtypes", "data", "_index", "_len")
+
+    def __init__(self, columns: List[str], dtypes: List[str], data: List[Any]):
+        self.columns = list(columns)
+        self.dtypes = list(dtypes)
+        self.data = data
+        self._index = {c: i for i, c in enumerate(self.columns)}
+        self._len = len(data[0]) if data else 0
+
+    @classmethod
+    def from_rows(cls, columns: Iterable[str], rows: Iterable[Sequence[Any]]) -> "ColumnarResult":
+        b = ColumnarBuilder(columns)
+        b.extend(rows)
+        return b.finish()
+
+    def __len__(self) -> int:
+        return self._len
+
+    def column(self, name: str):
+        return self.data[self._index[name]]
+
+    @property
+    def rows(self) -> "RowsView":
+        return RowsView(self)
+
+    def dicts(self) -> "DictRowsView":
+        return DictRowsView(self)
+
+    def nbytes(self) -> int:
+        """Stima della memoria occupata (contenitori + valori distinti)."""
+        total = 0
+        for col in self.data:
+            total += sys.getsizeof(col)
+            if not isinstance(col, array):
+                total += sum(sys.getsizeof(v) for v in {id(v): v for v in col}.values())
+        return total
+
+
+class RowsView(Sequence):
+    """Vista per riga come tuple (compatibile con rows=list di liste in lettura)."""
+    __slots__ = ("_res",)
+
+    def __init__(self, res: ColumnarResult):
+        self._res = res
+
+    def __len__(self) -> int:
+        return len(self._res)
+
+    def __getitem__(self, i):
+        data = self._res.data
+        if isinstance(i, slice):
+            return [tuple(col[k] for col in data) for k in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return tuple(col[i] for col in data)
+
+    def __iter__(self) -> Iterator[tuple]:
+        return zip(*self._res.data)
+
+
+class RowView(Mapping):
+    """Riga come mapping colonna->valore senza creare un dict; sola lettura (dict(row) per modificarla)."""
+    __slots__ = ("_res", "_i")
+
+    def __init__(self, res: ColumnarResult, i: int):
+        self._res = res
+        self._i = i
+
+    def __getitem__(self, key: str) -> Any:
+        res = self._res
+        return res.data[res._index[key]][self._i]
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        # il risultato è condiviso (cache delle query, single-flight): una modifica lo cambierebbe per tutti
+        raise TypeError("RowView è in sola lettura: usare dict(row)")
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._res.columns)
+
+    def __len__(self) -> int:
+        return len(self._res.columns)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._res._index
+
+    def __repr__(self) -> str:
+        return f"RowView({dict(self)!r})"
+
+
+class DictRowsView(Sequence):
+    """Vista per riga come mapping (compatibile con as_dict_rows=True in lettura)."""
+    __slots__ = ("_res",)
+
+    def __init__(self, res: ColumnarResult):
+        self._res = res
+
+    def __len__(self) -> int:
+        return len(self._res)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [RowView(self._res, k) for k in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return RowView(self._res, i)
+
+    def __iter__(self) -> Iterator[RowView]:
+        res = self._res
+        return (RowView(res, i) for i in range(len(res)))
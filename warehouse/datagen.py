@@ -0,0 +1,411 @@
+# datagen.py — dati sintetici del magazzino (riproducibili da seed) per il backend SQLite e per BULK INSERT
+#
+#   python datagen.py --scale dev --sqlite dev/warehouse.sqlite3
+#   python datagen.py --scale stress --cells 50000 --movements 5000000 --bulk out/stress
+from __future__ import annotations
+
+import argparse
+import asyncio
+import heapq
+import json
+import os
+import random
+import string
+import time
+from array import array
+from dataclasses import asdict, dataclass, replace
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from sqlite_backend import AsyncSQLiteClient, table_columns
+from stock_snapshot import StockSnapshot
+from traccia_prodotti import TracciaProdotti
+
+
+@dataclass(frozen=True)
+class Scale:
+    """Manopole del generatore; movements = righe di MagazziniPallet (V + P)."""
+    cells: int = 500
+    movements: int = 10_000
+    years: float = 3.0
+    occupancy: float = 0.75     # frazione di celle occupate oggi
+    double_rate: float = 0.02   # pallet allocati in una cella già occupata (celle doppie)
+    dup_rate: float = 0.01      # stessa UDC allocata due volte nella stessa cella (V ripetuta)
+    ghost_rate: float = 0.005   # UDC allocata in un'altra cella senza prelievo (UDC fantasma)
+    ship_rate: float = 0.3      # pallet prelevati che finiscono nelle celle spedite (7G)
+    products: int = 300
+    lots_per_pallet: float = 1.1
+    documents: int = 40         # bolle aperte dietro XMag_ViewPackingList
+    lines_per_document: int = 25
+    missing_rate: float = 0.05  # righe di bolla con UDC non a magazzino (Cella 1000 nella vista)
+    columns: int = 20           # colonne per corsia
+    levels: int = 5             # file per colonna
+
+
+SCALES: Dict[str, Scale] = {
+    "dev": Scale(),
+    "prod": Scale(cells=6_000, movements=1_500_000, products=2_000, documents=120),
+    "stress": Scale(cells=100_000, movements=20_000_000, years=8, products=10_000, documents=1_000),
+}
+
+NAZIONI = (("IT", "ITALIA"), ("DE", "GERMANIA"), ("TH", "THAILANDIA"), ("MEX", "MESSICO"),
+           ("FR", "FRANCIA"), ("ES", "SPAGNA"))
+UTENTI = ("magazzino", "raf", "MAG1", "MAG2")
+CORSIA_SPEDITI = "7G"
+CELLA_NON_SCAFFALATO = 9999
+IDMAGAZZINO = 1
+
+_B36 = string.digits + string.ascii_uppercase
+
+# colonne scritte dal generatore (le altre restano NULL / DEFAULT; VersioneDati la scrive il server)
+COLUMNS: Dict[str, Tuple[str, ...]] = {
+    "Aree": ("ID", "IDMagazzino", "Descrizione", "InsUtente", "InsDataOra"),
+    "Celle": ("ID", "Descrizione", "IDArea", "IDStato", "Ordinamento", "X", "Y", "Z",
+              "Corsia", "Colonna", "Fila", "InsUtente", "InsDataOra"),
+    "MagazziniPallet": ("ID", "Tipo", "IDRiferimento", "Attributo", "NumeroPallet", "IDMagazzino", "IDArea",
+                        "IDCella", "DataMagazzino", "PesoUnitario", "Tara", "InsUtente", "InsDataOra"),
+    "ARTICO": ("ID", "CODICE", "DESCR"),
+    "LOTSER": ("ID", "NUMSER", "NUMLOT", "IDARTICO"),
+    "vPreparaPackingListSAMA1": ("NUMLOT", "CODICE", "DESCR", "UDC", "Qta", "NUMDOC", "DATDOC", "ID",
+                                 "DESCRDEST", "Expr1", "NAZIONE", "IDMTRASP"),
+}
+# tabelle di Mediseawall (le altre sono stub del database SAMA1)
+WAREHOUSE_TABLES = ("Aree", "Celle", "MagazziniPallet")
+
+
+def barcode(n: int) -> str:
+    """UDC di 6 caratteri (base 36): è anche LEFT(NUMSER, 6) in vXTracciaProdotti."""
+    out = []
+    for _ in range(6):
+        n, r = divmod(n, 36)
+        out.append(_B36[r])
+    return "".join(reversed(out))
+
+
+def _ts(d: datetime) -> str:
+    return d.strftime("%Y-%m-%d %H:%M:%S")
+
+
+class WarehouseGenerator:
+    """
+    Stessi seed e scala → stessi dati. Le righe escono come iteratori di tuple (ordine di COLUMNS):
+        gen = WarehouseGenerator(SCALES["prod"], seed=7)
+        gen.aree(); gen.celle(); gen.movements()      # poi, a movimenti consumati:
+        gen.articoli(); gen.lotser(); gen.packing_list()
+    I movimenti sono in ordine di tempo (ID crescente con DataMagazzino): ogni pallet entra con
+    una V in una cella libera e, se la sua permanenza finisce prima di oggi, esce con una P
+    (e magari una V nelle celle 7G). In memoria restano solo i pallet a magazzino.
+    """
+    def __init__(self, scale: Scale = SCALES["dev"], *, seed: int = 1, now: Optional[datetime] = None):
+        self.scale = scale
+        self.seed = seed
+        self.now = (now or datetime(2025, 9, 17, 12, 0, 0)).replace(microsecond=0)
+        self.start = self.now - timedelta(days=365 * scale.years)
+        self._cells: List[Tuple[int, int, str]] = []     # (ID, IDArea, Corsia) scaffalate
+        self._shipped: List[Tuple[int, int]] = []        # celle 7G (ID, IDArea)
+        self._pallets = 0
+        self._arrival = array("I")      # giorno d'arrivo per pallet (lotti in LOTSER)
+        self._product = array("I")
+        self._stock: List[Tuple[str, int]] = []          # (barcode, IDCella) ancora a magazzino
+        self._done = False
+
+    def _rng(self, stream: str) -> random.Random:
+        # un generatore per tabella: cambiare una tabella non sposta i numeri delle altre
+        return random.Random(f"{self.seed}:{stream}")
+
+    # ---------- anagrafiche ----------
+    def _corsie(self) -> List[str]:
+        s = self.scale
+        per_corsia = max(1, s.columns * s.levels)
+        n = max(1, -(-s.cells // per_corsia))
+        names: List[str] = []
+        i = 0
+        while len(names) < n:
+            name = f"{i // 8 + 1}{'ABCDEFGH'[i % 8]}"
+            i += 1
+            if name != CORSIA_SPEDITI:
+                names.append(name)
+        return names
+
+    def aree(self) -> Iterator[Tuple[Any, ...]]:
+        ts = _ts(self.start)
+        yield (1, IDMAGAZZINO, "SCAFFALATO", "magazzino", ts)
+        yield (2, IDMAGAZZINO, "SPEDIZIONE", "magazzino", ts)
+        yield (5, IDMAGAZZINO, "NON SCAFFALATO", "magazzino", ts)
+
+    def celle(self) -> Iterator[Tuple[Any, ...]]:
+        s = self.scale
+        ts = _ts(self.start)
+        self._cells, self._shipped = [], []
+        cid = 0
+        order = 0
+        for x, corsia in enumerate(self._corsie(), start=1):
+            for col in range(1, s.columns + 1):
+                for lev in range(1, s.levels + 1):
+                    if len(self._cells) >= s.cells:
+                        break
+                    cid += 1
+                    if cid == CELLA_NON_SCAFFALATO:
+                        cid += 1
+                    order += 1
+                    self._cells.append((cid, 1, corsia))
+                    yield (cid, f"{corsia}.{col}.{lev}", 1, 0, float(order), x, col, lev,
+                           corsia, str(col), str(lev), "magazzino", ts)
+        for col in range(1, 11):    # 7G: celle delle spedizioni
+            cid += 1
+            if cid == CELLA_NON_SCAFFALATO:
+                cid += 1
+            self._shipped.append((cid, 2))
+            yield (cid, f"{CORSIA_SPEDITI}.{col:02d}.01", 2, 0, 99000.0 + col, 0, col, 1,
+                   CORSIA_SPEDITI, f"{col:02d}", "01", "magazzino", ts)
+        yield (CELLA_NON_SCAFFALATO, "NON SCAFFALATO", 5, 0, 99999.0, 0, 0, 0, "NS", "0", "0", "magazzino", ts)
+
+    # ---------- movimenti ----------
+    def movements(self) -> Iterator[Tuple[Any, ...]]:
+        if not self._cells:
+            for _ in self.celle():
+                pass
+        s = self.scale
+        rng = self._rng("movements")
+        span_days = 365.0 * s.years
+        live_target = max(1, int(len(self._cells) * s.occupancy))
+        # righe per pallet uscito ≈ V + P (+ V in 7G); quelli a magazzino ne hanno una
+        per_out = 2 + s.ship_rate + s.dup_rate + s.ghost_rate
+        n_pallets = max(live_target, int((s.movements - live_target) / per_out) + live_target)
+        rate = n_pallets / span_days                     # arrivi al giorno
+        dwell = live_target / rate                       # permanenza media (giorni), Little: L = λ·W
+        free = list(self._cells)
+        rng.shuffle(free)
+        occupied: Dict[int, int] = {}                    # IDCella → pallet presenti (celle doppie)
+        by_id = {c[0]: c for c in self._cells}
+        out_heap: List[Tuple[float, int, str, int, int, float, str]] = []
+        self._arrival = array("I")
+        self._product = array("I")
+        self._stock = []
+        mid = 0
+        t = 0.0
+        now_days = span_days
+
+        # strftime per riga costa quanto il resto del generatore: date precalcolate, ora composta a mano
+        days = [f"{self.start + timedelta(days=d):%Y-%m-%d}" for d in range(int(span_days) + 2)]
+        base_s = self.start.hour * 3600 + self.start.minute * 60 + self.start.second
+
+        def _row(tipo, udc, cell_id, area, day, peso, user):
+            nonlocal mid
+            mid += 1
+            d, sec = divmod(base_s + int(day * 86400), 86400)
+            h, sec = divmod(sec, 3600)
+            ts = f"{days[d]} {h:02d}:{sec // 60:02d}:{sec % 60:02d}"
+            return (mid, tipo, None, udc, 1, IDMAGAZZINO, area, cell_id, ts, peso, 20.0, user, ts)
+
+        def _release(until: float):
+            while out_heap and out_heap[0][0] <= until:
+                day, _n, udc, cell_id, area, peso, user = heapq.heappop(out_heap)
+                yield _row("P", udc, cell_id, area, day, peso, user)
+                left = occupied.get(cell_id, 0) - 1
+                if left > 0:
+                    occupied[cell_id] = left
+                elif occupied.pop(cell_id, None) is not None:
+                    free.append(by_id[cell_id])
+                if rng.random() < s.ship_rate:
+                    sc = self._shipped[rng.randrange(len(self._shipped))]
+                    yield _row("V", udc, sc[0], sc[1], day + rng.random() * 0.5, peso, user)
+
+        for n in range(n_pallets):
+            t += rng.expovariate(rate)
+            if t >= now_days:
+                break
+            yield from _release(t)
+            udc = barcode(n + 36 ** 5)     # prima cifra ≠ 0: codici a 6 caratteri pieni
+            self._arrival.append(int(t))
+            self._product.append(rng.randrange(s.products))
+            user = UTENTI[rng.randrange(len(UTENTI))]
+            peso = round(rng.uniform(200.0, 900.0), 1)
+            if free and rng.random() >= s.double_rate:
+                cell = free.pop(rng.randrange(len(free)))
+            else:
+                cell = self._cells[rng.randrange(len(self._cells))]   # cella già occupata: doppia
+            occupied[cell[0]] = occupied.get(cell[0], 0) + 1
+            yield _row("V", udc, cell[0], cell[1], t, peso, user)
+            if rng.random() < s.dup_rate:          # seconda lettura della stessa UDC, stessa cella
+                yield _row("V", udc, cell[0], cell[1], t + 0.001, peso, user)
+            if rng.random() < s.ghost_rate:        # spostata senza prelievo: resta in due celle
+                other = self._cells[rng.randrange(len(self._cells))]
+                yield _row("V", udc, other[0], other[1], t + 0.01, peso, user)
+                self._stock.append((udc, other[0]))
+            out = t + rng.expovariate(1.0 / dwell)
+            if out < now_days:
+                heapq.heappush(out_heap, (out, n, udc, cell[0], cell[1], peso, user))
+            else:
+                self._stock.append((udc, cell[0]))
+        self._pallets = len(self._arrival)
+        yield from _release(now_days)
+        self._done = True
+
+    # ---------- SAMA1: tracciabilità e bolle ----------
+    def _need_movements(self) -> None:
+        if not self._done:
+            raise RuntimeError("WarehouseGenerator: consumare prima movements()")
+
+    def _product_row(self, i: int) -> Tuple[str, str]:
+        return f"A{i:05d}", f"PRODOTTO {i:05d} {('KG', 'PZ', 'CT')[i % 3]}"
+
+    def articoli(self) -> Iterator[Tuple[Any, ...]]:
+        for i in range(self.scale.products):
+            yield (i + 1,) + self._product_row(i)
+
+    def lotser(self) -> Iterator[Tuple[Any, ...]]:
+        """Un lotto (a volte di più) per pallet; NUMLOT 'P…' come quelli che vXTracciaProdotti tiene."""
+        self._need_movements()
+        rng = self._rng("lotser")
+        extra = max(0.0, self.scale.lots_per_pallet - 1.0)
+        lid = 0
+        for n in range(self._pallets):
+            udc = barcode(n + 36 ** 5)
+            day = self.start + timedelta(days=self._arrival[n])
+            prod = self._product[n]
+            for k in range(1 + (rng.random() < extra)):
+                lid += 1
+                yield (lid, f"{udc}{k + 1:02d}", f"P{day:%y%m%d}{(prod + k) % 1000:03d}", prod + 1)
+
+    def packing_list(self) -> Iterator[Tuple[Any, ...]]:
+        """Righe di bolla aperte (vPreparaPackingListSAMA1): UDC a magazzino, qualcuna già sparita."""
+        self._need_movements()
+        s = self.scale
+        rng = self._rng("packing")
+        shipped = {c for c, _a in self._shipped}
+        stock = [b for b, cell in self._stock if cell not in shipped]
+        for d in range(s.documents):
+            numdoc = 250000 + d
+            naz, naz_descr = NAZIONI[rng.randrange(len(NAZIONI))]
+            dest = ("NA ", "BK ", "XX ")[rng.randrange(3)] + f"DESTINATARIO {d}"
+            datdoc = _ts(self.now - timedelta(days=rng.randrange(10)))
+            for _ in range(max(1, int(rng.gauss(s.lines_per_document, s.lines_per_document / 4)))):
+                if stock and rng.random() >= s.missing_rate:
+                    udc = stock[rng.randrange(len(stock))]
+                else:
+                    udc = barcode(rng.randrange(36 ** 5, 36 ** 6))
+                prod = rng.randrange(s.products)
+                codice, descr = self._product_row(prod)
+                yield (f"P{self.now:%y%m%d}{prod % 1000:03d}", codice, descr, udc,
+                       float(rng.randrange(1, 60)), numdoc, datdoc, 90000 + d, dest, naz,
+                       f"CAMION  {naz_descr}", 1)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"scale": asdict(self.scale), "seed": self.seed, "pallets": self._pallets,
+                "in_stock": len(self._stock), "cells": len(self._cells) + len(self._shipped) + 1}
+
+    def tables(self) -> List[Tuple[str, Callable[[], Iterator[Tuple[Any, ...]]]]]:
+        """(tabella, sorgente) nell'ordine di scrittura (lotser/packing_list dopo i movimenti)."""
+        return [("Aree", self.aree), ("Celle", self.celle), ("MagazziniPallet", self.movements),
+                ("ARTICO", self.articoli), ("LOTSER", self.lotser),
+                ("vPreparaPackingListSAMA1", self.packing_list)]
+
+
+# ---------------- scrittura ----------------
+async def load_sqlite(db: AsyncSQLiteClient, gen: WarehouseGenerator, *, chunk_rows: int = 50_000,
+                      progress: Optional[Callable[[str, int, float], None]] = None) -> Dict[str, Any]:
+    """
+    Schema da zero e righe via bulk_insert, poi lo snapshot della giacenza e la copia di vXTracciaProdotti;
+    ritorna righe e righe/s per tabella.
+    """
+    await db.create_schema(drop=True)
+    out: Dict[str, Any] = {}
+    for table, source in gen.tables():
+        t0 = time.perf_counter()
+        n = await db.bulk_insert(table, COLUMNS[table], source(), chunk_rows=chunk_rows)
+        s = time.perf_counter() - t0
+        out[table] = {"rows": n, "seconds": round(s, 3), "rows_per_s": round(n / s) if s > 0 else None}
+        if progress is not None:
+            progress(table, n, s)
+    out["stock"] = await StockSnapshot(db).rebuild()     # giacenza materializzata fino all'ultimo movimento
+    out["traccia"] = await TracciaProdotti(db).rebuild()  # tracciabilità SAMA1 fino all'ultimo LOTSER
+    async with db.transaction() as tx:
+        await tx.exec("ANALYZE")      # statistiche per il planner, come dopo un caricamento sul server
+    out["generator"] = gen.stats()
+    return out
+
+
+def _bcp_value(v: Any) -> str:
+    if v is None:
+        return ""       # campo vuoto + KEEPNULLS → NULL
+    if isinstance(v, float):
+        return repr(v)
+    s = str(v)
+    if len(s) == 19 and s[4] == "-" and s[10] == " ":
+        s = s.replace(" ", "T")     # ISO 8601: indipendente da SET DATEFORMAT/lingua
+    return s.replace("\t", " ").replace("\n", " ")
+
+
+def write_bulk_files(gen: WarehouseGenerator, out_dir: str, *, tables: Sequence[str] = WAREHOUSE_TABLES,
+                     database: str = "Mediseawall") -> str:
+    """
+    Un file .tsv (UTF-8) e un format file .fmt per tabella più load.sql con i BULK INSERT:
+    il format file mappa i campi sulle colonne del server (VersioneDati e le altre restano escluse).
+    I percorsi in load.sql sono quelli di out_dir: vanno visti dal servizio SQL Server.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    lines = [f"USE [{database}];", "SET NOCOUNT ON;"]
+    for table, source in gen.tables():
+        if table not in tables:
+            continue
+        cols = COLUMNS[table]
+        order = {c: i for i, (c, _t) in enumerate(table_columns(table), start=1)}
+        data_path = os.path.abspath(os.path.join(out_dir, f"{table}.tsv"))
+        fmt_path = os.path.abspath(os.path.join(out_dir, f"{table}.fmt"))
+        n = 0
+        with open(data_path, "w", encoding="utf-8", newline="\n") as f:
+            for row in source():
+                f.write("\t".join(_bcp_value(v) for v in row) + "\n")
+                n += 1
+        with open(fmt_path, "w", encoding="ascii", newline="\r\n") as f:
+            f.write("14.0\n")
+            f.write(f"{len(cols)}\n")
+            for i, c in enumerate(cols, start=1):
+                term = r"\n" if i == len(cols) else r"\t"
+                f.write(f'{i}\tSQLCHAR\t0\t0\t"{term}"\t{order[c]}\t{c}\t""\n')
+        lines.append(f"-- {table}: {n} righe")
+        lines.append(f"BULK INSERT dbo.{table} FROM '{data_path}'\n"
+                     f"  WITH (FORMATFILE = '{fmt_path}', CODEPAGE = '65001', KEEPIDENTITY, KEEPNULLS, "
+                     f"TABLOCK, BATCHSIZE = 100000);")
+    path = os.path.join(out_dir, "load.sql")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    return path
+
+
+def main(argv: Optional[Sequence[str]] = None) -> Dict[str, Any]:
+    ap = argparse.ArgumentParser(description="Dati sintetici del magazzino")
+    ap.add_argument("--scale", choices=sorted(SCALES), default="dev")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--cells", type=int)
+    ap.add_argument("--movements", type=int)
+    ap.add_argument("--sqlite", help="file SQLite da (ri)creare")
+    ap.add_argument("--bulk", help="cartella per .tsv/.fmt/load.sql (SQL Server)")
+    args = ap.parse_args(argv)
+    scale = SCALES[args.scale]
+    if args.cells:
+        scale = replace(scale, cells=args.cells)
+    if args.movements:
+        scale = replace(scale, movements=args.movements)
+    out: Dict[str, Any] = {}
+    if args.sqlite:
+        db = AsyncSQLiteClient(args.sqlite, log=False)
+
+        async def _load():
+            try:
+                return await load_sqlite(db, WarehouseGenerator(scale, seed=args.seed))
+            finally:
+                await db.dispose()
+        out["sqlite"] = asyncio.run(_load())
+    if args.bulk:
+        gen = WarehouseGenerator(scale, seed=args.seed)
+        out["bulk"] = write_bulk_files(gen, args.bulk)
+        out["bulk_generator"] = gen.stats()
+    if not out:
+        ap.error("serve --sqlite e/o --bulk")
+    return out
+
+
+if __name__ == "__main__":
+    print(json.dumps(main(), indent=2))
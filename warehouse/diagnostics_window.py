@@ -0,0 +1,201 @@
+# diagnostics_window.py — metriche live del runtime: query per nome, pool, scheduler, cache, ponte Tk
+from __future__ import annotations
+
+import tkinter as tk
+from tkinter import ttk, messagebox, filedialog
+from datetime import datetime
+from typing import Any, Dict, Iterator, Tuple
+
+from gestione_aree_frame_async import TkBridge
+from runtime import RUNTIME
+
+REFRESH_MS = 1000
+
+QUERY_COLS = (
+    # (chiave, intestazione, larghezza, allineamento)
+    ("count", "N", 60, "e"),
+    ("cached", "Cache", 60, "e"),
+    ("errors", "Errori", 60, "e"),
+    ("cancelled", "Annull.", 60, "e"),
+    ("slow", "Lente", 60, "e"),
+    ("p50", "p50 ms", 80, "e"),
+    ("p95", "p95 ms", 80, "e"),
+    ("p99", "p99 ms", 80, "e"),
+    ("max", "max ms", 80, "e"),
+    ("rows_avg", "Righe/q", 80, "e"),
+    ("kb", "KB tot", 80, "e"),
+    ("connect_p95", "Conn p95", 80, "e"),
+)
+
+# sezioni della snapshot mostrate come chiave/valore (queries ha la sua tabella)
+RUNTIME_SECTIONS = ("counters", "gauges", "histograms", "scheduler", "pool", "cache", "singleflight", "tk_bridge",
+                    "slow_log", "trace", "stock", "traccia", "occupancy", "search", "feed")
+
+
+def _flatten(prefix: str, obj: Any) -> Iterator[Tuple[str, Any]]:
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            yield from _flatten(f"{prefix}.{k}" if prefix else str(k), v)
+    elif not isinstance(obj, (list, tuple)):
+        yield prefix, obj
+
+
+class DiagnosticsWindow(tk.Toplevel):
+    """Legge RUNTIME.metrics ogni secondo (la snapshot si fa sul thread del loop) ed esporta in JSON."""
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.title("Diagnostica — query e runtime")
+        self.geometry("1200x720")
+        self.minsize(900, 500)
+
+        self._bridge = TkBridge.for_widget(self)
+        self._auto = tk.BooleanVar(value=True)
+        self._after_id = None
+        self._pending = False
+
+        self._build_ui()
+        self.protocol("WM_DELETE_WINDOW", self._on_close)
+        self._tick()
+
+    # ---------- UI ----------
+    def _build_ui(self):
+        top = ttk.Frame(self); top.pack(fill="x", padx=8, pady=8)
+        ttk.Checkbutton(top, text="Aggiorna ogni secondo", variable=self._auto, command=self._tick).pack(side="left")
+        ttk.Button(top, text="Aggiorna", command=self.refresh).pack(side="left", padx=(10, 0))
+        ttk.Button(top, text="Azzera query", command=self._reset_queries).pack(side="left", padx=(6, 0))
+        ttk.Button(top, text="Esporta JSON…", command=self._export).pack(side="right")
+        self.lbl = ttk.Label(top, text="")
+        self.lbl.pack(side="right", padx=10)
+
+        pan = ttk.Panedwindow(self, orient="vertical")
+        pan.pack(fill="both", expand=True, padx=8, pady=(0, 8))
+
+        qf = ttk.LabelFrame(pan, text="Query per nome")
+        qf.grid_rowconfigure(0, weight=1); qf.grid_columnconfigure(0, weight=1)
+        self.qtree = ttk.Treeview(qf, columns=[k for k, *_ in QUERY_COLS], show="tree headings")
+        self.qtree.heading("#0", text="Query"); self.qtree.column("#0", width=300, anchor="w")
+        for k, t, w, a in QUERY_COLS:
+            self.qtree.heading(k, text=t); self.qtree.column(k, width=w, anchor=a, stretch=False)
+        y = ttk.Scrollbar(qf, orient="vertical", command=self.qtree.yview)
+        self.qtree.configure(yscrollcommand=y.set)
+        self.qtree.grid(row=0, column=0, sticky="nsew"); y.grid(row=0, column=1, sticky="ns")
+        self.qtree.bind("<<TreeviewSelect>>", self._on_select)
+        self.sql_lbl = ttk.Label(qf, text="", foreground="#555", wraplength=1100, justify="left")
+        self.sql_lbl.grid(row=1, column=0, columnspan=2, sticky="ew", pady=(4, 0))
+        pan.add(qf, weight=3)
+
+        rf = ttk.LabelFrame(pan, text="Runtime")
+        rf.grid_rowconfigure(0, weight=1); rf.grid_columnconfigure(0, weight=1)
+        self.rtree = ttk.Treeview(rf, columns=("value",), show="tree headings")
+        self.rtree.heading("#0", text="Metrica"); self.rtree.column("#0", width=420, anchor="w")
+        self.rtree.heading("value", text="Valore"); self.rtree.column("value", width=300, anchor="w")
+        y2 = ttk.Scrollbar(rf, orient="vertical", command=self.rtree.yview)
+        self.rtree.configure(yscrollcommand=y2.set)
+        self.rtree.grid(row=0, column=0, sticky="nsew"); y2.grid(row=0, column=1, sticky="ns")
+        pan.add(rf, weight=2)
+
+        self._snap: Dict[str, Any] = {}
+
+    # ---------- dati ----------
+    def _tick(self):
+        if self._after_id is not None:
+            self.after_cancel(self._after_id)
+            self._after_id = None
+        if not self._auto.get():
+            return
+        self.refresh()
+        self._after_id = self.after(REFRESH_MS, self._tick)
+
+    def refresh(self):
+        if self._pending:       # snapshot precedente non ancora arrivata
+            return
+        self._pending = True
+        fut = RUNTIME.call(RUNTIME.metrics.snapshot)
+
+        def _done():
+            self._pending = False
+            if not self.winfo_exists():
+                return
+            try:
+                snap = fut.result()
+            except Exception as ex:
+                self.lbl.configure(text=f"Errore: {ex}")
+                return
+            self._fill(snap)
+
+        self._bridge.watch(fut, _done)
+
+    def _fill(self, snap: Dict[str, Any]):
+        self._snap = snap
+        queries = snap.get("queries") or {}
+        for name, q in queries.items():
+            lat, con = q["latency_ms"], q["connect_ms"]
+            vals = (q["count"], q["cached"], q["errors"], q["cancelled"], q["slow"],
+                    lat["p50"], lat["p95"], lat["p99"], lat["max"],
+                    q["rows_avg"], round(q["bytes"] / 1024, 1), con["p95"])
+            tags = ("err",) if q["errors"] else ()
+            if self.qtree.exists(name):
+                self.qtree.item(name, values=vals, tags=tags)
+            else:
+                self.qtree.insert("", "end", iid=name, text=name, values=vals, tags=tags)
+        for iid in self.qtree.get_children(""):
+            if iid not in queries:
+                self.qtree.delete(iid)
+        self.qtree.tag_configure("err", foreground="#b00020")
+
+        seen = set()
+        for section in RUNTIME_SECTIONS:
+            for key, val in _flatten(section, snap.get(section)):
+                seen.add(key)
+                if self.rtree.exists(key):
+                    self.rtree.item(key, values=(val,))
+                else:
+                    self.rtree.insert("", "end", iid=key, text=key, values=(val,))
+        for iid in self.rtree.get_children(""):
+            if iid not in seen:
+                self.rtree.delete(iid)
+        self.lbl.configure(text=f"uptime {snap.get('uptime_s', 0)} s · {datetime.now():%H:%M:%S}")
+
+    def _on_select(self, _evt=None):
+        sel = self.qtree.selection()
+        q = (self._snap.get("queries") or {}).get(sel[0]) if sel else None
+        if not q:
+            self.sql_lbl.configure(text="")
+            return
+        err = f"\nUltimo errore: {q['last_error']}" if q.get("last_error") else ""
+        self.sql_lbl.configure(text=f"{q['sql']}{err}")
+
+    def _reset_queries(self):
+        if RUNTIME.db is not None:
+            RUNTIME.call(RUNTIME.db.query_metrics.reset)
+        self.refresh()
+
+    def _export(self):
+        ts = datetime.now().strftime("%Y%m%d_%H%M%S")
+        path = filedialog.asksaveasfilename(parent=self, title="Esporta metriche",
+                                            defaultextension=".json", filetypes=[("JSON", "*.json")],
+                                            initialfile=f"metrics_{ts}.json")
+        if not path:
+            return
+        fut = RUNTIME.call(lambda: RUNTIME.metrics.dump_json(path, version=RUNTIME.app_version))
+
+        def _done():
+            try:
+                fut.result()
+            except Exception as ex:
+                messagebox.showerror("Esporta", f"Salvataggio fallito:\n{ex}", parent=self)
+            else:
+                messagebox.showinfo("Esporta", f"Metriche salvate in:\n{path}", parent=self)
+
+        self._bridge.watch(fut, _done)
+
+    def _on_close(self):
+        self._auto.set(False)
+        self._tick()
+        self.destroy()
+
+
+def open_diagnostics_window(parent):
+    win = DiagnosticsWindow(parent)
+    win.lift(); win.focus_set()
+    return win
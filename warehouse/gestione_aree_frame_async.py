@@ -2,7 +2,10 @@
 from __future__ import annotations
 
 import asyncio
-import threading
+import contextlib
+import queue
+import sys
+import time
 import tkinter as tk
 from tkinter import ttk
 from typing import Any, Callable, Optional
@@ -15,42 +18,17 @@ try:
 except Exception:
     AsyncMSSQLClient = object  # type: ignore
 
+from runtime import RUNTIME
+from scheduler import INTERACTIVE
+
 # ========================
-# Global asyncio loop
+# Global asyncio loop (del runtime)
 # ========================
-class _LoopHolder:
-    def __init__(self):
-        self.loop: Optional[asyncio.AbstractEventLoop] = None
-        self.thread: Optional[threading.Thread] = None
-        self.ready = threading.Event()
-
-_GLOBAL = _LoopHolder()
-
-def _run_loop():
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    _GLOBAL.loop = loop
-    _GLOBAL.ready.set()
-    loop.run_forever()
-
 def get_global_loop() -> asyncio.AbstractEventLoop:
-    if _GLOBAL.loop is not None:
-        return _GLOBAL.loop
-    _GLOBAL.thread = threading.Thread(target=_run_loop, name="warehouse-asyncio", daemon=True)
-    _GLOBAL.thread.start()
-    _GLOBAL.ready.wait(timeout=5.0)
-    if _GLOBAL.loop is None:
-        raise RuntimeError("Impossibile avviare l'event loop globale")
-    return _GLOBAL.loop
+    return RUNTIME.loop
 
 def stop_global_loop():
-    if _GLOBAL.loop and _GLOBAL.loop.is_running():
-        _GLOBAL.loop.call_soon_threadsafe(_GLOBAL.loop.stop)
-    if _GLOBAL.thread:
-        _GLOBAL.thread.join(timeout=2.0)
-    _GLOBAL.loop = None
-    _GLOBAL.thread = None
-    _GLOBAL.ready.clear()
+    RUNTIME.shutdown()
 
 # ========================
 # Busy overlay
@@ -123,14 +101,238 @@ class BusyOverlay:
                 pass
             self._bind_id = None
 
+# ========================
+# Ponte loop → Tk (coda di completamento unica)
+# ========================
+class TkBridge:
+    """
+    Una coda di completamento per interprete Tk. Il thread del loop vi deposita callback
+    (add_done_callback dei future, blocchi di run_stream, eventi dei feed) e non tocca Tk:
+    la coda la svuota un after() sul thread Tk, tutta in un colpo. Il timer resta armato solo
+    finché c'è da aspettare: ogni POLL_MS con future osservati, ogni HOLD_MS con sole
+    sottoscrizioni (hold/release); a riposo Tk non viene mai svegliato.
+    """
+    POLL_MS = 15         # future in attesa: latenza aggiunta al più POLL_MS
+    HOLD_MS = 200        # solo sottoscrizioni ai feed (eventi ogni qualche secondo)
+
+    def __init__(self, root: tk.Tk):
+        self.root = root
+        self._q: "queue.SimpleQueue[tuple[float, Callable[[], None]]]" = queue.SimpleQueue()
+        self._closed = False
+        self._outstanding = 0           # future osservati non ancora consegnati (thread Tk)
+        self._held = 0                  # sottoscrizioni aperte (thread Tk)
+        self._pump_id: Optional[str] = None
+        self._pump_ms = 0
+        self._stats = {"delivered": 0, "pumps": 0, "idle_wakeups": 0,
+                       "latency_ms_total": 0.0, "latency_ms_max": 0.0}
+        root.bind("<Destroy>", self._on_destroy, add="+")
+
+    @classmethod
+    def for_widget(cls, widget: tk.Misc) -> "TkBridge":
+        root = widget._root()
+        bridge = getattr(root, "_async_bridge", None)
+        if bridge is None or bridge._closed:
+            bridge = root._async_bridge = cls(root)
+            RUNTIME.metrics.register_source("tk_bridge", bridge.stats)
+        return bridge
+
+    # ---------- qualsiasi thread ----------
+    def post(self, fn: Callable[[], None]) -> None:
+        """Accoda fn da eseguire sul thread Tk (al prossimo giro del timer)."""
+        self._q.put((time.perf_counter(), fn))
+
+    # ---------- thread Tk ----------
+    def watch(self, future, fn: Callable[[], None]) -> None:
+        """Esegue fn sul thread Tk quando future termina (con successo, errore o annullato)."""
+        self._outstanding += 1
+
+        def _deliver():
+            self._outstanding -= 1
+            fn()
+
+        future.add_done_callback(lambda _f: self.post(_deliver))
+        self._arm()
+
+    def hold(self) -> None:
+        """Tiene armato il timer finché non arriva release(): per post() senza un future osservato (feed)."""
+        self._held += 1
+        self._arm()
+
+    def release(self) -> None:
+        self._held = max(0, self._held - 1)
+
+    def _arm(self):
+        if self._closed or not (self._outstanding or self._held):
+            return
+        ms = self.POLL_MS if self._outstanding else self.HOLD_MS
+        if self._pump_id is not None:
+            if self._pump_ms <= ms:
+                return
+            with contextlib.suppress(tk.TclError):
+                self.root.after_cancel(self._pump_id)   # timer lento delle sottoscrizioni: si accorcia
+        self._pump_ms = ms
+        self._pump_id = self.root.after(ms, self._on_pump)
+
+    def _on_pump(self):
+        self._pump_id = None
+        self._stats["pumps"] += 1
+        if not self.drain():
+            self._stats["idle_wakeups"] += 1
+        self._arm()
+
+    def drain(self) -> int:
+        n = 0
+        while True:
+            try:
+                t0, fn = self._q.get_nowait()
+            except queue.Empty:
+                break
+            ms = (time.perf_counter() - t0) * 1000
+            st = self._stats
+            st["delivered"] += 1
+            st["latency_ms_total"] += ms
+            st["latency_ms_max"] = max(st["latency_ms_max"], ms)
+            n += 1
+            try:
+                fn()
+            except Exception:
+                self.root.report_callback_exception(*sys.exc_info())
+        return n
+
+    def _on_destroy(self, event):
+        if event.widget is self.root:
+            self.close()
+
+    def close(self):
+        self._closed = True
+        if self._pump_id is not None:
+            with contextlib.suppress(tk.TclError):
+                self.root.after_cancel(self._pump_id)
+            self._pump_id = None
+
+    def stats(self):
+        st = dict(self._stats)
+        st["latency_ms_avg"] = round(st["latency_ms_total"] / st["delivered"], 3) if st["delivered"] else 0.0
+        st["outstanding"] = self._outstanding
+        st["held"] = self._held
+        return st
+
+
 # ========================
 # AsyncRunner (single-loop)
 # ========================
+class RunHandle:
+    """Lavoro lanciato da AsyncRunner. cancel() annulla il task sul loop (e lo statement ODBC in corso)."""
+    __slots__ = ("future", "key", "_busy", "_settled", "_cancelled")
+
+    def __init__(self, future, key: Optional[str], busy: Optional[BusyOverlay]):
+        self.future = future
+        self.key = key
+        self._busy = busy
+        self._settled = False       # callback già consegnate (o annullate): niente più consegne
+        self._cancelled = False
+
+    def cancel(self, *, hide_busy: bool = True) -> bool:
+        if self._settled:
+            return False
+        self._settled = True
+        self._cancelled = True
+        self.future.cancel()        # thread-safe: il task viene annullato sul loop globale
+        if hide_busy and self._busy:
+            self._busy.hide()
+        return True
+
+    def done(self) -> bool:
+        return self._settled
+
+    def cancelled(self) -> bool:
+        return self._cancelled
+
+
 class AsyncRunner:
-    """Run awaitables on the single global loop and callback on Tk main thread."""
+    """
+    Run awaitables on the single global loop and callback on Tk main thread.
+    run()/run_stream() ritornano un RunHandle annullabile. Con key="..." vale l'ultima richiesta:
+    la precedente con la stessa chiave viene annullata (sul server, non solo ignorata).
+    priority= sceglie la classe dello scheduler del runtime (interactive / refresh / background).
+    subscribe(feed, fn) consegna sul thread Tk gli eventi di un feed (change_feed.ChangeFeed).
+    Alla distruzione del widget tutto il lavoro ancora in corso viene annullato, le sottoscrizioni chiuse.
+    """
     def __init__(self, widget: tk.Misc):
         self.widget = widget
         self.loop = get_global_loop()
+        self._bridge = TkBridge.for_widget(widget)
+        self._pending: set[RunHandle] = set()
+        self._latest: dict[str, RunHandle] = {}
+        self._unsubscribe: list[Callable[[], None]] = []
+        try:
+            widget.bind("<Destroy>", self._on_destroy, add="+")
+        except tk.TclError:
+            pass
+
+    def _on_destroy(self, event):
+        # sui Toplevel <Destroy> arriva anche per ogni figlio: conta solo il widget del runner
+        if event.widget is self.widget:
+            self.cancel_all()
+            for unsubscribe in self._unsubscribe:
+                unsubscribe()
+            self._unsubscribe.clear()
+
+    def _start(self, coro, key: Optional[str], busy: Optional[BusyOverlay], priority: str) -> RunHandle:
+        if key is not None:
+            prev = self._latest.get(key)
+            if prev is not None:
+                prev.cancel(hide_busy=False)  # l'overlay passa alla nuova richiesta
+        h = RunHandle(RUNTIME.submit(coro, priority=priority), key, busy)
+        self._pending.add(h)
+        if key is not None:
+            self._latest[key] = h
+        return h
+
+    def _finish(self, h: RunHandle) -> bool:
+        """Segna h come concluso; False se era già stato annullato (niente callback)."""
+        self._pending.discard(h)
+        if h.key is not None and self._latest.get(h.key) is h:
+            del self._latest[h.key]
+        if h._settled:
+            return False
+        h._settled = True
+        return True
+
+    def subscribe(self, feed, on_event: Callable[[Any], None]) -> Callable[[], None]:
+        """
+        on_event(evento) sul thread Tk per ogni evento di feed (il feed chiama dal loop: qui si accoda e basta).
+        Ritorna la funzione che annulla la sottoscrizione; alla distruzione del widget lo fa da sé.
+        """
+        state = {"open": True}
+
+        def _deliver(ev):
+            if state["open"]:
+                on_event(ev)
+
+        unsubscribe_feed = feed.subscribe(lambda ev: self._bridge.post(lambda: _deliver(ev)))
+        self._bridge.hold()
+
+        def unsubscribe():
+            if not state["open"]:
+                return
+            state["open"] = False       # gli eventi già accodati non arrivano più
+            unsubscribe_feed()
+            self._bridge.release()
+        self._unsubscribe.append(unsubscribe)
+        return unsubscribe
+
+    def cancel(self, key: str) -> bool:
+        h = self._latest.get(key)
+        return h.cancel() if h is not None else False
+
+    def cancel_all(self) -> int:
+        n = 0
+        for h in list(self._pending):
+            n += h.cancel(hide_busy=False)
+        self._pending.clear()
+        self._latest.clear()
+        return n
 
     def run(
         self,
@@ -139,29 +341,100 @@ class AsyncRunner:
         on_error: Optional[Callable[[BaseException], None]] = None,
         busy: Optional[BusyOverlay] = None,
         message: str = "Operazione in corso…",
-    ):
+        key: Optional[str] = None,
+        priority: str = INTERACTIVE,
+    ) -> RunHandle:
         if busy:
             busy.show(message)
-        fut = asyncio.run_coroutine_threadsafe(awaitable, self.loop)
-
-        def _poll():
-            if fut.done():
-                if busy:
-                    busy.hide()
-                try:
-                    res = fut.result()
-                except BaseException as ex:
-                    if on_error:
-                        self.widget.after(0, lambda e=ex: on_error(e))
-                    else:
-                        print("[AsyncRunner] Unhandled error:", repr(ex))
+        h = self._start(awaitable, key, busy, priority)
+
+        def _done():
+            if not self._finish(h):
+                return
+            if busy:
+                busy.hide()
+            try:
+                res = h.future.result()
+            except BaseException as ex:
+                if on_error:
+                    on_error(ex)
+                else:
+                    print("[AsyncRunner] Unhandled error:", repr(ex))
+            else:
+                on_success(res)
+
+        self._bridge.watch(h.future, _done)
+        return h
+
+    def run_stream(
+        self,
+        agen,
+        on_batch: Callable[[list], None],
+        on_done: Optional[Callable[[int], None]] = None,
+        on_error: Optional[Callable[[BaseException], None]] = None,
+        busy: Optional[BusyOverlay] = None,
+        message: str = "Operazione in corso…",
+        max_pending: int = 4,
+        key: Optional[str] = None,
+        priority: str = INTERACTIVE,
+    ) -> RunHandle:
+        """
+        Consuma un async-iterator di blocchi (es. db.stream(...)) sul loop globale e
+        consegna ogni blocco a on_batch sul thread Tk appena arriva.
+        Al più max_pending blocchi attendono il thread Tk: se la UI è più lenta del DB
+        la lettura si ferma, così la memoria resta limitata.
+        """
+        if busy:
+            busy.show(message)
+        credits: Optional[asyncio.Semaphore] = None
+        state = {"first": True}
+        h: Optional[RunHandle] = None
+
+        def _deliver(batch):
+            # thread Tk: blocco consegnato, libera un credito sul loop
+            try:
+                if h._settled:
+                    return
+                if state["first"] and busy:
+                    busy.hide()  # il primo blocco è già visibile: via l'overlay
+                state["first"] = False
+                on_batch(batch)
+            finally:
+                self.loop.call_soon_threadsafe(credits.release)
+
+        async def _pump():
+            nonlocal credits
+            credits = asyncio.Semaphore(max_pending)
+            total = 0
+            async with contextlib.aclosing(agen) as it:
+                async for batch in it:
+                    await credits.acquire()
+                    total += len(batch)
+                    self._bridge.post(lambda b=batch: _deliver(b))
+            return total
+
+        h = self._start(_pump(), key, busy, priority)
+
+        def _done():
+            # i blocchi sono stati accodati prima del completamento: arrivano prima di questo
+            if not self._finish(h):
+                return
+            if busy:
+                busy.hide()
+            try:
+                total = h.future.result()
+            except BaseException as ex:
+                if on_error:
+                    on_error(ex)
                 else:
-                    self.widget.after(0, lambda r=res: on_success(r))
+                    print("[AsyncRunner] Unhandled error:", repr(ex))
             else:
-                self.widget.after(60, _poll)
+                if on_done:
+                    on_done(total)
 
-        _poll()
+        self._bridge.watch(h.future, _done)
+        return h
 
     def close(self):
-        # no-op: loop is global
-        pass
+        # il loop è globale: si annulla solo il lavoro lanciato da questo runner
+        self.cancel_all()
@@ -7,14 +7,16 @@ from tkinter import messagebox
 from typing import Optional, Any, Dict, List, Callable
 from dataclasses import dataclass
 
+from columnar_result import ColumnarResult
+
 # Usa overlay e runner "collaudati"
 from gestione_aree_frame_async import BusyOverlay, AsyncRunner
+from scheduler import REFRESH
+from sql_statements import register
 
-from async_loop_singleton import get_global_loop
-from db_async_singleton import get_db as _get_db_singleton
+from runtime import RUNTIME
 
 # === IMPORT procedura async prenota/s-prenota (no pyodbc qui) ===
-import asyncio
 try:
     from prenota_sprenota_sql import sp_xExePackingListPallet_async, SPResult
 except Exception:
@@ -26,7 +28,7 @@ except Exception:
 
 
 # -------------------- SQL --------------------
-SQL_PL = """
+SQL_PL = register("pickinglist.elenco", """
 SELECT
     COUNT(DISTINCT Pallet)        AS Pallet,
     COUNT(DISTINCT Lotto)         AS Lotto,
@@ -46,14 +48,23 @@ SELECT
 FROM dbo.XMag_ViewPackingList
 GROUP BY Documento, CodNazione, NAZIONE, Stato
 ORDER BY MIN(Ordinamento), Documento, NAZIONE, Stato;
-"""
+""")
 
-SQL_PL_DETAILS = """
+SQL_PL_DETAILS = register("pickinglist.dettagli", """
 SELECT *
 FROM ViewPackingListRestante
 WHERE Documento = :Documento
 ORDER BY Ordinamento;
-"""
+""")
+
+# celle e pallet di ogni documento: chi riceve il feed delle modifiche sa quali righe toccare
+SQL_PL_CELLE = register("pickinglist.celle", """
+SELECT DISTINCT Documento, Pallet, Cella, IDStato,
+       CASE WHEN Ubicazione = 'Non scaff.' THEN 0 ELSE 1 END AS InCella
+FROM dbo.XMag_ViewPackingList;
+""")
+
+FEED_DEBOUNCE_MS = 500   # più eventi ravvicinati → una sola ricarica silenziosa
 
 # -------------------- helpers --------------------
 def _rows_to_dicts(res: Dict[str, Any]) -> List[Dict[str, Any]]:
@@ -64,10 +75,14 @@ def _rows_to_dicts(res: Dict[str, Any]) -> List[Dict[str, Any]]:
       - res = { "rows": [..], "columns": [...] }
       - res = { "data": [..],  "columns": [...] }
       - res = { "rows": [tuple,..], "columns": [...] }
+      - res = { "columnar": ColumnarResult, ... }  → vista per riga, nessuna copia
     """
     if res is None:
         return []
 
+    if isinstance(res, dict) and isinstance(res.get("columnar"), ColumnarResult):
+        return res["columnar"].dicts()
+
     if isinstance(res, list):
         if not res:
             return []
@@ -341,7 +356,7 @@ class PLRow:
 class GestionePickingListFrame(ctk.CTkFrame):
     def __init__(self, master, *, db_client=None, conn_str=None):
         super().__init__(master)
-        self.db_client = db_client or _get_db_singleton(get_global_loop(), conn_str)
+        self.db_client = db_client or RUNTIME.get_db(conn_str)  # un solo client/engine per l'app
         self.runner = AsyncRunner(self)        # runner condiviso (usa loop globale)
         self.busy = BusyOverlay(self)          # overlay collaudato
 
@@ -351,6 +366,15 @@ class GestionePickingListFrame(ctk.CTkFrame):
 
         self._first_loading: bool = False  # flag per cursore d'attesa solo al primo load
 
+        # feed delle modifiche (runtime): prenotazioni ricolorate in place, pallet spostati → ricarica silenziosa
+        self._doc_celle: Dict[str, Dict[int, int]] = {}   # Documento → {IDCella: IDStato}
+        self._cella_docs: Dict[int, set] = {}             # IDCella → Documenti
+        self._udc_docs: Dict[str, set] = {}               # Pallet (maiuscolo) → Documenti
+        self._feed_job = None
+        self._feed_details = False
+        if RUNTIME.feed is not None:
+            self.runner.subscribe(RUNTIME.feed, self._on_delta)
+
         self._build_layout()
         # 🔇 Niente reload immediato: carichiamo quando la finestra è idle (= già resa)
         self.after_idle(self._first_show)
@@ -452,6 +476,8 @@ class GestionePickingListFrame(ctk.CTkFrame):
         """Aggiorna colore riga e cella IDStato per il Documento indicato."""
         for idx, m in enumerate(self.rows_models):
             if _s(m.pl.get("Documento")) == _s(documento):
+                # m.pl può essere una vista sul risultato in cache (query_json columnar): si modifica una copia
+                m.pl = dict(m.pl)
                 m.pl["IDStato"] = idstato
                 def _paint():
                     try:
@@ -487,42 +513,56 @@ class GestionePickingListFrame(ctk.CTkFrame):
                     m.set_checked(False)
 
             self.detail_doc = model.pl.get("Documento")
-            self.spinner.start(" Carico dettagli…")  # spinner ON
-
-            async def _job():
-                return await self.db_client.query_json(SQL_PL_DETAILS, {"Documento": self.detail_doc})
-
-            def _ok(res):
-                self.spinner.stop()  # spinner OFF
-                self._detail_cache[self.detail_doc] = _rows_to_dicts(res)
-                # differisci il render dei dettagli (più fluido)
-                self.after_idle(self._refresh_details)
-
-            def _err(ex):
-                self.spinner.stop()
-                messagebox.showerror("DB", f"Errore nel caricamento dettagli:\n{ex}")
-
-            self.runner.run(
-                _job(),
-                on_success=_ok,
-                on_error=_err,
-                busy=self.busy,
-                message=f"Carico UDC per Documento {self.detail_doc}…"
-            )
+            self._load_details()
 
         else:
             if not any(m.is_checked() for m in self.rows_models):
                 self.detail_doc = None
                 self._refresh_details()
 
+    def _load_details(self, quiet: bool = False):
+        self.spinner.start(" Carico dettagli…")  # spinner ON
+        documento = self.detail_doc
+
+        async def _job():
+            return await self.db_client.query_json(SQL_PL_DETAILS, {"Documento": documento}, columnar=True)
+
+        def _ok(res):
+            self.spinner.stop()  # spinner OFF
+            self._detail_cache[documento] = _rows_to_dicts(res)
+            # differisci il render dei dettagli (più fluido)
+            self.after_idle(self._refresh_details)
+
+        def _err(ex):
+            self.spinner.stop()
+            if not quiet:
+                messagebox.showerror("DB", f"Errore nel caricamento dettagli:\n{ex}")
+
+        self.runner.run(
+            _job(),
+            on_success=_ok,
+            on_error=_err,
+            busy=None if quiet else self.busy,
+            message=f"Carico UDC per Documento {documento}…",
+            key="dettagli",     # cambio documento: annulla il caricamento precedente
+        )
+
     # ----- load PL -----
-    def reload_from_db(self, first: bool = False):
+    def reload_from_db(self, first: bool = False, quiet: bool = False):
+        """quiet=True: aggiornamento dal feed, senza overlay e tenendo la PL selezionata."""
         self.spinner.start(" Carico…")  # spinner ON
         async def _job():
-            return await self.db_client.query_json(SQL_PL, {})
+            # primo load dalla cache (30 s); "Ricarica" rilegge sempre e aggiorna la cache
+            return await self.db_client.query_json(SQL_PL, {}, columnar=True, cache_ttl=30, cache_refresh=not first)
         def _on_success(res):
             rows = _rows_to_dicts(res)
             self._refresh_mid_rows(rows)
+            if quiet and self.detail_doc is not None:
+                for m in self.rows_models:
+                    if _s(m.pl.get("Documento")) == _s(self.detail_doc):
+                        m.set_checked(True)     # solo la spunta: i dettagli restano quelli a video
+                        break
+            self._load_feed_map()
             self.spinner.stop()  # spinner OFF
             # se era il primo load, ripristina il cursore standard
             if self._first_loading:
@@ -539,16 +579,68 @@ class GestionePickingListFrame(ctk.CTkFrame):
                 except Exception:
                     pass
                 self._first_loading = False
-            messagebox.showerror("DB", f"Errore nel caricamento:\n{ex}")
+            if not quiet:
+                messagebox.showerror("DB", f"Errore nel caricamento:\n{ex}")
 
         self.runner.run(
             _job(),
             on_success=_on_success,
             on_error=_on_error,
-            busy=self.busy,
-            message="Caricamento Picking List…" if first else "Aggiornamento…"
+            busy=None if quiet else self.busy,
+            message="Caricamento Picking List…" if first else "Aggiornamento…",
+            key="pl",
         )
 
+    # ----- feed delle modifiche -----
+    def _load_feed_map(self):
+        """Documento ↔ celle / pallet, solo se il feed è attivo (altrimenti nessuno la userebbe)."""
+        if RUNTIME.feed is None:
+            return
+
+        def _ok(res):
+            doc_celle: Dict[str, Dict[int, int]] = {}
+            cella_docs: Dict[int, set] = {}
+            udc_docs: Dict[str, set] = {}
+            for d in _rows_to_dicts(res):
+                doc = _s(d.get("Documento"))
+                celle = doc_celle.setdefault(doc, {})
+                if d.get("Pallet"):
+                    udc_docs.setdefault(str(d["Pallet"]).rstrip().upper(), set()).add(doc)
+                if d.get("InCella") and d.get("Cella") is not None:
+                    celle[int(d["Cella"])] = int(d.get("IDStato") or 0)
+                    cella_docs.setdefault(int(d["Cella"]), set()).add(doc)
+            self._doc_celle, self._cella_docs, self._udc_docs = doc_celle, cella_docs, udc_docs
+
+        self.runner.run(self.db_client.query_json(SQL_PL_CELLE, {}, columnar=True), _ok, lambda e: None,
+                        key="feed_map", priority=REFRESH)
+
+    def _on_delta(self, delta):
+        # prenotazione/s-prenotazione (anche da un'altra postazione): IDStato della PL = MAX sulle sue celle
+        for cella in delta.celle:
+            for doc in self._cella_docs.get(cella.ID, ()):
+                celle = self._doc_celle[doc]
+                celle[cella.ID] = int(cella.IDStato or 0)
+                stato = max(celle.values(), default=0)
+                if any(_s(m.pl.get("Documento")) == doc and int(m.pl.get("IDStato") or 0) != stato
+                       for m in self.rows_models):
+                    self._recolor_row_by_documento(doc, stato)
+        # pallet di una PL spostati o prelevati, corsie svuotate: elenco e ubicazioni da rileggere
+        docs = {doc for udc in delta.udc() for doc in self._udc_docs.get(udc, ())}
+        if docs or delta.svuotate:
+            self._feed_details |= self.detail_doc is not None and (
+                _s(self.detail_doc) in docs or bool(delta.svuotate))
+            if self._feed_job is None:
+                self._feed_job = self.after(FEED_DEBOUNCE_MS, self._apply_feed)
+
+    def _apply_feed(self):
+        self._feed_job = None
+        if not self.winfo_exists():
+            return
+        self.reload_from_db(quiet=True)
+        if self._feed_details and self.detail_doc is not None:
+            self._load_details(quiet=True)
+        self._feed_details = False
+
     def _refresh_details(self):
         self.det_table.clear_rows()
         if not self.detail_doc:
@@ -5,6 +5,10 @@ from tkinter import ttk, Menu, messagebox, filedialog
 from datetime import datetime
 
 from gestione_aree_frame_async import BusyOverlay, AsyncRunner
+from runtime import RUNTIME
+from scheduler import REFRESH
+from sql_statements import BARCODE, CORSIA, pick, register_sources
+from stock_snapshot import GIACENZA, GIACENZA_ORIGINALE
 
 # ---- Color palette ----
 COLOR_EMPTY  = "#B0B0B0"  # grigio (vuota)
@@ -13,6 +17,117 @@ COLOR_DOUBLE = "#D62728"  # rosso (>=2 UDC)
 FG_DARK      = "#111111"
 FG_LIGHT     = "#FFFFFF"
 
+LIVE_DEBOUNCE_MS = 400   # eventi del feed ravvicinati → un solo aggiornamento della matrice
+
+
+# finché lo snapshot non è pronto (RUNTIME.local_sources) le query leggono la vista originale
+_ORIGINALI = {GIACENZA: GIACENZA_ORIGINALE}
+
+
+# percentuali globali (tutte le corsie) per la barra in basso
+SQL_STATS_TOT = register_sources("layout.stats_tot", """
+    WITH C AS (
+        SELECT ID
+        FROM dbo.Celle
+        WHERE ID <> 9999 AND (DelDataOra IS NULL)
+          AND LTRIM(RTRIM(Corsia)) <> '7G'
+          AND LTRIM(RTRIM(Fila)) IS NOT NULL
+          AND LTRIM(RTRIM(Colonna)) IS NOT NULL
+    ),
+    S AS (
+        SELECT c.ID, COUNT(DISTINCT g.BarcodePallet) AS n
+        FROM C AS c LEFT JOIN dbo.XMag_GiacenzaPalletSnapshot AS g ON g.IDCella = c.ID
+        GROUP BY c.ID
+    )
+    SELECT
+      CAST(SUM(CASE WHEN s.n>0 THEN 1 ELSE 0 END) AS float)/NULLIF(COUNT(*),0) AS PercPieno,
+      CAST(SUM(CASE WHEN s.n>1 THEN 1 ELSE 0 END) AS float)/NULLIF(COUNT(*),0) AS PercDoppie
+    FROM C LEFT JOIN S s ON s.ID = C.ID;
+""", _ORIGINALI)
+
+
+# matrice della corsia: (riga, colonna) → stato 0/1/2, descrizione, prima UDC
+SQL_MATRIX = register_sources("layout.matrice", """
+    WITH C AS (
+        SELECT
+            ID,
+            LTRIM(RTRIM(Corsia))  AS Corsia,
+            LTRIM(RTRIM(Fila))    AS Fila,
+            LTRIM(RTRIM(Colonna)) AS Colonna,
+            Descrizione
+        FROM dbo.Celle
+        WHERE ID <> 9999 AND (DelDataOra IS NULL)
+          AND LTRIM(RTRIM(Corsia)) <> '7G' AND LTRIM(RTRIM(Corsia)) = :corsia
+    ),
+    R AS (
+        SELECT Fila,
+               DENSE_RANK() OVER (
+                 ORDER BY CASE WHEN TRY_CONVERT(int, Fila) IS NULL THEN 1 ELSE 0 END,
+                          TRY_CONVERT(int, Fila), Fila
+               ) AS RowN
+        FROM C GROUP BY Fila
+    ),
+    K AS (
+        SELECT Colonna,
+               DENSE_RANK() OVER (
+                 ORDER BY CASE WHEN TRY_CONVERT(int, Colonna) IS NULL THEN 1 ELSE 0 END,
+                          TRY_CONVERT(int, Colonna), Colonna
+               ) AS ColN
+        FROM C GROUP BY Colonna
+    ),
+    S AS (
+        SELECT c.ID, COUNT(DISTINCT g.BarcodePallet) AS n
+        FROM C AS c
+        LEFT JOIN dbo.XMag_GiacenzaPalletSnapshot AS g ON g.IDCella = c.ID
+        GROUP BY c.ID
+    ),
+    U AS (
+        SELECT c.ID, MIN(g.BarcodePallet) AS FirstUDC
+        FROM C c
+        LEFT JOIN dbo.XMag_GiacenzaPalletSnapshot g ON g.IDCella = c.ID
+        GROUP BY c.ID
+    )
+    SELECT
+        r.RowN, k.ColN,
+        CASE WHEN s.n IS NULL OR s.n = 0 THEN 0
+             WHEN s.n = 1 THEN 1
+             ELSE 2 END AS Stato,
+        c.Descrizione,
+        LTRIM(RTRIM(c.Fila)) AS FilaTxt,
+        LTRIM(RTRIM(c.Colonna)) AS ColTxt,
+        U.FirstUDC
+    FROM C c
+    JOIN R r ON r.Fila = c.Fila
+    JOIN K k ON k.Colonna = c.Colonna
+    LEFT JOIN S s ON s.ID = c.ID
+    LEFT JOIN U ON U.ID = c.ID
+    ORDER BY r.RowN, k.ColN;
+""", _ORIGINALI, corsia=CORSIA)
+
+
+# ubicazione di una UDC (per la ricerca nel layout)
+SQL_FIND_UDC = register_sources("layout.cerca_udc", """
+    SELECT TOP (1)
+           RTRIM(c.Corsia)  AS Corsia,
+           RTRIM(c.Colonna) AS Colonna,
+           RTRIM(c.Fila)    AS Fila,
+           c.ID             AS IDCella
+    FROM dbo.XMag_GiacenzaPalletSnapshot g
+    JOIN dbo.Celle c ON c.ID = g.IDCella
+    WHERE g.BarcodePallet = :barcode
+      AND c.ID <> 9999 AND RTRIM(c.Corsia) <> '7G'
+""", _ORIGINALI, barcode=BARCODE)
+
+
+def find_udc_rows(occ, barcode: str) -> list:
+    """Come SQL_FIND_UDC, dall'indice di occupazione in memoria: [(Corsia, Colonna, Fila, IDCella)] o []."""
+    for pos in occ.celle_di(barcode):
+        c = occ.cella(pos.IDCella)
+        if c is None or c.ID == 9999 or (c.Corsia or "").rstrip().upper() == "7G":
+            continue
+        return [((c.Corsia or "").rstrip(), (c.Colonna or "").rstrip(), (c.Fila or "").rstrip(), c.ID)]
+    return []
+
 
 def pct_text(p_full: float, p_double: float | None = None) -> str:
     p_full = max(0.0, min(1.0, p_full))
@@ -24,6 +139,34 @@ def pct_text(p_full: float, p_double: float | None = None) -> str:
     return f"Pieno {pf}%  ·  Vuoto {pe}%"
 
 
+def build_matrix(rows, corsia: str):
+    """
+    Righe di SQL_MATRIX → (max_r, max_c, stato, fila, colonna, descrizione, prima UDC):
+    matrici max_r × max_c indicizzate da RowN-1 / ColN-1 (fuori da Tk: la misurano i benchmark).
+    """
+    max_r = max_c = 0
+    for row in rows:
+        rown, coln = row[0], row[1]
+        if rown and coln:
+            max_r = max(max_r, int(rown))
+            max_c = max(max_c, int(coln))
+    mat  = [[0] * max_c for _ in range(max_r)]
+    fila = [[""] * max_c for _ in range(max_r)]
+    col  = [[""] * max_c for _ in range(max_r)]
+    desc = [[""] * max_c for _ in range(max_r)]
+    udc  = [[""] * max_c for _ in range(max_r)]
+    for row in rows:
+        rown, coln, stato, descr, fila_txt, col_txt, first_udc = row
+        r = int(rown) - 1
+        c = int(coln) - 1
+        mat[r][c]  = int(stato)
+        fila[r][c] = str(fila_txt or "")
+        col[r][c]  = str(col_txt or "")
+        desc[r][c] = str(descr or f"{corsia}.{col_txt}.{fila_txt}")
+        udc[r][c]  = str(first_udc or "")
+    return max_r, max_c, mat, fila, col, desc, udc
+
+
 class LayoutWindow(tk.Toplevel):
     """
     Visualizzazione layout corsie con matrice di celle.
@@ -66,10 +209,6 @@ class LayoutWindow(tk.Toplevel):
         self._pending_focus: tuple[str, str, str, str] | None = None
         self._highlighted: tuple[int, int] | None = None
 
-        # anti-race: token per ignorare risposte vecchie
-        self._req_counter = 0
-        self._last_req = 0
-
         self._build_top()
         self._build_matrix_host()
         self._build_stats()
@@ -77,6 +216,12 @@ class LayoutWindow(tk.Toplevel):
         self._load_corsie()
         self.bind("<Configure>", lambda e: self.after_idle(self._refresh_stats))
 
+        # feed delle modifiche del runtime: la corsia a video si aggiorna da sé, cella per cella
+        self._live_job = None
+        self._live_matrix = False
+        if RUNTIME.feed is not None:
+            self._async.subscribe(RUNTIME.feed, self._on_delta)
+
     # ---------------- TOP BAR ----------------
     def _build_top(self):
         top = ttk.Frame(self)
@@ -170,15 +315,7 @@ class LayoutWindow(tk.Toplevel):
                     cell, text=text, relief="raised", bd=1,
                     justify="center", wraplength=0  # wrap disattivato: niente 3a riga
                 )
-                if st == 0:
-                    btn.configure(bg=COLOR_EMPTY,  fg=FG_DARK,
-                                  activebackground="#9A9A9A", activeforeground=FG_DARK)
-                elif st == 1:
-                    btn.configure(bg=COLOR_FULL,   fg=FG_DARK,
-                                  activebackground="#E69500", activeforeground=FG_DARK)
-                else:
-                    btn.configure(bg=COLOR_DOUBLE, fg=FG_LIGHT,
-                                  activebackground="#B22222", activeforeground=FG_LIGHT)
+                self._style_button(btn, st)
 
                 rr = (rows - 1) - r  # capovolgi
                 cell.grid(row=rr, column=c, padx=1, pady=1, sticky="nsew")
@@ -218,15 +355,18 @@ class LayoutWindow(tk.Toplevel):
         y = self.winfo_pointery() if event is None else event.y_root
         m.tk_popup(x, y)
 
-    def _set_cell(self, r, c, val):
-        self.state[r][c] = val
-        btn = self.buttons[r][c]
-        if val == 0:
+    @staticmethod
+    def _style_button(btn, st):
+        if st == 0:
             btn.configure(bg=COLOR_EMPTY,  fg=FG_DARK,  activebackground="#9A9A9A", activeforeground=FG_DARK)
-        elif val == 1:
+        elif st == 1:
             btn.configure(bg=COLOR_FULL,   fg=FG_DARK,  activebackground="#E69500", activeforeground=FG_DARK)
         else:
             btn.configure(bg=COLOR_DOUBLE, fg=FG_LIGHT, activebackground="#B22222", activeforeground=FG_LIGHT)
+
+    def _set_cell(self, r, c, val):
+        self.state[r][c] = val
+        self._style_button(self.buttons[r][c], val)
         self._refresh_stats()
 
     # ---------------- STATS ----------------
@@ -299,7 +439,8 @@ class LayoutWindow(tk.Toplevel):
         def _err(ex):
             self._busy.hide()
             messagebox.showerror("Errore", f"Caricamento corsie fallito:\n{ex}")
-        self._async.run(self.db.query_json(sql, {}), _ok, _err, busy=self._busy, message="Carico corsie…")
+        # elenco corsie: cambia solo se si aggiungono celle → cache lunga
+        self._async.run(self.db.query_json(sql, {}, cache_ttl=300), _ok, _err, busy=self._busy, message="Carico corsie…")
 
     def _on_select(self, _):
         sel = self.lb.curselection()
@@ -318,107 +459,72 @@ class LayoutWindow(tk.Toplevel):
                 break
 
     def _load_matrix(self, corsia: str):
-        # nuovo token richiesta → evita che risposte vecchie spazzino la UI
-        self._req_counter += 1
-        req_id = self._req_counter
-        self._last_req = req_id
-
-        sql = """
-        WITH C AS (
-            SELECT
-                ID,
-                LTRIM(RTRIM(Corsia))  AS Corsia,
-                LTRIM(RTRIM(Fila))    AS Fila,
-                LTRIM(RTRIM(Colonna)) AS Colonna,
-                Descrizione
-            FROM dbo.Celle
-            WHERE ID <> 9999 AND (DelDataOra IS NULL)
-              AND LTRIM(RTRIM(Corsia)) <> '7G' AND LTRIM(RTRIM(Corsia)) = :corsia
-        ),
-        R AS (
-            SELECT Fila,
-                   DENSE_RANK() OVER (
-                     ORDER BY CASE WHEN TRY_CONVERT(int, Fila) IS NULL THEN 1 ELSE 0 END,
-                              TRY_CONVERT(int, Fila), Fila
-                   ) AS RowN
-            FROM C GROUP BY Fila
-        ),
-        K AS (
-            SELECT Colonna,
-                   DENSE_RANK() OVER (
-                     ORDER BY CASE WHEN TRY_CONVERT(int, Colonna) IS NULL THEN 1 ELSE 0 END,
-                              TRY_CONVERT(int, Colonna), Colonna
-                   ) AS ColN
-            FROM C GROUP BY Colonna
-        ),
-        S AS (
-            SELECT c.ID, COUNT(DISTINCT g.BarcodePallet) AS n
-            FROM C AS c
-            LEFT JOIN dbo.XMag_GiacenzaPallet AS g ON g.IDCella = c.ID
-            GROUP BY c.ID
-        ),
-        U AS (
-            SELECT c.ID, MIN(g.BarcodePallet) AS FirstUDC
-            FROM C c
-            LEFT JOIN dbo.XMag_GiacenzaPallet g ON g.IDCella = c.ID
-            GROUP BY c.ID
-        )
-        SELECT
-            r.RowN, k.ColN,
-            CASE WHEN s.n IS NULL OR s.n = 0 THEN 0
-                 WHEN s.n = 1 THEN 1
-                 ELSE 2 END AS Stato,
-            c.Descrizione,
-            LTRIM(RTRIM(c.Fila)) AS FilaTxt,
-            LTRIM(RTRIM(c.Colonna)) AS ColTxt,
-            U.FirstUDC
-        FROM C c
-        JOIN R r ON r.Fila = c.Fila
-        JOIN K k ON k.Colonna = c.Colonna
-        LEFT JOIN S s ON s.ID = c.ID
-        LEFT JOIN U ON U.ID = c.ID
-        ORDER BY r.RowN, k.ColN;
-        """
-        def _ok(res):
-            # ignora risposte superate
-            if req_id < self._last_req:
-                return
-            rows = res.get("rows", []) if isinstance(res, dict) else []
+        def _ok(results):
+            res, res_tot = results
+            self._apply_tot_stats(res_tot)
+            rows = res.get("rows", [])
             if not rows:
                 # mostra matrice vuota senza rimuovere il frame (evita "schermo bianco")
                 self._rebuild_matrix(0, 0, [], [], [], [], [], corsia)
-                self._refresh_stats()
+                self._refresh_sel_stats()
                 self._busy.hide()
                 return
-            max_r = max_c = 0
-            for row in rows:
-                rown, coln = row[0], row[1]
-                if rown and coln:
-                    max_r = max(max_r, int(rown))
-                    max_c = max(max_c, int(coln))
-            mat  = [[0] * max_c for _ in range(max_r)]
-            fila = [[""] * max_c for _ in range(max_r)]
-            col  = [[""] * max_c for _ in range(max_r)]
-            desc = [[""] * max_c for _ in range(max_r)]
-            udc  = [[""] * max_c for _ in range(max_r)]
-            for row in rows:
-                rown, coln, stato, descr, fila_txt, col_txt, first_udc = row
-                r = int(rown) - 1
-                c = int(coln) - 1
-                mat[r][c]  = int(stato)
-                fila[r][c] = str(fila_txt or "")
-                col[r][c]  = str(col_txt or "")
-                desc[r][c] = str(descr or f"{corsia}.{col_txt}.{fila_txt}")
-                udc[r][c]  = str(first_udc or "")
+            max_r, max_c, mat, fila, col, desc, udc = build_matrix(rows, corsia)
             self._rebuild_matrix(max_r, max_c, mat, fila, col, desc, udc, corsia)
-            self._refresh_stats()
+            self._refresh_sel_stats()
             self._busy.hide()
         def _err(ex):
-            if req_id < self._last_req:
-                return
             self._busy.hide()
             messagebox.showerror("Errore", f"Caricamento matrice {corsia} fallito:\n{ex}")
-        self._async.run(self.db.query_json(sql, {"corsia": corsia}), _ok, _err, busy=self._busy, message=f"Carico corsia {corsia}…")
+        # matrice + percentuali globali in un solo batch (un round trip);
+        # key="layout": una nuova corsia (o ricerca) annulla sul server il caricamento precedente
+        src = RUNTIME.local_sources
+        self._async.run(self.db.query_batch([(pick(SQL_MATRIX, src), {"corsia": corsia}), (pick(SQL_STATS_TOT, src), {})]),
+                        _ok, _err, busy=self._busy, message=f"Carico corsia {corsia}…", key="layout")
+
+    # ---------------- LIVE (feed delle modifiche) ----------------
+    def _on_delta(self, delta):
+        corsia = (self.corsia_selezionata.get() or "").strip().upper()
+        if corsia and corsia in delta.corsie():
+            self._live_matrix = True
+        if self._live_job is None:
+            self._live_job = self.after(LIVE_DEBOUNCE_MS, self._apply_live)
+
+    def _apply_live(self):
+        self._live_job = None
+        if not self.winfo_exists():
+            return
+        corsia = self.corsia_selezionata.get()
+        if not (self._live_matrix and corsia):
+            # altre corsie: cambia solo il riempimento globale
+            self._async.run(self.db.query_json(pick(SQL_STATS_TOT, RUNTIME.local_sources), {}, cache_ttl=5, cache_refresh=True),
+                            self._apply_tot_stats, lambda e: None, key="stats", priority=REFRESH)
+            return
+        self._live_matrix = False
+
+        def _ok(results):
+            res, res_tot = results
+            self._apply_tot_stats(res_tot)
+            if corsia != self.corsia_selezionata.get():
+                return      # nel frattempo l'operatore ha cambiato corsia
+            max_r, max_c, mat, fila, col, desc, udc = build_matrix(res.get("rows", []), corsia)
+            if (fila, col) != (self.fila_txt, self.col_txt):
+                # celle aggiunte o cancellate: la griglia cambia forma
+                self._rebuild_matrix(max_r, max_c, mat, fila, col, desc, udc, corsia)
+            else:
+                for r in range(max_r):
+                    for c in range(max_c):
+                        if (mat[r][c], udc[r][c]) != (self.state[r][c], self.udc1[r][c]):
+                            self.state[r][c], self.udc1[r][c], self.desc[r][c] = mat[r][c], udc[r][c], desc[r][c]
+                            btn = self.buttons[r][c]
+                            btn.configure(text=f"{corsia}.{col[r][c]}.{fila[r][c]}\n{udc[r][c]}")
+                            self._style_button(btn, mat[r][c])
+            self._refresh_sel_stats()
+
+        # senza overlay e con una chiave sua: non annulla un caricamento chiesto dall'operatore
+        src = RUNTIME.local_sources
+        self._async.run(self.db.query_batch([(pick(SQL_MATRIX, src), {"corsia": corsia}), (pick(SQL_STATS_TOT, src), {})]),
+                        _ok, lambda e: None, key="live", priority=REFRESH)
 
     # ---------------- SEARCH ----------------
     def _search_udc(self):
@@ -427,25 +533,7 @@ class LayoutWindow(tk.Toplevel):
             self._toast("Inserisci un barcode UDC da cercare.")
             return
 
-        # bump token per impedire che una vecchia _load_matrix cancelli UI
-        self._req_counter += 1
-        search_req_id = self._req_counter
-        self._last_req = search_req_id
-
-        sql = """
-            SELECT TOP (1)
-                   RTRIM(c.Corsia)  AS Corsia,
-                   RTRIM(c.Colonna) AS Colonna,
-                   RTRIM(c.Fila)    AS Fila,
-                   c.ID             AS IDCella
-            FROM dbo.XMag_GiacenzaPallet g
-            JOIN dbo.Celle c ON c.ID = g.IDCella
-            WHERE g.BarcodePallet = :barcode
-              AND c.ID <> 9999 AND RTRIM(c.Corsia) <> '7G'
-        """
         def _ok(res):
-            if search_req_id < self._last_req:
-                return
             rows = res.get("rows", []) if isinstance(res, dict) else []
             if not rows:
                 messagebox.showinfo("Ricerca", f"UDC {barcode} non trovata.", parent=self)
@@ -459,11 +547,15 @@ class LayoutWindow(tk.Toplevel):
             self.corsia_selezionata.set(corsia)
             self._load_matrix(corsia)  # highlight avverrà in _rebuild_matrix
         def _err(ex):
-            if search_req_id < self._last_req:
-                return
             messagebox.showerror("Ricerca", f"Errore ricerca UDC:\n{ex}", parent=self)
 
-        self._async.run(self.db.query_json(sql, {"barcode": barcode}), _ok, _err, busy=self._busy, message="Cerco UDC…")
+        occ = RUNTIME.occupancy
+        if occ is not None and occ.ready:
+            _ok({"rows": find_udc_rows(occ, barcode)})     # dalla memoria: niente round trip
+            return
+        # stessa chiave di _load_matrix: la ricerca annulla un caricamento corsia ancora in corso
+        self._async.run(self.db.query_json(pick(SQL_FIND_UDC, RUNTIME.local_sources), {"barcode": barcode}), _ok, _err,
+                        busy=self._busy, message="Cerco UDC…", key="layout")
 
     def _try_highlight(self, col_txt: str, fila_txt: str) -> bool:
         for r in range(len(self.col_txt)):
@@ -548,33 +640,19 @@ class LayoutWindow(tk.Toplevel):
     # ---------------- STATS ----------------
     def _refresh_stats(self):
         # globale dal DB
-        sql_tot = """
-            WITH C AS (
-                SELECT ID
-                FROM dbo.Celle
-                WHERE ID <> 9999 AND (DelDataOra IS NULL)
-                  AND LTRIM(RTRIM(Corsia)) <> '7G'
-                  AND LTRIM(RTRIM(Fila)) IS NOT NULL
-                  AND LTRIM(RTRIM(Colonna)) IS NOT NULL
-            ),
-            S AS (
-                SELECT c.ID, COUNT(DISTINCT g.BarcodePallet) AS n
-                FROM C AS c LEFT JOIN dbo.XMag_GiacenzaPallet AS g ON g.IDCella = c.ID
-                GROUP BY c.ID
-            )
-            SELECT
-              CAST(SUM(CASE WHEN s.n>0 THEN 1 ELSE 0 END) AS float)/NULLIF(COUNT(*),0) AS PercPieno,
-              CAST(SUM(CASE WHEN s.n>1 THEN 1 ELSE 0 END) AS float)/NULLIF(COUNT(*),0) AS PercDoppie
-            FROM C LEFT JOIN S s ON s.ID = C.ID;
-        """
-        def _ok(res):
-            rows = res.get("rows", []) if isinstance(res, dict) else []
-            p_full = float(rows[0][0] or 0.0) if rows else 0.0
-            p_dbl  = float(rows[0][1] or 0.0) if rows else 0.0
-            self._draw_bar(self.tot_canvas, p_full)
-            self.tot_text.configure(text=pct_text(p_full, p_dbl))
-        self._async.run(self.db.query_json(sql_tot, {}), _ok, lambda e: None, busy=None, message=None)
-
+        # <Configure> chiama spesso: il totale globale si ricalcola al più ogni 5 s (o dopo un DML)
+        self._async.run(self.db.query_json(pick(SQL_STATS_TOT, RUNTIME.local_sources), {}, cache_ttl=5), self._apply_tot_stats, lambda e: None,
+                        busy=None, message=None, key="stats", priority=REFRESH)
+        self._refresh_sel_stats()
+
+    def _apply_tot_stats(self, res):
+        rows = res.get("rows", []) if isinstance(res, dict) else []
+        p_full = float(rows[0][0] or 0.0) if rows else 0.0
+        p_dbl  = float(rows[0][1] or 0.0) if rows else 0.0
+        self._draw_bar(self.tot_canvas, p_full)
+        self.tot_text.configure(text=pct_text(p_full, p_dbl))
+
+    def _refresh_sel_stats(self):
         # selezionata dalla matrice in memoria
         if self.state:
             tot = sum(len(r) for r in self.state)
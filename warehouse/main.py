@@ -1,4 +1,5 @@
 
+import os
 import sys
 import asyncio
 import tkinter as tk
@@ -6,12 +7,13 @@ from tkinter import ttk
 import customtkinter as ctk
 
 from async_msssql_query import AsyncMSSQLClient, make_mssql_dsn
-from async_loop_singleton import get_global_loop
+from runtime import RUNTIME
 
 from layout_window import open_layout_window
 from view_celle_multiple import open_celle_multiple_window
 from reset_corsie import open_reset_corsie_window
 from search_pallets import open_search_window
+from diagnostics_window import open_diagnostics_window
 
 # Try factory, else frame, else app (senza passare conn_str all'App)
 try:
@@ -19,7 +21,6 @@ try:
 except Exception:
     try:
         from gestione_pickinglist import GestionePickingListFrame as _PLFrame
-        import customtkinter as ctk
         def create_pickinglist_frame(parent, db_client=None, conn_str=None):
             ctk.set_appearance_mode("light")
             ctk.set_default_color_theme("green")
@@ -36,10 +37,33 @@ except Exception:
 
 
 # ---- Config ----
+APP_VERSION = "1.0.0"
 SERVER = r"mde3\gesterp"
 DBNAME = "Mediseawall"
 USER = "sa"
 PASSWORD = "1Password1"
+POOL_SIZE = 4          # connessioni tenute aperte sul loop globale (0 = NullPool, login a ogni query)
+POOL_MAX_OVERFLOW = 4
+SLOW_QUERY_MS = 1500   # query più lente → logs/slow_queries.jsonl con piano (None = disattivato)
+SLOW_LOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs", "slow_queries.jsonl")
+# Manutenzione lato server (snapshot della giacenza, copia della traccia): una sola istanza designata
+# (WAREHOUSE_MAINTAINER=1) o un job di SQL Agent; negli altri client quei motori restano spenti e le
+# finestre leggono quello che l'istanza designata mantiene (o le viste originali, finché non c'è).
+MAINTAINER = os.environ.get("WAREHOUSE_MAINTAINER") == "1"
+STOCK_REFRESH_S = 5 if MAINTAINER else None         # consolidamento della giacenza (stock_snapshot.sql in deploy)
+STOCK_REBUILD_S = 6 * 3600 if MAINTAINER else None  # ricostruzione: recupera DELETE di movimenti fatti fuori dall'app
+TRACCIA_REFRESH_S = 30 if MAINTAINER else None      # copia di vXTracciaProdotti (traccia_prodotti.sql in deploy)
+TRACCIA_REBUILD_S = 3600 if MAINTAINER else None    # ricostruzione: riprende correzioni di lotti/articoli già copiati
+# Indici in memoria e feed: un load completo e un poll ogni pochi secondi per client, quindi opt-in
+# (WAREHOUSE_INDEXES=1 sulle postazioni che ne hanno bisogno); spenti, le finestre interrogano il DB.
+INDEXES = os.environ.get("WAREHOUSE_INDEXES") == "1"
+OCCUPANCY_REFRESH_S = 2 if INDEXES else None    # indice cella ↔ UDC (snapshot della giacenza in deploy)
+OCCUPANCY_RESYNC_S = 600
+SEARCH_REFRESH_S = 5 if INDEXES else None       # indice a trigrammi della ricerca UDC/Lotto/Codice
+SEARCH_RESYNC_S = 3600
+FEED_POLL_S = 2 if INDEXES else None            # modifiche da VersioneDati → layout, picking list (change_feed.sql in deploy)
+# WAREHOUSE_TRACE=logs/sessione.jsonl.gz → traccia di tutte le query (replay: benchmarks/replay_trace.py)
+TRACE_PATH = os.environ.get("WAREHOUSE_TRACE")
 
 if sys.platform.startswith("win"):
     try:
@@ -47,9 +71,20 @@ if sys.platform.startswith("win"):
     except Exception:
         pass
 
-# Create ONE global loop and make it the default everywhere
-_loop = get_global_loop()
-asyncio.set_event_loop(_loop)
+# Un solo runtime: loop in background + client DB + metriche (vedi runtime.py)
+dsn_app = make_mssql_dsn(server=SERVER, database=DBNAME, user=USER, password=PASSWORD)
+RUNTIME.start(dsn_app, pool_size=POOL_SIZE, max_overflow=POOL_MAX_OVERFLOW,
+              slow_query_ms=SLOW_QUERY_MS, slow_log_path=SLOW_LOG_PATH,
+              stock_refresh_s=STOCK_REFRESH_S, stock_rebuild_s=STOCK_REBUILD_S,
+              traccia_refresh_s=TRACCIA_REFRESH_S, traccia_rebuild_s=TRACCIA_REBUILD_S,
+              occupancy_refresh_s=OCCUPANCY_REFRESH_S, occupancy_resync_s=OCCUPANCY_RESYNC_S,
+              search_refresh_s=SEARCH_REFRESH_S, search_resync_s=SEARCH_RESYNC_S,
+              feed_poll_s=FEED_POLL_S)
+RUNTIME.app_version = APP_VERSION
+if TRACE_PATH:
+    RUNTIME.db.start_trace(TRACE_PATH, app_version=APP_VERSION)
+asyncio.set_event_loop(RUNTIME.loop)
+db_app = RUNTIME.db
 
 # --- DPI tracker compatibility ---
 def _noop(*args, **kwargs):
@@ -59,9 +94,6 @@ if not hasattr(tk.Toplevel, "block_update_dimensions_event"):
 if not hasattr(tk.Toplevel, "unblock_update_dimensions_event"):
     tk.Toplevel.unblock_update_dimensions_event = _noop  # type: ignore[attr-defined]
 
-dsn_app = make_mssql_dsn(server=SERVER, database=DBNAME, user=USER, password=PASSWORD)
-db_app = AsyncMSSQLClient(dsn_app)
-
 
 def open_pickinglist_window(parent: tk.Misc, db_client: AsyncMSSQLClient):
     win = ctk.CTkToplevel(parent)
@@ -118,7 +150,7 @@ def open_pickinglist_window(parent: tk.Misc, db_client: AsyncMSSQLClient):
 class Launcher(ctk.CTk):
     def __init__(self):
         super().__init__()
-        self.title("Warehouse 1.0.0")
+        self.title(f"Warehouse {APP_VERSION}")
         self.geometry("1200x70+0+0")
 
         wrap = ttk.Frame(self)
@@ -134,17 +166,15 @@ class Launcher(ctk.CTk):
                    command=lambda: open_search_window(self, db_app)).grid(row=0, column=3, padx=6, pady=6, sticky="ew")
         ttk.Button(wrap, text="Gestione Picking List",
                    command=lambda: open_pickinglist_window(self, db_app)).grid(row=0, column=4, padx=6, pady=6, sticky="ew")
+        ttk.Button(wrap, text="Diagnostica",
+                   command=lambda: open_diagnostics_window(self)).grid(row=0, column=5, padx=6, pady=6, sticky="ew")
 
-        for i in range(5):
+        for i in range(6):
             wrap.grid_columnconfigure(i, weight=1)
 
         def _on_close():
             try:
-                fut = asyncio.run_coroutine_threadsafe(db_app.dispose(), _loop)
-                try:
-                    fut.result(timeout=2)
-                except Exception:
-                    pass
+                RUNTIME.shutdown()      # annulla i task, chiude l'engine, ferma il loop
             finally:
                 self.destroy()
 
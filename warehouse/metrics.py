@@ -0,0 +1,233 @@
+# metrics.py — registro metriche del runtime: contatori, gauge, istogrammi e sorgenti (stats dei componenti) in un'unica snapshot
+from __future__ import annotations
+
+import asyncio
+import bisect
+import json
+import threading
+import time
+from collections.abc import Mapping
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+# limiti superiori dei bucket in ms: ~+25% per bucket da 0.05 ms a ~2 min
+_BOUNDS: List[float] = []
+_b = 0.05
+while _b < 120_000:
+    _BOUNDS.append(round(_b, 4))
+    _b *= 1.25
+del _b
+
+
+class Histogram:
+    """
+    Istogramma a bucket esponenziali (valori in ms): memoria fissa, percentili con errore
+    relativo ≤ 25% (il valore riportato è il limite superiore del bucket, mai oltre il max visto).
+    Non thread-safe: lo protegge MetricsRegistry.
+    """
+    __slots__ = ("counts", "count", "total", "min", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min: Optional[float] = None
+        self.max: Optional[float] = None
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(_BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, p: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = max(1, int(round(p / 100 * self.count + 0.5 - 1e-9)))
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                upper = _BOUNDS[i] if i < len(_BOUNDS) else self.max
+                return min(upper, self.max)
+        return self.max
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "mean": round(self.total / self.count, 3) if self.count else 0.0,
+            "min": round(self.min or 0.0, 3), "max": round(self.max or 0.0, 3),
+            "p50": round(self.percentile(50), 3),
+            "p95": round(self.percentile(95), 3),
+            "p99": round(self.percentile(99), 3),
+        }
+
+
+class QueryStats:
+    """Numeri di una query con nome: eseguite, dalla cache, errori, latenza, righe, byte, attesa connessione."""
+    __slots__ = ("name", "sql", "count", "cached", "errors", "cancelled", "slow", "rows", "bytes",
+                 "latency", "connect", "last_error")
+
+    def __init__(self, name: str, sql: str = ""):
+        self.name = name
+        self.sql = sql
+        self.count = 0
+        self.cached = 0
+        self.errors = 0
+        self.cancelled = 0
+        self.slow = 0                   # esecuzioni oltre la soglia dello slow log
+        self.rows = 0
+        self.bytes = 0
+        self.latency = Histogram()      # ms, solo esecuzioni riuscite sul DB
+        self.connect = Histogram()      # ms per avere la connessione (attesa pool + eventuale login)
+        self.last_error: Optional[str] = None
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "count": self.count, "cached": self.cached, "errors": self.errors, "cancelled": self.cancelled,
+            "slow": self.slow, "rows": self.rows, "rows_avg": round(self.rows / self.count, 1) if self.count else 0.0,
+            "bytes": self.bytes, "latency_ms": self.latency.summary(), "connect_ms": self.connect.summary(),
+            "last_error": self.last_error, "sql": self.sql,
+        }
+
+
+class QueryMetrics:
+    """
+    Metriche per query con nome (nome dello statement registrato, "adhoc:<hash>" per SQL inline).
+    Scritte dal loop, lette dalla finestra diagnostica: lock.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._q: Dict[str, QueryStats] = {}
+
+    def _get(self, name: str, sql: str) -> QueryStats:
+        qs = self._q.get(name)
+        if qs is None:
+            qs = self._q[name] = QueryStats(name, " ".join(sql.split())[:160])
+        return qs
+
+    def record(self, name: str, sql: str, *, elapsed_ms: float, rows: int = 0, nbytes: int = 0,
+               connect_ms: Optional[float] = None) -> None:
+        with self._lock:
+            qs = self._get(name, sql)
+            qs.count += 1
+            qs.rows += rows
+            qs.bytes += nbytes
+            qs.latency.observe(elapsed_ms)
+            if connect_ms is not None:
+                qs.connect.observe(connect_ms)
+
+    def record_cached(self, name: str, sql: str) -> None:
+        with self._lock:
+            self._get(name, sql).cached += 1
+
+    def record_slow(self, name: str) -> None:
+        with self._lock:
+            qs = self._q.get(name)
+            if qs is not None:
+                qs.slow += 1
+
+    def record_error(self, name: str, sql: str, ex: BaseException) -> None:
+        with self._lock:
+            qs = self._get(name, sql)
+            if isinstance(ex, asyncio.CancelledError):
+                qs.cancelled += 1
+            else:
+                qs.errors += 1
+                qs.last_error = f"{type(ex).__name__}: {ex}"[:300]
+
+    def reset(self) -> None:
+        with self._lock:
+            self._q.clear()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {name: qs.summary() for name, qs in sorted(self._q.items())}
+
+
+def estimate_bytes(rows, sample: int = 200) -> int:
+    """Byte del risultato stimati sulle prime sample righe (str/bytes = lunghezza, il resto 8)."""
+    n = len(rows)
+    if not n:
+        return 0
+    tot = 0
+    head = rows[:sample] if hasattr(rows, "__getitem__") else list(rows)[:sample]
+    for r in head:
+        for v in (r.values() if isinstance(r, Mapping) else r):
+            tot += len(v) if isinstance(v, (str, bytes, bytearray)) else 8
+    return int(tot * n / len(head))
+
+
+class MetricsRegistry:
+    """
+    Contatori, gauge e istogrammi aggiornati da Tk e dal loop (lock: sono due thread), più le
+    sorgenti registrate dai componenti (pool_stats, cache_stats, ...) lette solo in snapshot().
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = {}
+        self._gauges: Dict[str, float] = {}
+        self._hist: Dict[str, Histogram] = {}
+        self._sources: Dict[str, Callable[[], Dict[str, Any]]] = {}
+        self.started_at = time.time()
+
+    def inc(self, name: str, n: float = 1) -> None:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def set_gauge(self, name: str, value: float) -> None:
+        with self._lock:
+            self._gauges[name] = value
+
+    def add_gauge(self, name: str, delta: float) -> None:
+        with self._lock:
+            self._gauges[name] = self._gauges.get(name, 0) + delta
+
+    def observe(self, name: str, value_ms: float) -> None:
+        with self._lock:
+            h = self._hist.get(name)
+            if h is None:
+                h = self._hist[name] = Histogram()
+            h.observe(value_ms)
+
+    def histogram(self, name: str) -> Dict[str, Any]:
+        with self._lock:
+            h = self._hist.get(name)
+            return h.summary() if h is not None else Histogram().summary()
+
+    def counter(self, name: str) -> float:
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def register_source(self, name: str, fn: Callable[[], Dict[str, Any]]) -> None:
+        with self._lock:
+            self._sources[name] = fn
+
+    def unregister_source(self, name: str) -> None:
+        with self._lock:
+            self._sources.pop(name, None)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            out: Dict[str, Any] = {
+                "uptime_s": round(time.time() - self.started_at, 1),
+                "counters": dict(self._counters),
+                "gauges": dict(self._gauges),
+                "histograms": {k: h.summary() for k, h in self._hist.items()},
+            }
+            sources = list(self._sources.items())
+        for name, fn in sources:
+            try:
+                out[name] = fn()
+            except Exception as ex:     # una sorgente rotta non deve nascondere le altre
+                out[name] = {"error": repr(ex)}
+        return out
+
+    def dump_json(self, path: str, **meta: Any) -> Dict[str, Any]:
+        """Snapshot su file JSON (per confrontare i numeri fra due release); meta finisce in "meta"."""
+        snap = self.snapshot()
+        snap["meta"] = dict(meta, created=datetime.now().isoformat(timespec="seconds"))
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(snap, f, indent=2, default=str)
+        return snap
@@ -0,0 +1,350 @@
+# occupancy.py — indice in memoria dell'occupazione: cella → UDC, UDC → celle (caricato in blocco, poi a delta)
+from __future__ import annotations
+
+import asyncio
+import logging
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+from async_msssql_query import AsyncMSSQLClient
+from sql_statements import register
+from stock_snapshot import (EPS, NOME, SQL_SVUOTATE, SQL_TAIL, STATO, SVUOTATA, StockSnapshot, chiave,
+                            somma_movimenti, svuotate)
+
+SQL_CELLE = register("occupancy.celle", """
+SELECT ID, Corsia, Colonna, Fila, CASE WHEN DelDataOra IS NULL THEN 0 ELSE 1 END AS Cancellata
+FROM dbo.Celle
+""")
+SQL_SNAPSHOT = register("occupancy.snapshot", """
+SELECT NumeroPallet, IDMagazzino, IDArea, IDCella, Attributo, Peso
+FROM dbo.XMag_GiacenzaSnapshot
+""")
+# riga di stato del motore e generazioni dei reset: uguali prima e dopo la lettura dello snapshot → coerente
+_STATO = """
+SELECT Nome, UltimoID, UltimaVersione, Righe, RicostruitoIl
+FROM dbo.XMag_GiacenzaSnapshotStato{hint} WHERE Nome = :nome OR Nome LIKE 'svuotata:%'
+ORDER BY Nome
+"""
+SQL_STATO = register("occupancy.stato", _STATO.format(hint=""), nome=NOME)
+# ultimo tentativo: lock condiviso fino al commit (non blocca gli altri client, solo le scritture del motore)
+SQL_STATO_TENUTO = register("occupancy.stato_tenuto", _STATO.format(hint=" WITH (HOLDLOCK)"), nome=NOME)
+TENTATIVI = 3
+
+CELLA_NON_SCAFFALATO = 9999
+
+
+class Cella(NamedTuple):
+    """Riga di dbo.Celle (testi come nel DB, spazi compresi)."""
+    ID: int
+    Corsia: Optional[str]
+    Colonna: Optional[str]
+    Fila: Optional[str]
+    Cancellata: bool
+
+
+class Posizione(NamedTuple):
+    IDCella: int
+    IDArea: Optional[int]
+    IDMagazzino: Optional[int]
+
+
+def norm_udc(barcode: Optional[str]) -> str:
+    """Barcode come lo confronta la collation CI_AS: maiuscolo, senza spazi finali."""
+    return (barcode or "").rstrip(" ").upper()
+
+
+class _Stato:
+    """Le mappe dell'indice."""
+    def __init__(self):
+        self.peso: Dict[str, float] = {}                    # chiave di XMag_GiacenzaSnapshot → peso netto
+        self.info: Dict[str, Tuple[int, str, Any, Any]] = {}  # chiave → (IDCella, UDC, IDArea, IDMagazzino)
+        self.celle_udc: Dict[int, Dict[str, int]] = {}      # IDCella → {UDC: chiavi con peso > 0}
+        self.udc_celle: Dict[str, Dict[int, List[Any]]] = {}  # UDC → {IDCella: [chiavi, IDArea, IDMagazzino]}
+        self.raw: Dict[str, str] = {}                       # UDC normalizzata → barcode come nel DB
+        self.doppie: Set[int] = set()                       # celle con più di una UDC
+        self.entrate: Optional[List[str]] = None            # UDC entrate in giacenza (durante un refresh)
+
+    def add(self, k: str, cella: int, attributo: Optional[str], area: Any, magazzino: Any, delta: float) -> None:
+        udc = norm_udc(attributo)
+        old = self.peso.get(k, 0.0)
+        new = old + delta
+        if abs(new) < EPS:
+            self.peso.pop(k, None)
+            self.info.pop(k, None)
+        else:
+            self.peso[k] = new
+            self.info.setdefault(k, (cella, udc, area, magazzino))
+        was, now = old >= EPS, new >= EPS  # in giacenza: HAVING SUM(Peso) > 0, a meno di EPS (come il pop sopra)
+        if not udc or was == now:
+            return      # COUNT(DISTINCT BarcodePallet) ignora i NULL; appartenenza invariata
+        if now:
+            self._entra(cella, udc, attributo, area, magazzino)
+        else:
+            self._esce(cella, udc)
+
+    def _entra(self, cella: int, udc: str, attributo: Optional[str], area: Any, magazzino: Any) -> None:
+        per_cella = self.celle_udc.setdefault(cella, {})
+        per_cella[udc] = per_cella.get(udc, 0) + 1
+        pos = self.udc_celle.setdefault(udc, {}).setdefault(cella, [0, area, magazzino])
+        pos[0] += 1
+        self.raw.setdefault(udc, attributo.rstrip(" ") if attributo else udc)
+        if self.entrate is not None:
+            self.entrate.append(udc)
+        if len(per_cella) > 1:
+            self.doppie.add(cella)
+
+    def _esce(self, cella: int, udc: str) -> None:
+        per_cella = self.celle_udc.get(cella, {})
+        n = per_cella.get(udc, 0) - 1
+        if n > 0:
+            per_cella[udc] = n
+        else:
+            per_cella.pop(udc, None)
+            if not per_cella:
+                self.celle_udc.pop(cella, None)
+            if len(per_cella) <= 1:
+                self.doppie.discard(cella)
+        celle = self.udc_celle.get(udc, {})
+        pos = celle.get(cella)
+        if pos is not None:
+            pos[0] -= 1
+            if pos[0] <= 0:
+                del celle[cella]
+                if not celle:
+                    self.udc_celle.pop(udc, None)
+                    self.raw.pop(udc, None)
+
+
+class OccupancyIndex:
+    """
+    Cella → UDC e UDC → celle dalla memoria, con la semantica di XMag_GiacenzaPallet:
+        occ = OccupancyIndex(db)
+        await occ.load()                 # snapshot della giacenza + coda dei movimenti
+        await occ.refresh()              # movimenti con ID oltre il watermark
+        occ.udc_in_cella(1234) / occ.celle_di("A1B2C3") / occ.celle_doppie()   # da qualsiasi thread
+    DELETE e UPDATE di movimenti fatti fuori dall'app entrano al load() successivo (run(resync_s=...)).
+    """
+    def __init__(self, db: AsyncMSSQLClient, *, batch_rows: int = 50_000):
+        self.db = db
+        self.batch_rows = batch_rows
+        self._lock = threading.Lock()
+        self._s = _Stato()
+        self._celle: Dict[int, Cella] = {}
+        self._wm: Optional[int] = None
+        self._svuotate: Dict[str, int] = {}                 # CORSIA → generazione dei reset già applicati
+        self._subs: Tuple[Callable[[Optional[List[str]]], None], ...] = ()
+        self._log = logging.getLogger("OccupancyIndex")
+        self._stats: Dict[str, Any] = {"loads": 0, "refreshes": 0, "movements": 0, "errors": 0, "reloads": 0,
+                                       "load_ms": None, "last_ms": None, "last_error": None, "disabled": None}
+
+    @property
+    def ready(self) -> bool:
+        return self._wm is not None
+
+    # ---------- caricamento ----------
+    async def load(self) -> Dict[str, Any]:
+        """Snapshot con stato e generazioni invariati durante la lettura (nessuna scrittura), poi la coda."""
+        t0 = time.perf_counter()
+        celle = (await self.db.query_json(SQL_CELLE))["rows"]
+        for tentativo in range(1, TENTATIVI + 1):
+            async with self.db.transaction() as tx:
+                tenuto = tentativo == TENTATIVI
+                prima = (await tx.query(SQL_STATO_TENUTO if tenuto else SQL_STATO, {"nome": STATO}))["rows"]
+                rows = (await tx.query(SQL_SNAPSHOT))["rows"]
+                if tenuto or prima == (await tx.query(SQL_STATO, {"nome": STATO}))["rows"]:
+                    break
+        state = next((r[1:] for r in prima if r[0] == STATO), None)
+        if state is None:
+            raise RuntimeError("giacenza mai costruita: manca la riga di stato di XMag_GiacenzaSnapshotStato")
+        gen = svuotate([r[:2] for r in prima if r[0].startswith(SVUOTATA)])
+        # 200k righe in prod: costruzione in un thread, poi scambio
+        s = await asyncio.to_thread(self._build, rows)
+        with self._lock:
+            self._s = s
+            self._celle = {r[0]: Cella(r[0], r[1], r[2], r[3], bool(r[4])) for r in celle}
+            self._wm = state[0]
+            self._svuotate = gen
+        more = True
+        while more:
+            more = (await self.refresh())["more"]
+        ms = round((time.perf_counter() - t0) * 1000, 3)
+        self._stats.update(loads=self._stats["loads"] + 1, load_ms=ms)
+        self._notify(None)
+        return {"keys": len(rows), "watermark": self._wm, "ms": ms}
+
+    @staticmethod
+    def _build(rows: List[List[Any]]) -> _Stato:
+        s = _Stato()
+        for pallet, magazzino, area, cella, attributo, peso in rows:
+            if cella is not None:
+                s.add(chiave(pallet, magazzino, area, cella, attributo), cella, attributo, area, magazzino, peso)
+        return s
+
+    async def refresh(self, max_rows: Optional[int] = None) -> Dict[str, Any]:
+        """Fino a max_rows movimenti oltre il watermark ("more": ne restano); corsia svuotata altrove → load()."""
+        if self._wm is None:
+            return dict(await self.load(), more=False)
+        t0 = time.perf_counter()
+        n = max_rows or self.batch_rows
+        tail, gen = await self.db.query_batch([(SQL_TAIL, {"n": n, "wm": self._wm}), (SQL_SVUOTATE, None)])
+        if svuotate(gen["rows"]) != self._svuotate:
+            self._stats["reloads"] += 1
+            return dict(await self.load(), more=False)
+        rows = tail["rows"]
+        entrate: List[str] = []
+        if rows:
+            deltas = somma_movimenti(rows)
+            with self._lock:
+                self._s.entrate = entrate
+                try:
+                    for k, (pallet, magazzino, area, cella, attributo, peso, _n, _ultimo) in deltas.items():
+                        self._s.add(k, cella, attributo, area, magazzino, peso)
+                finally:
+                    self._s.entrate = None
+                self._wm = rows[-1][0]
+        if entrate:
+            self._notify(entrate)
+        ms = round((time.perf_counter() - t0) * 1000, 3)
+        s = self._stats
+        s.update(refreshes=s["refreshes"] + 1, movements=s["movements"] + len(rows), last_ms=ms)
+        return {"movements": len(rows), "watermark": self._wm, "more": len(rows) >= n, "ms": ms}
+
+    def svuota_corsia(self, corsia: str, generazione: Optional[int] = None) -> int:
+        """
+        Dopo il DELETE di reset_corsie toglie le UDC della corsia; ritorna le chiavi tolte.
+        generazione: quella di StockSnapshot.delete_corsia (se non segue l'ultima nota, il prossimo refresh ricarica).
+        """
+        corsia = corsia.strip().upper()
+        with self._lock:
+            if generazione is not None and generazione == self._svuotate.get(corsia, 0) + 1:
+                self._svuotate[corsia] = generazione
+            ids = {c.ID for c in self._celle.values()
+                   if c.ID != CELLA_NON_SCAFFALATO and (c.Corsia or "").strip().upper() == corsia}
+            keys = [(k, info) for k, info in self._s.info.items() if info[0] in ids]
+            for k, (cella, udc, area, magazzino) in keys:
+                self._s.add(k, cella, self._s.raw.get(udc, udc), area, magazzino, -self._s.peso[k])
+        return len(keys)
+
+    # ---------- sottoscrizioni ----------
+    def subscribe(self, fn: Callable[[Optional[List[str]]], None]) -> Callable[[], None]:
+        """fn(UDC entrate in giacenza) dopo ogni refresh, fn(None) dopo un load; ritorna l'annullamento."""
+        with self._lock:
+            self._subs = self._subs + (fn,)
+
+        def _unsubscribe():
+            with self._lock:
+                self._subs = tuple(f for f in self._subs if f is not fn)
+        return _unsubscribe
+
+    def _notify(self, entrate: Optional[List[str]]) -> None:
+        for fn in self._subs:
+            try:
+                fn(entrate)
+            except Exception as ex:
+                self._log.warning("sottoscrittore dell'occupazione: %s: %s", type(ex).__name__, ex)
+
+    # ---------- letture (qualsiasi thread) ----------
+    def udc_in_cella(self, idcella: int) -> List[str]:
+        """UDC in giacenza nella cella, ordinate."""
+        with self._lock:
+            raw = self._s.raw
+            return sorted(raw.get(u, u) for u in self._s.celle_udc.get(idcella, ()))
+
+    def occupazione(self, idcella: int) -> int:
+        """Numero di UDC distinte nella cella (COUNT(DISTINCT BarcodePallet))."""
+        with self._lock:
+            return len(self._s.celle_udc.get(idcella, ()))
+
+    def celle_di(self, barcode: str) -> List[Posizione]:
+        """Celle in cui l'UDC risulta in giacenza (più di una se c'è un'allocazione senza prelievo)."""
+        with self._lock:
+            celle = self._s.udc_celle.get(norm_udc(barcode), {})
+            return [Posizione(c, v[1], v[2]) for c, v in sorted(celle.items())]
+
+    def cerca_udc(self, parte: str) -> List[str]:
+        """UDC che contengono parte (LIKE '%parte%' case-insensitive)."""
+        parte = parte.strip().upper()
+        with self._lock:
+            raw = self._s.raw
+            return sorted(raw[u] for u in raw if parte in u)
+
+    def udc_in_giacenza(self) -> List[str]:
+        """Tutte le UDC in giacenza (normalizzate)."""
+        with self._lock:
+            return list(self._s.udc_celle)
+
+    def righe_di(self, udcs: Iterable[str]) -> Dict[str, Tuple[str, List[Tuple[int, int]]]]:
+        """Per le UDC in giacenza: barcode come nel DB e [(IDCella, chiavi)], una riga di XMag_GiacenzaPallet per chiave."""
+        out: Dict[str, Tuple[str, List[Tuple[int, int]]]] = {}
+        with self._lock:
+            raw, udc_celle = self._s.raw, self._s.udc_celle
+            for u in udcs:
+                celle = udc_celle.get(u)
+                if celle:
+                    out[u] = (raw.get(u, u), [(c, v[0]) for c, v in celle.items()])
+        return out
+
+    def cella(self, idcella: int) -> Optional[Cella]:
+        return self._celle.get(idcella)
+
+    def celle(self) -> List[Tuple[Cella, int]]:
+        """Tutte le celle di dbo.Celle con il numero di UDC in giacenza."""
+        with self._lock:
+            occ = self._s.celle_udc
+            return [(c, len(occ.get(c.ID, ()))) for c in self._celle.values()]
+
+    def celle_occupate(self) -> List[Tuple[Cella, int]]:
+        """Solo le celle con almeno una UDC (come un JOIN con la giacenza)."""
+        with self._lock:
+            celle = self._celle
+            return [(celle[i], len(u)) for i, u in self._s.celle_udc.items() if i in celle]
+
+    def celle_doppie(self) -> Dict[int, int]:
+        """IDCella → numero di UDC, per le celle con più di una UDC: mantenuto a ogni delta, niente query."""
+        with self._lock:
+            occ = self._s.celle_udc
+            return {i: len(occ[i]) for i in self._s.doppie}
+
+    # ---------- ciclo in background ----------
+    async def run(self, every_s: float, *, resync_s: Optional[float] = None,
+                  gate: Optional[Callable[[Awaitable[Any]], Awaitable[Any]]] = None) -> None:
+        """load(), poi refresh() ogni every_s; un nuovo load() ogni resync_s (DELETE/UPDATE esterni)."""
+        gate = gate or (lambda c: c)
+        try:
+            missing = await gate(StockSnapshot(self.db).check_schema())
+        except asyncio.CancelledError:
+            raise
+        except Exception as ex:
+            missing = None
+            self._error(ex)
+        if missing:
+            self._stats["disabled"] = f"mancano {', '.join(missing)}: eseguire stock_snapshot.sql"
+            self._log.warning("occupazione spenta: %s", self._stats["disabled"])
+            return
+        last_load = None
+        while True:
+            more = False
+            try:
+                if last_load is None or (resync_s and time.monotonic() - last_load >= resync_s):
+                    await gate(self.load())
+                    last_load = time.monotonic()
+                else:
+                    more = (await gate(self.refresh())).get("more", False)
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                self._error(ex)
+            if not more:
+                await asyncio.sleep(every_s)
+
+    def _error(self, ex: Exception) -> None:
+        self._stats["errors"] += 1
+        self._stats["last_error"] = f"{type(ex).__name__}: {ex}"
+        self._log.warning("occupazione: %s", self._stats["last_error"])
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            size = {"cells": len(self._s.celle_udc), "udc": len(self._s.udc_celle), "keys": len(self._s.peso),
+                    "double_cells": len(self._s.doppie), "watermark": self._wm}
+        return dict(self._stats, **size)
@@ -2,6 +2,8 @@ from __future__ import annotations
 from dataclasses import dataclass
 from typing import Optional, Any, Dict, List
 
+from sql_statements import ID_INT, UTENTE, register
+
 
 @dataclass
 class SPResult:
@@ -94,95 +96,84 @@ async def _execute(db, sql: str, params: Dict[str, Any]) -> int:
 
 
 # --- Procedura portata in async, usando il client DB passato dall'app ---
+SQL_CELLE_STATO = register("packinglist.celle_stato", """
+    SELECT c.ID, c.IDStato
+    FROM dbo.Celle AS c WITH (UPDLOCK, ROWLOCK)
+    WHERE c.ID IN (SELECT DISTINCT v.Cella
+                   FROM dbo.XMag_ViewPackingList AS v
+                   WHERE v.Documento = :Documento)
+""")
+
+SQL_SET_STATO = register("packinglist.set_stato", """
+    UPDATE Celle
+       SET IDStato = :S,
+           ModUtente = :N,
+           ModDataOra = GETDATE()
+     WHERE ID = :IDC
+""", S=ID_INT, N=UTENTE, IDC=ID_INT)
+
+_LOG_INSERT = """
+    INSERT INTO dbo.LogPackingList (Code, Description, IDInsUser, InsDateTime)
+    SELECT :Code,
+           (SELECT TOP 1 NAZIONE
+              FROM dbo.XMag_ViewPackingList
+             WHERE Documento = :Code
+             GROUP BY Documento, NAZIONE
+             ORDER BY NAZIONE),
+           :IDInsUser, GETDATE()"""
+
+# OUTPUT senza INTO fallisce se LogPackingList ha trigger: SCOPE_IDENTITY nello stesso batch
+SQL_LOG_INSERT = {
+    "mssql": register("packinglist.log_insert", "SET NOCOUNT ON;" + _LOG_INSERT
+                      + ";\n    SELECT CAST(SCOPE_IDENTITY() AS int) AS ID;"),
+    "sqlite": register("packinglist.log_insert.sqlite", _LOG_INSERT + "\n    RETURNING ID"),
+}
+
+
+def _transaction(db):
+    """db.transaction(): la procedura è tutto o niente, senza transazione non parte."""
+    if not hasattr(db, "transaction"):
+        raise RuntimeError("Il client DB non espone transaction()")
+    return db.transaction()
+
+
 async def sp_xExePackingListPallet_async(db, IDOperatore: int, Documento: str) -> SPResult:
     """
     Porting asincrono di [dbo].[sp_xExePackingListPallet] usando il client DB già aperto dall'app.
+    Gira in una sola transazione (db.transaction()): tutto o niente, una connessione.
     Logica:
       1) Recupera LOGIN operatore
-      2) Elenca le celle (DISTINCT Cella da XMag_ViewPackingList per Documento)
-      3) Per ogni cella: leggi IDStato e toggla 0<->1 + aggiorna ModUtente/ModDataOra
-      4) Description = TOP 1 NAZIONE per Documento
-      5) Inserisci LogPackingList(Code=Documento, Description, IDInsUser=IDOperatore, InsDateTime=GETDATE())
+      2) Celle della packing list (DISTINCT Cella da XMag_ViewPackingList) con IDStato, in una lettura
+      3) Per ogni cella: toggla IDStato 0<->1 + aggiorna ModUtente/ModDataOra
+      4) Inserisci LogPackingList(Code=Documento, Description=TOP 1 NAZIONE, IDInsUser, InsDateTime=GETDATE())
+         e legge l'ID con SCOPE_IDENTITY() nello stesso batch
     """
     try:
-        # 1) LOGIN operatore (se manca, prosegue come da SP originaria)
-        nominativo = await _query_one_value(
-            db,
-            "SELECT LOGIN FROM Operatori WHERE id = :IDOperatore",
-            {"IDOperatore": IDOperatore}
-        ) or ""
-
-        # 2) Celle da trattare
-        celle = await _query_all(
-            db,
-            """
-            SELECT DISTINCT Cella
-            FROM dbo.XMag_ViewPackingList
-            WHERE Documento = :Documento
-            """,
-            {"Documento": Documento}
-        )
-        id_celle = [r.get("Cella") for r in celle if "Cella" in r]
-
-        # 3) Toggle stato per ogni cella
-        for id_cella in id_celle:
-            if id_cella is None:
-                continue
-            stato = await _query_one_value(
-                db,
-                "SELECT IDStato FROM Celle WHERE ID = :IDC",
-                {"IDC": id_cella}
-            )
-            if stato == 0:
-                await _execute(
-                    db,
-                    """
-                    UPDATE Celle
-                       SET IDStato = 1,
-                           ModUtente = :N,
-                           ModDataOra = GETDATE()
-                     WHERE ID = :IDC
-                    """,
-                    {"N": nominativo, "IDC": id_cella}
-                )
+        async with _transaction(db) as tx:
+            # 1) LOGIN operatore (se manca, prosegue come da SP originaria)
+            nominativo = await _query_one_value(
+                tx,
+                "SELECT LOGIN FROM Operatori WHERE id = :IDOperatore",
+                {"IDOperatore": IDOperatore}
+            ) or ""
+
+            # 2) Celle da trattare + stato attuale (lock fino al commit: il toggle resta atomico)
+            celle = await _query_all(tx, SQL_CELLE_STATO, {"Documento": Documento})
+
+            # 3) Toggle stato per ogni cella
+            updates = [{"S": 1 if r.get("IDStato") == 0 else 0, "N": nominativo, "IDC": r.get("ID")}
+                       for r in celle if r.get("ID") is not None]
+            if updates and hasattr(tx, "executemany"):
+                await tx.executemany(SQL_SET_STATO, updates)
             else:
-                await _execute(
-                    db,
-                    """
-                    UPDATE Celle
-                       SET IDStato = 0,
-                           ModUtente = :N,
-                           ModDataOra = GETDATE()
-                     WHERE ID = :IDC
-                    """,
-                    {"N": nominativo, "IDC": id_cella}
-                )
-
-        # 4) Description = NAZIONE (TOP 1)
-        description = await _query_one_value(
-            db,
-            """
-            SELECT TOP 1 NAZIONE
-            FROM dbo.XMag_ViewPackingList
-            WHERE Documento = :Documento
-            GROUP BY Documento, NAZIONE
-            ORDER BY NAZIONE
-            """,
-            {"Documento": Documento}
-        )
-
-        # 5) LogPackingList
-        await _execute(
-            db,
-            """
-            INSERT INTO dbo.LogPackingList (Code, Description, IDInsUser, InsDateTime)
-            VALUES (:Code, :Descr, :IDInsUser, GETDATE());
-            """,
-            {"Code": Documento, "Descr": description, "IDInsUser": IDOperatore}
-        )
-
-        # Se vuoi proprio l'ID appena inserito:
-        new_id = await _query_one_value(db, "SELECT SCOPE_IDENTITY() AS ID", {})
+                for p in updates:
+                    await _execute(tx, SQL_SET_STATO, p)
+
+            # 4) LogPackingList (Description = NAZIONE) con ID restituito dallo stesso statement
+            new_id = await _query_one_value(
+                tx, SQL_LOG_INSERT["sqlite" if tx.backend == "sqlite" else "mssql"],
+                {"Code": Documento, "IDInsUser": IDOperatore}
+            )
         return SPResult(rc=0, message="", id_result=int(new_id) if new_id is not None else None)
 
     except Exception as e:
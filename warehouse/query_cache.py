@@ -0,0 +1,254 @@
+# query_cache.py — cache TTL/LRU dei risultati query con invalidazione per tabella
+from __future__ import annotations
+
+import re
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+from typing import Any, Dict, FrozenSet, Hashable, Iterable, Optional, Tuple
+
+# Viste dello schema → tabelle base da cui dipendono (vedi script.sql).
+# Un DML su una tabella base invalida anche le query che leggono le viste.
+VIEW_DEPENDENCIES: Dict[str, FrozenSet[str]] = {
+    "xmag_dettagliopallet": frozenset({"magazzinipallet", "celle"}),
+    "xmag_giacenzapallet": frozenset({"magazzinipallet", "celle"}),
+    # la riga di stato no: il lock di ogni refresh la scrive anche quando la giacenza non cambia
+    "xmag_giacenzapalletsnapshot": frozenset({"magazzinipallet", "celle", "xmag_giacenzasnapshot"}),
+    "xmag_giacenzapalletxubicazionecella": frozenset({"magazzinipallet", "celle", "lotser", "artico"}),
+    "xmag_giacenzapalletxubicazione": frozenset({"magazzinipallet", "celle", "lotser", "artico"}),
+    "vxtracciaprodotti": frozenset({"lotser", "artico"}),
+    "xmag_viewpackinglist": frozenset({"magazzinipallet", "celle", "vpreparapackinglist"}),
+    "viewpackinglistrestante": frozenset({"magazzinipallet", "celle", "vpreparapackinglist"}),
+}
+
+# Stored procedure → tabelle base che scrivono, comprese le procedure che chiamano (corpo T-SQL in
+# warehouse_sp_python.py). Un EXEC invalida solo queste; None = tutto (ripristino del database).
+PROCEDURE_WRITES: Dict[str, Optional[FrozenSet[str]]] = {
+    **{f"spt_{op}{t}": frozenset({t}) for op in ("save", "delete")
+       for t in ("aree", "celle", "celledimensione", "cellestati", "divisioni", "magazzini", "operatori",
+                 "reparti", "stabilimenti", "unitaproduzione")},
+    "sp_ordinacelle": frozenset({"celle"}),
+    "backupdb": frozenset({"celle"}),                       # chiama spt_SaveCelle
+    "creanuovecellemde6": frozenset({"celle"}),
+    "creanuovecellemde6_bis": frozenset({"celle"}),
+    "sp_xexepackinglistpalletprenota": frozenset({"celle"}),
+    "sp_controllaprenotazionepackinglistpallet": frozenset({"celle"}),
+    "sp_xexepackinglistpallet": frozenset({"celle", "logpackinglist"}),
+    "sp_logpackinglist": frozenset({"logpackinglist"}),
+    "sp_logoperation": frozenset({"logoperation"}),
+    "sp_xmaggestionemagazzinipallet": frozenset({"magazzinipallet", "celle", "logoperation"}),
+    "createlooparea": frozenset({"magazzinipallet", "celle", "logoperation"}),
+    "sp_xmaggestioneaccettazione": frozenset({"accettazione"}),
+    "sp_xmaggestioneaccettazioneold": frozenset({"accettazione"}),
+    "usp_mediseawall_takesnapshot": frozenset(),
+    "usp_mediseawall_reverttosnapshot": None,
+}
+
+_NAME = r"((?:\[?\w+\]?\.){0,3}\[?\w+\]?)"
+_RE_TABLES = re.compile(r"\b(?:FROM|JOIN|UPDATE|INTO|APPLY)\s+" + _NAME, re.IGNORECASE)
+_RE_DML = re.compile(r"\b(INSERT|UPDATE|DELETE|MERGE|TRUNCATE)\b", re.IGNORECASE)
+_RE_EXEC = re.compile(r"\bEXEC(?:UTE)?\s+(?:@\w+\s*=\s*)?" + _NAME, re.IGNORECASE)
+_RE_WRITE = (
+    re.compile(r"\bDELETE\s+\w+\s+FROM\s+" + _NAME, re.IGNORECASE),      # DELETE alias FROM tabella alias ...
+    re.compile(r"\bDELETE\s+(?:FROM\s+)?" + _NAME, re.IGNORECASE),
+    re.compile(r"\bUPDATE\s+" + _NAME, re.IGNORECASE),
+    re.compile(r"\bINSERT\s+(?:INTO\s+)?" + _NAME, re.IGNORECASE),
+    re.compile(r"\bMERGE\s+(?:INTO\s+)?" + _NAME, re.IGNORECASE),
+    re.compile(r"\bTRUNCATE\s+TABLE\s+" + _NAME, re.IGNORECASE),
+)
+# UPDATE alias SET ... FROM tabella alias: il bersaglio è nel FROM, non dopo UPDATE
+_RE_UPDATE_FROM = re.compile(r"\bUPDATE\s+\S+\s+SET\b.*?\bFROM\b", re.IGNORECASE | re.DOTALL)
+_RE_COMMENT = re.compile(r"--[^\n]*|/\*.*?\*/", re.DOTALL)
+_RE_STRING = re.compile(r"'(?:[^']|'')*'")
+_SQL_WORDS = {"select", "set", "where", "values", "output", "top", "from", "into"}
+
+
+def _bare(name: str) -> str:
+    return name.split(".")[-1].strip("[]").lower()
+
+
+def _strip(sql: str) -> str:
+    return _RE_STRING.sub("''", _RE_COMMENT.sub(" ", sql))
+
+
+def _expand(tables: Iterable[str]) -> FrozenSet[str]:
+    out = set()
+    for t in tables:
+        out.add(t)
+        out |= VIEW_DEPENDENCIES.get(t, frozenset())
+    return frozenset(out)
+
+
+def read_tables(sql: str) -> FrozenSet[str]:
+    """Tabelle/viste lette dalla query, espanse alle tabelle base."""
+    return _expand(_bare(m) for m in _RE_TABLES.findall(_strip(sql)) if _bare(m) not in _SQL_WORDS)
+
+
+def is_dml(sql: str) -> bool:
+    """DML o EXEC di una procedura: può scrivere, quindi niente cache e niente riesecuzione."""
+    body = _strip(sql)
+    return bool(_RE_DML.search(body) or _RE_EXEC.search(body))
+
+
+def procedures(sql: str) -> FrozenSet[str]:
+    """Procedure chiamate con EXEC (nome senza schema, minuscolo)."""
+    return frozenset(_bare(m) for m in _RE_EXEC.findall(_strip(sql)))
+
+
+def invalidated_tables(sql: str) -> Optional[FrozenSet[str]]:
+    """
+    Tabelle da invalidare dopo sql: scritte dal DML più quelle di PROCEDURE_WRITES per ogni EXEC.
+    None = svuotare tutto (DML con bersaglio non riconosciuto, ripristino del database).
+    Le procedure fuori da PROCEDURE_WRITES non invalidano nulla: le voci scadono con il loro TTL.
+    """
+    out = set(write_tables(sql))
+    for proc in procedures(sql):
+        tables = PROCEDURE_WRITES.get(proc, frozenset())
+        if tables is None:
+            return None
+        out |= tables
+    if not out and _RE_DML.search(_strip(sql)):
+        return None
+    return frozenset(out)
+
+
+def write_tables(sql: str) -> FrozenSet[str]:
+    """Tabelle modificate da un DML (vuoto se non riconosciute)."""
+    body = _strip(sql)
+    out = set()
+    for rx in _RE_WRITE:
+        for m in rx.findall(body):
+            t = _bare(m)
+            if t not in _SQL_WORDS:
+                out.add(t)
+    if _RE_UPDATE_FROM.search(body):
+        # alias non risolto: per sicurezza conta come scritta ogni tabella del FROM/JOIN
+        out |= {_bare(m) for m in _RE_TABLES.findall(body) if _bare(m) not in _SQL_WORDS}
+    return frozenset(out)
+
+
+def normalize_sql(sql: str) -> str:
+    return " ".join(sql.split())
+
+
+def _norm_value(v: Any) -> Hashable:
+    if isinstance(v, (list, tuple, set, frozenset)):
+        return tuple(_norm_value(x) for x in v)
+    if isinstance(v, dict):
+        return tuple(sorted((str(k), _norm_value(x)) for k, x in v.items()))
+    if isinstance(v, str):
+        return v
+    try:
+        hash(v)
+        return v
+    except TypeError:
+        return repr(v)
+
+
+def cache_key(sql: str, params: Optional[Dict[str, Any]]) -> Tuple[str, Tuple]:
+    """Chiave = testo SQL normalizzato (spazi) + parametri ordinati per nome."""
+    return normalize_sql(sql), tuple(sorted((k, _norm_value(v)) for k, v in (params or {}).items()))
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    stores: int = 0
+    expired: int = 0
+    evictions: int = 0
+    invalidations: int = 0      # voci rimosse da DML
+
+    def as_dict(self) -> Dict[str, Any]:
+        d = asdict(self)
+        lookups = self.hits + self.misses
+        d["hit_ratio"] = round(self.hits / lookups, 4) if lookups else 0.0
+        return d
+
+
+class _Entry:
+    __slots__ = ("value", "expires", "tables")
+
+    def __init__(self, value: Any, expires: float, tables: FrozenSet[str]):
+        self.value = value
+        self.expires = expires
+        self.tables = tables
+
+
+class QueryCache:
+    """
+    LRU limitata a max_entries; ogni voce ha il suo TTL e l'insieme delle tabelle base lette.
+    Usata solo dal thread del loop: nessun lock.
+    """
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max(1, int(max_entries))
+        self._data: "OrderedDict[Tuple, _Entry]" = OrderedDict()
+        self._stats = CacheStats()
+        # ultima invalidazione per tabella: una query partita prima di un DML non viene salvata
+        self._gen = 0
+        self._clear_gen = 0
+        self._table_gen: Dict[str, int] = {}
+
+    def generation(self) -> int:
+        return self._gen
+
+    def get(self, key: Tuple) -> Optional[Any]:
+        e = self._data.get(key)
+        if e is None:
+            self._stats.misses += 1
+            return None
+        if e.expires <= time.monotonic():
+            del self._data[key]
+            self._stats.expired += 1
+            self._stats.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self._stats.hits += 1
+        return e.value
+
+    def put(self, key: Tuple, value: Any, *, ttl: float, sql: str, started_gen: Optional[int] = None) -> bool:
+        tables = read_tables(sql)
+        if started_gen is not None and (started_gen < self._clear_gen
+                                        or any(self._table_gen.get(t, -1) > started_gen for t in tables)):
+            return False  # nel frattempo un DML ha toccato una delle tabelle lette
+        self._data[key] = _Entry(value, time.monotonic() + ttl, tables)
+        self._data.move_to_end(key)
+        self._stats.stores += 1
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+            self._stats.evictions += 1
+        return True
+
+    def invalidate_tables(self, tables: Iterable[str]) -> int:
+        tables = frozenset(t.lower() for t in tables)
+        if not tables:
+            return 0
+        self._gen += 1
+        for t in tables:
+            self._table_gen[t] = self._gen
+        stale = [k for k, e in self._data.items() if e.tables & tables]
+        for k in stale:
+            del self._data[k]
+        self._stats.invalidations += len(stale)
+        return len(stale)
+
+    def invalidate_for(self, sql: str) -> int:
+        """Invalidazione dopo un DML o un EXEC: vedi invalidated_tables."""
+        tables = invalidated_tables(sql)
+        if tables is None:
+            return self.clear()
+        return self.invalidate_tables(tables)
+
+    def clear(self) -> int:
+        n = len(self._data)
+        self._gen += 1
+        self._clear_gen = self._gen
+        self._data.clear()
+        self._stats.invalidations += n
+        return n
+
+    def stats(self) -> Dict[str, Any]:
+        d = self._stats.as_dict()
+        d["size"] = len(self._data)
+        d["max_entries"] = self.max_entries
+        return d
@@ -0,0 +1,477 @@
+# query_trace.py — traccia delle chiamate del client (JSONL compatto, anche .gz) e replay con i tempi originali
+from __future__ import annotations
+
+import asyncio
+import base64
+import contextlib
+import gzip
+import itertools
+import json
+import os
+import statistics
+import time
+import uuid
+from datetime import date, datetime, time as dtime
+from decimal import Decimal
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from query_cache import is_dml
+from scheduler import INTERACTIVE, QueryScheduler, current_job
+
+TRACE_VERSION = 1
+
+# operazioni che scrivono a prescindere dal testo (il replay le salta senza writes=True)
+WRITE_OPS = {"exec", "executemany", "transaction"}
+
+
+# ---------------- parametri ----------------
+def encode_value(v: Any) -> Any:
+    """Valore di un parametro → JSON senza perdere il tipo (datetime, Decimal, bytes, UUID)."""
+    if v is None or isinstance(v, (bool, int, float, str)):
+        return v
+    if isinstance(v, datetime):
+        return {"$dt": v.isoformat()}
+    if isinstance(v, date):
+        return {"$d": v.isoformat()}
+    if isinstance(v, dtime):
+        return {"$t": v.isoformat()}
+    if isinstance(v, Decimal):
+        return {"$dec": str(v)}
+    if isinstance(v, (bytes, bytearray, memoryview)):
+        return {"$b": base64.b64encode(bytes(v)).decode("ascii")}
+    if isinstance(v, uuid.UUID):
+        return {"$u": str(v)}
+    return str(v)
+
+
+_DECODERS: Dict[str, Callable[[str], Any]] = {
+    "$dt": datetime.fromisoformat, "$d": date.fromisoformat, "$t": dtime.fromisoformat,
+    "$dec": Decimal, "$b": base64.b64decode, "$u": uuid.UUID,
+}
+
+
+def decode_value(v: Any) -> Any:
+    if isinstance(v, dict) and len(v) == 1:
+        (tag, raw), = v.items()
+        dec = _DECODERS.get(tag)
+        if dec is not None:
+            return dec(raw)
+    return v
+
+
+def _enc_params(p: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: encode_value(v) for k, v in p.items()}
+
+
+def _dec_params(p: Any) -> Any:
+    if isinstance(p, list):
+        return [_dec_params(x) for x in p]
+    if isinstance(p, dict):
+        return {k: decode_value(v) for k, v in p.items()}
+    return p
+
+
+def _open(path: str, mode: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+# ---------------- registrazione ----------------
+class QueryTrace:
+    """
+    Una riga JSON per chiamata del client (query_json, query_batch, stream, exec, transaction e
+    gli statement dentro la transazione), scritta a chiamata finita:
+        {"k": "trace", "v": 1, "started": ..., "backend": ..., "app_version": ...}
+        {"k": "sql", "id": 3, "name": "layout.matrice", "sql": "...", "columns": [...]}   prima occorrenza
+        {"k": "ev", "n": 17, "t": 12.5, "op": "query_json", "s": 3, "p": {...}, "o": {...},
+         "ms": 8.1, "r": "ok", "rows": 100, "cols": 7, "job": 41, "prio": "refresh", "q": 12.49}
+    t = secondi dall'inizio della traccia all'avvio della chiamata; job/prio/q = run() dello
+    scheduler che l'ha eseguita (q = arrivo da Tk); tx = transazione di appartenenza.
+    r: ok, cached, coalesced, error, cancelled, closed (stream chiuso prima della fine).
+    Solo sul thread del loop. Un errore di scrittura spegne la traccia, mai la query.
+    """
+    def __init__(self, path: str, *, name_of: Callable[[str], str] = lambda sql: "",
+                 backend: str = "", app_version: str = "", max_many: int = 1000, flush_s: float = 2.0):
+        os.makedirs(os.path.dirname(os.path.abspath(path)) or ".", exist_ok=True)
+        self.path = path
+        self.max_many = max_many        # righe di parametri registrate per executemany
+        self.flush_s = flush_s
+        self._name_of = name_of
+        self._f = _open(path, "w")
+        self._t0 = time.perf_counter()
+        self._last_flush = self._t0
+        self._seq = itertools.count(1)
+        self._tx_ids = itertools.count(1)
+        self._sql_ids: Dict[str, int] = {}
+        self.events = 0
+        self.failed: Optional[str] = None
+        self._write({"k": "trace", "v": TRACE_VERSION, "started": datetime.now().isoformat(timespec="seconds"),
+                     "backend": backend, "app_version": app_version})
+
+    @property
+    def active(self) -> bool:
+        return self._f is not None
+
+    @contextlib.contextmanager
+    def event(self, op: str, sql: Any, params: Any = None, *, tx: Optional[int] = None,
+              **opts: Any) -> Iterator[Dict[str, Any]]:
+        """Il blocco mette in ev["res"] il risultato (o ev["rows"] se lo conta da sé)."""
+        n = next(self._seq)
+        job = current_job()
+        ev: Dict[str, Any] = {}
+        if op == "transaction":
+            ev["id"] = next(self._tx_ids)
+        t0 = time.perf_counter()
+        r, err = "ok", None
+        try:
+            yield ev
+        except GeneratorExit:
+            r = "closed"
+            raise
+        except asyncio.CancelledError:
+            r = "cancelled"
+            raise
+        except BaseException as ex:
+            r, err = "error", f"{type(ex).__name__}: {ex}"[:300]
+            raise
+        finally:
+            if self._f is not None:
+                self._record(n, op, sql, params, opts, tx, job, t0, ev, r, err)
+
+    def _record(self, n, op, sql, params, opts, tx, job, t0, ev, r, err) -> None:
+        rec: Dict[str, Any] = {"k": "ev", "n": n, "t": round(t0 - self._t0, 6), "op": op,
+                               "ms": round((time.perf_counter() - t0) * 1000, 3)}
+        res = ev.get("res")
+        if isinstance(res, dict):
+            if res.get("cached"):
+                r = "cached"
+            elif res.get("coalesced"):
+                r = "coalesced"
+            rec["rows"], rec["cols"] = len(res.get("rows") or ()), len(res.get("columns") or ())
+        elif isinstance(res, list):                                     # query_batch
+            rec["rows"] = [len(x.get("rows") or ()) for x in res]
+        elif "rows" in ev:
+            rec["rows"] = ev["rows"]
+        elif isinstance(res, int) and not isinstance(res, bool):      # exec: rowcount
+            rec["rows"] = res
+        rec["r"] = r
+        if isinstance(sql, list):
+            rec["s"] = [self._sql_id(s, None) for s in sql]
+            rec["p"] = [_enc_params(p or {}) for p in params or ()]
+        elif sql is not None:
+            rec["s"] = self._sql_id(sql, res)
+            if isinstance(params, list):
+                rec["p"] = [_enc_params(p) for p in params[:self.max_many]]
+                rec["p_total"] = len(params)
+            elif params:
+                rec["p"] = _enc_params(params)
+        opts = {k: v for k, v in opts.items() if v}
+        if opts:
+            rec["o"] = opts
+        if "id" in ev:
+            rec["id"] = ev["id"]
+        if tx is not None:
+            rec["tx"] = tx
+        if job is not None:
+            rec["job"], rec["prio"], rec["q"] = job[0], job[1], round(job[2] - self._t0, 6)
+        if err:
+            rec["err"] = err
+        self._write(rec)
+        self.events += 1
+
+    def _sql_id(self, sql: str, res: Any) -> int:
+        sid = self._sql_ids.get(sql)
+        if sid is None:
+            sid = self._sql_ids[sql] = len(self._sql_ids) + 1
+            rec = {"k": "sql", "id": sid, "name": self._name_of(sql), "sql": sql}
+            if isinstance(res, dict) and res.get("columns"):
+                rec["columns"] = list(res["columns"])
+            self._write(rec)
+        return sid
+
+    def _write(self, rec: Dict[str, Any]) -> None:
+        if self._f is None:
+            return
+        try:
+            self._f.write(json.dumps(rec, separators=(",", ":"), default=str, ensure_ascii=False) + "\n")
+            now = time.perf_counter()
+            if now - self._last_flush >= self.flush_s:
+                self._f.flush()
+                self._last_flush = now
+        except OSError as ex:
+            self.failed = str(ex)
+            self.close()
+
+    def close(self) -> None:
+        f, self._f = self._f, None
+        if f is not None:
+            with contextlib.suppress(OSError):
+                f.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"path": self.path, "active": self.active, "events": self.events,
+                "statements": len(self._sql_ids), "seconds": round(time.perf_counter() - self._t0, 1),
+                "failed": self.failed}
+
+
+# ---------------- lettura ----------------
+class Trace:
+    """Traccia caricata: intestazione, testi per id, eventi in ordine di avvio."""
+    def __init__(self, header: Dict[str, Any], sql: Dict[int, Dict[str, Any]], events: List[Dict[str, Any]]):
+        self.header = header
+        self.sql = sql
+        self.events = events
+
+    def text(self, sid: int) -> str:
+        return self.sql[sid]["sql"]
+
+    def name(self, ev: Dict[str, Any]) -> str:
+        s = ev.get("s")
+        if isinstance(s, list):
+            return "batch:" + "+".join(self.sql[x]["name"] or f"sql{x}" for x in s)
+        if s is None:
+            return ev["op"]
+        return self.sql[s]["name"] or f"sql{s}"
+
+    def is_write(self, ev: Dict[str, Any]) -> bool:
+        if ev["op"] in WRITE_OPS:
+            return True
+        s = ev.get("s")
+        return any(is_dml(self.text(x)) for x in (s if isinstance(s, list) else [s] if s is not None else []))
+
+
+def load_trace(path: str, *, limit: Optional[int] = None) -> Trace:
+    header: Dict[str, Any] = {}
+    sql: Dict[int, Dict[str, Any]] = {}
+    events: List[Dict[str, Any]] = []
+    with _open(path, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                break       # ultima riga troncata (app chiusa male): si tiene quel che c'è
+            k = rec.get("k")
+            if k == "ev":
+                events.append(rec)
+            elif k == "sql":
+                sql[rec["id"]] = rec
+            elif k == "trace":
+                if rec.get("v") != TRACE_VERSION:
+                    raise ValueError(f"versione traccia {rec.get('v')!r} non supportata (attesa {TRACE_VERSION})")
+                header = rec
+    events.sort(key=lambda e: (e["t"], e["n"]))
+    if limit is not None:
+        events = events[:limit]
+    return Trace(header, sql, events)
+
+
+# ---------------- replay ----------------
+class _Rollback(Exception):
+    pass
+
+
+def _groups(trace: Trace) -> List[List[Dict[str, Any]]]:
+    """
+    Unità di replay: gli eventi dello stesso run() dello scheduler (codice sequenziale nella
+    finestra), altrimenti la singola transazione o la singola chiamata. Ordinate per arrivo.
+    """
+    groups: Dict[Tuple[str, int], List[Dict[str, Any]]] = {}
+    for ev in trace.events:
+        if "job" in ev:
+            key = ("job", ev["job"])
+        elif "tx" in ev or ev["op"] == "transaction":
+            key = ("tx", ev.get("tx", ev.get("id")))
+        else:
+            key = ("ev", ev["n"])
+        groups.setdefault(key, []).append(ev)
+    return sorted(groups.values(), key=lambda g: (_arrival(g), g[0]["n"]))
+
+
+def _arrival(group: List[Dict[str, Any]]) -> float:
+    first = group[0]
+    return first.get("q", first["t"])
+
+
+def _steps(group: List[Dict[str, Any]]) -> List[Tuple[Dict[str, Any], List[Dict[str, Any]]]]:
+    """(evento, statement della sua transazione) in ordine: le transazioni si rigiocano come blocco."""
+    members: Dict[int, List[Dict[str, Any]]] = {}
+    for ev in group:
+        if "tx" in ev:
+            members.setdefault(ev["tx"], []).append(ev)
+    return [(ev, members.get(ev["id"], []) if ev["op"] == "transaction" else [])
+            for ev in group if "tx" not in ev]
+
+
+def _pct(xs: List[float], p: float) -> Optional[float]:
+    if not xs:
+        return None
+    xs = sorted(xs)
+    return round(xs[min(len(xs) - 1, int(p * len(xs)))], 3)
+
+
+class _Replay:
+    def __init__(self, db: Any, trace: Trace, *, speed: float, writes: bool,
+                 scheduler: Optional[QueryScheduler], concurrency: int):
+        self.db = db
+        self.trace = trace
+        self.speed = speed
+        self.writes = writes
+        self.scheduler = scheduler
+        self.concurrency = max(1, concurrency)
+        self.by_name: Dict[str, Dict[str, Any]] = {}
+        self.lag_ms: List[float] = []
+        self.skipped_writes = 0
+        self.replayed = 0
+
+    def _slot(self, name: str) -> Dict[str, Any]:
+        st = self.by_name.get(name)
+        if st is None:
+            st = self.by_name[name] = {"recorded": [], "replayed": [], "errors": 0, "rows_mismatch": 0,
+                                       "cached_recorded": 0, "cached_replayed": 0, "last_error": None}
+        return st
+
+    async def _call(self, target: Any, ev: Dict[str, Any]) -> None:
+        op, tr = ev["op"], self.trace
+        st = self._slot(tr.name(ev))
+        st["recorded"].append(ev["ms"])
+        if ev["r"] == "cached":
+            st["cached_recorded"] += 1
+        params = _dec_params(ev.get("p"))
+        opts = ev.get("o") or {}
+        t0 = time.perf_counter()
+        rows: Any = None
+        try:
+            if op == "query_batch":
+                res = await target.query_batch([(tr.text(s), p) for s, p in zip(ev["s"], params)], **opts)
+                rows = [len(x["rows"]) for x in res]
+            elif op == "stream":
+                rows = 0
+                async with contextlib.aclosing(target.stream(tr.text(ev["s"]), params, **opts)) as it:
+                    async for batch in it:
+                        rows += len(batch)
+            else:
+                res = await getattr(target, op)(tr.text(ev["s"]), params, **opts)
+                if isinstance(res, dict):
+                    rows = len(res["rows"])
+                    if res.get("cached"):
+                        st["cached_replayed"] += 1
+                elif op in ("exec", "executemany"):
+                    rows = res
+        except asyncio.CancelledError:
+            raise
+        except Exception as ex:
+            st["errors"] += 1
+            st["last_error"] = f"{type(ex).__name__}: {ex}"[:300]
+            if "tx" in ev:
+                raise       # dentro una transazione: rollback del blocco, come nell'app
+            return
+        finally:
+            st["replayed"].append((time.perf_counter() - t0) * 1000)
+        if ev["r"] in ("ok", "cached", "coalesced") and "rows" in ev and rows != ev["rows"]:
+            st["rows_mismatch"] += 1
+
+    async def _transaction(self, ev: Dict[str, Any], members: List[Dict[str, Any]]) -> None:
+        t0 = time.perf_counter()
+        st = self._slot("transaction")
+        st["recorded"].append(ev["ms"])
+        try:
+            async with self.db.transaction() as tx:
+                for m in members:
+                    await self._call(tx, m)
+                if ev["r"] != "ok":
+                    raise _Rollback()
+        except _Rollback:
+            pass
+        except Exception as ex:
+            st["errors"] += 1
+            st["last_error"] = f"{type(ex).__name__}: {ex}"[:300]
+        finally:
+            st["replayed"].append((time.perf_counter() - t0) * 1000)
+
+    async def _group(self, group: List[Dict[str, Any]], due: Optional[float]) -> None:
+        if due is not None:
+            self.lag_ms.append(max(0.0, (time.perf_counter() - due) * 1000))
+        prio = group[0].get("prio", INTERACTIVE)
+        slot = self.scheduler.slot(prio) if self.scheduler is not None else contextlib.nullcontext()
+        async with slot:
+            base, first_t = time.perf_counter(), group[0]["t"]
+            for ev, members in _steps(group):
+                if self.speed > 0:      # pause della finestra fra una query e l'altra dello stesso job
+                    delay = (ev["t"] - first_t) / self.speed - (time.perf_counter() - base)
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                if ev["op"] == "transaction":
+                    await self._transaction(ev, members)
+                else:
+                    await self._call(self.db, ev)
+                self.replayed += 1 + len(members)
+
+    async def run(self) -> Dict[str, Any]:
+        groups = _groups(self.trace)
+        start = time.perf_counter()
+        origin = _arrival(groups[0]) if groups else 0.0
+        # senza tempi: un tetto ai gruppi in volo (più largo con lo scheduler, che deve avere una coda)
+        sem = asyncio.Semaphore(self.concurrency * (4 if self.scheduler is not None else 1))
+        tasks: List[asyncio.Task] = []
+
+        async def _bounded(g):
+            try:
+                await self._group(g, None)
+            finally:
+                sem.release()
+
+        for g in groups:
+            if not self.writes and any(self.trace.is_write(ev) for ev in g):
+                self.skipped_writes += len(g)
+                continue
+            if self.speed > 0:
+                due = start + (_arrival(g) - origin) / self.speed
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                tasks.append(asyncio.ensure_future(self._group(g, due)))
+            else:
+                await sem.acquire()
+                tasks.append(asyncio.ensure_future(_bounded(g)))
+        if tasks:
+            await asyncio.gather(*tasks)
+        wall = time.perf_counter() - start
+        ev = self.trace.events
+        queries = {}
+        for name, st in sorted(self.by_name.items()):
+            rec, rep = st["recorded"], st["replayed"]
+            p50_rec, p50_rep = _pct(rec, 0.50), _pct(rep, 0.50)
+            queries[name] = {"count": len(rep),
+                             "recorded": {"p50": p50_rec, "p95": _pct(rec, 0.95),
+                                          "mean": round(statistics.fmean(rec), 3) if rec else None},
+                             "replayed": {"p50": p50_rep, "p95": _pct(rep, 0.95),
+                                          "mean": round(statistics.fmean(rep), 3) if rep else None},
+                             "ratio_p50": round(p50_rep / p50_rec, 2) if p50_rec and p50_rep is not None else None,
+                             "errors": st["errors"], "rows_mismatch": st["rows_mismatch"],
+                             "cached": {"recorded": st["cached_recorded"], "replayed": st["cached_replayed"]},
+                             "last_error": st["last_error"]}
+        return {"events": len(ev), "groups": len(groups), "replayed": self.replayed,
+                "skipped_writes": self.skipped_writes,
+                "errors": sum(q["errors"] for q in queries.values()),
+                "trace_s": round(ev[-1]["t"] - ev[0]["t"], 3) if ev else 0.0, "wall_s": round(wall, 3),
+                "speed": self.speed or "max",
+                "lag_ms": {"p50": _pct(self.lag_ms, 0.50), "p95": _pct(self.lag_ms, 0.95),
+                           "max": round(max(self.lag_ms), 3) if self.lag_ms else None},
+                "queries": queries}
+
+
+async def replay(db: Any, trace: Trace, *, speed: float = 1.0, writes: bool = False,
+                 scheduler: Optional[QueryScheduler] = None, concurrency: int = 4) -> Dict[str, Any]:
+    """
+    Rigioca la traccia su db (AsyncMSSQLClient, anche il backend SQLite).
+    speed > 0: arrivi con i tempi originali (2.0 = al doppio della velocità); speed = 0: il prima
+    possibile, al più concurrency gruppi in volo. scheduler: i gruppi passano dalle code con la
+    priorità registrata. writes=False salta i gruppi con DML o transazioni (default: server di test
+    in sola lettura). Ritorna latenze registrate vs rigiocate per nome, errori, righe diverse e il
+    ritardo degli arrivi (lag_ms: se cresce il replayer non tiene il passo della traccia).
+    """
+    return await _Replay(db, trace, speed=speed, writes=writes, scheduler=scheduler,
+                         concurrency=concurrency).run()
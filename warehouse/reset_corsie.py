@@ -1,12 +1,14 @@
 # reset_corsie.py
 import tkinter as tk
-from tkinter import ttk, messagebox
-from datetime import datetime
+from tkinter import ttk, messagebox, simpledialog
 
 from gestione_aree_frame_async import BusyOverlay, AsyncRunner
+from runtime import RUNTIME
+from sql_statements import CORSIA, pick, register, register_sources
+from stock_snapshot import GIACENZA, GIACENZA_ORIGINALE, StockSnapshot
 
 # ---------------- SQL ----------------
-SQL_CORSIE = """
+SQL_CORSIE = register("reset_corsie.corsie", """
     WITH C AS (
         SELECT DISTINCT LTRIM(RTRIM(Corsia)) AS Corsia
         FROM dbo.Celle
@@ -24,9 +26,13 @@ SQL_CORSIE = """
       CASE WHEN TRY_CONVERT(int, Corsia) IS NOT NULL THEN TRY_CONVERT(int, Corsia) END,
       CASE WHEN TRY_CONVERT(int, Corsia) IS NOT NULL THEN SUBSTRING(Corsia, LEN(CAST(TRY_CONVERT(int, Corsia) AS varchar(20)))+1, 50) END,
       Corsia;
-"""
+""")
 
-SQL_RIEPILOGO = """
+# finché lo snapshot non è pronto (RUNTIME.local_sources) le query leggono la vista originale
+_ORIGINALI = {GIACENZA: GIACENZA_ORIGINALE}
+
+
+SQL_RIEPILOGO = register_sources("reset_corsie.riepilogo", """
 WITH C AS (
     SELECT ID, LTRIM(RTRIM(Corsia)) AS Corsia,
            LTRIM(RTRIM(Colonna)) AS Colonna,
@@ -37,7 +43,7 @@ WITH C AS (
 ),
 S AS (
     SELECT c.ID, COUNT(DISTINCT g.BarcodePallet) AS n
-    FROM C AS c LEFT JOIN dbo.XMag_GiacenzaPallet AS g ON g.IDCella = c.ID
+    FROM C AS c LEFT JOIN dbo.XMag_GiacenzaPalletSnapshot AS g ON g.IDCella = c.ID
     GROUP BY c.ID
 )
 SELECT
@@ -46,9 +52,9 @@ SELECT
   SUM(CASE WHEN s.n>1 THEN 1 ELSE 0 END) AS CelleDoppie,
   SUM(COALESCE(s.n,0)) AS TotPallet
 FROM C LEFT JOIN S s ON s.ID = C.ID;
-"""
+""", _ORIGINALI, corsia=CORSIA)
 
-SQL_DETTAGLIO = """
+SQL_DETTAGLIO = register_sources("reset_corsie.dettaglio", """
 WITH C AS (
     SELECT ID, LTRIM(RTRIM(Corsia)) AS Corsia,
            LTRIM(RTRIM(Colonna)) AS Colonna,
@@ -59,7 +65,7 @@ WITH C AS (
 ),
 S AS (
     SELECT c.ID, COUNT(DISTINCT g.BarcodePallet) AS n
-    FROM C AS c LEFT JOIN dbo.XMag_GiacenzaPallet AS g ON g.IDCella = c.ID
+    FROM C AS c LEFT JOIN dbo.XMag_GiacenzaPalletSnapshot AS g ON g.IDCella = c.ID
     GROUP BY c.ID
 )
 SELECT c.ID AS IDCella,
@@ -68,21 +74,39 @@ SELECT c.ID AS IDCella,
 FROM C c LEFT JOIN S s ON s.ID = c.ID
 WHERE COALESCE(s.n,0) > 0
 ORDER BY TRY_CONVERT(int,c.Colonna), c.Colonna, TRY_CONVERT(int,c.Fila), c.Fila;
-"""
+""", _ORIGINALI, corsia=CORSIA)
 
-SQL_COUNT_DELETE = """
+SQL_COUNT_DELETE = register("reset_corsie.count_delete", """
 SELECT COUNT(*) AS RowsToDelete
 FROM dbo.MagazziniPallet mp
 JOIN dbo.Celle c ON c.ID = mp.IDCella
 WHERE c.ID <> 9999 AND LTRIM(RTRIM(c.Corsia)) = :corsia;
-"""
+""", corsia=CORSIA)
 
-SQL_DELETE = """
+SQL_DELETE = register("reset_corsie.delete", """
 DELETE mp
 FROM dbo.MagazziniPallet mp
 JOIN dbo.Celle c ON c.ID = mp.IDCella
 WHERE c.ID <> 9999 AND LTRIM(RTRIM(c.Corsia)) = :corsia;
-"""
+""", corsia=CORSIA)
+
+
+async def svuota_corsia_async(db, corsia: str, occupancy=None, feed=None) -> int:
+    """
+    DELETE dei movimenti della corsia e delle sue righe nello snapshot della giacenza, in una transazione;
+    dopo il commit anche dall'indice di occupazione in memoria e, come evento, sul feed delle modifiche
+    (un DELETE non ha rowversion: le finestre sottoscritte lo sanno solo da qui). Gli altri client lo vedono
+    dalla generazione della corsia che delete_corsia incrementa nella stessa transazione.
+    """
+    async with db.transaction() as tx:
+        generazione = await StockSnapshot.delete_corsia(tx, corsia)
+        n = await tx.exec(SQL_DELETE, {"corsia": corsia})
+    if occupancy is not None and occupancy.ready:
+        occupancy.svuota_corsia(corsia, generazione)
+    if feed is not None:
+        feed.svuotata(corsia, generazione)
+    return n
+
 
 class ResetCorsieWindow(tk.Toplevel):
     """
@@ -165,15 +189,16 @@ class ResetCorsieWindow(tk.Toplevel):
                 messagebox.showinfo("Info", "Nessuna corsia trovata.", parent=self)
         def _err(ex):
             messagebox.showerror("Errore", f"Caricamento corsie fallito:\n{ex}", parent=self)
-        self._async.run(self.db.query_json(SQL_CORSIE, {}), _ok, _err, busy=self._busy, message="Carico corsie…")
+        self._async.run(self.db.query_json(SQL_CORSIE, {}, cache_ttl=300), _ok, _err, busy=self._busy, message="Carico corsie…")
 
     def refresh(self):
         corsia = self.cmb.get().strip()
         if not corsia:
             return
-        # riepilogo
-        def _ok_sum(res):
-            rows = res.get("rows", []) if isinstance(res, dict) else []
+        # riepilogo + dettaglio in un solo batch (un round trip)
+        def _ok(results):
+            res_sum, res_det = results
+            rows = res_sum.get("rows", [])
             if rows:
                 tot, occ, dbl, pallet = rows[0]
                 self.var_tot_celle.set(str(tot or 0))
@@ -182,21 +207,18 @@ class ResetCorsieWindow(tk.Toplevel):
                 self.var_pallet.set(str(pallet or 0))
             else:
                 self.var_tot_celle.set("0"); self.var_occ.set("0"); self.var_dbl.set("0"); self.var_pallet.set("0")
-        def _err_sum(ex):
-            messagebox.showerror("Errore", f"Riepilogo fallito:\n{ex}", parent=self)
-
-        self._async.run(self.db.query_json(SQL_RIEPILOGO, {"corsia": corsia}), _ok_sum, _err_sum, busy=self._busy, message=f"Riepilogo {corsia}…")
 
-        # dettaglio
-        def _ok_det(res):
-            rows = res.get("rows", []) if isinstance(res, dict) else []
             for i in self.tree.get_children(): self.tree.delete(i)
-            for idc, ubi, n in rows:
+            for idc, ubi, n in res_det.get("rows", []):
                 self.tree.insert("", "end", values=(ubi, n))
-        def _err_det(ex):
-            messagebox.showerror("Errore", f"Dettaglio fallito:\n{ex}", parent=self)
+        def _err(ex):
+            messagebox.showerror("Errore", f"Riepilogo fallito:\n{ex}", parent=self)
 
-        self._async.run(self.db.query_json(SQL_DETTAGLIO, {"corsia": corsia}), _ok_det, _err_det, busy=None, message=None)
+        # dal database, non dall'indice di occupazione: è il riepilogo che precede uno svuotamento
+        params = {"corsia": corsia}
+        src = RUNTIME.local_sources
+        self._async.run(self.db.query_batch([(pick(SQL_RIEPILOGO, src), params), (pick(SQL_DETTAGLIO, src), params)]), _ok, _err,
+                        busy=self._busy, message=f"Riepilogo {corsia}…", key="refresh")
 
     # ---------- Reset ----------
     def _ask_reset(self):
@@ -211,8 +233,9 @@ class ResetCorsieWindow(tk.Toplevel):
                 messagebox.showinfo("Svuota corsia", f"Nessun pallet da rimuovere per la corsia {corsia}.", parent=self)
                 return
             # doppia conferma
-            msg = (f"Verranno cancellati {n} record da MagazziniPallet per la corsia {corsia}.",f"Questa operazione è irreversibile."f"Digitare il nome della corsia per confermare:")
-            confirm = tk.simpledialog.askstring("Conferma", msg, parent=self)
+            msg = (f"Verranno cancellati {n} record da MagazziniPallet per la corsia {corsia}.\n"
+                   "Questa operazione è irreversibile.\nDigitare il nome della corsia per confermare:")
+            confirm = simpledialog.askstring("Conferma", msg, parent=self)
             if confirm is None:
                 return
             if confirm.strip().upper() != corsia.upper():
@@ -231,7 +254,8 @@ class ResetCorsieWindow(tk.Toplevel):
         def _err_del(ex):
             messagebox.showerror("Errore", f"Svuotamento fallito:\n{ex}", parent=self)
 
-        self._async.run(self.db.query_json(SQL_DELETE, {"corsia": corsia}), _ok_del, _err_del, busy=self._busy, message=f"Svuoto {corsia}…")
+        # transazione: al commit invalida le query in cache su MagazziniPallet e sulla giacenza
+        self._async.run(svuota_corsia_async(self.db, corsia, RUNTIME.occupancy, RUNTIME.feed), _ok_del, _err_del, busy=self._busy, message=f"Svuoto {corsia}…")
 
 
 def open_reset_corsie_window(parent, db_app):
@@ -0,0 +1,278 @@
+# runtime.py — servizio unico dell'app: un loop asyncio in un thread, un AsyncMSSQLClient, un registro metriche
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, FrozenSet, Optional
+
+from async_msssql_query import AsyncMSSQLClient, make_client
+from change_feed import ChangeFeed
+from metrics import MetricsRegistry
+from scheduler import BACKGROUND, INTERACTIVE, QueryScheduler
+from occupancy import OccupancyIndex
+from search_index import SearchIndex
+from stock_snapshot import GIACENZA, StockSnapshot
+from traccia_prodotti import TRACCIA, TracciaProdotti
+
+DEFAULT_CAPACITY = 4    # slot dello scheduler senza pool (NullPool: una connessione per query)
+SOURCES_PROBE_S = 60    # ogni quanto ricontrollare gli oggetti dei motori non ancora pronti sul database
+
+
+class Runtime:
+    """
+    Ciclo di vita esplicito:
+        RUNTIME.start(dsn, pool_size=4, max_overflow=4)   # avvio (main)
+        RUNTIME.db / RUNTIME.loop / RUNTIME.submit(coro, priority="refresh")  # finestre e AsyncRunner
+        RUNTIME.shutdown()                                # chiusura (WM_DELETE_WINDOW)
+    Il loop parte anche da solo al primo accesso a .loop (finestre aperte senza main);
+    il client esiste solo dopo start() con un DSN.
+    Tutto ciò che passa da submit() entra nello scheduler: classi di priorità con un tetto
+    di concorrenza ciascuna sopra le pool_size + max_overflow connessioni (vedi scheduler.py).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self.db: Optional[AsyncMSSQLClient] = None
+        self.metrics = MetricsRegistry()
+        self.scheduler: Optional[QueryScheduler] = None
+        self.stock: Optional[StockSnapshot] = None
+        self.traccia: Optional[TracciaProdotti] = None
+        self.occupancy: Optional[OccupancyIndex] = None     # None o non ready → le finestre vanno in SQL
+        self.feed: Optional[ChangeFeed] = None               # None → le finestre si aggiornano solo con "Aggiorna"
+        self.search: Optional[SearchIndex] = None            # None o non ready → la ricerca UDC va in SQL
+        self._sources: FrozenSet[str] = frozenset()          # oggetti dei motori trovati pronti (_probe_sources)
+        self.app_version = ""          # finisce nei dump delle metriche (confronto fra release)
+
+    # ---------- loop ----------
+    @property
+    def running(self) -> bool:
+        return self._loop is not None and self._loop.is_running()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        return self.ensure_loop()
+
+    def ensure_loop(self) -> asyncio.AbstractEventLoop:
+        """Avvia il thread del loop se non c'è ancora; idempotente."""
+        if self._loop is None:
+            self._start_loop()
+        return self._loop
+
+    def _start_loop(self) -> None:
+        with self._lock:
+            if self._loop is not None:
+                return
+            ready = threading.Event()
+            holder = {}
+
+            def _run():
+                loop = asyncio.new_event_loop()
+                asyncio.set_event_loop(loop)
+                holder["loop"] = loop
+                ready.set()
+                loop.run_forever()
+                loop.close()
+
+            t = threading.Thread(target=_run, name="warehouse-asyncio", daemon=True)
+            t.start()
+            if not ready.wait(timeout=5.0):
+                raise RuntimeError("Impossibile avviare l'event loop globale")
+            self._loop, self._thread = holder["loop"], t
+
+    def submit(self, coro: Awaitable[Any], *, priority: str = INTERACTIVE) -> "concurrent.futures.Future[Any]":
+        """Esegue la coroutine sul loop del runtime (da qualsiasi thread) quando la sua classe ha uno slot."""
+        if self.scheduler is None:
+            self._make_scheduler()
+        self.metrics.inc("tasks.submitted")
+        queued_at = time.perf_counter()     # l'attesa misurata include il passaggio Tk → loop
+        return asyncio.run_coroutine_threadsafe(self.scheduler.run(coro, priority, queued_at=queued_at), self.loop)
+
+    def call(self, fn: Callable[..., Any], *args: Any) -> "concurrent.futures.Future[Any]":
+        """fn(*args) sul thread del loop, fuori dallo scheduler (letture di stato, niente DB)."""
+        fut: "concurrent.futures.Future[Any]" = concurrent.futures.Future()
+
+        def _run():
+            if not fut.set_running_or_notify_cancel():
+                return
+            try:
+                fut.set_result(fn(*args))
+            except BaseException as ex:
+                fut.set_exception(ex)
+
+        self.loop.call_soon_threadsafe(_run)
+        return fut
+
+    def _make_scheduler(self, capacity: Optional[int] = None, limits: Optional[Dict[str, int]] = None) -> None:
+        if capacity is None:
+            capacity = DEFAULT_CAPACITY
+            if self.db is not None and self.db.pooled:
+                capacity = self.db.pool_capacity
+        self.scheduler = QueryScheduler(capacity, limits, self.metrics)
+        self.metrics.register_source("scheduler", self.scheduler.stats)
+
+    # ---------- ciclo di vita ----------
+    def start(self, dsn: Optional[str] = None, *, scheduler_limits: Optional[Dict[str, int]] = None,
+              stock_refresh_s: Optional[float] = None, stock_rebuild_s: Optional[float] = None,
+              occupancy_refresh_s: Optional[float] = None, occupancy_resync_s: Optional[float] = None,
+              feed_poll_s: Optional[float] = None, traccia_refresh_s: Optional[float] = None,
+              traccia_rebuild_s: Optional[float] = None, search_refresh_s: Optional[float] = None,
+              search_resync_s: Optional[float] = None, **client_kw: Any) -> "Runtime":
+        """
+        Avvia il loop e, con un DSN, crea l'unico client DB. Idempotente.
+        dsn "sqlite:///file" → backend SQLite con lo schema di script.sql (sviluppo, benchmark).
+        scheduler_limits: tetti per classe ({"refresh": 2, ...}); default in scheduler.default_limits.
+        stock_refresh_s: ogni quanti secondi consolidare la giacenza (stock_snapshot.py, classe background);
+        stock_rebuild_s: ricostruzione completa periodica. None = motore spento: le finestre leggono lo snapshot
+        se lo mantiene un'altra istanza (local_sources), altrimenti XMag_GiacenzaPallet.
+        occupancy_refresh_s / occupancy_resync_s: indice in memoria cella ↔ UDC (occupancy.py), delta e ricarica.
+        feed_poll_s: feed delle modifiche da VersioneDati (change_feed.py) per le finestre sottoscritte.
+        traccia_refresh_s / traccia_rebuild_s: copia locale di vXTracciaProdotti (traccia_prodotti.py), coda e ricostruzione.
+        search_refresh_s / search_resync_s: indice a trigrammi della ricerca UDC (search_index.py), sopra l'occupazione.
+        """
+        self.ensure_loop()
+        new_db = dsn is not None and self.db is None
+        if new_db:
+            self.db = make_client(dsn, **client_kw)
+            self.metrics.register_source("pool", self.db.pool_stats)
+            self.metrics.register_source("cache", self.db.cache_stats)
+            self.metrics.register_source("singleflight", self.db.singleflight_stats)
+            self.metrics.register_source("statements", self.db.statement_stats)
+            self.metrics.register_source("queries", self.db.query_stats)
+            self.metrics.register_source("trace", self.db.trace_stats)
+            if self.db.slow_log is not None:
+                self.metrics.register_source("slow_log", self.db.slow_log.stats)
+        if self.scheduler is None or new_db or scheduler_limits is not None:
+            # con il pool: tanti slot quante connessioni (le code restano nello scheduler, non nel pool)
+            self._make_scheduler(limits=scheduler_limits)
+        if new_db:
+            asyncio.run_coroutine_threadsafe(self._probe_sources(SOURCES_PROBE_S), self.loop)
+        if new_db and stock_refresh_s:
+            self.stock = StockSnapshot(self.db)
+            self.metrics.register_source("stock", self.stock.stats)
+            # ogni giro prende uno slot background e lo rilascia: niente slot tenuto fra un giro e l'altro
+            asyncio.run_coroutine_threadsafe(
+                self.stock.run(stock_refresh_s, rebuild_s=stock_rebuild_s,
+                               gate=lambda coro: self.scheduler.run(coro, BACKGROUND)),
+                self.loop)
+        if new_db and traccia_refresh_s:
+            self.traccia = TracciaProdotti(self.db)
+            self.metrics.register_source("traccia", self.traccia.stats)
+            asyncio.run_coroutine_threadsafe(
+                self.traccia.run(traccia_refresh_s, rebuild_s=traccia_rebuild_s,
+                                 gate=lambda coro: self.scheduler.run(coro, BACKGROUND)),
+                self.loop)
+        if new_db and occupancy_refresh_s:
+            self.occupancy = OccupancyIndex(self.db)
+            self.metrics.register_source("occupancy", self.occupancy.stats)
+            asyncio.run_coroutine_threadsafe(
+                self.occupancy.run(occupancy_refresh_s, resync_s=occupancy_resync_s,
+                                   gate=lambda coro: self.scheduler.run(coro, BACKGROUND)),
+                self.loop)
+        if new_db and search_refresh_s and self.occupancy is not None:
+            self.search = SearchIndex(self.db, self.occupancy, sources=lambda: self.local_sources)
+            self.metrics.register_source("search", self.search.stats)
+            asyncio.run_coroutine_threadsafe(
+                self.search.run(search_refresh_s, resync_s=search_resync_s,
+                                gate=lambda coro: self.scheduler.run(coro, BACKGROUND)),
+                self.loop)
+        if new_db and feed_poll_s:
+            self.feed = ChangeFeed(self.db, before_publish=self._align_occupancy)
+            self.metrics.register_source("feed", self.feed.stats)
+            asyncio.run_coroutine_threadsafe(
+                self.feed.run(feed_poll_s, gate=lambda coro: self.scheduler.run(coro, BACKGROUND)), self.loop)
+        return self
+
+    @property
+    def local_sources(self) -> FrozenSet[str]:
+        """
+        Oggetti mantenuti dai motori che le finestre possono leggere (sql_statements.pick): trovati pronti
+        sul database o consolidati da un motore di questa istanza. Gli altri si leggono dall'originale.
+        """
+        found = set(self._sources)
+        if self.stock is not None and self.stock.ready:
+            found.add(GIACENZA)
+        if self.traccia is not None and self.traccia.ready:
+            found.add(TRACCIA)
+        return frozenset(found)
+
+    async def _probe_sources(self, every_s: float) -> None:
+        """Controlla ogni every_s secondi gli oggetti non ancora pronti, finché ci sono tutti."""
+        checks = {GIACENZA: StockSnapshot(self.db).available, TRACCIA: TracciaProdotti(self.db).available}
+        while True:
+            for name, available in checks.items():
+                if name in self._sources:
+                    continue
+                try:
+                    if await self.scheduler.run(available(), BACKGROUND):
+                        self._sources = self._sources | {name}
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    self.metrics.inc("sources.probe_errors")
+            if set(checks) <= self._sources:
+                return
+            await asyncio.sleep(every_s)
+
+    async def _align_occupancy(self) -> None:
+        """Prima di pubblicare i movimenti del feed: l'indice in memoria li ha già applicati."""
+        occ = self.occupancy
+        if occ is not None and occ.ready:
+            await occ.refresh()
+
+    def get_db(self, dsn: Optional[str] = None) -> AsyncMSSQLClient:
+        """Il client del runtime; se non c'è ancora viene creato con dsn (fallback delle finestre)."""
+        if self.db is None:
+            if dsn is None:
+                raise RuntimeError("Runtime non avviato: serve start(dsn) prima di usare il DB")
+            self.start(dsn)
+        return self.db
+
+    async def _shutdown_async(self, timeout: float) -> None:
+        me = asyncio.current_task()
+        tasks = [t for t in asyncio.all_tasks() if t is not me]
+        for t in tasks:
+            t.cancel()
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
+        if self.db is not None:
+            await self.db.dispose()
+
+    def shutdown(self, timeout: float = 3.0) -> None:
+        """Annulla i task in corso, chiude l'engine sul suo loop, ferma il loop e il thread."""
+        loop, thread = self._loop, self._thread
+        if loop is None:
+            return
+        if loop.is_running():
+            try:
+                asyncio.run_coroutine_threadsafe(self._shutdown_async(timeout), loop).result(timeout + 2)
+            except Exception:
+                pass
+            loop.call_soon_threadsafe(loop.stop)
+        if thread is not None:
+            thread.join(timeout=2.0)
+        with self._lock:
+            self._loop = None
+            self._thread = None
+            self.scheduler = None       # i suoi future appartenevano al loop fermato
+            self.metrics.unregister_source("scheduler")
+            if self.db is not None:
+                for name in ("pool", "cache", "singleflight", "statements", "queries", "trace", "slow_log",
+                             "stock", "traccia", "occupancy", "search", "feed"):
+                    self.metrics.unregister_source(name)
+                self.db = None
+                self._sources = frozenset()
+                self.stock = None
+                self.traccia = None
+                self.occupancy = None
+                self.search = None
+                self.feed = None
+
+
+RUNTIME = Runtime()
+
+
+def get_runtime() -> Runtime:
+    return RUNTIME
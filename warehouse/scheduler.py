@@ -0,0 +1,146 @@
+# scheduler.py — code di priorità sul loop del runtime: limiti di concorrenza per classe sopra il pool di connessioni
+from __future__ import annotations
+
+import asyncio
+import heapq
+import inspect
+import itertools
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Awaitable, Dict, List, Optional, Tuple
+
+from metrics import MetricsRegistry
+
+INTERACTIVE = "interactive"     # azioni dell'operatore (ricerca barcode, dettagli, prenotazioni)
+REFRESH = "refresh"             # aggiornamenti periodici/statistiche di magazzino
+BACKGROUND = "background"       # export, manutenzione, prefetch
+
+PRIORITIES: Tuple[str, ...] = (INTERACTIVE, REFRESH, BACKGROUND)   # ordine = precedenza
+
+# job dello scheduler in cui gira il task corrente: (id, classe, arrivo perf_counter); lo legge query_trace
+_JOB: ContextVar[Optional[Tuple[int, str, float]]] = ContextVar("scheduler_job", default=None)
+_JOB_IDS = itertools.count(1)
+
+
+def current_job() -> Optional[Tuple[int, str, float]]:
+    """(id, priorità, queued_at) del run() in corso nel task corrente; None fuori dallo scheduler."""
+    return _JOB.get()
+
+
+def default_limits(capacity: int) -> Dict[str, int]:
+    """interactive può usare tutto; refresh metà; background un quarto (almeno 1)."""
+    capacity = max(1, capacity)
+    return {INTERACTIVE: capacity,
+            REFRESH: max(1, capacity // 2),
+            BACKGROUND: max(1, capacity // 4)}
+
+
+class QueryScheduler:
+    """
+    capacity slot totali (di norma pool_size + max_overflow) e un tetto per classe.
+    Uno slot liberato va al primo in coda nell'ordine interactive → refresh → background
+    (FIFO nella classe) la cui classe è sotto il proprio tetto: con i tetti di default
+    refresh + background non occupano mai tutto il pool e resta spazio per l'operatore.
+    Da usare solo sul thread del loop (nessun lock).
+    """
+    def __init__(self, capacity: int, limits: Optional[Dict[str, int]] = None,
+                 metrics: Optional[MetricsRegistry] = None):
+        self.capacity = max(1, int(capacity))
+        self.limits = dict(default_limits(self.capacity), **(limits or {}))
+        self.metrics = metrics
+        self._running: Dict[str, int] = {p: 0 for p in PRIORITIES}
+        self._queue: List[Tuple[int, int, str, asyncio.Future]] = []   # (rango, seq, classe, future)
+        self._seq = itertools.count()
+
+    @property
+    def in_use(self) -> int:
+        return sum(self._running.values())
+
+    def _rank(self, priority: str) -> int:
+        try:
+            return PRIORITIES.index(priority)
+        except ValueError:
+            raise ValueError(f"priorità sconosciuta: {priority!r} (attese: {', '.join(PRIORITIES)})") from None
+
+    def _can_run(self, priority: str) -> bool:
+        return self.in_use < self.capacity and self._running[priority] < self.limits[priority]
+
+    def _grant(self, priority: str) -> None:
+        self._running[priority] += 1
+        if self.metrics is not None:
+            self.metrics.set_gauge(f"scheduler.running.{priority}", self._running[priority])
+
+    def _dispatch(self) -> None:
+        # il primo servibile in ordine di priorità: una classe al tetto non blocca le altre
+        skipped = []
+        while self._queue and self.in_use < self.capacity:
+            item = heapq.heappop(self._queue)
+            _rank, _seq, priority, fut = item
+            if fut.done():          # waiter annullato mentre era in coda
+                continue
+            if self._running[priority] >= self.limits[priority]:
+                skipped.append(item)
+                continue
+            self._grant(priority)
+            fut.set_result(None)
+        for item in skipped:
+            heapq.heappush(self._queue, item)
+
+    async def acquire(self, priority: str = INTERACTIVE) -> None:
+        rank = self._rank(priority)
+        if not self._queue and self._can_run(priority):
+            self._grant(priority)
+            return
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (rank, next(self._seq), priority, fut))
+        self._dispatch()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release(priority)      # slot assegnato ma il chiamante se ne è andato
+            raise
+
+    def release(self, priority: str) -> None:
+        self._running[priority] -= 1
+        if self.metrics is not None:
+            self.metrics.set_gauge(f"scheduler.running.{priority}", self._running[priority])
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, priority: str = INTERACTIVE, *, queued_at: Optional[float] = None) -> AsyncIterator[None]:
+        """Slot di esecuzione; queued_at (perf_counter) = quando la richiesta è partita da Tk."""
+        t0 = time.perf_counter() if queued_at is None else queued_at
+        await self.acquire(priority)
+        if self.metrics is not None:
+            self.metrics.observe(f"scheduler.wait_ms.{priority}", (time.perf_counter() - t0) * 1000)
+            self.metrics.inc(f"scheduler.started.{priority}")
+        try:
+            yield
+        finally:
+            self.release(priority)
+
+    async def run(self, coro: Awaitable[Any], priority: str = INTERACTIVE, *,
+                  queued_at: Optional[float] = None) -> Any:
+        t0 = time.perf_counter() if queued_at is None else queued_at
+        token = _JOB.set((next(_JOB_IDS), priority, t0))
+        try:
+            async with self.slot(priority, queued_at=t0):
+                res = await coro
+            if self.metrics is not None:
+                self.metrics.observe(f"scheduler.latency_ms.{priority}", (time.perf_counter() - t0) * 1000)
+            return res
+        finally:
+            _JOB.reset(token)
+            # coroutine mai partita (annullata in coda): niente "never awaited"
+            if inspect.iscoroutine(coro) and inspect.getcoroutinestate(coro) == inspect.CORO_CREATED:
+                coro.close()
+
+    def stats(self) -> Dict[str, Any]:
+        queued: Dict[str, int] = {p: 0 for p in PRIORITIES}
+        for _r, _s, p, fut in self._queue:
+            if not fut.done():
+                queued[p] += 1
+        return {"capacity": self.capacity, "limits": dict(self.limits),
+                "running": dict(self._running), "queued": queued}
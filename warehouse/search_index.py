@@ -0,0 +1,373 @@
+# search_index.py — indice a trigrammi per la ricerca UDC / Lotto / Codice: giacenza da occupancy, tracciabilità in memoria
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import sys
+import threading
+import time
+from array import array
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from async_msssql_query import AsyncMSSQLClient
+from occupancy import CELLA_NON_SCAFFALATO, OccupancyIndex
+from sql_statements import ID_INT, pick, register, register_sources
+from stock_snapshot import GIACENZA, GIACENZA_ORIGINALE
+from traccia_prodotti import TRACCIA, TRACCIA_ORIGINALE
+
+# finché la copia della traccia non è pronta (sources()) si legge vXTracciaProdotti
+_ORIGINALI = {GIACENZA: GIACENZA_ORIGINALE, TRACCIA: TRACCIA_ORIGINALE}
+
+# tracciabilità dei soli pallet in giacenza (al load) e di un pallet che entra dopo
+SQL_TRACCIA_GIACENZA = register_sources("search_index.traccia", """
+SELECT t.Pallet, t.Lotto, t.Prodotto, t.Descrizione
+FROM dbo.XMag_TracciaProdottiLocale AS t
+WHERE t.Pallet IN (SELECT LEFT(g.BarcodePallet, 6) COLLATE Latin1_General_CI_AS
+                   FROM dbo.XMag_GiacenzaPalletSnapshot AS g)
+""", _ORIGINALI)
+# pallet come lista JSON: un solo statement set-based per blocco (seek sull'indice cluster per ogni valore)
+_PALLET_JSON = {"mssql": "SELECT j.Pallet FROM OPENJSON(:pallets) WITH (Pallet varchar(6) '$') AS j",
+                "sqlite": "SELECT j.value FROM json_each(:pallets) AS j"}
+SQL_TRACCIA_PALLET = {d: register_sources(f"search_index.traccia_pallet.{d}", f"""
+SELECT t.Pallet, t.Lotto, t.Prodotto, t.Descrizione
+FROM dbo.XMag_TracciaProdottiLocale AS t
+WHERE t.Pallet IN ({j})
+""", _ORIGINALI) for d, j in _PALLET_JSON.items()}
+# gruppi copiati da traccia_prodotti.py dopo l'ultimo letto (seek su IX_XMag_TracciaProdotti_UltimoID);
+# solo con la copia pronta, senza i lotti nuovi di pallet già noti arrivano al load successivo
+SQL_TRACCIA_NUOVE = register("search_index.traccia_nuove", """
+SELECT t.Pallet, t.Lotto, t.Prodotto, t.Descrizione, t.UltimoID
+FROM dbo.XMag_TracciaProdotti AS t
+WHERE t.UltimoID > :wm
+""", wm=ID_INT)
+SQL_TRACCIA_MAX = register("search_index.traccia_max", "SELECT MAX(UltimoID) FROM dbo.XMag_TracciaProdotti")
+
+JOLLY = "%_["           # caratteri jolly di LIKE: quella ricerca resta a SQL_SEARCH
+
+Traccia = Tuple[Optional[str], Optional[str], Optional[str]]    # (Lotto, Prodotto, Descrizione) come nel DB
+
+
+def chiave_pallet(testo: Optional[str]) -> str:
+    """Pallet come lo confronta la JOIN di SQL_SEARCH: LEFT(UDC, 6) con collation CI_AS."""
+    return (testo or "")[:6].rstrip(" ").upper()
+
+
+def _ord(v: Any) -> Tuple[int, str]:
+    """Chiave d'ordine come ORDER BY con collation CI_AS: NULL prima, maiuscole = minuscole, spazi finali ignorati."""
+    return (0, "") if v is None else (1, str(v).rstrip(" ").upper())
+
+
+def _trigrammi(testo: str) -> Set[str]:
+    return {testo[i:i + 3] for i in range(len(testo) - 2)}
+
+
+class Trigrammi:
+    """Valori distinti → id, trigramma → id dei valori; solo aggiunte (la ricarica compatta)."""
+    def __init__(self):
+        self.ids: Dict[str, int] = {}
+        self.valori: List[str] = []
+        self._post: Dict[str, array] = {}
+
+    def add(self, valore: str) -> int:
+        i = self.ids.get(valore)
+        if i is None:
+            i = self.ids[valore] = len(self.valori)
+            self.valori.append(valore)
+            for g in _trigrammi(valore):
+                p = self._post.get(g)
+                if p is None:
+                    p = self._post[g] = array("I")
+                p.append(i)
+        return i
+
+    def cerca(self, parte: str) -> List[int]:
+        """Id dei valori che contengono parte (normalizzata); sotto i 3 caratteri scorre tutti i valori."""
+        valori = self.valori
+        if len(parte) < 3:
+            return [i for i, v in enumerate(valori) if parte in v]
+        liste = []
+        for g in _trigrammi(parte):
+            p = self._post.get(g)
+            if p is None:
+                return []
+            liste.append(p)
+        liste.sort(key=len)
+        cand = set(liste[0])
+        for p in liste[1:]:
+            if len(cand) <= 64:
+                break       # pochi candidati: la verifica costa meno dell'intersezione
+            cand.intersection_update(p)
+        return [i for i in cand if parte in valori[i]]
+
+
+class _Mappe:
+    """Stato dell'indice; 200k pallet in prod: chiavi internate e tuple invece di liste e set."""
+    def __init__(self):
+        self.udc = Trigrammi()                                  # UDC viste in giacenza
+        self.campi = {"lotto": Trigrammi(), "prodotto": Trigrammi(), "descrizione": Trigrammi()}
+        self.pallet_di: Dict[str, Dict[int, Tuple[str, ...]]] = {c: {} for c in self.campi}  # campo → valore → pallet
+        self.traccia: Dict[str, Tuple[Traccia, ...]] = {}       # pallet → righe di tracciabilità
+        self.udc_di: Dict[str, Tuple[str, ...]] = {}            # pallet → UDC più lunghe di 6 caratteri
+        self.noti: Set[str] = set()                             # pallet con la tracciabilità già letta
+
+    def add_udc(self, udc: str) -> str:
+        self.udc.add(udc)
+        p = sys.intern(chiave_pallet(udc))
+        if p != udc:
+            altre = self.udc_di.get(p, ())
+            if udc not in altre:
+                self.udc_di[p] = altre + (udc,)
+        return p
+
+    def udc_del_pallet(self, p: str) -> List[str]:
+        altre = list(self.udc_di.get(p, ()))
+        return [p] + altre if p in self.udc.ids else altre
+
+    def add_traccia(self, pallet: Optional[str], lotto: Optional[str], prodotto: Optional[str],
+                    descrizione: Optional[str]) -> None:
+        p = sys.intern(chiave_pallet(pallet))
+        riga = (lotto, sys.intern(prodotto) if prodotto else prodotto,
+                sys.intern(descrizione) if descrizione else descrizione)
+        righe = self.traccia.get(p, ())
+        if riga in righe:
+            return
+        self.traccia[p] = righe + (riga,)
+        for campo, v in zip(("lotto", "prodotto", "descrizione"), riga):
+            if v is not None:
+                per_valore = self.pallet_di[campo]
+                i = self.campi[campo].add(v.upper())
+                ps = per_valore.get(i, ())
+                if p not in ps:
+                    per_valore[i] = ps + (p,)
+
+
+class SearchIndex:
+    """
+    Ricerca per sottostringa (LIKE '%x%') su UDC, lotto e codice prodotto dalla memoria:
+        idx = SearchIndex(db, occupancy)
+        await idx.load()                            # tracciabilità dei pallet in giacenza (una query)
+        idx.cerca(udc="A1B", lotto=None, codice="123")   # righe come SQL_SEARCH, o None → usare SQL
+    UDC e celle vengono dall'indice di occupazione; qui solo trigrammi e tracciabilità dei pallet.
+    """
+    def __init__(self, db: AsyncMSSQLClient, occupancy: OccupancyIndex, *, chunk: int = 200,
+                 max_udc: int = 10_000, sources: Optional[Callable[[], Iterable[str]]] = None):
+        self.db = db
+        self.occupancy = occupancy
+        self.sources = sources or (lambda: (GIACENZA, TRACCIA))
+        self.chunk = chunk
+        self.max_udc = max_udc
+        self._lock = threading.Lock()
+        self._m = _Mappe()
+        self._attesa: Set[str] = set()          # pallet in giacenza con tracciabilità ancora da leggere
+        self._wm: Optional[int] = None          # MAX(UltimoID) di XMag_TracciaProdotti già letto (None: senza copia)
+        self._ready = False
+        self._ricarica_udc = False
+        self._wake: Optional[asyncio.Event] = None
+        self._unsubscribe = occupancy.subscribe(self._on_occupancy)
+        self._log = logging.getLogger("SearchIndex")
+        self._stats: Dict[str, Any] = {"loads": 0, "refreshes": 0, "searches": 0, "fallbacks": 0,
+                                       "pallets_fetched": 0, "errors": 0, "load_ms": None,
+                                       "last_search_ms": None, "last_error": None}
+
+    @property
+    def ready(self) -> bool:
+        return self._ready and self.occupancy.ready
+
+    # ---------- caricamento ----------
+    async def load(self) -> Dict[str, Any]:
+        """Trigrammi e tracciabilità da zero; le UDC entrate nel frattempo si recuperano dopo lo scambio."""
+        t0 = time.perf_counter()
+        udcs = self.occupancy.udc_in_giacenza()     # prima della query: i loro pallet sono nel risultato
+        src = frozenset(self.sources())
+        wm = None
+        if TRACCIA in src:
+            wm = (await self.db.query_json(SQL_TRACCIA_MAX))["rows"][0][0] or 0
+        rows = (await self.db.query_json(pick(SQL_TRACCIA_GIACENZA, src)))["rows"]
+        m = await asyncio.to_thread(self._build, rows, udcs)
+        with self._lock:
+            self._m = m
+            self._attesa = set()
+            self._wm = wm
+            self._ready = True
+        self._allinea_udc()
+        ms = round((time.perf_counter() - t0) * 1000, 3)
+        self._stats.update(loads=self._stats["loads"] + 1, load_ms=ms)
+        return {"udc": len(udcs), "traccia": len(rows), "ms": ms}
+
+    @staticmethod
+    def _build(rows: List[List[Any]], udcs: List[str]) -> _Mappe:
+        m = _Mappe()
+        for pallet, lotto, prodotto, descrizione in rows:
+            m.add_traccia(pallet, lotto, prodotto, descrizione)
+        for u in udcs:
+            m.noti.add(m.add_udc(u))
+        return m
+
+    def _allinea_udc(self) -> None:
+        """Aggiunge le UDC in giacenza che l'indice non ha (entrate durante un load, o dopo un load dell'occupazione)."""
+        udcs = self.occupancy.udc_in_giacenza()
+        with self._lock:
+            m = self._m
+            self._add_udc(u for u in udcs if u not in m.udc.ids)
+            self._ricarica_udc = False
+
+    def _add_udc(self, udcs: Iterable[str]) -> None:
+        m = self._m
+        for u in udcs:
+            p = m.add_udc(u)
+            if p not in m.noti:
+                self._attesa.add(p)
+
+    def _on_occupancy(self, entrate: Optional[List[str]]) -> None:
+        """Dal loop del runtime, dopo un refresh (UDC entrate) o un load (None) dell'occupazione."""
+        if entrate is None:
+            self._ricarica_udc = True
+        elif self._ready:
+            with self._lock:
+                self._add_udc(entrate)
+        if self._wake is not None:
+            self._wake.set()
+
+    # ---------- aggiornamento incrementale ----------
+    async def refresh(self) -> Dict[str, Any]:
+        """Tracciabilità dei pallet in attesa (a blocchi di chunk) e dei gruppi nuovi della copia."""
+        if not self._ready:
+            return dict(await self.load(), more=False)
+        if self._ricarica_udc:
+            self._allinea_udc()
+        with self._lock:
+            attesa = sorted(self._attesa)[:self.chunk]
+            wm = self._wm
+        letti: List[List[Any]] = []
+        if attesa:
+            sql = pick(SQL_TRACCIA_PALLET[self._dialect], self.sources())
+            letti = (await self.db.query_json(sql, {"pallets": json.dumps(attesa)}))["rows"]
+        nuove = (await self.db.query_json(SQL_TRACCIA_NUOVE, {"wm": wm}))["rows"] if wm is not None else []
+        with self._lock:
+            m = self._m
+            for pallet, lotto, prodotto, descrizione in letti:
+                m.add_traccia(pallet, lotto, prodotto, descrizione)
+            m.noti.update(attesa)
+            self._attesa.difference_update(attesa)
+            for pallet, lotto, prodotto, descrizione, ultimo in nuove:
+                if chiave_pallet(pallet) in m.noti:
+                    m.add_traccia(pallet, lotto, prodotto, descrizione)
+                self._wm = max(self._wm, ultimo)
+            more = bool(self._attesa)
+        s = self._stats
+        s.update(refreshes=s["refreshes"] + 1, pallets_fetched=s["pallets_fetched"] + len(attesa))
+        return {"pallets": len(attesa), "new_groups": len(nuove), "more": more}
+
+    # ---------- ricerca (qualsiasi thread) ----------
+    def cerca(self, udc: Optional[str] = None, lotto: Optional[str] = None, codice: Optional[str] = None,
+              descrizione: Optional[str] = None) -> Optional[List[List[Any]]]:
+        """
+        Righe di SQL_SEARCH nello stesso ordine; None → chiedere al DB (indice non pronto, pallet in attesa,
+        caratteri jolly, nessun filtro, più di max_udc UDC).
+        """
+        filtri = {k: (v or "").strip().upper() for k, v in
+                  (("udc", udc), ("lotto", lotto), ("prodotto", codice), ("descrizione", descrizione))}
+        filtri = {k: v for k, v in filtri.items() if v}
+        if (not self.ready or self._attesa or not filtri
+                or any(ch in v for v in filtri.values() for ch in JOLLY)):
+            self._stats["fallbacks"] += 1
+            return None
+        t0 = time.perf_counter()
+        campi = [(i, filtri[c]) for i, c in enumerate(("lotto", "prodotto", "descrizione")) if c in filtri]
+        with self._lock:
+            m = self._m
+            pallet: Optional[Set[str]] = None
+            for c in ("lotto", "prodotto", "descrizione"):
+                if c in filtri:
+                    per_valore = m.pallet_di[c]
+                    trovati = {p for v in m.campi[c].cerca(filtri[c]) for p in per_valore.get(v, ())}
+                    pallet = trovati if pallet is None else pallet & trovati
+            if "udc" in filtri:
+                udcs = [m.udc.valori[i] for i in m.udc.cerca(filtri["udc"])]
+                if pallet is not None:
+                    udcs = [u for u in udcs if chiave_pallet(u) in pallet]
+            else:
+                udcs = [u for p in pallet for u in m.udc_del_pallet(p)]
+            tracce: Dict[str, List[Tuple[Traccia, Tuple]]] = {}
+            for u in (udcs if len(udcs) <= self.max_udc else ()):
+                p = chiave_pallet(u)
+                if p not in tracce:
+                    # LIKE su NULL non è vero: con un filtro sulla tracciabilità le righe senza valore escono
+                    tracce[p] = [(r, (_ord(r[0]), _ord(r[1]))) for r in m.traccia.get(p, ())
+                                 if all(r[i] is not None and parte in r[i].upper() for i, parte in campi)]
+        if len(udcs) > self.max_udc:
+            self._stats["fallbacks"] += 1
+            return None
+        occ = self.occupancy
+        celle: Dict[int, Optional[Tuple[str, Tuple]]] = {}      # IDCella → (Ubicazione, chiave d'ordine)
+        out: List[Tuple[Tuple, List[Any]]] = []
+        for u, (raw, posizioni) in occ.righe_di(udcs).items():
+            righe = tracce[chiave_pallet(u)]
+            if not righe:
+                if campi:
+                    continue
+                righe = [((None, None, None), ((0, ""), (0, "")))]      # LEFT JOIN senza tracciabilità
+            ord_udc = _ord(raw)
+            for idcella, n in posizioni:
+                cella = celle.get(idcella, False)
+                if cella is False:
+                    ce = occ.cella(idcella)
+                    cella = celle[idcella] = None if ce is None else (
+                        ".".join("NA" if v is None else str(v).strip(" ") for v in (ce.Corsia, ce.Colonna, ce.Fila)).upper(),
+                        (idcella == CELLA_NON_SCAFFALATO, _ord(ce.Corsia), _ord(ce.Colonna), _ord(ce.Fila)))
+                if cella is None:
+                    continue                        # la giacenza fa INNER JOIN con Celle
+                ubi, ord_cella = cella
+                for (lot, prod, desc), ord_traccia in righe:
+                    k = ord_cella + (ord_udc,) + ord_traccia
+                    out.extend((k, [idcella, ubi, raw, lot, prod, desc]) for _ in range(n))
+        out.sort(key=lambda kr: kr[0])
+        ms = round((time.perf_counter() - t0) * 1000, 3)
+        self._stats.update(searches=self._stats["searches"] + 1, last_search_ms=ms)
+        return [r for _k, r in out]
+
+    # ---------- ciclo in background ----------
+    async def run(self, every_s: float, *, resync_s: Optional[float] = None,
+                  gate: Optional[Callable[[Awaitable[Any]], Awaitable[Any]]] = None) -> None:
+        """load() a occupazione pronta, poi refresh() ogni every_s o a ogni UDC entrata; load() ogni resync_s."""
+        gate = gate or (lambda c: c)
+        self._wake = asyncio.Event()
+        last_load = None
+        while True:
+            more = False
+            try:
+                if not self.occupancy.ready:
+                    pass
+                elif last_load is None or (resync_s and time.monotonic() - last_load >= resync_s):
+                    await gate(self.load())
+                    last_load = time.monotonic()
+                else:
+                    more = (await gate(self.refresh())).get("more", False)
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                self._stats["errors"] += 1
+                self._stats["last_error"] = f"{type(ex).__name__}: {ex}"
+                self._log.warning("indice di ricerca: %s", self._stats["last_error"])
+            if not more:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), every_s)
+                except asyncio.TimeoutError:
+                    pass
+                self._wake.clear()
+
+    @property
+    def _dialect(self) -> str:
+        return "sqlite" if self.db.backend == "sqlite" else "mssql"
+
+    def close(self) -> None:
+        self._unsubscribe()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            m = self._m
+            size = {"udc": len(m.udc.valori), "pallets": len(m.traccia), "pending": len(self._attesa),
+                    "values": {c: len(t.valori) for c, t in m.campi.items()}, "watermark": self._wm,
+                    "ready": self.ready}
+        return dict(self._stats, **size)
@@ -6,10 +6,15 @@
 # - Se la ricerca restituisce >0 righe, i campi input vengono svuotati
 
 from __future__ import annotations
+import asyncio
 import tkinter as tk
 from tkinter import ttk, messagebox
 
 from gestione_aree_frame_async import BusyOverlay, AsyncRunner
+from runtime import RUNTIME
+from sql_statements import TESTO, pick, register_sources
+from stock_snapshot import GIACENZA, GIACENZA_ORIGINALE
+from traccia_prodotti import TRACCIA, TRACCIA_ORIGINALE
 from tkinter import filedialog
 
 # opzionale export xlsx
@@ -26,7 +31,11 @@ try:
 except Exception:
     Sheet = None
 
-SQL_SEARCH = r"""
+# finché snapshot e copia della traccia non sono pronti (RUNTIME.local_sources) le query leggono le viste originali
+_ORIGINALI = {GIACENZA: GIACENZA_ORIGINALE, TRACCIA: TRACCIA_ORIGINALE}
+
+
+SQL_SEARCH = register_sources("search_pallets", r"""
 WITH BASE AS (
     SELECT
         g.IDCella,
@@ -35,7 +44,7 @@ WITH BASE AS (
         c.Corsia,
         c.Colonna,
         c.Fila
-    FROM dbo.XMag_GiacenzaPallet AS g
+    FROM dbo.XMag_GiacenzaPalletSnapshot AS g
     LEFT JOIN dbo.Celle AS c ON c.ID = g.IDCella
     -- NB: qui NON escludiamo IDCella=9999 né '7G'
 ),
@@ -50,7 +59,7 @@ JOINED AS (
         t.Prodotto,
         t.Descrizione
     FROM BASE b
-    LEFT JOIN dbo.vXTracciaProdotti AS t
+    LEFT JOIN dbo.XMag_TracciaProdottiLocale AS t
       ON t.Pallet COLLATE Latin1_General_CI_AS = LEFT(b.UDC, 6) COLLATE Latin1_General_CI_AS
 )
 SELECT 
@@ -74,7 +83,7 @@ WHERE 1=1
 ORDER BY 
     CASE WHEN j.IDCella = 9999 THEN 1 ELSE 0 END,
     j.Corsia, j.Colonna, j.Fila, j.UDC, j.Lotto, j.Prodotto;
-"""
+""", _ORIGINALI, udc=TESTO, lotto=TESTO, codice=TESTO)
 
 class SearchWindow(tk.Toplevel):
     def __init__(self, parent: tk.Widget, db_app):
@@ -389,25 +398,32 @@ class SearchWindow(tk.Toplevel):
             "codice": (codice if codice else None),
         }
 
-        def _ok(res):
-            rows = res.get("rows", []) if isinstance(res, dict) else []
-            # --- popola UI ---
+        # --- popola UI a blocchi: le prime righe compaiono mentre il resto arriva ---
+        if self.use_sheet:
+            try:
+                self.sheet.set_sheet_data([])
+            except Exception:
+                self.use_sheet = False
+        if not self.use_sheet:
+            for iid in self.tree.get_children():
+                self.tree.delete(iid)
+        shown = {"n": 0}
+
+        def _on_batch(rows):
             if self.use_sheet:
                 try:
                     data = []
                     for r in rows:
                         idc, ubi, udc_v, lot_v, cod_v, desc_v = r
                         data.append([idc, ubi, udc_v, lot_v, cod_v, desc_v])
-                    self.sheet.set_sheet_data(data)
+                    self.sheet.insert_rows(data)
                     self.sheet.set_all_cell_sizes_to_text()
-                except Exception as ex:
+                except Exception:
                     # fallback di sicurezza su Treeview
                     self.use_sheet = False
             if not self.use_sheet:
                 # Treeview
-                for iid in self.tree.get_children():
-                    self.tree.delete(iid)
-                for idx, r in enumerate(rows):
+                for idx, r in enumerate(rows, start=shown["n"]):
                     idc, ubi, udc_v, lot_v, cod_v, desc_v = r
                     zebra = "even" if idx % 2 == 0 else "odd"
                     try:
@@ -416,9 +432,11 @@ class SearchWindow(tk.Toplevel):
                         is9999 = False
                     tags = ("id9999", zebra) if is9999 else (zebra,)
                     self.tree.insert("", "end", values=(idc, ubi, udc_v, lot_v, cod_v, desc_v), tags=tags)
+            shown["n"] += len(rows)
 
+        def _on_done(total):
             # --- feedback utente ---
-            if not rows:
+            if not total:
                 messagebox.showinfo(
                     "Nessun risultato",
                     "Nessuna corrispondenza trovata con le chiavi di ricerca inserite.",
@@ -435,7 +453,27 @@ class SearchWindow(tk.Toplevel):
             self._busy.hide()
             messagebox.showerror("Errore ricerca", str(ex), parent=self)
 
-        self._async.run(self.db.query_json(SQL_SEARCH, params), _ok, _err, busy=self._busy, message="Cerco…")
+        def _sql():
+            self._async.run_stream(self.db.stream(pick(SQL_SEARCH, RUNTIME.local_sources), params, batch_size=500),
+                                   _on_batch, _on_done, _err, busy=self._busy, message="Cerco…", key="search")
+
+        def _from_index(rows):
+            # None: indice non allineato, caratteri jolly, nessun filtro o troppe UDC; vuoto: l'indice
+            # può non avere ancora un'UDC entrata dopo l'ultimo refresh, decide SQL
+            if not rows:
+                _sql()
+                return
+            for i in range(0, len(rows), 500):
+                _on_batch(rows[i:i + 500])
+            _on_done(len(rows))
+
+        # stesse righe di SQL_SEARCH dall'indice a trigrammi (search_index.py), fuori dal thread di Tk
+        idx = RUNTIME.search
+        if idx is not None and idx.ready:
+            self._async.run(asyncio.to_thread(idx.cerca, params["udc"], params["lotto"], params["codice"]),
+                            _from_index, _err, busy=self._busy, message="Cerco…", key="search")
+            return
+        _sql()
 
 
 def open_search_window(parent, db_app):
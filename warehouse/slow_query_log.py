@@ -0,0 +1,107 @@
+# slow_query_log.py — query oltre soglia su file JSONL, con piano (STATISTICS XML) e letture logiche (STATISTICS IO)
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import re
+import time
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+# "Table 'Celle'. Scan count 1, logical reads 123, physical reads 0, ..."
+_RE_IO = re.compile(r"Table '([^']+)'\. Scan count (\d+), logical reads (\d+)(?:, physical reads (\d+))?")
+
+
+def parse_statistics_io(messages: List[str]) -> Dict[str, Any]:
+    """Messaggi di SET STATISTICS IO → letture per tabella (sommate se la tabella compare più volte)."""
+    tables: Dict[str, Dict[str, int]] = {}
+    for msg in messages:
+        for m in _RE_IO.finditer(msg):
+            t = tables.setdefault(m.group(1), {"scans": 0, "logical_reads": 0, "physical_reads": 0})
+            t["scans"] += int(m.group(2))
+            t["logical_reads"] += int(m.group(3))
+            t["physical_reads"] += int(m.group(4) or 0)
+    return {"tables": tables, "logical_reads": sum(t["logical_reads"] for t in tables.values())}
+
+
+def _safe_name(name: str) -> str:
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", name)[:80]
+
+
+class SlowQueryLog:
+    """
+    Una riga JSON per query lenta (nome, SQL, parametri, tempi) in path. Per le SELECT la query
+    viene rieseguita una volta, in background, con STATISTICS XML/IO: il piano va in
+    plans/<ts>_<nome>.sqlplan (si apre con SSMS) e le letture logiche nella riga del log.
+    Una cattura per nome ogni cooldown_s secondi e una alla volta: una query lenta non
+    viene rilanciata a raffica sul server.
+    """
+    def __init__(self, path: str, threshold_ms: float, *, capture_plans: bool = True,
+                 cooldown_s: float = 600.0):
+        self.path = path
+        self.threshold_ms = float(threshold_ms)
+        self.capture_plans = capture_plans
+        self.cooldown_s = cooldown_s
+        self.plans_dir = os.path.join(os.path.dirname(os.path.abspath(path)), "plans")
+        self._last_capture: Dict[str, float] = {}
+        self._capturing: Optional[asyncio.Lock] = None
+        self._tasks: set = set()
+        self.logged = 0
+        self.captured = 0
+
+    def is_slow(self, elapsed_ms: float) -> bool:
+        return elapsed_ms >= self.threshold_ms
+
+    def observe(self, name: str, sql: str, params: Optional[Dict[str, Any]], elapsed_ms: float,
+                capture: Optional[Callable[[str, Optional[Dict[str, Any]]], Awaitable[Dict[str, Any]]]],
+                **extra: Any) -> None:
+        """Chiamata sul loop a query finita; capture = coroutine che riesegue con le statistiche."""
+        entry: Dict[str, Any] = {
+            "ts": datetime.now().isoformat(timespec="milliseconds"),
+            "name": name, "elapsed_ms": round(elapsed_ms, 3), "threshold_ms": self.threshold_ms,
+            "params": params or {}, "sql": sql, **extra,
+        }
+        now = time.monotonic()
+        if (capture is None or not self.capture_plans
+                or now - self._last_capture.get(name, -1e18) < self.cooldown_s):
+            self._write(entry)
+            return
+        self._last_capture[name] = now
+        task = asyncio.ensure_future(self._capture(entry, capture, sql, params))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _capture(self, entry: Dict[str, Any], capture, sql: str, params) -> None:
+        if self._capturing is None:
+            self._capturing = asyncio.Lock()
+        try:
+            async with self._capturing:
+                res = await capture(sql, params)
+            plan = res.pop("plan_xml", None)
+            if plan:
+                os.makedirs(self.plans_dir, exist_ok=True)
+                ts = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+                plan_path = os.path.join(self.plans_dir, f"{ts}_{_safe_name(entry['name'])}.sqlplan")
+                with open(plan_path, "w", encoding="utf-8") as f:
+                    f.write(plan)
+                res["plan_file"] = plan_path
+            entry["capture"] = res
+            self.captured += 1
+        except asyncio.CancelledError:
+            entry["capture"] = {"error": "annullata"}
+            self._write(entry)
+            raise
+        except Exception as ex:
+            entry["capture"] = {"error": f"{type(ex).__name__}: {ex}"}
+        self._write(entry)
+
+    def _write(self, entry: Dict[str, Any]) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, default=str, ensure_ascii=False) + "\n")
+        self.logged += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {"threshold_ms": self.threshold_ms, "logged": self.logged, "captured": self.captured,
+                "capturing": len(self._tasks), "path": self.path}
@@ -0,0 +1,123 @@
+# sql_scripts.py — script T-SQL del repository (schema di produzione e oggetti dei motori): percorsi, batch, deploy
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import re
+from typing import Any, List, Optional, Sequence
+
+from sql_statements import register
+
+_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SCRIPT_SQL = os.path.join(_DIR, "script.sql")                # schema di Mediseawall (export SSMS)
+SNAPSHOT_SQL = os.path.join(_DIR, "stock_snapshot.sql")      # giacenza materializzata (stock_snapshot.py)
+TRACCIA_SQL = os.path.join(_DIR, "traccia_prodotti.sql")     # copia di vXTracciaProdotti (traccia_prodotti.py)
+FEED_SQL = os.path.join(_DIR, "change_feed.sql")             # indici su VersioneDati (change_feed.py)
+
+_RE_GO = re.compile(r"^\s*GO\s*$", re.M | re.I)
+_RE_USE = re.compile(r"^\s*USE\s+\[?\w+\]?\s*$", re.I)
+_RE_COMMENT = re.compile(r"--[^\n]*|/\*.*?\*/", re.S)
+
+
+def read_script(path: str) -> str:
+    """Testo dello script (SSMS salva anche in UTF-16), con fine riga \\n."""
+    with open(path, "rb") as f:
+        raw = f.read()
+    if raw[:2] in (b"\xff\xfe", b"\xfe\xff"):
+        return raw.decode("utf-16").replace("\r\n", "\n")
+    return raw.decode("utf-8-sig").replace("\r\n", "\n")
+
+
+def split_go(script: str) -> List[str]:
+    """Batch separati da GO, così come sono (vuoti compresi)."""
+    return _RE_GO.split(script)
+
+
+def script_batches(path: str) -> List[str]:
+    """Batch di uno script SSMS (separati da GO), senza quelli vuoti e senza USE: il database è quello del DSN."""
+    return [b.strip() for b in split_go(read_script(path))
+            if b.strip() and not _RE_USE.match(_RE_COMMENT.sub(" ", b))]
+
+
+# Gli oggetti dei motori (stock_snapshot.sql, traccia_prodotti.sql, change_feed.sql) sono un passo di deploy:
+# li crea il DBA (sqlcmd -i, SSMS o main() qui sotto) con il permesso DDL; i client controllano solo che ci siano.
+SQL_MISSING_OBJECTS = {
+    "mssql": register("schema.missing_objects.mssql", """
+SELECT j.value FROM OPENJSON(:names) AS j WHERE OBJECT_ID(N'dbo.' + j.value) IS NULL
+"""),
+    "sqlite": register("schema.missing_objects.sqlite", """
+SELECT j.value FROM json_each(:names) AS j
+WHERE NOT EXISTS (SELECT 1 FROM sqlite_master AS o WHERE o.type IN ('table', 'view') AND o.name = j.value)
+"""),
+}
+# indici come "Tabella.Indice"
+SQL_MISSING_INDEXES = {
+    "mssql": register("schema.missing_indexes.mssql", """
+SELECT j.value FROM OPENJSON(:names) AS j
+WHERE NOT EXISTS (SELECT 1 FROM sys.indexes AS i
+                  WHERE i.object_id = OBJECT_ID(N'dbo.' + PARSENAME(j.value, 2)) AND i.name = PARSENAME(j.value, 1))
+"""),
+    "sqlite": register("schema.missing_indexes.sqlite", """
+SELECT j.value FROM json_each(:names) AS j
+WHERE NOT EXISTS (SELECT 1 FROM sqlite_master AS o
+                  WHERE o.type = 'index' AND o.tbl_name || '.' || o.name = j.value)
+"""),
+}
+
+
+def _bare(name: str) -> str:
+    return name.split(".")[-1].strip("[]")
+
+
+async def missing_objects(db: Any, objects: Sequence[str] = (), indexes: Sequence[str] = ()) -> List[str]:
+    """
+    Tabelle/viste ("dbo.X") e indici ("Tabella.Indice") che mancano sul database, nell'ordine dato.
+    db: client o transazione (query_json + backend); solo letture di catalogo, nessun DDL.
+    """
+    dialect = "sqlite" if db.backend == "sqlite" else "mssql"
+    missing: List[str] = []
+    if objects:
+        rows = (await db.query_json(SQL_MISSING_OBJECTS[dialect], {"names": json.dumps([_bare(o) for o in objects])}))["rows"]
+        gone = {r[0] for r in rows}
+        missing += [o for o in objects if _bare(o) in gone]
+    if indexes:
+        rows = (await db.query_json(SQL_MISSING_INDEXES[dialect], {"names": json.dumps(list(indexes))}))["rows"]
+        gone = {r[0] for r in rows}
+        missing += [i for i in indexes if i in gone]
+    return missing
+
+
+async def deploy(db: Any, paths: Sequence[str]) -> int:
+    """Esegue gli script (idempotenti) batch per batch; ritorna i batch eseguiti."""
+    n = 0
+    for path in paths:
+        for batch in script_batches(path):
+            await db.exec(batch, commit=True)
+            n += 1
+    return n
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    from async_msssql_query import make_client
+    ap = argparse.ArgumentParser(description="Deploy degli oggetti dei motori (serve il permesso DDL)")
+    ap.add_argument("dsn", help="mssql+aioodbc://... (vedi make_mssql_dsn)")
+    ap.add_argument("scripts", nargs="*", default=[SNAPSHOT_SQL, TRACCIA_SQL, FEED_SQL])
+    args = ap.parse_args(argv)
+
+    async def _run() -> int:
+        db = make_client(args.dsn)
+        try:
+            return await deploy(db, args.scripts)
+        finally:
+            await db.dispose()
+
+    n = asyncio.run(_run())
+    print(f"{n} batch eseguiti")
+    return n
+
+
+if __name__ == "__main__":
+    main()
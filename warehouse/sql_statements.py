@@ -0,0 +1,204 @@
+# sql_statements.py — registro degli statement: text() costruito una volta per testo SQL, tipi dei parametri dichiarati
+from __future__ import annotations
+
+import time
+import weakref
+import zlib
+from collections import OrderedDict
+from itertools import combinations
+from typing import Any, Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+from sqlalchemy import bindparam, text
+from sqlalchemy.engine.interfaces import BindTyping
+from sqlalchemy.sql.elements import TextClause
+from sqlalchemy.types import BigInteger, DateTime, Integer, NullType, String
+
+# Tipi dei parametri allineati alle colonne di script.sql. Con mssql+pyodbc (setinputsizes)
+# String(n) arriva come VARCHAR: un str python non tipizzato arriva come NVARCHAR e il confronto
+# con una colonna varchar diventa CONVERT_IMPLICIT sulla colonna (scan invece di seek).
+BARCODE = String(16)    # MagazziniPallet.Attributo → XMag_GiacenzaPallet.BarcodePallet varchar(16)
+CORSIA = String(8)      # Celle.Corsia / Colonna / Fila varchar(8)
+UTENTE = String(50)     # Celle.InsUtente / ModUtente varchar(50)
+TESTO = String(64)      # filtri LIKE su colonne varchar (lotto, codice prodotto)
+ID_INT = Integer()      # chiavi int (Celle.ID, MagazziniPallet.IDCella, ...)
+DATAORA = DateTime()    # colonne datetime
+VERSIONE = BigInteger()  # rowversion (VersioneDati) letta come CAST(... AS bigint)
+
+
+_SIZES: "weakref.WeakKeyDictionary[Any, Optional[List[Tuple[str, Any, Any]]]]" = weakref.WeakKeyDictionary()
+
+
+def _odbc_type(dialect, sqltype):
+    """
+    Tipo per setinputsizes dal tipo dichiarato (dialect_impl + get_dbapi_type, API pubblica dei tipi).
+    pyodbc vuole codici SQL_*: i type object DB-API generici (NUMBER, DATETIME) no.
+    """
+    if isinstance(sqltype, NullType):
+        return None
+    dbapi = dialect.loaded_dbapi
+    dbtype = sqltype.dialect_impl(dialect).get_dbapi_type(dbapi)
+    if isinstance(dbtype, (int, tuple)):
+        return dbtype
+    if isinstance(sqltype, BigInteger):
+        return getattr(dbapi, "SQL_BIGINT", None)
+    if isinstance(sqltype, Integer):
+        return getattr(dbapi, "SQL_INTEGER", None)
+    if isinstance(sqltype, DateTime):
+        return getattr(dbapi, "SQL_TYPE_TIMESTAMP", None)
+    return None
+
+
+def input_sizes(compiled) -> Optional[List[Tuple[str, Any, Any]]]:
+    """
+    Argomento per dialect.do_set_input_sizes() di uno statement text() compilato:
+    (nome, tipo DBAPI, tipo SQLAlchemy) per ogni marcatore posizionale, dai tipi dichiarati
+    con register(). None se nessun parametro è tipizzato o se il dialetto non usa setinputsizes.
+    SQLAlchemy salta setinputsizes per text(): i tipi dichiarati con register() andrebbero persi.
+    """
+    try:
+        return _SIZES[compiled]
+    except KeyError:
+        pass
+    sizes = None
+    dialect = compiled.dialect
+    if getattr(dialect, "bind_typing", None) is BindTyping.SETINPUTSIZES and dialect.positional:
+        binds = [compiled.binds[k] for k in compiled.positiontup or ()]
+        sizes = [(b.key, _odbc_type(dialect, b.type), b.type) for b in binds]
+        if all(dbtype is None for _k, dbtype, _t in sizes):
+            sizes = None
+    _SIZES[compiled] = sizes
+    return sizes
+
+
+class Statement:
+    """
+    Testo SQL con la sua TextClause già costruita (parsing dei :parametri fatto una volta)
+    e le forme compilate per dialetto (stringa + ordine dei parametri posizionali).
+    """
+    __slots__ = ("name", "sql", "types", "clause", "parse_ms", "hits", "_compiled")
+
+    def __init__(self, name: Optional[str], sql: str, types: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.sql = sql
+        self.types = dict(types or {})
+        t0 = time.perf_counter()
+        clause = text(sql)
+        if self.types:
+            clause = clause.bindparams(*[bindparam(k, type_=t) for k, t in self.types.items()])
+        self.clause: TextClause = clause
+        self.parse_ms = (time.perf_counter() - t0) * 1000
+        self.hits = 0
+        self._compiled: Dict[str, Tuple[str, Tuple[str, ...], Any]] = {}
+
+    def compiled(self, dialect) -> Tuple[str, Tuple[str, ...], Optional[List[Tuple[str, Any, Any]]]]:
+        """(SQL con marcatori posizionali, nomi dei parametri in ordine, input_sizes) per il dialetto."""
+        key = f"{dialect.name}:{dialect.paramstyle}"
+        c = self._compiled.get(key)
+        if c is None:
+            comp = self.clause.compile(dialect=dialect)
+            c = self._compiled[key] = (comp.string, tuple(comp.positiontup or ()), input_sizes(comp))
+        return c
+
+
+class StatementRegistry:
+    """
+    Statement per testo SQL. Quelli registrati con nome (register) restano sempre;
+    gli altri (SQL scritto inline) entrano in una LRU limitata a max_entries.
+    Usato solo dal thread del loop (e all'import dei moduli): nessun lock.
+    """
+    def __init__(self, max_entries: int = 512):
+        self.max_entries = max(1, int(max_entries))
+        self._named: Dict[str, Statement] = {}
+        self._adhoc: "OrderedDict[str, Statement]" = OrderedDict()
+        self._misses = 0
+
+    def register(self, name: str, sql: str, types: Optional[Dict[str, Any]] = None) -> Statement:
+        st = Statement(name, sql, types)
+        self._named[sql] = st
+        self._adhoc.pop(sql, None)
+        return st
+
+    def get(self, sql: str) -> Statement:
+        st = self._named.get(sql)
+        if st is None:
+            st = self._adhoc.get(sql)
+            if st is None:
+                self._misses += 1
+                st = self._adhoc[sql] = Statement(None, sql)
+                while len(self._adhoc) > self.max_entries:
+                    self._adhoc.popitem(last=False)
+                return st
+            self._adhoc.move_to_end(sql)
+        st.hits += 1
+        return st
+
+    def clause(self, sql: str) -> TextClause:
+        return self.get(sql).clause
+
+    def name_of(self, sql: str) -> str:
+        """Nome per le metriche (senza contare un uso): quello registrato, altrimenti adhoc:<crc32 del testo>."""
+        st = self._named.get(sql)
+        if st is not None and st.name:
+            return st.name
+        return f"adhoc:{zlib.crc32(sql.encode('utf-8')):08x}"
+
+    def stats(self) -> Dict[str, Any]:
+        """Riuso per statement: saved_ms = hits × tempo del primo parsing."""
+        named = []
+        saved = 0.0
+        hits = 0
+        for st in list(self._named.values()) + list(self._adhoc.values()):
+            s = st.hits * st.parse_ms
+            saved += s
+            hits += st.hits
+            if st.name:
+                named.append({"name": st.name, "hits": st.hits, "parse_ms": round(st.parse_ms, 4),
+                              "saved_ms": round(s, 3), "typed": sorted(st.types)})
+        return {
+            "named": len(self._named), "adhoc": len(self._adhoc), "hits": hits, "misses": self._misses,
+            "saved_ms_total": round(saved, 3),
+            "saved_ms_per_call": round(saved / hits, 4) if hits else 0.0,
+            "statements": sorted(named, key=lambda d: -d["saved_ms"]),
+        }
+
+
+STATEMENTS = StatementRegistry()
+
+
+def register(name: str, sql: str, **types: Any) -> str:
+    """
+    Registra uno statement con nome e tipi SQL dei parametri; ritorna il testo,
+    così le costanti SQL_* restano stringhe e i chiamanti non cambiano:
+        SQL_X = register("x", "SELECT ... WHERE ID = :id", id=Integer())
+    """
+    STATEMENTS.register(name, sql, types)
+    return sql
+
+
+def register_sources(name: str, sql: str, fallback: Dict[str, str], **types: Any) -> Dict[FrozenSet[str], str]:
+    """
+    Statement che legge oggetti mantenuti dai motori (snapshot della giacenza, copia della traccia) con
+    un sostituto che dà le stesse righe ({oggetto: originale}): una variante registrata per ogni sottoinsieme
+    degli oggetti disponibili, le altre leggono l'originale. Si sceglie con pick():
+        SQL_X = register_sources("x", "SELECT ... FROM dbo.XMag_GiacenzaPalletSnapshot ...",
+                                 {GIACENZA: GIACENZA_ORIGINALE}, corsia=CORSIA)
+        sql = pick(SQL_X, RUNTIME.local_sources)
+    Nome: name con tutti gli oggetti disponibili, name.<originali letti> altrimenti.
+    """
+    used = [o for o in fallback if o in sql]
+    variants: Dict[FrozenSet[str], str] = {}
+    for k in range(len(used) + 1):
+        for keep in combinations(used, k):
+            text_, swapped = sql, []
+            for o in used:
+                if o not in keep:
+                    text_ = text_.replace(o, fallback[o])
+                    swapped.append(fallback[o].split(".")[-1])
+            suffix = "." + "+".join(swapped) if swapped else ""
+            variants[frozenset(keep)] = register(name + suffix, text_, **types)
+    return variants
+
+
+def pick(variants: Dict[FrozenSet[str], str], available: Iterable[str]) -> str:
+    """Variante di register_sources per gli oggetti disponibili (gli altri letti dall'originale)."""
+    return variants[frozenset(available) & max(variants, key=len)]
@@ -0,0 +1,477 @@
+# sqlite_backend.py — backend SQLite al posto di Mediseawall: schema da script.sql, riscrittura T-SQL → SQLite
+from __future__ import annotations
+
+import asyncio
+import functools
+import os
+import re
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+
+from async_msssql_query import AsyncMSSQLClient, is_sqlite_dsn
+from sql_scripts import SCRIPT_SQL, SNAPSHOT_SQL, TRACCIA_SQL, read_script, split_go
+from sql_statements import STATEMENTS, Statement, StatementRegistry
+
+# oggetti di script.sql ricreati in SQLite (tabelle prima, viste in ordine di dipendenza)
+TABLES = ("Celle", "MagazziniPallet", "Aree", "Operatori", "LogPackingList")
+VIEWS = ("XMag_DettaglioPallet", "XMag_GiacenzaPallet", "vXTracciaProdotti",
+         "vPreparaPackingList", "XMag_ViewPackingList", "ViewPackingListRestante")
+
+# vXTracciaProdotti legge SAMA1.dbo.LOTSER / ARTICO (database ERP): qui due tabelle minime
+# con le sole colonne usate dalla vista, così la vista gira con la sua definizione originale
+STUB_TABLES = (
+    "CREATE TABLE IF NOT EXISTS LOTSER (ID INTEGER PRIMARY KEY, NUMSER TEXT COLLATE NOCASE, "
+    "NUMLOT TEXT COLLATE NOCASE, IDARTICO INTEGER)",
+    "CREATE TABLE IF NOT EXISTS ARTICO (ID INTEGER PRIMARY KEY, CODICE TEXT COLLATE NOCASE, "
+    "DESCR TEXT COLLATE NOCASE)",
+    # vPreparaPackingListSAMA1 (righe di bolla aperte in SAMA1): tabella con le colonne della vista
+    "CREATE TABLE IF NOT EXISTS vPreparaPackingListSAMA1 (NUMLOT TEXT COLLATE NOCASE, CODICE TEXT COLLATE NOCASE, "
+    "DESCR TEXT COLLATE NOCASE, UDC TEXT COLLATE NOCASE, Qta REAL, NUMDOC INTEGER, DATDOC TEXT, ID INTEGER, "
+    "DESCRDEST TEXT COLLATE NOCASE, Expr1 TEXT COLLATE NOCASE, NAZIONE TEXT COLLATE NOCASE, IDMTRASP INTEGER)",
+)
+STUB_NAMES = ("LOTSER", "ARTICO", "vPreparaPackingListSAMA1")
+
+# giacenza materializzata (stock_snapshot.py): oggetti di SNAPSHOT_SQL ricreati in SQLite
+SNAPSHOT_TABLES = ("XMag_GiacenzaSnapshot", "XMag_GiacenzaSnapshotStato")
+SNAPSHOT_VIEWS = ("XMag_GiacenzaPalletSnapshot",)
+
+# copia locale di vXTracciaProdotti (traccia_prodotti.py): la vista legge le tabelle stub LOTSER/ARTICO
+TRACCIA_TABLES = ("XMag_TracciaProdotti",)
+TRACCIA_VIEWS = ("XMag_TracciaProdottiLocale",)
+
+# rowversion (VersioneDati) emulata: un contatore unico del database, scritto dai trigger a ogni
+# INSERT/UPDATE come fa il server; indici come change_feed.sql. MAX della versione: SELECT Valore FROM RowVersion
+ROWVERSION_TABLES = ("MagazziniPallet", "Celle")
+
+
+def rowversion_ddl(tables: Sequence[str] = ROWVERSION_TABLES) -> List[str]:
+    ddl = ["CREATE TABLE IF NOT EXISTS RowVersion (ID INTEGER PRIMARY KEY CHECK (ID = 1), Valore INTEGER NOT NULL)",
+           # su un file che ha già versioni il contatore parte dalla più alta
+           "INSERT OR IGNORE INTO RowVersion (ID, Valore) SELECT 1, COALESCE(MAX(v), 0) FROM ("
+           + " UNION ALL ".join(f"SELECT MAX(VersioneDati) AS v FROM {t}" for t in tables) + ")"]
+    for t in tables:
+        ddl.append(f"CREATE INDEX IF NOT EXISTS IX_{t}_VersioneDati ON {t} (VersioneDati)")
+        for ev, when in (("INSERT", ""), ("UPDATE", " WHEN NEW.VersioneDati IS OLD.VersioneDati")):
+            ddl.append(f"CREATE TRIGGER IF NOT EXISTS TR_{t}_VersioneDati_{ev.title()} AFTER {ev} ON {t}{when} "
+                       "BEGIN UPDATE RowVersion SET Valore = Valore + 1; "
+                       f"UPDATE {t} SET VersioneDati = (SELECT Valore FROM RowVersion) WHERE rowid = NEW.rowid; END")
+    return ddl
+
+
+_TYPES = {
+    "int": "INTEGER", "bigint": "INTEGER", "smallint": "INTEGER", "tinyint": "INTEGER", "bit": "INTEGER",
+    "float": "REAL", "real": "REAL", "decimal": "REAL", "numeric": "REAL", "money": "REAL",
+    "timestamp": "INTEGER", "rowversion": "INTEGER",
+    "datetime": "TEXT", "datetime2": "TEXT", "date": "TEXT", "smalldatetime": "TEXT",
+    "image": "BLOB", "varbinary": "BLOB", "binary": "BLOB",
+}
+_TEXT_TYPES = {"char", "varchar", "nchar", "nvarchar", "text", "ntext", "uniqueidentifier"}
+
+
+# ---------------- schema da script.sql ----------------
+_RE_CREATE = re.compile(r"CREATE\s+(?:OR\s+ALTER\s+)?(TABLE|VIEW)\s+\[dbo\]\.\[(\w+)\]", re.I)
+_RE_COLUMN = re.compile(r"^\s*\[(\w+)\]\s+\[(\w+)\](?:\(([^)]*)\))?(\s+IDENTITY\s*\(\s*\d+\s*,\s*\d+\s*\))?"
+                        r"\s+(NOT\s+NULL|NULL)", re.I | re.M)
+_RE_KEY = re.compile(r"CONSTRAINT\s+\[\w+\]\s+(PRIMARY\s+KEY|UNIQUE)\s+(?:NON)?CLUSTERED\s*\(([^)]*)\)", re.I)
+_RE_INDEX = re.compile(r"CREATE\s+(UNIQUE\s+)?(?:NON)?CLUSTERED\s+INDEX\s+\[(\w+)\]\s+ON\s+\[dbo\]\.\[(\w+)\]"
+                       r"\s*\(([^)]*)\)", re.I)
+_RE_DEFAULT = re.compile(r"ALTER\s+TABLE\s+\[dbo\]\.\[(\w+)\]\s+ADD\s+CONSTRAINT\s+\[\w+\]\s+DEFAULT\s+"
+                         r"(\(.*\))\s+FOR\s+\[(\w+)\]", re.I)
+_RE_VIEW_BODY = re.compile(r"^\s*AS\s*$", re.I | re.M)
+
+
+def _table_ddl(name: str, batch: str, defaults: Dict[str, str]) -> str:
+    cols = _RE_COLUMN.findall(batch)
+    keys = [(kind.upper().split()[0], re.findall(r"\[(\w+)\]", body)) for kind, body in _RE_KEY.findall(batch)]
+    pk = next((c for kind, c in keys if kind == "PRIMARY"), [])
+    lines = []
+    for col, typ, _size, identity, null in cols:
+        typ = typ.lower()
+        if identity and pk == [col]:
+            # IDENTITY: id crescenti mai riusati (i watermark per ID restano validi dopo un DELETE)
+            lines.append(f"{col} INTEGER PRIMARY KEY AUTOINCREMENT")
+            pk = []
+            continue
+        if typ in _TEXT_TYPES:
+            sqlt = "TEXT COLLATE NOCASE"    # collation del database: Latin1_General_CI_AS
+        else:
+            sqlt = _TYPES.get(typ, "NUMERIC")
+        line = f"{col} {sqlt}"
+        if null.upper().startswith("NOT"):
+            line += " NOT NULL"
+        if col in defaults:
+            line += f" DEFAULT {defaults[col]}"
+        lines.append(line)
+    if pk:
+        lines.append(f"PRIMARY KEY ({', '.join(pk)})")
+    for kind, c in keys:
+        if kind == "UNIQUE":
+            lines.append(f"UNIQUE ({', '.join(c)})")
+    return f"CREATE TABLE IF NOT EXISTS {name} (\n  " + ",\n  ".join(lines) + "\n)"
+
+
+@functools.lru_cache(maxsize=4)
+def sqlite_schema(script_path: str = SCRIPT_SQL, tables: Sequence[str] = TABLES,
+                  views: Sequence[str] = VIEWS, stubs: bool = True) -> List[str]:
+    """
+    DDL SQLite per tables/views letti da script.sql: colonne, chiavi, UNIQUE, DEFAULT e indici
+    come in produzione; le viste passano da rewrite_tsql. Tabelle stub SAMA1 comprese (stubs=True).
+    """
+    script = read_script(script_path)
+    defaults: Dict[str, Dict[str, str]] = {}
+    for table, expr, col in _RE_DEFAULT.findall(script):
+        defaults.setdefault(table, {})[col] = expr
+    found_t: Dict[str, str] = {}
+    found_v: Dict[str, str] = {}
+    indexes: List[str] = []
+    for batch in split_go(script):
+        m = _RE_CREATE.search(batch)
+        if m is not None:
+            kind, name = m.group(1).upper(), m.group(2)
+            if kind == "TABLE" and name in tables:
+                found_t[name] = _table_ddl(name, batch, defaults.get(name, {}))
+            elif kind == "VIEW" and name in views:
+                body = _RE_VIEW_BODY.split(batch[m.end():], maxsplit=1)[-1]
+                found_v[name] = f"CREATE VIEW IF NOT EXISTS {name} AS\n{rewrite_tsql(body).strip()}"
+            continue
+        mi = _RE_INDEX.search(batch)
+        if mi is not None and mi.group(3) in tables:
+            cols = ", ".join(f"{c} {d}" for c, d in re.findall(r"\[(\w+)\]\s+(ASC|DESC)", mi.group(4), re.I))
+            unique = "UNIQUE " if mi.group(1) else ""
+            indexes.append(f"CREATE {unique}INDEX IF NOT EXISTS {mi.group(2)} ON {mi.group(3)} ({cols})")
+    missing = [n for n in tables if n not in found_t] + [n for n in views if n not in found_v]
+    if missing:
+        raise ValueError(f"script.sql: oggetti non trovati: {', '.join(missing)}")
+    return ([found_t[n] for n in tables] + list(STUB_TABLES if stubs else ()) + indexes
+            + [found_v[n] for n in views])
+
+
+@functools.lru_cache(maxsize=32)
+def table_columns(name: str, script_path: str = SCRIPT_SQL) -> List[Tuple[str, str]]:
+    """(colonna, tipo SQL Server) di una tabella di script.sql, nell'ordine del server."""
+    for batch in split_go(read_script(script_path)):
+        m = _RE_CREATE.search(batch)
+        if m is not None and m.group(1).upper() == "TABLE" and m.group(2) == name:
+            return [(col, typ.lower()) for col, typ, _s, _i, _n in _RE_COLUMN.findall(batch)]
+    raise ValueError(f"script.sql: tabella {name} non trovata")
+
+
+# ---------------- riscrittura T-SQL → SQLite ----------------
+_RE_COMMENT = re.compile(r"--[^\n]*|/\*.*?\*/", re.S)
+_RE_LITERAL = re.compile(r"N?'(?:[^']|'')*'")
+_RE_DBO = re.compile(r"(?:\[?\b\w+\]?\.)?\[?\bdbo\]?\.", re.I)
+_RE_BRACKET = re.compile(r"\[(\w+)\]")
+_RE_COLLATE = re.compile(r"\bCOLLATE\s+(\w+)", re.I)
+_RE_HINT = re.compile(r"\bWITH\s*\(\s*(?:NOLOCK|UPDLOCK|ROWLOCK|HOLDLOCK|READPAST|XLOCK|PAGLOCK|TABLOCKX?|READCOMMITTEDLOCK)"
+                      r"(?:\s*,\s*\w+)*\s*\)", re.I)
+_RE_NOCOUNT = re.compile(r"\bSET\s+NOCOUNT\s+(?:ON|OFF)\s*;?", re.I)
+_RE_OUTPUT = re.compile(r"\bOUTPUT\s+INSERTED\.(\w+)", re.I)
+_RE_PLUS_LIT = re.compile(r"\+\s*(?=\x00)|(?<=\x00)\s*\+")
+_RE_TOP = re.compile(r"\bTOP\s*(?:\(\s*([^()]+?)\s*\)|(\d+))", re.I)
+_RE_ALIAS_EQ = re.compile(r"\bSELECT(\s+DISTINCT)?\s+(\w+)\s*=\s*([\w.]+)", re.I)
+_RE_DELETE_JOIN = re.compile(r"^\s*DELETE\s+(\w+)\s+FROM\s+(\w+)\s+(?:AS\s+)?(\w+)\b(.*?);?\s*$", re.I | re.S)
+_RE_APPLY = re.compile(r"\bOUTER\s+APPLY\s*\(", re.I)
+_RE_APPLY_ALIAS = re.compile(r"\s*(?:AS\s+)?(\w+)", re.I)
+_RE_SELECT_FROM = re.compile(r"^\s*SELECT\s+(.*?)\s+FROM\s+(.*\bLIMIT\s+1)\s*$", re.I | re.S)
+_RE_CLAUSE = re.compile(r"\b(SELECT|FROM|WHERE|GROUP\s+BY|ORDER\s+BY|HAVING)\b", re.I)
+_RE_ITEM_END = re.compile(r"\s*(?:,|FROM\b)", re.I)
+_RE_CALL = re.compile(r"\b(TRY_CONVERT|CONCAT|LEFT|LEN|ISNULL|GETDATE)\s*\(", re.I)
+
+_INT_TYPES = {"int", "bigint", "smallint", "tinyint", "bit"}
+_REAL_TYPES = {"float", "real", "decimal", "numeric", "money"}
+
+
+def _close_paren(sql: str, start: int) -> int:
+    """Indice della ')' che chiude la '(' in sql[start]."""
+    depth = 0
+    for i in range(start, len(sql)):
+        ch = sql[i]
+        if ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+            if depth == 0:
+                return i
+    raise ValueError(f"parentesi non bilanciate: {sql[start:start + 60]!r}")
+
+
+def _split_args(inner: str) -> List[str]:
+    args, depth, cur = [], 0, 0
+    for i, ch in enumerate(inner):
+        if ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+        elif ch == "," and depth == 0:
+            args.append(inner[cur:i].strip())
+            cur = i + 1
+    args.append(inner[cur:].strip())
+    return [] if args == [""] else args
+
+
+def _try_convert(args: List[str]) -> str:
+    typ = args[0].split("(")[0].strip().lower()
+    if typ in _INT_TYPES:
+        return f"tsql_try_int({args[1]})"
+    if typ in _REAL_TYPES:
+        return f"tsql_try_real({args[1]})"
+    if typ in _TEXT_TYPES:
+        return f"CAST({args[1]} AS TEXT)"
+    return args[1]
+
+
+_CALLS: Dict[str, Callable[[List[str]], str]] = {
+    "TRY_CONVERT": _try_convert,
+    # CONCAT di T-SQL tratta NULL come stringa vuota; || di SQLite no
+    "CONCAT": lambda a: "(" + " || ".join(f"COALESCE({x}, '')" for x in a) + ")",
+    "LEFT": lambda a: f"substr({a[0]}, 1, {a[1]})",
+    "LEN": lambda a: f"length(rtrim({a[0]}))",      # LEN ignora gli spazi finali
+    "ISNULL": lambda a: f"IFNULL({a[0]}, {a[1]})",
+    "GETDATE": lambda a: "datetime('now', 'localtime')",
+}
+
+
+def _rewrite_calls(sql: str) -> str:
+    out: List[str] = []
+    pos = 0
+    while True:
+        m = _RE_CALL.search(sql, pos)
+        if m is None:
+            out.append(sql[pos:])
+            return "".join(out)
+        open_at = m.end() - 1
+        close_at = _close_paren(sql, open_at)
+        args = [_rewrite_calls(a) for a in _split_args(sql[open_at + 1:close_at])]
+        out.append(sql[pos:m.start()])
+        out.append(_CALLS[m.group(1).upper()](args))
+        pos = close_at + 1
+
+
+def _rewrite_top(sql: str) -> str:
+    """SELECT TOP (n) ... → SELECT ... LIMIT n, in fondo allo stesso livello di parentesi."""
+    while True:
+        m = _RE_TOP.search(sql)
+        if m is None:
+            return sql
+        n = m.group(1) or m.group(2)
+        depth, end = 0, len(sql)
+        for i in range(m.end(), len(sql)):
+            ch = sql[i]
+            if ch == "(":
+                depth += 1
+            elif ch == ")":
+                if depth == 0:
+                    end = i
+                    break
+                depth -= 1
+        body = sql[m.end():end].rstrip()
+        tail = ""
+        if body.endswith(";"):
+            body, tail = body[:-1].rstrip(), ";"
+        sql = f"{sql[:m.start()].rstrip()} {body.lstrip()} LIMIT {n}{tail}{sql[end:]}"
+
+
+def _rewrite_outer_apply(sql: str) -> str:
+    """
+    OUTER APPLY (SELECT … LIMIT 1) AS a → una subquery scalare correlata per ogni colonna a.X
+    (SQLite non ha APPLY/LATERAL); stesso risultato, una riga per riga esterna.
+    """
+    while True:
+        m = _RE_APPLY.search(sql)
+        if m is None:
+            return sql
+        close_at = _close_paren(sql, m.end() - 1)
+        ma = _RE_APPLY_ALIAS.match(sql, close_at + 1)
+        inner = _RE_SELECT_FROM.match(sql[m.end():close_at])
+        if ma is None or inner is None:
+            return sql      # forma non gestita: la segnala SQLite
+        alias, rest = ma.group(1), inner.group(2)
+        cols: Dict[str, str] = {}
+        for expr in _split_args(inner.group(1)):
+            parts = re.split(r"\s+AS\s+", expr, flags=re.I)
+            cols[(parts[1] if len(parts) > 1 else parts[0].split(".")[-1]).strip().lower()] = parts[0]
+        sql = sql[:m.start()] + sql[ma.end():]
+
+        def _col(mc: "re.Match[str]") -> str:
+            expr = cols.get(mc.group(1).lower())
+            if expr is None:
+                return mc.group(0)
+            sub = f"(SELECT {expr} FROM {rest})"
+            # voce della lista di SELECT senza alias: il nome della colonna resta quello di prima
+            kw = _RE_CLAUSE.findall(mc.string, 0, mc.start())
+            if kw and kw[-1].upper() == "SELECT" and _RE_ITEM_END.match(mc.string, mc.end()):
+                sub += f" AS {mc.group(1)}"
+            return sub
+
+        sql = re.sub(rf"\b{re.escape(alias)}\.(\w+)", _col, sql)
+
+
+@functools.lru_cache(maxsize=1024)
+def rewrite_tsql(sql: str) -> str:
+    """
+    Riscrittura minima dei costrutti T-SQL usati dalle query dell'app:
+    dbo./[nomi], COLLATE (…_CI_… → NOCASE), + con un letterale stringa (→ ||), TRY_CONVERT, TOP, CONCAT, LEFT, LEN, ISNULL, GETDATE,
+    table hint WITH (UPDLOCK, …), SET NOCOUNT, SELECT alias = expr, DELETE alias FROM … JOIN, OUTPUT INSERTED.x,
+    OUTER APPLY (SELECT TOP (1) …). Il resto (CROSS APPLY, UPDATE … FROM con alias, OPENJSON) passa invariato: SQLite dà errore.
+    """
+    sql = _RE_COMMENT.sub(" ", sql)
+    literals: List[str] = []
+
+    def _keep(m: "re.Match[str]") -> str:
+        literals.append(m.group(0).lstrip("Nn"))
+        return f"\x00{len(literals) - 1}\x00"
+
+    sql = _RE_LITERAL.sub(_keep, sql)
+    sql = _RE_NOCOUNT.sub("", sql)
+    sql = _RE_PLUS_LIT.sub(" || ", sql)      # 'a' + x: concatenazione, non somma
+    sql = _RE_DBO.sub("", sql)
+    sql = _RE_BRACKET.sub(r'"\1"', sql)
+    sql = _RE_HINT.sub("", sql)
+    sql = _RE_COLLATE.sub(lambda m: "COLLATE NOCASE" if "_CI" in m.group(1).upper() else "COLLATE BINARY", sql)
+    sql = _RE_ALIAS_EQ.sub(lambda m: f"SELECT{m.group(1) or ''} {m.group(3)} AS {m.group(2)}", sql)
+    sql = _rewrite_calls(sql)
+    sql = _rewrite_top(sql)
+    sql = _rewrite_outer_apply(sql)
+    m = _RE_OUTPUT.search(sql)
+    if m is not None:       # OUTPUT INSERTED.x → RETURNING x in fondo
+        body = (sql[:m.start()] + sql[m.end():]).rstrip()
+        tail = ";" if body.endswith(";") else ""
+        sql = f"{body.rstrip(';').rstrip()} RETURNING {m.group(1)}{tail}"
+    m = _RE_DELETE_JOIN.match(sql)
+    if m is not None and m.group(1).lower() == m.group(3).lower():
+        alias, table, rest = m.group(1), m.group(2), m.group(4)
+        sql = f"DELETE FROM {table} WHERE rowid IN (SELECT {alias}.rowid FROM {table} AS {alias}{rest})"
+    return re.sub(r"\x00(\d+)\x00", lambda m: literals[int(m.group(1))], sql)
+
+
+class SQLiteStatements(StatementRegistry):
+    """
+    Registro che compila il testo riscritto da rewrite_tsql ma resta indicizzato per il testo
+    originale: nomi e tipi arrivano da STATEMENTS, le metriche si confrontano con quelle su SQL Server.
+    """
+    def __init__(self, base: StatementRegistry = STATEMENTS, max_entries: int = 512):
+        super().__init__(max_entries)
+        self._base = base
+
+    def get(self, sql: str) -> Statement:
+        if sql not in self._named and sql not in self._adhoc:
+            src = self._base._named.get(sql)
+            if src is not None:
+                self._named[sql] = Statement(src.name, rewrite_tsql(sql), src.types)
+            else:
+                self._misses += 1
+                st = self._adhoc[sql] = Statement(None, rewrite_tsql(sql))
+                while len(self._adhoc) > self.max_entries:
+                    self._adhoc.popitem(last=False)
+                return st
+        return super().get(sql)
+
+    def name_of(self, sql: str) -> str:
+        return self._base.name_of(sql)
+
+
+# ---------------- funzioni T-SQL registrate sulla connessione ----------------
+def _try_int(v: Any) -> Optional[int]:
+    if v is None or isinstance(v, int):
+        return v
+    if isinstance(v, float):
+        return int(v)
+    try:
+        return int(str(v).strip())
+    except ValueError:
+        return None
+
+
+def _try_real(v: Any) -> Optional[float]:
+    if v is None:
+        return None
+    try:
+        return float(str(v).strip()) if not isinstance(v, (int, float)) else float(v)
+    except ValueError:
+        return None
+
+
+class AsyncSQLiteClient(AsyncMSSQLClient):
+    """
+    Stessa interfaccia di AsyncMSSQLClient (query_json, exec, query_batch, stream, transaction,
+    cache, metriche, slow log) su un file SQLite con lo schema di script.sql:
+        db = AsyncSQLiteClient("dev/warehouse.sqlite3")
+        await db.create_schema()
+        await db.query_json(SQL_SEARCH, {...})
+    Le query T-SQL dell'app passano da rewrite_tsql (una volta per testo SQL).
+    Serve un file: con :memory: ogni connessione vedrebbe un database vuoto.
+    """
+    def __init__(self, path: str, *, statements: Optional[StatementRegistry]=None, **kw: Any):
+        if is_sqlite_dsn(path):
+            path = path.split(":///", 1)[1] if ":///" in path else path
+        if path in ("", ":memory:"):
+            raise ValueError("AsyncSQLiteClient: serve un file, non :memory:")
+        self.path = os.path.abspath(path)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        kw.pop("fast_executemany", None)
+        super().__init__(f"sqlite+aiosqlite:///{self.path}",
+                         statements=statements if statements is not None else SQLiteStatements(), **kw)
+
+    def _engine_kwargs(self, loop: asyncio.AbstractEventLoop) -> Dict[str, Any]:
+        return {}                               # aiosqlite: niente fast_executemany né loop da passare
+
+    def _install_pool_events(self, engine):
+        super()._install_pool_events(engine)
+        self._install_sqlite_events(engine)
+
+    @staticmethod
+    def _install_sqlite_events(engine):
+        @event.listens_for(engine.sync_engine, "connect")
+        def _on_connect(dbapi_conn, conn_rec):
+            dbapi_conn.create_function("tsql_try_int", 1, _try_int, deterministic=True)
+            dbapi_conn.create_function("tsql_try_real", 1, _try_real, deterministic=True)
+            cur = dbapi_conn.cursor()
+            # WAL: letture concorrenti mentre il generatore scrive; busy_timeout come il lock wait del server
+            cur.execute("PRAGMA journal_mode=WAL")
+            cur.execute("PRAGMA synchronous=NORMAL")
+            cur.execute("PRAGMA busy_timeout=5000")
+            cur.close()
+
+    async def bulk_insert(self, table: str, columns: Sequence[str], rows: Iterable[Sequence[Any]], *,
+                          chunk_rows: int=50_000) -> int:
+        """
+        INSERT a blocchi di chunk_rows tuple (executemany del driver, senza compilazione per riga)
+        in una transazione; rows può essere un generatore: in memoria resta un blocco.
+        """
+        sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+        total = 0
+        with self._measured(sql, name=f"bulk:{table}", slow=False) as m:
+            async with self._connection(begin=True, timing=m) as conn:
+                await conn.exec_driver_sql("PRAGMA synchronous=OFF")
+                chunk: List[Sequence[Any]] = []
+                for row in rows:
+                    chunk.append(row)
+                    if len(chunk) >= chunk_rows:
+                        await conn.exec_driver_sql(sql, chunk)
+                        total += len(chunk)
+                        chunk = []
+                if chunk:
+                    await conn.exec_driver_sql(sql, chunk)
+                    total += len(chunk)
+            m["rows"] = total
+        self.invalidate_cache(table)
+        return total
+
+    async def create_schema(self, *, drop: bool=False, script_path: str=SCRIPT_SQL) -> List[str]:
+        """
+        Crea tabelle, indici e viste (idempotente), snapshot della giacenza, copia di vXTracciaProdotti e
+        trigger della rowversion compresi; drop=True riparte da vuoto.
+        """
+        ddl = (sqlite_schema(script_path) + sqlite_schema(SNAPSHOT_SQL, SNAPSHOT_TABLES, SNAPSHOT_VIEWS, stubs=False)
+               + sqlite_schema(TRACCIA_SQL, TRACCIA_TABLES, TRACCIA_VIEWS, stubs=False) + rowversion_ddl())
+        async with self._connection(begin=True) as conn:
+            if drop:
+                for name in TRACCIA_VIEWS + SNAPSHOT_VIEWS + tuple(reversed(VIEWS)):
+                    await conn.exec_driver_sql(f"DROP VIEW IF EXISTS {name}")
+                for name in TABLES + STUB_NAMES + SNAPSHOT_TABLES + TRACCIA_TABLES + ("RowVersion",):
+                    await conn.exec_driver_sql(f"DROP TABLE IF EXISTS {name}")
+            for stmt in ddl:
+                await conn.exec_driver_sql(stmt)
+        self.invalidate_cache()
+        return ddl
@@ -0,0 +1,333 @@
+# stock_snapshot.py — giacenza per pallet/cella mantenuta in modo incrementale (schema in stock_snapshot.sql)
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy.types import String
+
+from async_msssql_query import AsyncMSSQLClient, Transaction
+from sql_scripts import missing_objects
+from sql_statements import ID_INT, VERSIONE, register
+
+# Vista letta dalle finestre al posto di dbo.XMag_GiacenzaPallet: stesse colonne e stesse righe,
+# ma calcolata da snapshot + movimenti oltre il watermark invece che da tutta la storia.
+# Finché lo snapshot non c'è (script non eseguito, mai costruito) le finestre leggono l'originale.
+GIACENZA = "dbo.XMag_GiacenzaPalletSnapshot"
+GIACENZA_ORIGINALE = "dbo.XMag_GiacenzaPallet"
+# oggetti di stock_snapshot.sql (deploy: sql_scripts.py)
+OGGETTI = ("dbo.XMag_GiacenzaSnapshot", "dbo.XMag_GiacenzaSnapshotStato", GIACENZA)
+
+STATO = "giacenza"      # riga di XMag_GiacenzaSnapshotStato del motore
+EPS = 1e-9              # |peso netto| sotto soglia = pallet non più in giacenza (riga rimossa)
+CHIAVE = String(80)     # XMag_GiacenzaSnapshot.Chiave varchar(80)
+NOME = String(32)
+
+# chiave del gruppo di XMag_GiacenzaPallet: NumeroPallet|IDMagazzino|IDArea|IDCella|ATTRIBUTO
+# (Attributo come lo confronta la collation CI_AS: maiuscolo, senza spazi finali); uguale a chiave() in Python
+_CHIAVE_SQL = ("CONCAT(CAST(m.NumeroPallet AS varchar(11)), '|', CAST(m.IDMagazzino AS varchar(11)), '|', "
+               "CAST(m.IDArea AS varchar(11)), '|', CAST(m.IDCella AS varchar(11)), '|', m.Norm)")
+
+_AGGREGA = f"""
+INSERT INTO dbo.XMag_GiacenzaSnapshot (Chiave, NumeroPallet, IDMagazzino, IDArea, IDCella, Attributo,
+                                       Peso, Movimenti, UltimoID)
+SELECT {_CHIAVE_SQL}, m.NumeroPallet, m.IDMagazzino, m.IDArea, m.IDCella, MAX(m.Attributo),
+       ISNULL(SUM(m.Peso), 0), COUNT(*), MAX(m.ID)
+FROM (SELECT ID, NumeroPallet, IDMagazzino, IDArea, IDCella, Attributo, UPPER(RTRIM(Attributo)) AS Norm,
+             CASE WHEN Tipo = 'P' THEN -PesoUnitario ELSE PesoUnitario END AS Peso
+      FROM dbo.MagazziniPallet WITH (READCOMMITTEDLOCK)
+      WHERE Tipo IN ('V', 'P') AND IDCella IS NOT NULL AND ID <= :hi{{filtro}}) AS m
+GROUP BY m.NumeroPallet, m.IDMagazzino, m.IDArea, m.IDCella, m.Norm
+HAVING ABS(ISNULL(SUM(m.Peso), 0)) >= {EPS!r}
+"""
+# barcode con movimenti consolidati modificati dopo :rv; VersioneDati confrontata senza CAST (seek sull'indice)
+_MODIFICATI = {"mssql": "SELECT DISTINCT m2.Attributo FROM dbo.MagazziniPallet AS m2 "
+                        "WHERE m2.ID <= :hi AND m2.VersioneDati > CAST(:rv AS binary(8))",
+               "sqlite": "SELECT DISTINCT m2.Attributo FROM dbo.MagazziniPallet AS m2 "
+                         "WHERE m2.ID <= :hi AND m2.VersioneDati > :rv"}
+
+SQL_REBUILD = register("stock.rebuild", _AGGREGA.format(filtro=""), hi=ID_INT)
+SQL_RECHECK = {d: register(f"stock.recheck.{d}", _AGGREGA.format(filtro=f" AND Attributo IN ({q})"),
+                           hi=ID_INT, rv=VERSIONE) for d, q in _MODIFICATI.items()}
+SQL_CHANGED = {d: register(f"stock.changed.{d}", q, hi=ID_INT, rv=VERSIONE) for d, q in _MODIFICATI.items()}
+SQL_DELETE_ALL = register("stock.delete_all", "DELETE FROM dbo.XMag_GiacenzaSnapshot")
+SQL_DELETE_CHANGED = {d: register(f"stock.delete_changed.{d}",
+                                  f"DELETE FROM dbo.XMag_GiacenzaSnapshot WHERE Attributo IN ({q})",
+                                  hi=ID_INT, rv=VERSIONE) for d, q in _MODIFICATI.items()}
+SQL_MAX_ID = register("stock.max_id", "SELECT MAX(ID) FROM dbo.MagazziniPallet WITH (READCOMMITTEDLOCK)")
+# rowversion già stabile: le modifiche con versione <= di questa sono tutte committed
+SQL_ROWVERSION = {
+    "mssql": register("stock.rowversion", "SELECT CAST(MIN_ACTIVE_ROWVERSION() AS bigint) - 1"),
+    "sqlite": register("stock.rowversion.sqlite", "SELECT Valore FROM dbo.RowVersion"),     # sqlite_backend
+}
+SQL_TAIL = register("stock.tail", """
+SELECT TOP (:n) ID, Tipo, NumeroPallet, IDMagazzino, IDArea, IDCella, Attributo, PesoUnitario
+FROM dbo.MagazziniPallet WITH (READCOMMITTEDLOCK)
+WHERE ID > :wm AND Tipo IN ('V', 'P')
+ORDER BY ID
+""", n=ID_INT, wm=ID_INT)
+# righe dello snapshot nelle celle toccate dalla coda (seek su ID, poi sull'indice per IDCella)
+SQL_CURRENT = register("stock.current", """
+SELECT s.Chiave, s.Peso, s.Movimenti
+FROM dbo.XMag_GiacenzaSnapshot AS s
+WHERE s.IDCella IN (SELECT m.IDCella FROM dbo.MagazziniPallet AS m WHERE m.ID > :wm AND m.ID <= :hi)
+""", wm=ID_INT, hi=ID_INT)
+SQL_UPDATE = register("stock.update", """
+UPDATE dbo.XMag_GiacenzaSnapshot SET Peso = :peso, Movimenti = :movimenti, UltimoID = :ultimo
+WHERE Chiave = :chiave
+""", chiave=CHIAVE, movimenti=ID_INT, ultimo=ID_INT)
+SQL_INSERT = register("stock.insert", """
+INSERT INTO dbo.XMag_GiacenzaSnapshot (Chiave, NumeroPallet, IDMagazzino, IDArea, IDCella, Attributo,
+                                       Peso, Movimenti, UltimoID)
+VALUES (:chiave, :pallet, :magazzino, :area, :cella, :attributo, :peso, :movimenti, :ultimo)
+""", chiave=CHIAVE, pallet=ID_INT, magazzino=ID_INT, area=ID_INT, cella=ID_INT, attributo=String(16),
+    movimenti=ID_INT, ultimo=ID_INT)
+SQL_DELETE = register("stock.delete", "DELETE FROM dbo.XMag_GiacenzaSnapshot WHERE Chiave = :chiave",
+                      chiave=CHIAVE)
+SQL_DELETE_CELLS = register("stock.delete_cells", """
+DELETE FROM dbo.XMag_GiacenzaSnapshot
+WHERE IDCella IN (SELECT c.ID FROM dbo.Celle AS c WHERE c.ID <> 9999 AND LTRIM(RTRIM(c.Corsia)) = :corsia)
+""", corsia=String(8))
+SQL_LOCK = register("stock.lock", """
+UPDATE dbo.XMag_GiacenzaSnapshotStato SET AggiornatoIl = GETDATE() WHERE Nome = :nome
+""", nome=NOME)
+SQL_STATE = register("stock.state", """
+SELECT UltimoID, UltimaVersione, Righe, RicostruitoIl, AggiornatoIl
+FROM dbo.XMag_GiacenzaSnapshotStato WHERE Nome = :nome
+""", nome=NOME)
+SQL_STATE_SET = register("stock.state_set", """
+UPDATE dbo.XMag_GiacenzaSnapshotStato
+SET UltimoID = :wm, UltimaVersione = :rv, Righe = Righe + :righe, AggiornatoIl = GETDATE()
+WHERE Nome = :nome
+""", nome=NOME, wm=ID_INT, righe=ID_INT)
+SQL_STATE_DELETE = register("stock.state_delete", "DELETE FROM dbo.XMag_GiacenzaSnapshotStato WHERE Nome = :nome",
+                            nome=NOME)
+SQL_STATE_INSERT = register("stock.state_insert", """
+INSERT INTO dbo.XMag_GiacenzaSnapshotStato (Nome, UltimoID, UltimaVersione, Righe, RicostruitoIl, AggiornatoIl)
+VALUES (:nome, :wm, :rv, :righe, GETDATE(), GETDATE())
+""", nome=NOME, wm=ID_INT, righe=ID_INT)
+# Generazione per corsia svuotata (reset_corsie): righe "svuotata:<CORSIA>" della tabella di stato, UltimoID
+# incrementato a ogni reset. Un DELETE di movimenti non ha rowversion né ID nuovo: gli altri client
+# (indice di occupazione, feed) lo vedono da qui.
+SVUOTATA = "svuotata:"
+SQL_SVUOTATE = register("stock.svuotate", """
+SELECT Nome, UltimoID FROM dbo.XMag_GiacenzaSnapshotStato WHERE Nome LIKE 'svuotata:%'
+""")
+SQL_SVUOTATA_BUMP = register("stock.svuotata_bump", """
+UPDATE dbo.XMag_GiacenzaSnapshotStato SET UltimoID = UltimoID + 1, AggiornatoIl = GETDATE()
+OUTPUT INSERTED.UltimoID
+WHERE Nome = :nome
+""", nome=NOME)
+SQL_SVUOTATA_INSERT = register("stock.svuotata_insert", """
+INSERT INTO dbo.XMag_GiacenzaSnapshotStato (Nome, UltimoID, UltimaVersione, Righe, RicostruitoIl, AggiornatoIl)
+VALUES (:nome, 1, NULL, 0, NULL, GETDATE())
+""", nome=NOME)
+
+
+def chiave(pallet: Any, magazzino: Any, area: Any, cella: Any, attributo: Optional[str]) -> str:
+    """Chiave di XMag_GiacenzaSnapshot, come _CHIAVE_SQL (NULL → stringa vuota, come CONCAT)."""
+    parts = ["" if v is None else str(int(v)) for v in (pallet, magazzino, area, cella)]
+    parts.append((attributo or "").rstrip(" ").upper())
+    return "|".join(parts)
+
+
+def svuotate(rows: List[List[Any]]) -> Dict[str, int]:
+    """Righe di SQL_SVUOTATE → {CORSIA: generazione}."""
+    return {nome[len(SVUOTATA):]: gen for nome, gen in rows}
+
+
+def somma_movimenti(rows: List[List[Any]]) -> Dict[str, List[Any]]:
+    """SQL_TAIL per chiave: {chiave: [pallet, magazzino, area, cella, attributo, peso, n, ultimo ID]}, P negativi."""
+    deltas: Dict[str, List[Any]] = {}
+    for id_, tipo, pallet, magazzino, area, cella, attributo, peso in rows:
+        if cella is None:
+            continue
+        k = chiave(pallet, magazzino, area, cella, attributo)
+        d = deltas.get(k)
+        if d is None:
+            d = deltas[k] = [pallet, magazzino, area, cella, attributo, 0.0, 0, 0]
+        peso = peso or 0.0
+        d[5] += -peso if (tipo or "").upper() == "P" else peso
+        d[6] += 1
+        d[7] = id_
+    return deltas
+
+
+class StockSnapshot:
+    """
+    Giacenza materializzata:
+        snap = StockSnapshot(db)
+        await snap.check_schema()      # oggetti di stock_snapshot.sql mancanti ([] = pronti)
+        await snap.refresh()           # consolida i movimenti con ID oltre il watermark
+        await snap.rebuild()           # da zero (DELETE di movimenti fatti fuori dall'app)
+    GIACENZA = snapshot + coda non consolidata, esatta anche a motore fermo. Gli UPDATE di righe già
+    consolidate si vedono da VersioneDati ogni check_every refresh. Gira su un'istanza (WAREHOUSE_MAINTAINER).
+    """
+    def __init__(self, db: AsyncMSSQLClient, *, batch_rows: int = 50_000, check_every: int = 12):
+        self.db = db
+        self.batch_rows = batch_rows
+        self.check_every = max(1, check_every)
+        self._log = logging.getLogger("StockSnapshot")
+        self._refreshes = 0
+        self.ready = False      # consolidato almeno una volta da questa istanza
+        self._stats: Dict[str, Any] = {
+            "refreshes": 0, "rebuilds": 0, "movements": 0, "keys_written": 0, "rechecks": 0,
+            "rechecked_rows": 0, "errors": 0, "watermark": None, "rowversion": None,
+            "last_ms": None, "rebuild_ms": None, "last_error": None, "disabled": None,
+        }
+
+    # ---------- schema ----------
+    async def check_schema(self) -> List[str]:
+        """Oggetti di stock_snapshot.sql che mancano sul database."""
+        return await missing_objects(self.db, OGGETTI)
+
+    async def available(self) -> bool:
+        """GIACENZA leggibile: schema presente e snapshot costruito (riga di stato) da questa o da un'altra istanza."""
+        if await self.check_schema():
+            return False
+        return bool((await self.db.query_json(SQL_STATE, {"nome": STATO}))["rows"])
+
+    # ---------- ricostruzione ----------
+    async def rebuild(self) -> Dict[str, Any]:
+        """Snapshot da zero fino al MAX(ID) attuale, in una transazione (le letture vedono il vecchio o il nuovo)."""
+        t0 = time.perf_counter()
+        async with self.db.transaction() as tx:
+            await tx.exec(SQL_STATE_DELETE, {"nome": STATO})
+            await tx.exec(SQL_DELETE_ALL)
+            rv = await tx.scalar(SQL_ROWVERSION[self._dialect])
+            hi = await tx.scalar(SQL_MAX_ID) or 0
+            n = await tx.exec(SQL_REBUILD, {"hi": hi})
+            await tx.exec(SQL_STATE_INSERT, {"nome": STATO, "wm": hi, "rv": rv, "righe": max(n, 0)})
+        ms = round((time.perf_counter() - t0) * 1000, 3)
+        self.ready = True
+        self._stats.update(rebuilds=self._stats["rebuilds"] + 1, watermark=hi, rowversion=rv, rebuild_ms=ms)
+        return {"rebuilt": True, "rows": n, "watermark": hi, "ms": ms}
+
+    # ---------- aggiornamento incrementale ----------
+    async def refresh(self, max_rows: Optional[int] = None) -> Dict[str, Any]:
+        """Consolida fino a max_rows movimenti (batch_rows se None); "more": ne restano. Senza stato: rebuild()."""
+        t0 = time.perf_counter()
+        n = max_rows or self.batch_rows
+        self._refreshes += 1
+        async with self.db.transaction() as tx:
+            if await tx.exec(SQL_LOCK, {"nome": STATO}) <= 0:
+                state = None
+            else:
+                state = (await tx.query(SQL_STATE, {"nome": STATO}))["rows"][0]
+            if state is not None:
+                wm, rv = state[0], state[1]
+                if rv is not None and self._refreshes % self.check_every == 0:
+                    rv = await self._recheck(tx, wm, rv)
+                rows = (await tx.query(SQL_TAIL, {"n": n, "wm": wm}))["rows"]
+                hi = rows[-1][0] if rows else wm
+                written = await self._apply(tx, rows, wm, hi) if rows else 0
+                await tx.exec(SQL_STATE_SET, {"nome": STATO, "wm": hi, "rv": rv, "righe": written})
+        if state is None:
+            return await self.rebuild()
+        ms = round((time.perf_counter() - t0) * 1000, 3)
+        self.ready = True
+        s = self._stats
+        s.update(refreshes=s["refreshes"] + 1, movements=s["movements"] + len(rows),
+                 keys_written=s["keys_written"] + written, watermark=hi, rowversion=rv, last_ms=ms)
+        return {"movements": len(rows), "keys": written, "watermark": hi, "more": len(rows) >= n, "ms": ms}
+
+    async def _recheck(self, tx: Transaction, wm: int, rv: int) -> int:
+        """Ricalcola i barcode con movimenti consolidati modificati dopo la rowversion rv; ritorna quella nuova."""
+        new_rv = await tx.scalar(SQL_ROWVERSION[self._dialect])
+        d = self._dialect
+        changed = (await tx.query(SQL_CHANGED[d], {"hi": wm, "rv": rv}))["rows"]
+        self._stats["rechecks"] += 1
+        if changed:
+            await tx.exec(SQL_DELETE_CHANGED[d], {"hi": wm, "rv": rv})
+            self._stats["rechecked_rows"] += max(await tx.exec(SQL_RECHECK[d], {"hi": wm, "rv": rv}), 0)
+        return rv if new_rv is None else new_rv
+
+    async def _apply(self, tx: Transaction, rows: List[List[Any]], wm: int, hi: int) -> int:
+        """Somma la coda per chiave e la applica alle righe dello snapshot (UPDATE / INSERT / DELETE)."""
+        deltas = somma_movimenti(rows)
+        if not deltas:
+            return 0
+        current: Dict[str, Tuple[str, float, int]] = {}
+        for ch, peso, movimenti in (await tx.query(SQL_CURRENT, {"wm": wm, "hi": hi}))["rows"]:
+            current[ch.rstrip(" ").upper()] = (ch, peso, movimenti)
+        upd: List[Dict[str, Any]] = []
+        ins: List[Dict[str, Any]] = []
+        dele: List[Dict[str, Any]] = []
+        for k, (pallet, magazzino, area, cella, attributo, peso, movimenti, ultimo) in deltas.items():
+            cur = current.get(k)
+            if cur is not None:
+                peso += cur[1]
+                if abs(peso) < EPS:
+                    dele.append({"chiave": cur[0]})
+                else:
+                    upd.append({"chiave": cur[0], "peso": peso, "movimenti": cur[2] + movimenti, "ultimo": ultimo})
+            elif abs(peso) >= EPS:
+                ins.append({"chiave": k, "pallet": pallet, "magazzino": magazzino, "area": area, "cella": cella,
+                            "attributo": attributo, "peso": peso, "movimenti": movimenti, "ultimo": ultimo})
+        await tx.executemany(SQL_DELETE, dele)
+        await tx.executemany(SQL_UPDATE, upd)
+        await tx.executemany(SQL_INSERT, ins)
+        return len(dele) + len(upd) + len(ins)
+
+    @staticmethod
+    async def delete_corsia(tx: Transaction, corsia: str) -> Optional[int]:
+        """
+        Nella transazione del reset di corsia, prima del DELETE: toglie le righe della corsia dallo snapshot
+        e ne incrementa la generazione. Ritorna la generazione; None senza snapshot sul database.
+        """
+        if await missing_objects(tx, OGGETTI[:2]):
+            return None
+        await tx.exec(SQL_LOCK, {"nome": STATO})
+        await tx.exec(SQL_DELETE_CELLS, {"corsia": corsia})
+        nome = SVUOTATA + corsia.strip().upper()
+        rows = (await tx.query(SQL_SVUOTATA_BUMP, {"nome": nome}))["rows"]
+        if rows:
+            return rows[0][0]
+        await tx.exec(SQL_SVUOTATA_INSERT, {"nome": nome})
+        return 1
+
+    # ---------- ciclo in background ----------
+    async def run(self, every_s: float, *, rebuild_s: Optional[float] = None,
+                  gate: Optional[Callable[[Awaitable[Any]], Awaitable[Any]]] = None) -> None:
+        """refresh() ogni every_s (subito se la coda supera batch_rows), rebuild() ogni rebuild_s, via gate()."""
+        gate = gate or (lambda c: c)
+        try:
+            missing = await gate(self.check_schema())
+        except asyncio.CancelledError:
+            raise
+        except Exception as ex:
+            missing = None
+            self._error(ex)
+        if missing:
+            self._stats["disabled"] = f"mancano {', '.join(missing)}: eseguire stock_snapshot.sql"
+            self._log.warning("giacenza: %s", self._stats["disabled"])
+            return
+        last_rebuild = time.monotonic()
+        while True:
+            more = False
+            try:
+                if rebuild_s and time.monotonic() - last_rebuild >= rebuild_s:
+                    await gate(self.rebuild())
+                    last_rebuild = time.monotonic()
+                else:
+                    more = (await gate(self.refresh())).get("more", False)
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                self._error(ex)
+            if not more:
+                await asyncio.sleep(every_s)
+
+    def _error(self, ex: BaseException) -> None:
+        self._stats["errors"] += 1
+        self._stats["last_error"] = f"{type(ex).__name__}: {ex}"
+        self._log.warning("giacenza: %s", self._stats["last_error"])
+
+    @property
+    def _dialect(self) -> str:
+        return "sqlite" if self.db.backend == "sqlite" else "mssql"
+
+    def stats(self) -> Dict[str, Any]:
+        return dict(self._stats)
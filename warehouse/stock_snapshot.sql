@@ -0,0 +1,81 @@
+-- stock_snapshot.sql — giacenza materializzata: snapshot per pallet/cella + coda dei movimenti non ancora consolidati
+--
+-- XMag_GiacenzaSnapshot     una riga per (NumeroPallet, IDMagazzino, IDArea, IDCella, Attributo) con il peso netto
+--                           dei movimenti V/P fino a UltimoID di XMag_GiacenzaSnapshotStato
+-- XMag_GiacenzaSnapshotStato watermark del motore (stock_snapshot.py): ultimo ID consolidato, rowversion letta
+--                           e righe "svuotata:<CORSIA>": UltimoID = generazione dei reset di corsia
+-- XMag_GiacenzaPalletSnapshot stesse colonne di XMag_GiacenzaPallet: snapshot + righe di MagazziniPallet con
+--                           ID oltre il watermark (seek sull'indice cluster), raggruppate come la vista originale.
+--                           Senza riga di stato la coda è tutta la storia: risultato identico, costo di prima.
+--
+-- Passo di deploy, con il permesso DDL: sqlcmd -i stock_snapshot.sql, SSMS o python sql_scripts.py <dsn>.
+-- I client non lo eseguono: StockSnapshot.check_schema controlla che gli oggetti ci siano e, finché mancano,
+-- le finestre leggono XMag_GiacenzaPallet. Idempotente: si può rieseguire.
+USE [Mediseawall]
+GO
+SET ANSI_NULLS ON
+GO
+SET QUOTED_IDENTIFIER ON
+GO
+IF OBJECT_ID(N'[dbo].[XMag_GiacenzaSnapshot]', N'U') IS NULL
+CREATE TABLE [dbo].[XMag_GiacenzaSnapshot](
+	[Chiave] [varchar](80) NOT NULL,
+	[NumeroPallet] [int] NULL,
+	[IDMagazzino] [int] NULL,
+	[IDArea] [int] NULL,
+	[IDCella] [int] NULL,
+	[Attributo] [varchar](16) NULL,
+	[Peso] [float] NOT NULL,
+	[Movimenti] [int] NOT NULL,
+	[UltimoID] [int] NOT NULL,
+ CONSTRAINT [PK_XMag_GiacenzaSnapshot] PRIMARY KEY NONCLUSTERED
+(
+	[Chiave] ASC
+)
+) ON [PRIMARY]
+GO
+IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = N'IX_XMag_GiacenzaSnapshot_Cella'
+               AND object_id = OBJECT_ID(N'[dbo].[XMag_GiacenzaSnapshot]'))
+CREATE CLUSTERED INDEX [IX_XMag_GiacenzaSnapshot_Cella] ON [dbo].[XMag_GiacenzaSnapshot]
+(
+	[IDCella] ASC
+)
+GO
+IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = N'IX_XMag_GiacenzaSnapshot_Attributo'
+               AND object_id = OBJECT_ID(N'[dbo].[XMag_GiacenzaSnapshot]'))
+CREATE NONCLUSTERED INDEX [IX_XMag_GiacenzaSnapshot_Attributo] ON [dbo].[XMag_GiacenzaSnapshot]
+(
+	[Attributo] ASC
+)
+GO
+IF OBJECT_ID(N'[dbo].[XMag_GiacenzaSnapshotStato]', N'U') IS NULL
+CREATE TABLE [dbo].[XMag_GiacenzaSnapshotStato](
+	[Nome] [varchar](32) NOT NULL,
+	[UltimoID] [int] NOT NULL,
+	[UltimaVersione] [bigint] NULL,
+	[Righe] [int] NOT NULL,
+	[RicostruitoIl] [datetime] NULL,
+	[AggiornatoIl] [datetime] NULL,
+ CONSTRAINT [PK_XMag_GiacenzaSnapshotStato] PRIMARY KEY CLUSTERED
+(
+	[Nome] ASC
+)
+) ON [PRIMARY]
+GO
+CREATE OR ALTER VIEW [dbo].[XMag_GiacenzaPalletSnapshot]
+AS
+SELECT     g.Attributo AS BarcodePallet, g.NumeroPallet, g.IDMagazzino, g.IDArea, g.IDCella, SUM(g.Peso) AS Peso,
+           g.Attributo AS CodiceProdotto, c.IDStato
+FROM       (SELECT s.NumeroPallet, s.IDMagazzino, s.IDArea, s.IDCella, s.Attributo, s.Peso
+            FROM dbo.XMag_GiacenzaSnapshot AS s
+            UNION ALL
+            SELECT m.NumeroPallet, m.IDMagazzino, m.IDArea, m.IDCella, m.Attributo,
+                   CASE WHEN m.Tipo = 'P' THEN -m.PesoUnitario ELSE m.PesoUnitario END
+            FROM dbo.MagazziniPallet AS m
+            WHERE m.Tipo IN ('V', 'P')
+              AND m.ID > ISNULL((SELECT st.UltimoID FROM dbo.XMag_GiacenzaSnapshotStato AS st
+                                 WHERE st.Nome = 'giacenza'), 0)) AS g
+           INNER JOIN dbo.Celle AS c ON c.ID = g.IDCella
+GROUP BY g.NumeroPallet, g.IDMagazzino, g.IDArea, g.IDCella, g.Attributo, c.IDStato
+HAVING     (SUM(g.Peso) > 0)
+GO
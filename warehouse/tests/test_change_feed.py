@@ -0,0 +1,48 @@
+# test_change_feed.py — feed delle modifiche da VersioneDati e indici di change_feed.sql (SQLite)
+import asyncio
+
+from change_feed import INDICI, ChangeFeed
+from datagen import Scale, WarehouseGenerator, load_sqlite
+from sqlite_backend import AsyncSQLiteClient
+
+SCALE = Scale(cells=60, movements=200, products=10, documents=2, lines_per_document=3)
+
+
+def test_poll_pubblica_movimenti_e_celle(tmp_path):
+    async def main():
+        db = AsyncSQLiteClient(str(tmp_path / "w.sqlite3"))
+        await load_sqlite(db, WarehouseGenerator(SCALE, seed=3))
+        feed = ChangeFeed(db)
+        assert await feed.check_schema() == []
+        first = await feed.poll()               # parte dalla versione corrente: nessun evento
+        eventi = []
+        feed.subscribe(eventi.append)
+        cella = (await db.query_json("SELECT MIN(ID) FROM Celle WHERE ID <> 9999"))["rows"][0][0]
+        async with db.transaction() as tx:
+            await tx.exec("UPDATE Celle SET IDStato = 1 WHERE ID = :c", {"c": cella})
+        res = await feed.poll()
+        vuoto = await feed.poll()
+        await db.dispose()
+        return first, res, vuoto, eventi, cella
+
+    first, res, vuoto, eventi, cella = asyncio.run(main())
+    assert first["cells"] == 0 and not eventi[1:]
+    assert res["cells"] == 1 and vuoto["cells"] == 0
+    assert [c.ID for c in eventi[0].celle] == [cella] and eventi[0].idcelle() == {cella}
+
+
+def test_feed_spento_senza_indici(tmp_path):
+    async def main():
+        db = AsyncSQLiteClient(str(tmp_path / "w.sqlite3"))
+        await db.create_schema()
+        async with db.transaction() as tx:
+            await tx.exec("DROP INDEX IX_Celle_VersioneDati")
+        feed = ChangeFeed(db)
+        missing = await feed.check_schema()
+        await asyncio.wait_for(feed.run(0.01), 5)     # niente DDL dal client: il feed si ferma
+        await db.dispose()
+        return missing, feed.stats()
+
+    missing, stats = asyncio.run(main())
+    assert missing == [INDICI[1]]
+    assert "IX_Celle_VersioneDati" in stats["disabled"] and stats["polls"] == 0
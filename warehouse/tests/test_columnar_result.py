@@ -0,0 +1,28 @@
+# test_columnar_result.py — viste per riga del risultato per colonne
+import pytest
+
+from columnar_result import ColumnarResult
+
+
+def _res():
+    return ColumnarResult.from_rows(["ID", "Corsia", "Peso"], [(1, "A", 1.5), (2, None, 2.0)])
+
+
+def test_viste_per_riga():
+    res = _res()
+    assert res.dtypes == ["int64", "str", "float64"]
+    assert res.rows[1] == (2, None, 2.0) and res.rows[-1] == res.rows[1]
+    assert list(res.rows) == [(1, "A", 1.5), (2, None, 2.0)]
+    assert dict(res.dicts()[0]) == {"ID": 1, "Corsia": "A", "Peso": 1.5}
+
+
+def test_righe_in_sola_lettura():
+    res = _res()
+    row = res.dicts()[0]
+    with pytest.raises(TypeError):
+        row["Corsia"] = "B"
+    with pytest.raises(TypeError):
+        res.rows[0][1] = "B"
+    copia = dict(row)
+    copia["Corsia"] = "B"
+    assert res.dicts()[0]["Corsia"] == "A"
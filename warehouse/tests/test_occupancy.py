@@ -0,0 +1,85 @@
+# test_occupancy.py — mappe dell'indice di occupazione e reset di corsia visti da un altro client (SQLite)
+import asyncio
+
+from change_feed import ChangeFeed
+from datagen import Scale, WarehouseGenerator, load_sqlite
+from occupancy import OccupancyIndex, _Stato
+from reset_corsie import svuota_corsia_async
+from sqlite_backend import AsyncSQLiteClient
+from stock_snapshot import EPS, SQL_STATE, STATO
+
+SCALE = Scale(cells=60, movements=800, products=20, documents=3, lines_per_document=5)
+
+
+def test_stato_entrata_e_uscita():
+    s = _Stato()
+    s.entrate = []
+    s.add("k1", 5, "ab1 ", 1, 1, 10.0)
+    assert s.celle_udc == {5: {"AB1": 1}} and s.raw == {"AB1": "ab1"} and s.entrate == ["AB1"]
+    s.add("k1", 5, "ab1", 1, 1, -4.0)           # prelievo parziale: resta in giacenza, nessuna entrata
+    assert s.peso["k1"] == 6.0 and s.entrate == ["AB1"]
+    s.add("k2", 5, "CD2", 1, 1, 3.0)            # seconda UDC nella cella
+    assert s.doppie == {5}
+    s.add("k3", 7, "AB1", 2, 1, 1.0)            # stessa UDC in un'altra cella
+    assert sorted(s.udc_celle["AB1"]) == [5, 7]
+    s.add("k1", 5, "ab1", 1, 1, -6.0)           # prelievo totale: esce dalla cella 5, non dalla 7
+    assert "k1" not in s.peso and "k1" not in s.info
+    assert s.celle_udc[5] == {"CD2": 1} and s.doppie == set()
+    assert list(s.udc_celle["AB1"]) == [7] and "AB1" in s.raw
+    s.add("k3", 7, "AB1", 2, 1, -1.0)
+    assert "AB1" not in s.udc_celle and "AB1" not in s.raw and 7 not in s.celle_udc
+
+
+def test_stato_stessa_udc_piu_chiavi_e_senza_barcode():
+    s = _Stato()
+    s.add("k1", 5, "X", 1, 1, 1.0)
+    s.add("k2", 5, "X", 2, 1, 1.0)              # altro pallet della stessa UDC nella stessa cella
+    assert s.celle_udc[5] == {"X": 2} and s.udc_celle["X"][5][0] == 2
+    s.add("k1", 5, "X", 1, 1, -1.0)
+    assert s.celle_udc[5] == {"X": 1}
+    s.add("k9", 6, None, 1, 1, 5.0)             # senza barcode: pesa ma non occupa (COUNT DISTINCT ignora NULL)
+    assert s.peso["k9"] == 5.0 and 6 not in s.celle_udc
+
+
+def test_stato_residuo_sotto_eps():
+    s = _Stato()
+    s.add("k1", 5, "AB1", 1, 1, 1.0)
+    s.add("k1", 5, "AB1", 1, 1, -(1.0 - EPS / 2))  # residuo sotto EPS: chiave tolta ed esce dalla cella
+    assert "k1" not in s.peso and 5 not in s.celle_udc and "AB1" not in s.udc_celle
+    s.add("k1", 5, "AB1", 1, 1, EPS / 4)            # sotto EPS anche in entrata: non entra
+    assert "k1" not in s.peso and 5 not in s.celle_udc
+    s.add("k1", 5, "AB1", 1, 1, 2.0)
+    assert s.celle_udc == {5: {"AB1": 1}} and s.udc_celle["AB1"][5][0] == 1
+
+
+def test_reset_corsia_visto_da_un_altro_client(tmp_path):
+    async def main():
+        db = AsyncSQLiteClient(str(tmp_path / "w.sqlite3"))
+        await load_sqlite(db, WarehouseGenerator(SCALE, seed=5))
+        a, b = OccupancyIndex(db), OccupancyIndex(db)
+        stato = (await db.query_json(SQL_STATE, {"nome": STATO}))["rows"]
+        await a.load()
+        await b.load()
+        # il load legge soltanto: AggiornatoIl resta quello del motore
+        assert (await db.query_json(SQL_STATE, {"nome": STATO}))["rows"] == stato
+        feed = ChangeFeed(db)
+        await feed.poll()                       # primo giro: versioni e generazioni correnti, niente eventi
+        eventi = []
+        feed.subscribe(eventi.append)
+        cella, corsia = (await db.query_json(
+            "SELECT TOP (1) c.ID, LTRIM(RTRIM(c.Corsia)) FROM dbo.XMag_GiacenzaSnapshot s "
+            "JOIN dbo.Celle c ON c.ID = s.IDCella WHERE c.ID <> 9999 ORDER BY c.ID"))["rows"][0]
+        assert a.udc_in_cella(cella) and b.udc_in_cella(cella)
+        # il reset lo fa il client A (e il suo indice); B lo vede solo dalla generazione della corsia
+        await svuota_corsia_async(db, corsia, a)
+        assert not a.udc_in_cella(cella) and b.udc_in_cella(cella)
+        res_a, res_b = await a.refresh(), await b.refresh()
+        res = await feed.poll()
+        await db.dispose()
+        return a, b, cella, res_a, res_b, res, eventi, corsia
+
+    a, b, cella, res_a, res_b, res, eventi, corsia = asyncio.run(main())
+    assert a.stats()["reloads"] == 0 and "keys" not in res_a
+    assert b.stats()["reloads"] == 1 and "keys" in res_b
+    assert not b.udc_in_cella(cella)
+    assert res["cleared"] == 1 and [e.svuotate for e in eventi] == [(corsia.upper(),)]
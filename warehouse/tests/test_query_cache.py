@@ -0,0 +1,125 @@
+# test_query_cache.py — tabelle lette/scritte e invalidazione della QueryCache
+import asyncio
+
+import pytest
+
+from query_cache import QueryCache, cache_key, invalidated_tables, is_dml, read_tables, write_tables
+from sqlite_backend import AsyncSQLiteClient
+
+
+@pytest.mark.parametrize("sql, expected", [
+    ("SELECT * FROM dbo.Celle", {"celle"}),
+    ("SELECT c.ID FROM [Mediseawall].[dbo].[Celle] AS c JOIN dbo.Aree a ON a.ID = c.IDArea", {"celle", "aree"}),
+    # le viste si espandono alle tabelle base
+    ("SELECT * FROM dbo.XMag_GiacenzaPallet", {"xmag_giacenzapallet", "magazzinipallet", "celle"}),
+    ("SELECT * FROM dbo.vXTracciaProdotti", {"vxtracciaprodotti", "lotser", "artico"}),
+    ("SELECT x FROM t OUTER APPLY (SELECT TOP 1 y FROM dbo.Celle) AS z", {"t", "celle"}),
+    # commenti e stringhe non contano
+    ("SELECT 1 FROM dbo.Aree -- FROM dbo.Celle\nWHERE x = 'FROM Magazzini'", {"aree"}),
+    ("SELECT 1 FROM dbo.Aree /* JOIN dbo.Celle */", {"aree"}),
+    ("SELECT 1", set()),
+])
+def test_read_tables(sql, expected):
+    assert read_tables(sql) == expected
+
+
+@pytest.mark.parametrize("sql, expected", [
+    ("UPDATE dbo.Celle SET IDStato = 1 WHERE ID = :id", {"celle"}),
+    ("INSERT INTO dbo.LogPackingList (Code) VALUES (:c)", {"logpackinglist"}),
+    ("INSERT dbo.LogPackingList (Code) VALUES (:c)", {"logpackinglist"}),
+    ("DELETE FROM MagazziniPallet WHERE ID = 1", {"magazzinipallet"}),
+    ("DELETE MagazziniPallet WHERE ID = 1", {"magazzinipallet"}),
+    ("DELETE m FROM dbo.MagazziniPallet m JOIN dbo.Celle c ON c.ID = m.IDCella", {"magazzinipallet"}),
+    ("MERGE INTO dbo.Celle AS t USING src ON 1 = 0 WHEN MATCHED THEN DELETE;", {"celle"}),
+    ("TRUNCATE TABLE dbo.XMag_GiacenzaSnapshot", {"xmag_giacenzasnapshot"}),
+    # UPDATE alias ... FROM: alias non risolto, contano tutte le tabelle del FROM
+    ("UPDATE c SET IDStato = 0 FROM dbo.Celle c JOIN dbo.Aree a ON a.ID = c.IDArea", {"celle", "aree"}),
+    ("SELECT * FROM dbo.Celle", set()),
+])
+def test_write_tables(sql, expected):
+    assert expected <= write_tables(sql)
+    if not expected:
+        assert write_tables(sql) == frozenset()
+
+
+def test_write_tables_exact_for_simple_dml():
+    assert write_tables("UPDATE dbo.Celle SET IDStato = 1 OUTPUT INSERTED.ID WHERE ID = 1") == {"celle"}
+
+
+def test_is_dml():
+    assert is_dml("UPDATE Celle SET IDStato = 1")
+    assert is_dml("EXEC dbo.sp_xExePackingListPallet :op, :doc")
+    assert not is_dml("SELECT 'UPDATE' AS x FROM dbo.Celle")
+    assert not is_dml("SELECT 1 -- DELETE FROM Celle")
+
+
+@pytest.mark.parametrize("sql, expected", [
+    ("EXEC dbo.sp_xExePackingListPallet :op, :doc", {"celle", "logpackinglist"}),
+    ("EXECUTE @RC = [dbo].[spt_SaveCelle] :id", {"celle"}),
+    ("exec sp_xMagGestioneMagazziniPallet 1, 'A', 'B', 0", {"magazzinipallet", "celle", "logoperation"}),
+    # procedura sconosciuta: nessuna tabella, non svuota la cache
+    ("EXEC dbo.sp_Sconosciuta 1", set()),
+    ("CREATE INDEX IX ON dbo.Celle (ID)", set()),
+])
+def test_invalidated_tables(sql, expected):
+    assert invalidated_tables(sql) == expected
+
+
+def test_invalidated_tables_unknown_target_clears():
+    assert invalidated_tables("INSERT INTO #tmp VALUES (1)") is None
+    assert invalidated_tables("UPDATE TOP (10) dbo.Celle SET IDStato = 0") is None
+    assert invalidated_tables("EXEC master.dbo.usp_Mediseawall_RevertToSnapshot") is None
+
+
+def _cache_with(*sqls):
+    cache = QueryCache()
+    for sql in sqls:
+        cache.put(cache_key(sql, None), [sql], ttl=60, sql=sql)
+    return cache
+
+
+def test_invalidate_for_exec_only_mapped_tables():
+    celle, aree = "SELECT * FROM dbo.Celle", "SELECT * FROM dbo.Aree"
+    cache = _cache_with(celle, aree)
+    assert cache.invalidate_for("EXEC dbo.sp_xExePackingListPalletPrenota 1, 'D', 0") == 1
+    assert cache.get(cache_key(celle, None)) is None
+    assert cache.get(cache_key(aree, None)) == [aree]
+
+
+def test_invalidate_for_unknown_procedure_keeps_cache():
+    cache = _cache_with("SELECT * FROM dbo.Celle")
+    assert cache.invalidate_for("EXEC dbo.sp_Sconosciuta") == 0
+    assert cache.stats()["size"] == 1
+
+
+def test_invalidate_for_view_dependency():
+    giacenza = "SELECT * FROM dbo.XMag_GiacenzaPallet"
+    cache = _cache_with(giacenza)
+    cache.invalidate_for("UPDATE dbo.MagazziniPallet SET IDCella = 1")
+    assert cache.get(cache_key(giacenza, None)) is None
+
+
+def test_put_skipped_after_concurrent_write():
+    cache = QueryCache()
+    sql = "SELECT * FROM dbo.Celle"
+    gen = cache.generation()
+    cache.invalidate_for("UPDATE dbo.Celle SET IDStato = 0")
+    assert not cache.put(cache_key(sql, None), [], ttl=60, sql=sql, started_gen=gen)
+    assert cache.put(cache_key(sql, None), [], ttl=60, sql=sql, started_gen=cache.generation())
+
+
+def test_righe_proprie_per_ogni_chiamante(tmp_path):
+    async def main():
+        db = AsyncSQLiteClient(str(tmp_path / "w.sqlite3"))
+        sql = "SELECT 1 AS ID, 'A' AS Descrizione"
+        leader, follower = await asyncio.gather(*(db.query_json(sql, as_dict_rows=True, cache_ttl=60)
+                                                  for _ in range(2)))
+        leader["rows"][0]["Descrizione"] = "X"
+        follower["rows"].clear()
+        hit = await db.query_json(sql, as_dict_rows=True, cache_ttl=60)
+        await db.dispose()
+        return follower, hit, db.singleflight_stats()
+
+    follower, hit, stats = asyncio.run(main())
+    assert follower["coalesced"] and stats["coalesced"] == 1
+    assert hit["cached"] and hit["rows"] == [{"ID": 1, "Descrizione": "A"}]
@@ -0,0 +1,97 @@
+# test_rewrite_tsql.py — una regola di rewrite_tsql per caso, più lo split degli script SSMS
+import sqlite3
+
+import pytest
+
+from sql_scripts import script_batches
+from sqlite_backend import _try_int, _try_real, rewrite_tsql
+
+
+def _norm(sql: str) -> str:
+    return " ".join(sql.split())
+
+
+@pytest.mark.parametrize("tsql, expected", [
+    # commenti
+    ("SELECT 1 -- commento\nFROM t /* x */", "SELECT 1 FROM t"),
+    # letterali: N'' perde la N, il contenuto non si tocca
+    ("SELECT N'àè' AS x, 'dbo.[Celle]' AS y FROM t", "SELECT 'àè' AS x, 'dbo.[Celle]' AS y FROM t"),
+    ("SET NOCOUNT ON; SELECT 1", "SELECT 1"),
+    # + con un letterale stringa → ||, fra colonne resta una somma
+    ("SELECT 'A' + c.Corsia FROM Celle c", "SELECT 'A' || c.Corsia FROM Celle c"),
+    ("SELECT a + b FROM t", "SELECT a + b FROM t"),
+    # prefissi di schema/database e nomi fra parentesi quadre
+    ("SELECT * FROM Mediseawall.dbo.Celle JOIN [dbo].[Aree] ON 1 = 1", 'SELECT * FROM Celle JOIN "Aree" ON 1 = 1'),
+    ("SELECT [ID], [Corsia] FROM [Celle]", 'SELECT "ID", "Corsia" FROM "Celle"'),
+    # table hint
+    ("SELECT * FROM dbo.Celle WITH (UPDLOCK, ROWLOCK) WHERE ID = 1", "SELECT * FROM Celle WHERE ID = 1"),
+    ("SELECT * FROM Celle c WITH (NOLOCK)", "SELECT * FROM Celle c"),
+    # COLLATE
+    ("SELECT * FROM t WHERE a COLLATE Latin1_General_CI_AS = b", "SELECT * FROM t WHERE a COLLATE NOCASE = b"),
+    ("SELECT * FROM t WHERE a COLLATE Latin1_General_BIN2 = b", "SELECT * FROM t WHERE a COLLATE BINARY = b"),
+    # SELECT alias = expr
+    ("SELECT Pallet = m.Attributo FROM m", "SELECT m.Attributo AS Pallet FROM m"),
+    ("SELECT DISTINCT Pallet = m.Attributo FROM m", "SELECT DISTINCT m.Attributo AS Pallet FROM m"),
+    # TRY_CONVERT per famiglia di tipo
+    ("SELECT TRY_CONVERT(int, x), TRY_CONVERT(decimal(10,2), y), TRY_CONVERT(varchar(20), z), TRY_CONVERT(date, w) FROM t",
+     "SELECT tsql_try_int(x), tsql_try_real(y), CAST(z AS TEXT), w FROM t"),
+    ("SELECT CONCAT(a, '-', b) FROM t", "SELECT (COALESCE(a, '') || COALESCE('-', '') || COALESCE(b, '')) FROM t"),
+    ("SELECT LEFT(a, 3), LEN(b) FROM t", "SELECT substr(a, 1, 3), length(rtrim(b)) FROM t"),
+    ("SELECT ISNULL(c, 0), GETDATE() FROM t", "SELECT IFNULL(c, 0), datetime('now', 'localtime') FROM t"),
+    ("SELECT ISNULL(LEFT(a, 2), '') FROM t", "SELECT IFNULL(substr(a, 1, 2), '') FROM t"),
+    # TOP → LIMIT in fondo allo stesso livello di parentesi
+    ("SELECT TOP 5 * FROM t ORDER BY ID", "SELECT * FROM t ORDER BY ID LIMIT 5"),
+    ("SELECT TOP (:n) * FROM t;", "SELECT * FROM t LIMIT :n;"),
+    ("SELECT x, (SELECT TOP 1 y FROM u) AS z FROM t", "SELECT x, (SELECT y FROM u LIMIT 1) AS z FROM t"),
+    # OUTER APPLY (SELECT TOP (1) …) → subquery correlata, stesso nome di colonna
+    ("SELECT c.ID, a.Pallet FROM Celle c OUTER APPLY (SELECT TOP (1) m.Attributo AS Pallet FROM MagazziniPallet m "
+     "WHERE m.IDCella = c.ID ORDER BY m.ID DESC) AS a",
+     "SELECT c.ID, (SELECT m.Attributo FROM MagazziniPallet m WHERE m.IDCella = c.ID ORDER BY m.ID DESC LIMIT 1) "
+     "AS Pallet FROM Celle c"),
+    # OUTPUT INSERTED.x → RETURNING x
+    ("UPDATE Celle SET IDStato = 1 OUTPUT INSERTED.ID WHERE ID = 1;", "UPDATE Celle SET IDStato = 1 WHERE ID = 1 RETURNING ID;"),
+    # DELETE alias FROM … JOIN
+    ("DELETE s FROM dbo.XMag_GiacenzaSnapshot s JOIN dbo.Celle c ON c.ID = s.IDCella WHERE c.Corsia = :c;",
+     "DELETE FROM XMag_GiacenzaSnapshot WHERE rowid IN (SELECT s.rowid FROM XMag_GiacenzaSnapshot AS s "
+     "JOIN Celle c ON c.ID = s.IDCella WHERE c.Corsia = :c)"),
+    # non gestito: passa invariato
+    ("SELECT * FROM t CROSS APPLY OPENJSON(:p)", "SELECT * FROM t CROSS APPLY OPENJSON(:p)"),
+])
+def test_rewrite_tsql(tsql, expected):
+    assert _norm(rewrite_tsql(tsql)) == expected
+
+
+@pytest.fixture
+def conn():
+    c = sqlite3.connect(":memory:")
+    c.create_function("tsql_try_int", 1, _try_int)
+    c.create_function("tsql_try_real", 1, _try_real)
+    c.execute("CREATE TABLE t (a TEXT, b TEXT, n TEXT)")
+    c.executemany("INSERT INTO t VALUES (?, ?, ?)", [("x", None, "12"), ("ab  ", "y", "abc"), ("Q", "q", " 3.5")])
+    yield c
+    c.close()
+
+
+def _rows(conn, tsql):
+    return conn.execute(rewrite_tsql(tsql)).fetchall()
+
+
+def test_semantics_on_sqlite(conn):
+    # CONCAT: NULL come stringa vuota
+    assert _rows(conn, "SELECT CONCAT(a, '-', b) FROM t ORDER BY rowid")[0] == ("x-",)
+    # LEN ignora gli spazi finali
+    assert _rows(conn, "SELECT LEN(a) FROM t ORDER BY rowid")[1] == (2,)
+    # TRY_CONVERT: NULL se non convertibile
+    assert _rows(conn, "SELECT TRY_CONVERT(int, n), TRY_CONVERT(float, n) FROM t ORDER BY rowid") == \
+        [(12, 12.0), (None, None), (None, 3.5)]
+    # COLLATE …_CI_… confronta senza distinguere maiuscole
+    assert _rows(conn, "SELECT COUNT(*) FROM dbo.t WHERE a COLLATE Latin1_General_CI_AS = b") == [(1,)]
+    assert _rows(conn, "SELECT COUNT(*) FROM dbo.t WHERE a COLLATE Latin1_General_BIN2 = b") == [(0,)]
+    assert _rows(conn, "SELECT TOP (2) n FROM [dbo].[t] WITH (NOLOCK) ORDER BY n") == [(" 3.5",), ("12",)]
+
+
+def test_script_batches_skip_use_and_empty(tmp_path):
+    path = tmp_path / "s.sql"
+    path.write_bytes("USE [Mediseawall]\r\nGO\r\n\r\nGO\r\nCREATE TABLE [dbo].[T] (a int)\r\nGO\r\n"
+                     "-- vista\r\nCREATE VIEW v AS SELECT 1 AS x\r\ngo\r\n".encode("utf-16"))
+    assert script_batches(str(path)) == ["CREATE TABLE [dbo].[T] (a int)", "-- vista\nCREATE VIEW v AS SELECT 1 AS x"]
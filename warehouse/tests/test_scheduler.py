@@ -0,0 +1,151 @@
+# test_scheduler.py — tetti per classe e ordine di servizio del QueryScheduler
+import asyncio
+
+import pytest
+
+from metrics import MetricsRegistry
+from scheduler import BACKGROUND, INTERACTIVE, REFRESH, QueryScheduler, current_job, default_limits
+
+
+def test_default_limits():
+    assert default_limits(8) == {INTERACTIVE: 8, REFRESH: 4, BACKGROUND: 2}
+    assert default_limits(1) == {INTERACTIVE: 1, REFRESH: 1, BACKGROUND: 1}
+    assert default_limits(0) == {INTERACTIVE: 1, REFRESH: 1, BACKGROUND: 1}
+
+
+def test_limits_override_defaults():
+    s = QueryScheduler(8, {BACKGROUND: 1})
+    assert s.limits == {INTERACTIVE: 8, REFRESH: 4, BACKGROUND: 1}
+
+
+def test_unknown_priority():
+    with pytest.raises(ValueError):
+        asyncio.run(QueryScheduler(2).acquire("urgente"))
+
+
+async def _peak(s: QueryScheduler, priorities, hold: float = 0.01):
+    """Lancia un job per priorità e misura il massimo di job contemporanei per classe e in totale."""
+    running = {p: 0 for p in (INTERACTIVE, REFRESH, BACKGROUND)}
+    peak = dict(running, total=0)
+
+    async def job(p):
+        running[p] += 1
+        peak[p] = max(peak[p], running[p])
+        peak["total"] = max(peak["total"], sum(running.values()))
+        await asyncio.sleep(hold)
+        running[p] -= 1
+
+    await asyncio.gather(*(s.run(job(p), p) for p in priorities))
+    return peak
+
+
+def test_per_class_limits():
+    s = QueryScheduler(4)          # interactive 4, refresh 2, background 1
+    peak = asyncio.run(_peak(s, [BACKGROUND] * 5 + [REFRESH] * 5))
+    assert peak[BACKGROUND] == 1
+    assert peak[REFRESH] == 2
+    assert peak["total"] <= 3      # refresh + background non prendono mai tutto il pool
+    assert s.in_use == 0
+
+
+def test_interactive_uses_whole_capacity():
+    s = QueryScheduler(4)
+    peak = asyncio.run(_peak(s, [INTERACTIVE] * 10))
+    assert peak[INTERACTIVE] == 4
+    assert peak["total"] == 4
+
+
+def test_freed_slot_goes_to_highest_priority():
+    async def main():
+        s = QueryScheduler(1)
+        order = []
+        gate = asyncio.Event()
+
+        async def first():
+            await gate.wait()
+
+        async def job(name):
+            order.append(name)
+
+        t0 = asyncio.create_task(s.run(first(), BACKGROUND))
+        await asyncio.sleep(0)
+        tasks = [asyncio.create_task(s.run(job(n), p)) for n, p in
+                 (("b1", BACKGROUND), ("r1", REFRESH), ("i1", INTERACTIVE), ("i2", INTERACTIVE))]
+        await asyncio.sleep(0)
+        assert s.stats()["queued"] == {INTERACTIVE: 2, REFRESH: 1, BACKGROUND: 1}
+        gate.set()
+        await asyncio.gather(t0, *tasks)
+        return order
+
+    assert asyncio.run(main()) == ["i1", "i2", "r1", "b1"]
+
+
+def test_class_at_limit_does_not_block_others():
+    async def main():
+        s = QueryScheduler(4, {BACKGROUND: 1})
+        gate = asyncio.Event()
+        served = []
+
+        async def held():
+            await gate.wait()
+
+        async def job(name):
+            served.append(name)
+
+        bg = asyncio.create_task(s.run(held(), BACKGROUND))
+        await asyncio.sleep(0)
+        waiting = asyncio.create_task(s.run(job("b2"), BACKGROUND))     # background al tetto: in coda
+        ref = asyncio.create_task(s.run(job("r1"), REFRESH))            # passa avanti
+        await asyncio.wait_for(ref, 1)
+        assert served == ["r1"]
+        assert not waiting.done()
+        gate.set()
+        await asyncio.gather(bg, waiting)
+        return served
+
+    assert asyncio.run(main()) == ["r1", "b2"]
+
+
+def test_cancelled_waiter_releases_nothing_and_closes_coroutine():
+    async def main():
+        s = QueryScheduler(1)
+        gate = asyncio.Event()
+
+        async def held():
+            await gate.wait()
+
+        async def never():
+            raise AssertionError("non deve partire")
+
+        t0 = asyncio.create_task(s.run(held(), INTERACTIVE))
+        await asyncio.sleep(0)
+        queued = asyncio.create_task(s.run(never(), INTERACTIVE))
+        await asyncio.sleep(0)
+        queued.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await queued
+        gate.set()
+        await t0
+        return s
+
+    s = asyncio.run(main())
+    assert s.in_use == 0
+    assert s.stats()["queued"] == {INTERACTIVE: 0, REFRESH: 0, BACKGROUND: 0}
+
+
+def test_current_job_and_metrics():
+    async def main():
+        m = MetricsRegistry()
+        s = QueryScheduler(2, metrics=m)
+
+        async def job():
+            return current_job()
+
+        job_info = await s.run(job(), REFRESH)
+        return job_info, current_job(), m
+
+    job_info, outside, m = asyncio.run(main())
+    assert job_info[1] == REFRESH
+    assert outside is None
+    assert m.counter(f"scheduler.started.{REFRESH}") == 1
+    assert m.histogram(f"scheduler.latency_ms.{REFRESH}")["count"] == 1
@@ -0,0 +1,96 @@
+# test_search_index.py — SearchIndex.cerca contro SQL_SEARCH, stesse righe nello stesso ordine (SQLite)
+import asyncio
+
+import pytest
+
+from datagen import Scale, WarehouseGenerator, load_sqlite
+from occupancy import OccupancyIndex
+from search_index import SearchIndex, Trigrammi, chiave_pallet
+from search_pallets import SQL_SEARCH
+from sql_statements import pick
+from sqlite_backend import AsyncSQLiteClient
+from stock_snapshot import GIACENZA
+from traccia_prodotti import TRACCIA
+
+SCALE = Scale(cells=60, movements=800, products=20, documents=3, lines_per_document=5)
+LOCAL = frozenset({GIACENZA, TRACCIA})
+
+
+def test_trigrammi():
+    t = Trigrammi()
+    for v in ("A1B2C3", "XA1B99", "ZZ"):
+        t.add(v)
+    assert t.add("A1B2C3") == 0
+    assert sorted(t.valori[i] for i in t.cerca("A1B")) == ["A1B2C3", "XA1B99"]
+    assert [t.valori[i] for i in t.cerca("Z")] == ["ZZ"]        # sotto i 3 caratteri: scansione
+    assert t.cerca("QQQ") == []
+
+
+def test_chiave_pallet():
+    assert chiave_pallet("ab12cd99") == "AB12CD"
+    assert chiave_pallet("ab1 ") == "AB1"
+    assert chiave_pallet(None) == ""
+
+
+async def _sql(db, udc=None, lotto=None, codice=None):
+    rows = (await db.query_json(pick(SQL_SEARCH, LOCAL), {"udc": udc, "lotto": lotto, "codice": codice}))["rows"]
+    return [list(r) for r in rows]
+
+
+@pytest.fixture(scope="module")
+def indici(tmp_path_factory):
+    async def main():
+        db = AsyncSQLiteClient(str(tmp_path_factory.mktemp("search") / "w.sqlite3"))
+        await load_sqlite(db, WarehouseGenerator(SCALE, seed=5))
+        occ = OccupancyIndex(db)
+        await occ.load()
+        idx = SearchIndex(db, occ)
+        await idx.load()
+        return db, occ, idx
+
+    return asyncio.run(main())
+
+
+def test_cerca_come_sql(indici):
+    db, occ, idx = indici
+
+    async def main():
+        udc = occ.udc_in_giacenza()[0]
+        lotto = (await db.query_json("SELECT MIN(Lotto) FROM dbo.XMag_TracciaProdottiLocale"))["rows"][0][0]
+        casi = [{"udc": udc[:3]}, {"udc": udc.lower()}, {"lotto": lotto[1:5]}, {"codice": "A0001"},
+                {"udc": udc[:2], "codice": "A0"}, {"udc": "NONCE"}]
+        return [(c, idx.cerca(**c), await _sql(db, **c)) for c in casi]
+
+    for caso, mem, sql in asyncio.run(main()):
+        assert mem is not None, caso
+        assert mem == sql, caso
+
+
+def test_cerca_rimanda_a_sql(indici):
+    _db, _occ, idx = indici
+    assert idx.cerca() is None                  # nessun filtro
+    assert idx.cerca(udc="A%B") is None         # caratteri jolly di LIKE
+
+
+def test_pallet_rientrato_letto_a_blocchi(indici):
+    db, occ, idx = indici
+
+    async def main():
+        # pallet con tracciabilità ma non più in giacenza: rientra con un movimento nuovo
+        pallet = (await db.query_json(
+            "SELECT MIN(LEFT(l.NUMSER, 6)) FROM LOTSER l WHERE l.NUMLOT LIKE 'P%' AND LEFT(l.NUMSER, 6) NOT IN "
+            "(SELECT BarcodePallet FROM dbo.XMag_GiacenzaPalletSnapshot)"))["rows"][0][0]
+        top, cella = (await db.query_json(
+            "SELECT (SELECT MAX(ID) FROM MagazziniPallet), MIN(ID) FROM Celle WHERE ID <> 9999"))["rows"][0]
+        async with db.transaction() as tx:
+            await tx.exec("INSERT INTO MagazziniPallet (ID, Tipo, Attributo, NumeroPallet, IDMagazzino, IDArea, "
+                          "IDCella, PesoUnitario) SELECT :id, 'V', :udc, 990001, 1, IDArea, ID, 5.0 FROM Celle "
+                          "WHERE ID = :c", {"id": top + 1, "udc": pallet, "c": cella})
+        await occ.refresh()                     # entrata → pallet in attesa nell'indice di ricerca
+        attesa = idx.cerca(udc=pallet)
+        res = await idx.refresh()               # un solo statement per il blocco di pallet in attesa
+        return pallet, attesa, res, idx.cerca(udc=pallet), await _sql(db, udc=pallet)
+
+    pallet, attesa, res, mem, sql = asyncio.run(main())
+    assert pallet and attesa is None and res["pallets"] == 1
+    assert mem and mem == sql
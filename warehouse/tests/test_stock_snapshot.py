@@ -0,0 +1,166 @@
+# test_stock_snapshot.py — somma dei movimenti e snapshot incrementale contro XMag_GiacenzaPallet (SQLite)
+import asyncio
+
+import pytest
+
+from datagen import Scale, WarehouseGenerator, load_sqlite
+from sql_scripts import missing_objects
+from sql_statements import pick, register_sources
+from sqlite_backend import AsyncSQLiteClient
+from stock_snapshot import GIACENZA, GIACENZA_ORIGINALE, STATO, SQL_STATE, StockSnapshot, chiave, somma_movimenti
+
+SCALE = Scale(cells=60, movements=800, products=20, documents=3, lines_per_document=5)
+
+_CONFRONTO = """
+SELECT BarcodePallet, NumeroPallet, IDMagazzino, IDArea, IDCella, ROUND(Peso, 6), IDStato
+FROM {vista} ORDER BY IDCella, BarcodePallet, NumeroPallet
+"""
+
+
+def test_chiave_normalizza_attributo():
+    assert chiave(1, 2, 3, 4, "ab12  ") == "1|2|3|4|AB12"
+    assert chiave(None, 2, None, 4, None) == "|2||4|"
+
+
+def test_somma_movimenti():
+    rows = [
+        # ID, Tipo, NumeroPallet, IDMagazzino, IDArea, IDCella, Attributo, PesoUnitario
+        [10, "V", 1, 1, 1, 5, "A1", 100.0],
+        [11, "V", 2, 1, 1, 5, "B2", 50.0],
+        [12, "p", 1, 1, 1, 5, "a1 ", 30.0],      # prelievo, stessa chiave di ID 10 (CI, senza spazi finali)
+        [13, "V", 3, 1, 1, None, "C3", 10.0],     # senza cella: non conta
+        [14, "P", 2, 1, 1, 5, "B2", None],        # peso NULL come 0
+    ]
+    d = somma_movimenti(rows)
+    assert set(d) == {"1|1|1|5|A1", "2|1|1|5|B2"}
+    assert d["1|1|1|5|A1"][5:] == [70.0, 2, 12]
+    assert d["2|1|1|5|B2"][5:] == [50.0, 2, 14]
+    assert somma_movimenti([]) == {}
+
+
+def test_register_sources_and_pick():
+    sql = "SELECT * FROM dbo.XMag_GiacenzaPalletSnapshot AS g"
+    variants = register_sources("test.sorgenti", sql, {GIACENZA: GIACENZA_ORIGINALE})
+    assert set(variants) == {frozenset(), frozenset({GIACENZA})}
+    assert pick(variants, {GIACENZA, "dbo.Altro"}) == sql
+    assert pick(variants, ()) == "SELECT * FROM dbo.XMag_GiacenzaPallet AS g"
+    # oggetto non letto dallo statement: una sola variante
+    assert register_sources("test.sorgenti.no", "SELECT 1", {GIACENZA: GIACENZA_ORIGINALE}) == {frozenset(): "SELECT 1"}
+
+
+@pytest.fixture(scope="module")
+def db(tmp_path_factory):
+    db = AsyncSQLiteClient(str(tmp_path_factory.mktemp("stock") / "w.sqlite3"))
+    asyncio.run(load_sqlite(db, WarehouseGenerator(SCALE, seed=5)))
+    return db
+
+
+async def _confronta(db):
+    snap = (await db.query_json(_CONFRONTO.format(vista=GIACENZA)))["rows"]
+    orig = (await db.query_json(_CONFRONTO.format(vista=GIACENZA_ORIGINALE)))["rows"]
+    return snap, orig
+
+
+def test_rebuild_uguale_alla_vista(db):
+    snap, orig = asyncio.run(_confronta(db))
+    assert snap and snap == orig
+
+
+def test_refresh_incrementale(db):
+    async def main():
+        s = StockSnapshot(db, check_every=1)
+        base = (await db.query_json("SELECT MAX(ID), MAX(NumeroPallet) FROM MagazziniPallet"))["rows"][0]
+        cella, area, pallet = (await db.query_json(
+            "SELECT TOP (1) IDCella, IDArea, Attributo FROM dbo.XMag_GiacenzaSnapshot ORDER BY IDCella"))["rows"][0]
+        nid, npal = base[0] + 1, base[1] + 1
+        async with db.transaction() as tx:
+            # pallet nuovo, prelievo parziale e prelievo totale di un pallet già consolidato
+            await tx.exec("INSERT INTO MagazziniPallet (ID, Tipo, Attributo, NumeroPallet, IDMagazzino, IDArea, IDCella, "
+                          "PesoUnitario) VALUES (:id, 'V', 'ZZ0001', :np, 1, :a, :c, 42.5)",
+                          {"id": nid, "np": npal, "a": area, "c": cella})
+            await tx.exec("INSERT INTO MagazziniPallet (ID, Tipo, Attributo, NumeroPallet, IDMagazzino, IDArea, IDCella, "
+                          "PesoUnitario) VALUES (:id, 'P', 'ZZ0001', :np, 1, :a, :c, 2.5)",
+                          {"id": nid + 1, "np": npal, "a": area, "c": cella})
+            await tx.exec("INSERT INTO MagazziniPallet (ID, Tipo, Attributo, NumeroPallet, IDMagazzino, IDArea, IDCella, "
+                          "PesoUnitario) SELECT :id, 'P', Attributo, NumeroPallet, IDMagazzino, IDArea, IDCella, Peso "
+                          "FROM dbo.XMag_GiacenzaSnapshot WHERE IDCella = :c AND Attributo = :p",
+                          {"id": nid + 2, "c": cella, "p": pallet})
+        # la vista è esatta anche prima del refresh (snapshot + coda)
+        snap, orig = await _confronta(db)
+        assert snap == orig
+        res = await s.refresh()
+        assert res["movements"] == 3 and res["watermark"] == nid + 2 and not res["more"]
+        state = (await db.query_json(SQL_STATE, {"nome": STATO}))["rows"][0]
+        assert state[0] == nid + 2
+        righe = (await db.query_json("SELECT Peso, Movimenti FROM XMag_GiacenzaSnapshot WHERE Attributo = 'ZZ0001'"))["rows"]
+        assert righe == [[40.0, 2]]
+        assert not (await db.query_json("SELECT 1 FROM XMag_GiacenzaSnapshot WHERE IDCella = :c AND Attributo = :p",
+                                        {"c": cella, "p": pallet}))["rows"]
+        # UPDATE di un movimento già consolidato: lo riprende il ricontrollo su VersioneDati
+        async with db.transaction() as tx:
+            await tx.exec("UPDATE MagazziniPallet SET PesoUnitario = 12.5 WHERE ID = :id", {"id": nid})
+        await s.refresh()
+        assert s.stats()["rechecks"] >= 1 and s.ready
+        righe = (await db.query_json("SELECT Peso FROM XMag_GiacenzaSnapshot WHERE Attributo = 'ZZ0001'"))["rows"]
+        assert righe == [[10.0]]
+        return await _confronta(db)
+
+    snap, orig = asyncio.run(main())
+    assert snap == orig
+
+
+def test_refresh_a_blocchi(db):
+    async def main():
+        s = StockSnapshot(db, batch_rows=2)
+        top = (await db.query_json("SELECT MAX(ID) FROM MagazziniPallet"))["rows"][0][0]
+        async with db.transaction() as tx:
+            for i in range(5):
+                await tx.exec("INSERT INTO MagazziniPallet (ID, Tipo, Attributo, NumeroPallet, IDMagazzino, IDArea, "
+                              "IDCella, PesoUnitario) SELECT :id, 'V', :att, 900000 + :i, 1, IDArea, ID, 1.0 "
+                              "FROM Celle WHERE ID = (SELECT MIN(ID) FROM Celle)",
+                              {"id": top + 1 + i, "att": f"YY{i:04d}", "i": i})
+        giri = []
+        while True:
+            res = await s.refresh()
+            giri.append(res["movements"])
+            if not res["more"]:
+                break
+        return giri, await _confronta(db)
+
+    giri, (snap, orig) = asyncio.run(main())
+    assert giri == [2, 2, 1]
+    assert snap == orig
+
+
+def test_schema_e_disponibilita(db):
+    async def main():
+        s = StockSnapshot(db)
+        assert await s.check_schema() == []
+        assert await s.available()
+        assert await missing_objects(db, ["dbo.NonEsiste", GIACENZA], ["MagazziniPallet.IX_NonEsiste"]) == \
+            ["dbo.NonEsiste", "MagazziniPallet.IX_NonEsiste"]
+        async with db.transaction() as tx:
+            await tx.exec("DELETE FROM XMag_GiacenzaSnapshotStato WHERE Nome = :n", {"n": STATO})
+        assert not await s.available()      # schema presente ma mai costruito
+        await s.rebuild()
+        assert await s.available()
+
+    asyncio.run(main())
+
+
+def test_motore_spento_senza_schema(tmp_path):
+    async def main():
+        db = AsyncSQLiteClient(str(tmp_path / "vuoto.sqlite3"))
+        await db.create_schema()
+        async with db.transaction() as tx:
+            await tx.exec("DROP VIEW XMag_GiacenzaPalletSnapshot")
+            await tx.exec("DROP TABLE XMag_GiacenzaSnapshot")
+        s = StockSnapshot(db)
+        await asyncio.wait_for(s.run(0.01), 5)      # niente DDL dal client: il motore si ferma
+        async with db.transaction() as tx:
+            assert await StockSnapshot.delete_corsia(tx, "1A") is None
+        await db.dispose()
+        return s.stats()
+
+    stats = asyncio.run(main())
+    assert "dbo.XMag_GiacenzaSnapshot" in stats["disabled"] and stats["refreshes"] == 0
@@ -0,0 +1,71 @@
+# test_traccia_prodotti.py — copia di vXTracciaProdotti: stesse righe della vista, schema come passo di deploy (SQLite)
+import asyncio
+
+import pytest
+
+from datagen import Scale, WarehouseGenerator, load_sqlite
+from search_pallets import SQL_SEARCH
+from sql_statements import pick
+from sqlite_backend import AsyncSQLiteClient
+from stock_snapshot import GIACENZA
+from traccia_prodotti import STATO, TRACCIA, TRACCIA_ORIGINALE, TracciaProdotti
+
+SCALE = Scale(cells=60, movements=800, products=20, documents=3, lines_per_document=5)
+
+_CONFRONTO = "SELECT Pallet, Lotto, Prodotto, Descrizione FROM {vista} ORDER BY Pallet, Lotto, Prodotto, Descrizione"
+
+
+@pytest.fixture(scope="module")
+def db(tmp_path_factory):
+    db = AsyncSQLiteClient(str(tmp_path_factory.mktemp("traccia") / "w.sqlite3"))
+    asyncio.run(load_sqlite(db, WarehouseGenerator(SCALE, seed=5)))
+    return db
+
+
+def test_copia_uguale_alla_vista(db):
+    async def main():
+        copia = (await db.query_json(_CONFRONTO.format(vista=TRACCIA)))["rows"]
+        vista = (await db.query_json(_CONFRONTO.format(vista=TRACCIA_ORIGINALE)))["rows"]
+        return copia, vista
+
+    copia, vista = asyncio.run(main())
+    assert copia and copia == vista
+
+
+def test_ricerca_con_e_senza_copia(db):
+    async def main():
+        params = {"udc": None, "lotto": "P", "codice": None}
+        return [(await db.query_json(pick(SQL_SEARCH, src), params))["rows"]
+                for src in ({GIACENZA, TRACCIA}, {GIACENZA}, ())]
+
+    locale, senza_copia, originale = asyncio.run(main())
+    assert locale and locale == senza_copia == originale
+
+
+def test_schema_e_disponibilita(db):
+    async def main():
+        t = TracciaProdotti(db)
+        assert await t.check_schema() == []
+        assert await t.available()
+        async with db.transaction() as tx:
+            await tx.exec("DELETE FROM XMag_GiacenzaSnapshotStato WHERE Nome = :n", {"n": STATO})
+        assert not await t.available()      # schema presente ma copia mai costruita
+        await t.refresh()                   # senza stato: rebuild
+        assert t.ready and await t.available()
+
+    asyncio.run(main())
+
+
+def test_motore_spento_senza_schema(tmp_path):
+    async def main():
+        db = AsyncSQLiteClient(str(tmp_path / "vuoto.sqlite3"))
+        await db.create_schema()
+        async with db.transaction() as tx:
+            await tx.exec("DROP VIEW XMag_TracciaProdottiLocale")
+        t = TracciaProdotti(db)
+        await asyncio.wait_for(t.run(0.01), 5)      # niente DDL dal client: il motore si ferma
+        await db.dispose()
+        return t
+
+    t = asyncio.run(main())
+    assert TRACCIA in t.stats()["disabled"] and not t.ready and t.stats()["refreshes"] == 0
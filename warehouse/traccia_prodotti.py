@@ -0,0 +1,166 @@
+# traccia_prodotti.py — copia locale di vXTracciaProdotti (SAMA1) aggiornata per LOTSER.ID (schema in traccia_prodotti.sql)
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from async_msssql_query import AsyncMSSQLClient
+from sql_scripts import missing_objects
+from sql_statements import ID_INT, register
+from stock_snapshot import SQL_LOCK, SQL_STATE, SQL_STATE_DELETE, SQL_STATE_INSERT, SQL_STATE_SET
+
+# Vista letta dalle finestre al posto di dbo.vXTracciaProdotti: stesse colonne (Pallet, Lotto, Prodotto,
+# Descrizione) e stesse righe, ma dalla copia locale più le sole righe di LOTSER oltre il watermark.
+TRACCIA = "dbo.XMag_TracciaProdottiLocale"
+TRACCIA_ORIGINALE = "dbo.vXTracciaProdotti"
+# oggetti di traccia_prodotti.sql (passo di deploy: il client non li crea)
+OGGETTI = ("dbo.XMag_TracciaProdotti", "dbo.XMag_GiacenzaSnapshotStato", TRACCIA)
+
+STATO = "traccia"       # riga di XMag_GiacenzaSnapshotStato del motore
+
+# gruppi di vXTracciaProdotti (GROUP BY pallet, codice, lotto, descrizione; lotti 'P…') per un intervallo di ID
+_GRUPPI = """
+SELECT LEFT(l.NUMSER, 6) COLLATE Latin1_General_CI_AS AS Pallet, l.NUMLOT COLLATE Latin1_General_CI_AS AS Lotto,
+       a.CODICE COLLATE Latin1_General_CI_AS AS Prodotto, a.DESCR COLLATE Latin1_General_CI_AS AS Descrizione,
+       MAX(l.ID) AS UltimoID
+FROM SAMA1.dbo.LOTSER AS l
+INNER JOIN SAMA1.dbo.ARTICO AS a ON a.ID = l.IDARTICO
+WHERE LEFT(l.NUMLOT, 1) = 'P' AND l.ID > :wm AND l.ID <= :hi
+GROUP BY LEFT(l.NUMSER, 6), a.CODICE, l.NUMLOT, a.DESCR
+"""
+_INSERT = "INSERT INTO dbo.XMag_TracciaProdotti (Pallet, Lotto, Prodotto, Descrizione, UltimoID)\n"
+
+SQL_REBUILD = register("traccia.rebuild", _INSERT + _GRUPPI, wm=ID_INT, hi=ID_INT)
+# solo i gruppi che la copia non ha già (lo stesso lotto può avere più numeri di serie in momenti diversi)
+SQL_APPEND = register("traccia.append", _INSERT + f"""
+SELECT g.Pallet, g.Lotto, g.Prodotto, g.Descrizione, g.UltimoID
+FROM ({_GRUPPI}) AS g
+WHERE NOT EXISTS (SELECT 1 FROM dbo.XMag_TracciaProdotti AS t
+                  WHERE t.Pallet = g.Pallet AND t.Lotto = g.Lotto
+                    AND ISNULL(t.Prodotto, '') = ISNULL(g.Prodotto, '')
+                    AND ISNULL(t.Descrizione, '') = ISNULL(g.Descrizione, ''))
+""", wm=ID_INT, hi=ID_INT)
+SQL_DELETE_ALL = register("traccia.delete_all", "DELETE FROM dbo.XMag_TracciaProdotti")
+SQL_MAX_ID = register("traccia.max_id", "SELECT MAX(ID) FROM SAMA1.dbo.LOTSER")
+# fine del prossimo blocco di n righe di LOTSER oltre il watermark
+SQL_NEXT_ID = register("traccia.next_id", """
+SELECT MAX(b.ID), COUNT(*) FROM (SELECT TOP (:n) l.ID FROM SAMA1.dbo.LOTSER AS l WHERE l.ID > :wm ORDER BY l.ID) AS b
+""", n=ID_INT, wm=ID_INT)
+
+
+class TracciaProdotti:
+    """
+    Motore della copia di vXTracciaProdotti (vista cross-database su SAMA1.LOTSER/ARTICO):
+        traccia = TracciaProdotti(db)
+        await traccia.check_schema()      # oggetti di traccia_prodotti.sql mancanti ([] = pronti)
+        await traccia.refresh()           # periodico: copia i gruppi delle righe di LOTSER con ID oltre il watermark
+        await traccia.rebuild()           # da zero: prima volta, e periodicamente (rebuild_s)
+    TRACCIA = copia + coda non copiata, esatta anche a motore fermo. Correzioni e DELETE su LOTSER non
+    cambiano l'ID: le riprende rebuild(). Gira su un'istanza (WAREHOUSE_MAINTAINER).
+    """
+    def __init__(self, db: AsyncMSSQLClient, *, batch_rows: int = 50_000):
+        self.db = db
+        self.batch_rows = batch_rows
+        self._log = logging.getLogger("TracciaProdotti")
+        self._stats: Dict[str, Any] = {
+            "refreshes": 0, "rebuilds": 0, "lotser_rows": 0, "groups_added": 0, "rows": None,
+            "errors": 0, "watermark": None, "last_ms": None, "rebuild_ms": None, "last_error": None,
+            "disabled": None,
+        }
+        self.ready = False      # copia consolidata almeno una volta da questa istanza
+
+    # ---------- schema ----------
+    async def check_schema(self) -> List[str]:
+        """Oggetti di traccia_prodotti.sql che mancano sul database."""
+        return await missing_objects(self.db, OGGETTI)
+
+    async def available(self) -> bool:
+        """TRACCIA leggibile: schema presente e copia costruita (riga di stato) da questa o da un'altra istanza."""
+        if await self.check_schema():
+            return False
+        return bool((await self.db.query_json(SQL_STATE, {"nome": STATO}))["rows"])
+
+    # ---------- ricostruzione ----------
+    async def rebuild(self) -> Dict[str, Any]:
+        """Copia da zero fino al MAX(ID) attuale di LOTSER, in una transazione."""
+        t0 = time.perf_counter()
+        async with self.db.transaction() as tx:
+            await tx.exec(SQL_STATE_DELETE, {"nome": STATO})
+            await tx.exec(SQL_DELETE_ALL)
+            hi = await tx.scalar(SQL_MAX_ID) or 0
+            n = max(await tx.exec(SQL_REBUILD, {"wm": 0, "hi": hi}), 0)
+            await tx.exec(SQL_STATE_INSERT, {"nome": STATO, "wm": hi, "rv": None, "righe": n})
+        ms = round((time.perf_counter() - t0) * 1000, 3)
+        self._stats.update(rebuilds=self._stats["rebuilds"] + 1, watermark=hi, rows=n, rebuild_ms=ms)
+        self.ready = True
+        return {"rebuilt": True, "rows": n, "watermark": hi, "ms": ms}
+
+    # ---------- aggiornamento incrementale ----------
+    async def refresh(self, max_rows: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Copia i gruppi di fino a max_rows righe di LOTSER oltre il watermark (batch_rows se None);
+        "more": True se ne restano altre. Senza stato (prima volta) fa rebuild().
+        """
+        t0 = time.perf_counter()
+        n = max_rows or self.batch_rows
+        async with self.db.transaction() as tx:
+            if await tx.exec(SQL_LOCK, {"nome": STATO}) <= 0:
+                state = None
+            else:
+                state = (await tx.query(SQL_STATE, {"nome": STATO}))["rows"][0]
+            if state is not None:
+                wm, righe = state[0], state[2]
+                hi, letti = (await tx.query(SQL_NEXT_ID, {"n": n, "wm": wm}))["rows"][0]
+                hi, letti = hi or wm, letti or 0
+                added = max(await tx.exec(SQL_APPEND, {"wm": wm, "hi": hi}), 0) if letti else 0
+                await tx.exec(SQL_STATE_SET, {"nome": STATO, "wm": hi, "rv": None, "righe": added})
+        if state is None:
+            return await self.rebuild()
+        ms = round((time.perf_counter() - t0) * 1000, 3)
+        s = self._stats
+        s.update(refreshes=s["refreshes"] + 1, lotser_rows=s["lotser_rows"] + letti,
+                 groups_added=s["groups_added"] + added, rows=righe + added, watermark=hi, last_ms=ms)
+        self.ready = True
+        return {"lotser_rows": letti, "groups": added, "watermark": hi, "more": letti >= n, "ms": ms}
+
+    # ---------- ciclo in background ----------
+    async def run(self, every_s: float, *, rebuild_s: Optional[float] = None,
+                  gate: Optional[Callable[[Awaitable[Any]], Awaitable[Any]]] = None) -> None:
+        """refresh() ogni every_s (subito se la coda supera batch_rows), rebuild() ogni rebuild_s."""
+        gate = gate or (lambda c: c)
+        try:
+            missing = await gate(self.check_schema())
+        except asyncio.CancelledError:
+            raise
+        except Exception as ex:
+            missing = None
+            self._error(ex)
+        if missing:
+            self._stats["disabled"] = f"mancano {', '.join(missing)}: eseguire traccia_prodotti.sql"
+            self._log.warning("traccia prodotti: %s", self._stats["disabled"])
+            return
+        last_rebuild = time.monotonic()
+        while True:
+            more = False
+            try:
+                if rebuild_s and time.monotonic() - last_rebuild >= rebuild_s:
+                    await gate(self.rebuild())
+                    last_rebuild = time.monotonic()
+                else:
+                    more = (await gate(self.refresh())).get("more", False)
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                self._error(ex)
+            if not more:
+                await asyncio.sleep(every_s)
+
+    def _error(self, ex: BaseException) -> None:
+        self._stats["errors"] += 1
+        self._stats["last_error"] = f"{type(ex).__name__}: {ex}"
+        self._log.warning("traccia prodotti: %s", self._stats["last_error"])
+
+    def stats(self) -> Dict[str, Any]:
+        return dict(self._stats)
@@ -0,0 +1,81 @@
+-- traccia_prodotti.sql — copia locale di vXTracciaProdotti (tracciabilità SAMA1) per le ricerche del magazzino
+--
+-- XMag_TracciaProdotti        righe distinte di vXTracciaProdotti (Pallet = LEFT(NUMSER, 6), Lotto, Prodotto,
+--                             Descrizione) con UltimoID = MAX(LOTSER.ID) del gruppo; indice cluster su Pallet,
+--                             su UltimoID per chi legge solo i gruppi nuovi (search_index.py)
+-- XMag_GiacenzaSnapshotStato  riga Nome = 'traccia': ultimo LOTSER.ID copiato (motore traccia_prodotti.py)
+-- XMag_TracciaProdottiLocale  stesse colonne di vXTracciaProdotti: copia + gruppi delle righe di LOTSER con ID
+--                             oltre il watermark che la copia non ha (UNION ALL di parti disgiunte: il filtro
+--                             su Pallet arriva a entrambe). Senza riga di stato la coda è tutto LOTSER:
+--                             risultato identico, costo di prima.
+--
+-- Le viste esistenti (XMag_GiacenzaPalletxUbicazioneCella e le altre che leggono vXTracciaProdotti) non
+-- vengono toccate: le usano anche altre applicazioni.
+--
+-- Le modifiche a righe di LOTSER/ARTICO già copiate non hanno un ID nuovo: le riprende la ricostruzione
+-- periodica (TracciaProdotti.run, rebuild_s).
+--
+-- Passo di deploy, con il permesso DDL: sqlcmd -i traccia_prodotti.sql, SSMS o python sql_scripts.py <dsn>.
+-- I client non lo eseguono: TracciaProdotti.check_schema controlla che gli oggetti ci siano e, finché
+-- mancano, le finestre leggono vXTracciaProdotti. Idempotente: si può rieseguire.
+USE [Mediseawall]
+GO
+SET ANSI_NULLS ON
+GO
+SET QUOTED_IDENTIFIER ON
+GO
+IF OBJECT_ID(N'[dbo].[XMag_TracciaProdotti]', N'U') IS NULL
+CREATE TABLE [dbo].[XMag_TracciaProdotti](
+	[Pallet] [varchar](6) NOT NULL,
+	[Lotto] [varchar](100) NULL,
+	[Prodotto] [varchar](100) NULL,
+	[Descrizione] [varchar](500) NULL,
+	[UltimoID] [int] NOT NULL
+) ON [PRIMARY]
+GO
+IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = N'IX_XMag_TracciaProdotti_Pallet'
+               AND object_id = OBJECT_ID(N'[dbo].[XMag_TracciaProdotti]'))
+CREATE CLUSTERED INDEX [IX_XMag_TracciaProdotti_Pallet] ON [dbo].[XMag_TracciaProdotti]
+(
+	[Pallet] ASC
+)
+GO
+IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = N'IX_XMag_TracciaProdotti_UltimoID'
+               AND object_id = OBJECT_ID(N'[dbo].[XMag_TracciaProdotti]'))
+CREATE NONCLUSTERED INDEX [IX_XMag_TracciaProdotti_UltimoID] ON [dbo].[XMag_TracciaProdotti]
+(
+	[UltimoID] ASC
+)
+GO
+IF OBJECT_ID(N'[dbo].[XMag_GiacenzaSnapshotStato]', N'U') IS NULL
+CREATE TABLE [dbo].[XMag_GiacenzaSnapshotStato](
+	[Nome] [varchar](32) NOT NULL,
+	[UltimoID] [int] NOT NULL,
+	[UltimaVersione] [bigint] NULL,
+	[Righe] [int] NOT NULL,
+	[RicostruitoIl] [datetime] NULL,
+	[AggiornatoIl] [datetime] NULL,
+ CONSTRAINT [PK_XMag_GiacenzaSnapshotStato] PRIMARY KEY CLUSTERED
+(
+	[Nome] ASC
+)
+) ON [PRIMARY]
+GO
+CREATE OR ALTER VIEW [dbo].[XMag_TracciaProdottiLocale]
+AS
+SELECT     t.Pallet, t.Lotto, t.Prodotto, t.Descrizione
+FROM       dbo.XMag_TracciaProdotti AS t
+UNION ALL
+SELECT     DISTINCT LEFT(l.NUMSER, 6) COLLATE Latin1_General_CI_AS, l.NUMLOT COLLATE Latin1_General_CI_AS,
+           a.CODICE COLLATE Latin1_General_CI_AS, a.DESCR COLLATE Latin1_General_CI_AS
+FROM       SAMA1.dbo.LOTSER AS l
+           INNER JOIN SAMA1.dbo.ARTICO AS a ON a.ID = l.IDARTICO
+WHERE      LEFT(l.NUMLOT, 1) = 'P'
+  AND      l.ID > ISNULL((SELECT st.UltimoID FROM dbo.XMag_GiacenzaSnapshotStato AS st
+                          WHERE st.Nome = 'traccia'), 0)
+  AND      NOT EXISTS (SELECT 1 FROM dbo.XMag_TracciaProdotti AS t
+                       WHERE t.Pallet = LEFT(l.NUMSER, 6) COLLATE Latin1_General_CI_AS
+                         AND t.Lotto = l.NUMLOT COLLATE Latin1_General_CI_AS
+                         AND ISNULL(t.Prodotto, '') = ISNULL(a.CODICE, '') COLLATE Latin1_General_CI_AS
+                         AND ISNULL(t.Descrizione, '') = ISNULL(a.DESCR, '') COLLATE Latin1_General_CI_AS)
+GO
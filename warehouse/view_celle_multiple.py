@@ -8,6 +8,11 @@ from openpyxl import Workbook
 from openpyxl.styles import Font, Alignment
 
 from gestione_aree_frame_async import AsyncRunner
+from runtime import RUNTIME
+from scheduler import REFRESH
+from sql_statements import CORSIA, ID_INT, pick, register_sources
+from stock_snapshot import GIACENZA, GIACENZA_ORIGINALE
+from traccia_prodotti import TRACCIA, TRACCIA_ORIGINALE
 
 def _json_obj(res):
     if isinstance(res, str):
@@ -37,13 +42,17 @@ WITH base AS (
     RTRIM(c.Corsia) AS Corsia,
     c.Colonna,
     c.Fila
-  FROM dbo.XMag_GiacenzaPallet AS g
+  FROM dbo.XMag_GiacenzaPalletSnapshot AS g
   JOIN dbo.Celle AS c ON c.ID = g.IDCella
   WHERE g.IDCella <> 9999 AND RTRIM(c.Corsia) <> '7G'
 )
 """
 
-SQL_CORSIE = BASE_CTE + """
+# finché snapshot e copia della traccia non sono pronti (RUNTIME.local_sources) le query leggono le viste originali
+_ORIGINALI = {GIACENZA: GIACENZA_ORIGINALE, TRACCIA: TRACCIA_ORIGINALE}
+
+
+SQL_CORSIE = register_sources("celle_multiple.corsie", BASE_CTE + """
 , dup_celle AS (
   SELECT IDCCella = b.IDCella
   FROM base b
@@ -54,9 +63,9 @@ SELECT DISTINCT b.Corsia
 FROM base b
 WHERE EXISTS (SELECT 1 FROM dup_celle d WHERE d.IDCCella = b.IDCella)
 ORDER BY b.Corsia;
-"""
+""", _ORIGINALI)
 
-SQL_CELLE_DUP_PER_CORSIA = BASE_CTE + f"""
+SQL_CELLE_DUP_PER_CORSIA = register_sources("celle_multiple.celle_dup", BASE_CTE + f"""
 , dup_celle AS (
   SELECT b.IDCella, COUNT(DISTINCT b.BarcodePallet) AS NumUDC
   FROM base b
@@ -72,9 +81,9 @@ JOIN base b ON b.IDCella = dc.IDCella
 WHERE b.Corsia = RTRIM(:corsia)
 GROUP BY dc.IDCella, {UBI_B}, b.Colonna, b.Fila, b.Corsia, dc.NumUDC
 ORDER BY b.Colonna, b.Fila;
-"""
+""", _ORIGINALI, corsia=CORSIA)
 
-SQL_PALLET_IN_CELLA = BASE_CTE + """
+SQL_PALLET_IN_CELLA = register_sources("celle_multiple.pallet_in_cella", BASE_CTE + """
 SELECT
   b.BarcodePallet AS Pallet,
   ta.Descrizione,
@@ -82,16 +91,16 @@ SELECT
 FROM base b
 OUTER APPLY (
   SELECT TOP (1) t.Descrizione, t.Lotto
-  FROM dbo.vXTracciaProdotti AS t
+  FROM dbo.XMag_TracciaProdottiLocale AS t
   WHERE t.Pallet = b.BarcodePallet COLLATE Latin1_General_CI_AS
   ORDER BY t.Lotto
 ) AS ta
 WHERE b.IDCella = :idcella
 GROUP BY b.BarcodePallet, ta.Descrizione, ta.Lotto
 ORDER BY b.BarcodePallet;
-"""
+""", _ORIGINALI, idcella=ID_INT)
 
-SQL_RIEPILOGO_PERCENTUALI = BASE_CTE + """
+SQL_RIEPILOGO_PERCENTUALI = register_sources("celle_multiple.riepilogo_percentuali", BASE_CTE + """
 , tot AS (
   SELECT b.Corsia, COUNT(DISTINCT b.IDCella) AS TotCelle
   FROM base b GROUP BY b.Corsia
@@ -125,7 +134,60 @@ unione AS (
 SELECT Corsia, TotCelle, CelleMultiple, Percentuale
 FROM unione
 ORDER BY Ord, Corsia;
-"""
+""", _ORIGINALI)
+
+# ---- stesse risposte dall'indice di occupazione in memoria (RUNTIME.occupancy), righe come as_dict_rows ----
+def _base_indice(occ):
+    """Le celle di BASE_CTE con il numero di UDC: in giacenza, <> 9999, corsia <> '7G'."""
+    return [(c, n) for c, n in occ.celle_occupate()
+            if c.ID != 9999 and (c.Corsia or "").rstrip().upper() != "7G"]
+
+
+def _corsia(c) -> str:
+    return (c.Corsia or "").rstrip()
+
+
+def corsie_da_indice(occ) -> dict:
+    """SQL_CORSIE: corsie con almeno una cella doppia."""
+    doppie = occ.celle_doppie()
+    corsie = {_corsia(c).upper(): _corsia(c) for c, _n in _base_indice(occ) if c.ID in doppie}
+    return {"rows": [{"Corsia": corsie[k]} for k in sorted(corsie)]}
+
+
+def celle_dup_da_indice(occ, corsia: str) -> dict:
+    """SQL_CELLE_DUP_PER_CORSIA: celle della corsia con più di una UDC."""
+    key = corsia.rstrip().upper()
+    rows = [{"IDCella": c.ID,
+             "Ubicazione": ".".join((v or "").rstrip() for v in (c.Corsia, c.Colonna, c.Fila)).upper(),
+             "Colonna": c.Colonna, "Fila": c.Fila, "Corsia": _corsia(c), "NumUDC": n}
+            for c, n in _base_indice(occ) if n > 1 and _corsia(c).upper() == key]
+    rows.sort(key=lambda r: ((r["Colonna"] or "").rstrip().upper(), (r["Fila"] or "").rstrip().upper()))
+    return {"rows": rows}
+
+
+def riepilogo_da_indice(occ) -> dict:
+    """SQL_RIEPILOGO_PERCENTUALI: celle occupate e doppie per corsia, più la riga TOTALE."""
+    per_corsia: dict[str, dict] = {}
+    for c, n in _base_indice(occ):
+        k = _corsia(c).upper()
+        r = per_corsia.setdefault(k, {"Corsia": _corsia(c), "TotCelle": 0, "CelleMultiple": 0})
+        r["TotCelle"] += 1
+        r["CelleMultiple"] += n > 1
+    rows = [per_corsia[k] for k in sorted(per_corsia)]
+    tot = {"Corsia": "TOTALE", "TotCelle": sum(r["TotCelle"] for r in rows),
+           "CelleMultiple": sum(r["CelleMultiple"] for r in rows)}
+    for r in rows + [tot]:
+        r["Percentuale"] = round(100.0 * r["CelleMultiple"] / r["TotCelle"], 2) if r["TotCelle"] else 0.0
+    return {"rows": rows + [tot]}
+
+
+LIVE_DEBOUNCE_MS = 500   # eventi del feed ravvicinati → un solo aggiornamento dell'albero
+
+
+def _indice():
+    occ = RUNTIME.occupancy
+    return occ if occ is not None and occ.ready else None
+
 
 class CelleMultipleWindow(tk.Toplevel):
     def __init__(self, root, db_client, runner: AsyncRunner | None = None):
@@ -140,6 +202,15 @@ class CelleMultipleWindow(tk.Toplevel):
         self._bind_events()
         self.refresh_all()
 
+        # feed delle modifiche (runtime): corsie, celle e pallet toccati si aggiornano nell'albero già aperto
+        self._live_job = None
+        self._live_corsie: set = set()
+        self._live_celle: set = set()
+        if RUNTIME.feed is not None:
+            # il runner può essere della finestra principale: la sottoscrizione finisce con questa finestra
+            unsubscribe = self.runner.subscribe(RUNTIME.feed, self._on_delta)
+            self.bind("<Destroy>", lambda e: unsubscribe() if e.widget is self else None, add="+")
+
     def _build_layout(self):
         self.grid_rowconfigure(0, weight=5)
         self.grid_rowconfigure(1, weight=70)
@@ -183,7 +254,10 @@ class CelleMultipleWindow(tk.Toplevel):
 
     def _load_corsie(self):
         self.tree.delete(*self.tree.get_children())
-        async def _q(db): return await db.query_json(SQL_CORSIE, as_dict_rows=True)
+        occ = _indice()
+        if occ is not None:
+            self._fill_corsie(corsie_da_indice(occ)); return
+        async def _q(db): return await db.query_json(pick(SQL_CORSIE, RUNTIME.local_sources), as_dict_rows=True, columnar=True)
         self.runner.run(_q(self.db), self._fill_corsie, lambda e: messagebox.showerror("Errore", str(e), parent=self))
 
     def _fill_corsie(self, res):
@@ -213,28 +287,45 @@ class CelleMultipleWindow(tk.Toplevel):
                     self.tree.delete(child)
                 self._load_pallet_for_cella(sel, idcella)
 
-    def _load_celle_for_corsia(self, parent_iid, corsia):
-        async def _q(db): return await db.query_json(SQL_CELLE_DUP_PER_CORSIA, params={"corsia": corsia}, as_dict_rows=True)
-        self.runner.run(_q(self.db), lambda res: self._fill_celle(parent_iid, res),
+    def _load_celle_for_corsia(self, parent_iid, corsia, touched=None):
+        occ = _indice()
+        if occ is not None:
+            self._fill_celle(parent_iid, celle_dup_da_indice(occ, corsia), touched); return
+        async def _q(db): return await db.query_json(pick(SQL_CELLE_DUP_PER_CORSIA, RUNTIME.local_sources), params={"corsia": corsia}, as_dict_rows=True, columnar=True)
+        self.runner.run(_q(self.db), lambda res: self._fill_celle(parent_iid, res, touched),
                         lambda e: messagebox.showerror("Errore", str(e), parent=self))
 
-    def _fill_celle(self, parent_iid, res):
+    def _fill_celle(self, parent_iid, res, touched=None):
+        """touched (IDCella toccate dal feed): aggiornamento in place, via le celle non più doppie."""
         rows = _json_obj(res).get("rows", [])
+        if touched is not None:
+            keep = {f"cella:{r['IDCella']}" for r in rows}
+            for iid in self.tree.get_children(parent_iid):
+                if iid not in keep: self.tree.delete(iid)
         if not rows:
             self.tree.insert(parent_iid, "end", text="(nessuna cella con >1 UDC)", values=("", "")); return
-        for r in rows:
+        for i, r in enumerate(rows):
             idc = r["IDCella"]; ubi = r["Ubicazione"]; corsia = r.get("Corsia"); num = r.get("NumUDC", 0)
             node_id = f"cella:{idc}"; label = f"{ubi}  [x{num}]"
             if self.tree.exists(node_id):
                 self.tree.item(node_id, text=label, values=(f"IDCella {idc}", ""))
+                if touched is not None:
+                    if idc in touched and self.tree.item(node_id, "open"):
+                        # pallet a video: riletti subito
+                        self.tree.delete(*self.tree.get_children(node_id))
+                        self._load_pallet_for_cella(node_id, idc)
+                        continue
+                    if idc not in touched:
+                        continue
+                    self.tree.delete(*self.tree.get_children(node_id))     # chiusa: si rilegge all'apertura
             else:
-                self.tree.insert(parent_iid, "end", iid=node_id, text=label,
+                self.tree.insert(parent_iid, i if touched is not None else "end", iid=node_id, text=label,
                                  values=(f"IDCella {idc}", ""), open=False, tags=("cella", f"corsia:{corsia}"))
             if not any(ch.endswith("::lazy") for ch in self.tree.get_children(node_id)):
                 self.tree.insert(node_id, "end", iid=f"{node_id}::lazy", text="...", values=("", ""))
 
     def _load_pallet_for_cella(self, parent_iid, idcella: int):
-        async def _q(db): return await db.query_json(SQL_PALLET_IN_CELLA, params={"idcella": idcella}, as_dict_rows=True)
+        async def _q(db): return await db.query_json(pick(SQL_PALLET_IN_CELLA, RUNTIME.local_sources), params={"idcella": idcella}, as_dict_rows=True, columnar=True)
         self.runner.run(_q(self.db), lambda res: self._fill_pallet(parent_iid, res),
                         lambda e: messagebox.showerror("Errore", str(e), parent=self))
 
@@ -259,8 +350,12 @@ class CelleMultipleWindow(tk.Toplevel):
                              tags=("pallet", f"corsia:{corsia_val}", f"ubicazione:{cella_ubi}", f"idcella:{idcella_num}"))
 
     def _load_riepilogo(self):
-        async def _q(db): return await db.query_json(SQL_RIEPILOGO_PERCENTUALI, as_dict_rows=True)
-        self.runner.run(_q(self.db), self._fill_riepilogo, lambda e: messagebox.showerror("Errore", str(e), parent=self))
+        occ = _indice()
+        if occ is not None:
+            self._fill_riepilogo(riepilogo_da_indice(occ)); return
+        async def _q(db): return await db.query_json(pick(SQL_RIEPILOGO_PERCENTUALI, RUNTIME.local_sources), as_dict_rows=True, columnar=True)
+        self.runner.run(_q(self.db), self._fill_riepilogo, lambda e: messagebox.showerror("Errore", str(e), parent=self),
+                        priority=REFRESH)   # percentuali di tutto il magazzino: non davanti all'operatore
 
     def _fill_riepilogo(self, res):
         rows = _json_obj(res).get("rows", [])
@@ -269,6 +364,40 @@ class CelleMultipleWindow(tk.Toplevel):
             self.sum_tbl.insert("", "end", values=(r.get("Corsia"), r.get("TotCelle",0),
                                                    r.get("CelleMultiple",0), f"{r.get('Percentuale',0):.2f}"))
 
+    # ---- feed delle modifiche ----
+    def _on_delta(self, delta):
+        if not (delta.movimenti or delta.svuotate):
+            return      # IDStato / ModDataOra delle celle: qui non si vedono
+        self._live_corsie |= delta.corsie(); self._live_celle |= delta.idcelle()
+        if self._live_job is None:
+            self._live_job = self.after(LIVE_DEBOUNCE_MS, self._apply_live)
+
+    def _apply_live(self):
+        self._live_job = None
+        if not self.winfo_exists(): return
+        corsie, celle = self._live_corsie, self._live_celle
+        self._live_corsie, self._live_celle = set(), set()
+        self._load_riepilogo()
+        occ = _indice()
+        if occ is not None:
+            self._sync_corsie(corsie, celle, corsie_da_indice(occ)); return
+        async def _q(db): return await db.query_json(pick(SQL_CORSIE, RUNTIME.local_sources), as_dict_rows=True, columnar=True)
+        self.runner.run(_q(self.db), lambda res: self._sync_corsie(corsie, celle, res), lambda e: None,
+                        key="live", priority=REFRESH)
+
+    def _sync_corsie(self, corsie, celle, res):
+        """Come _fill_corsie sull'albero aperto: corsie nuove aggiunte, senza più celle doppie tolte, aperte toccate rilette."""
+        want = [r.get("Corsia") for r in _json_obj(res).get("rows", []) if r.get("Corsia")]
+        ids = [f"corsia:{c}" for c in want]
+        for iid in self.tree.get_children(""):
+            if iid not in ids: self.tree.delete(iid)
+        for i, (corsia, node_id) in enumerate(zip(want, ids)):
+            if not self.tree.exists(node_id):
+                self.tree.insert("", i, iid=node_id, text=f"Corsia {corsia}", values=("", ""), open=False, tags=("corsia",))
+                self.tree.insert(node_id, "end", iid=f"{node_id}::lazy", text="...", values=("", ""))
+            elif corsia.strip().upper() in corsie and not self.tree.exists(f"{node_id}::lazy"):
+                self._load_celle_for_corsia(node_id, corsia, celle)
+
     def expand_all(self):
         for iid in self.tree.get_children(""):
             self.tree.item(iid, open=True)
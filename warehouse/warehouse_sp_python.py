@@ -9,7 +9,7 @@ Notes:
 """
 from __future__ import annotations
 from dataclasses import dataclass
-from typing import Optional, Tuple, Any
+from typing import Tuple, Any
 from datetime import datetime
 import pyodbc
 